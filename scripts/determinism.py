@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Check that -deterministic gives the same tree for any number of threads,
+and measure its overhead against the default (nondeterministic) mode.
+
+Each thread count is run with and without -deterministic, keeping the
+fastest of a few repeats. Exits with status 1 if the deterministic trees
+differ, or if the overhead exceeds the given limit.
+"""
+
+import subprocess
+import argparse
+import hashlib
+import time
+import sys
+import os
+
+
+def run(args, alignment, threads):
+    """Return (seconds, tree digest) for one run of the console tool"""
+    command = [
+        sys.executable, '-c', 'from itaxotools.fasttreepy import main; main()',
+        '-quiet', '-nopr', '-threads', str(threads)] + args + [alignment]
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode(errors='replace'))
+    return elapsed, hashlib.sha1(result.stdout).hexdigest()[:12]
+
+
+def measure(alignment, args, thread_counts, repeats):
+    rows = []
+    for threads in thread_counts:
+        row = {'threads': threads}
+        for mode, extra in [('default', []), ('deterministic', ['-deterministic'])]:
+            runs = [run(args + extra, alignment, threads) for _ in range(repeats)]
+            row[mode] = min(elapsed for elapsed, _ in runs)
+            row[mode + '_trees'] = {tree for _, tree in runs}
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        epilog='Arguments after -- are passed on to FastTree.')
+    parser.add_argument('alignment', help='alignment to build trees for')
+    parser.add_argument('--threads', default=None,
+                        help='comma-separated thread counts (default: 1,2,4,..,all)')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max-overhead', type=float, default=None,
+                        help='fail if deterministic mode is slower by more '
+                             'than this fraction at any thread count')
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        extra = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        counts = [int(x) for x in args.threads.split(',')]
+    else:
+        cpus = os.cpu_count() or 1
+        counts = [1]
+        while counts[-1] * 2 < cpus:
+            counts.append(counts[-1] * 2)
+        if cpus > 1:
+            counts.append(cpus)
+
+    rows = measure(args.alignment, extra, counts, args.repeats)
+    print('threads   default  determ.  overhead  trees (default / determ.)')
+    ok = True
+    for row in rows:
+        overhead = row['deterministic'] / row['default'] - 1
+        print(f'{row["threads"]:7d} {row["default"]:8.2f}s {row["deterministic"]:7.2f}s '
+              f'{100 * overhead:+8.1f}%  '
+              f'{",".join(sorted(row["default_trees"]))} / '
+              f'{",".join(sorted(row["deterministic_trees"]))}')
+        if args.max_overhead is not None and overhead > args.max_overhead:
+            ok = False
+    trees = set.union(*(row['deterministic_trees'] for row in rows))
+    if len(trees) != 1:
+        print('FAIL: deterministic trees differ between runs')
+        ok = False
+    else:
+        print('ok: deterministic trees are identical for all thread counts')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Import-time regression check, using python -X importtime.
+
+Each entry-point is imported in a fresh interpreter, which must not load
+any of the modules it is not supposed to need, and must finish within
+the given budget. Exits with status 1 on failure.
+"""
+
+import subprocess
+import argparse
+import sys
+
+
+# statement: modules that must not be imported by it
+CASES = {
+    'from itaxotools.fasttreepy import main': [
+        'PySide6', 'itaxotools.common', 'multiprocessing', 'tempfile',
+        'itaxotools.fasttreepy.core', 'itaxotools.fasttreepy.params'],
+    'from itaxotools.fasttreepy.server import Client': [
+        'PySide6', 'itaxotools.common', 'multiprocessing',
+        'itaxotools.fasttreepy.fasttree', 'itaxotools.fasttreepy.core'],
+    'from itaxotools.fasttreepy import PhylogenyApproximation': [
+        'PySide6', 'multiprocessing', 'itaxotools.fasttreepy.fasttree'],
+}
+
+
+def importtime(statement):
+    """Return {module: cumulative microseconds} for a fresh import"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue  # header
+        times[fields[2].strip()] = cumulative
+    return times
+
+
+def check(statement, forbidden, budget):
+    times = importtime(statement)
+    total = sum(t for m, t in times.items() if '.' not in m) / 1000
+    found = [m for m in times if any(
+        m == f or m.startswith(f + '.') for f in forbidden)]
+    ok = not found and (budget is None or total <= budget)
+    print(f'{"ok  " if ok else "FAIL"} {total:8.1f} ms  {statement}')
+    for module in found:
+        print(f'       imports {module}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--budget', type=float,
+                        help='fail if any case takes longer (ms)')
+    args = parser.parse_args()
+    results = [check(s, f, args.budget) for s, f in CASES.items()]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
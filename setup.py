@@ -3,6 +3,7 @@
 # Always prefer setuptools over distutils
 from setuptools import setup, Command, Extension, find_namespace_packages
 from setuptools.command.build_ext import build_ext as _build_ext
+import tempfile
 import pathlib
 
 
@@ -15,16 +16,44 @@ class build_ext(_build_ext):
         _build_ext.build_extensions(self)
 
 
+# Optional libraries for reading compressed input: (macro, header, library)
+compression_libraries = [
+    ('USE_ZLIB', 'zlib.h', 'z'),
+    ('USE_BZIP2', 'bzlib.h', 'bz2'),
+    ('USE_LZMA', 'lzma.h', 'lzma'),
+    ('USE_ZSTD', 'zstd.h', 'zstd'),
+]
+
+
+def has_library(compiler, header, library):
+    """Check if a C program including header links with library"""
+    with tempfile.TemporaryDirectory() as dir:
+        source = pathlib.Path(dir) / 'check.c'
+        source.write_text(f'#include <{header}>\nint main(void) {{ return 0; }}\n')
+        try:
+            objects = compiler.compile([str(source)], output_dir=dir)
+            compiler.link_executable(
+                objects, 'check', output_dir=dir, libraries=[library])
+        except Exception:
+            return False
+    return True
+
+
 class FastTreeExtension(Extension):
     """Extension subclass that defines build_init"""
     def build_init(self, build):
-        """Called by build_ext to link openmp"""
+        """Called by build_ext to link openmp and compression libraries"""
         if build.compiler.compiler_type == 'msvc':
             self.extra_compile_args += ['/openmp']
         else:
             self.extra_compile_args += [
                 '-fopenmp', '-finline-functions', '-funroll-loops']
             self.libraries += ['m', 'gomp']
+            for macro, header, library in compression_libraries:
+                if has_library(build.compiler, header, library):
+                    self.define_macros += [(macro, '1')]
+                    self.libraries += [library]
+            self.libraries += ['pthread']
 
 
 # * gcc -Wall -O3 -finline-functions -funroll-loops -o FastTree -lm FastTree.c
@@ -74,11 +103,15 @@ setup(
         ],
     extras_require={
         'dev': ['pyinstaller>=4.5.1'],
+        'divide': ['numpy>=1.20'],
     },
     entry_points={
         'console_scripts': [
             'fasttreepy = itaxotools.fasttreepy:main',
             'fasttreepy-gui = itaxotools.fasttreepy.gui:main',
+            'fasttreepy-server = itaxotools.fasttreepy.server:main',
+            'fasttreepy-client = itaxotools.fasttreepy.server:client',
+            'fasttreepy-calibrate = itaxotools.fasttreepy.calibrate:main',
         ],
     },
     cmdclass = {
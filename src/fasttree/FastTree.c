@@ -48,6 +48,8 @@
  *  not available, and modern mallocs should return 16-byte-aligned values)
  * Use -DOPENMP -fopenmp to use multiple threads (note, old versions of gcc
  *   may not support -fopenmp)
+ * Use -DUSE_ZLIB -lz, -DUSE_BZIP2 -lbz2, -DUSE_LZMA -llzma, and/or -DUSE_ZSTD -lzstd
+ *   (with -pthread) to read gzip, bzip2, xz, or zstd compressed input files
  * Use -DTRACK_MEMORY if you want detailed reports of memory usage,
  * but results are not correct above 4GB because mallinfo stores int values.
  * It also makes FastTree run significantly slower.
@@ -293,6 +295,7 @@
 #include <math.h>
 #include <stdlib.h>
 #include <ctype.h>
+#include <stdint.h>
 #ifdef TRACK_MEMORY
 /* malloc.h apparently doesn't exist on MacOS */
 #include <malloc.h>
@@ -328,7 +331,32 @@ int gettimeofday(struct timeval* t, char* timezone) {
 
 #else
 #include <sys/time.h>
+#include <sys/mman.h>
 #include <unistd.h>
+#include <time.h>
+#include <errno.h>
+#include <sys/wait.h>
+#include <sys/resource.h>
+#include <fcntl.h>
+#endif
+
+/* Compressed input, see OpenInput() */
+#if !defined(_WIN32) && (defined(USE_ZLIB) || defined(USE_BZIP2) || defined(USE_LZMA) || defined(USE_ZSTD))
+#define USE_INFLATE
+#include <pthread.h>
+#include <errno.h>
+#endif
+#ifdef USE_ZLIB
+#include <zlib.h>
+#endif
+#ifdef USE_BZIP2
+#include <bzlib.h>
+#endif
+#ifdef USE_LZMA
+#include <lzma.h>
+#endif
+#ifdef USE_ZSTD
+#include <zstd.h>
 #endif
 
 /* Compile with -DUSE_OPENMP to turn on multithreading */
@@ -418,8 +446,8 @@ char *usage =
   "For more information, see http://www.microbesonline.org/fasttree/\n";
 
 char *expertUsage =
-  "FastTree [-nt] [-n 100] [-quote] [-pseudo | -pseudo 1.0]\n"
-  "           [-boot 1000 | -nosupport]\n"
+  "FastTree [-nt] [-n 100 [-nprocs 4]] [-quote] [-pseudo | -pseudo 1.0]\n"
+  "           [-boot 1000 | -nosupport] [-gboot 100 [-gbootprocs 4]]\n"
   "           [-intree starting_trees_file | -intree1 starting_tree_file]\n"
   "           [-quiet | -nopr]\n"
   "           [-nni 10] [-spr 2] [-noml | -mllen | -mlnni 10]\n"
@@ -430,7 +458,9 @@ char *expertUsage =
   "           [ -lg | -wag | -trans transitionmatrixfile ]\n"
   "           [-matrix Matrix | -nomatrix] [-nj | -bionj]\n"
   "           [ -constraints constraintAlignment [ -constraintWeight 100.0 ] ]\n"
-  "           [-log logfile]\n"
+  "           [-log logfile] [-jsonlog jsonlog_file] [-haplotypes haplotypes_file]\n"
+  "           [-sitelk sitelk_file [-sitelktrees trees_file]]\n"
+  "           [-models jtt,wag,lg [-modelprocs 4] [-modelsout models_file]]\n"
   "         [ alignment_file ]\n"
   "        [ -out output_newick_file | > newick_tree]\n"
   "\n"
@@ -447,7 +477,13 @@ char *expertUsage =
   "  -n -- read in multiple alignments in. This only\n"
   "    works with phylip interleaved format. For example, you can\n"
   "    use it with the output from phylip's seqboot. If you use -n, FastTree\n"
-  "    will write 1 tree per line to standard output.\n"
+  "    will write 1 tree per line to standard output. Alignment i (from 0)\n"
+  "    uses the stream seed+i of the random number generator\n"
+  "  -nprocs n -- with -n, build up to n trees at once, each in a process\n"
+  "    of its own with a single thread (not on Windows). The alignments are\n"
+  "    read ahead and the trees, logs, and other outputs are written in input\n"
+  "    order, and are the same as without -nprocs. Cannot be used with\n"
+  "    -intree, -intree1, -constraints, -sitelktrees, or -makematrix\n"
   "  -intree newickfile -- read the starting tree in from newickfile.\n"
   "     Any branch lengths in the starting trees are ignored.\n"
   "    -intree with -n will read a separate starting tree for each alignment.\n"
@@ -458,8 +494,24 @@ char *expertUsage =
   "  -log logfile -- save intermediate trees so you can extract\n"
   "    the trees and restart long-running jobs if they crash\n"
   "    -log also reports the per-site rates (1 means slowest category)\n"
+  "  -jsonlog file -- write the progress as one JSON record per line: the\n"
+  "    intermediate trees, and the log likelihood, number of changes, maximum\n"
+  "    change, time, and operation counts after each round of NNIs, SPRs, or\n"
+  "    ML branch lengths. Records are flushed as they are written\n"
   "  -quote -- quote sequence names in the output and allow spaces, commas,\n"
   "    parentheses, and colons in them but not ' characters (fasta files only)\n"
+  "  The alignment, -intree, and -constraints files may be compressed with\n"
+  "    gzip, bzip2, xz, or zstd (if supported by this build). They are\n"
+  "    decompressed on the fly, in a separate thread\n"
+  "  -haplotypes file -- write the map from sequences to unique sequences\n"
+  "    (name, 0-based haplotype index, and haplotype size, tab-delimited).\n"
+  "    With -n, each line starts with the 0-based index of its alignment\n"
+  "  -sitelk file -- write the log likelihood and the rate category of each\n"
+  "    site of the final tree, in binary (see WriteSiteLogLk in the source).\n"
+  "    With -gamma, also the Gamma20 log likelihood of each site\n"
+  "  -sitelktrees trees_file -- with -sitelk, also optimize the branch lengths\n"
+  "    of each tree in trees_file with the model and rate categories of the\n"
+  "    final tree held fixed, and write its site log likelihoods\n"
   "\n"
   "Distances:\n"
   "  Default: For protein sequences, log-corrected distances and an\n"
@@ -513,6 +565,15 @@ char *expertUsage =
   "            The final tree will have rescaled lengths. Used with -log, this\n"
   "            also generates per-site likelihoods for use with CONSEL, see\n"
   "            GammaLogToPaup.pl and documentation on the FastTree web site.\n"
+  "  -mlbatch -- optimize all branch lengths in parallel batches of nodes of\n"
+  "            the same height (with OpenMP). Results do not depend on the number\n"
+  "            of threads, but differ from the default serial order: each pass\n"
+  "            gains a little less, which changes the course of the NNIs, so\n"
+  "            the final log likelihood may be a few units lower (or higher).\n"
+  "            Use it for speed, not for the best tree\n"
+  "  -tcache 512 -- entries per thread in the cache of transition probabilities\n"
+  "            for recently seen branch lengths (0 turns it off). Cache hits\n"
+  "            return exactly the same values, so trees do not change\n"
   "\n"
   "Support value options:\n"
   "  By default, FastTree computes local support values by resampling the site\n"
@@ -523,6 +584,19 @@ char *expertUsage =
   "  Use -nosupport to turn off support values or -boot 100 to use just 100 resamples\n"
   "  Use -seed to initialize the random number generator\n"
   "\n"
+  "  -gboot 100 -- global bootstrap: build 100 replicate trees and use the\n"
+  "      fraction of them that have each split as its support, instead of\n"
+  "      the local supports. Each replicate resamples the columns in memory\n"
+  "      (no alignment copies are written) and builds its tree from scratch\n"
+  "      with the same options, in a process forked from this one, which\n"
+  "      shares the alignment (not on Windows). Replicate i uses the stream\n"
+  "      seed+1+i of the random number generator, so the supports do not\n"
+  "      depend on the number of processes\n"
+  "  -gbootprocs n -- build the main tree and up to n-1 replicates at once\n"
+  "      (default: the number of ML threads), each with a single thread.\n"
+  "      With 1, the replicates are built one after another before the main\n"
+  "      tree, which keeps its threads\n"
+  "\n"
   "Searching for the best join:\n"
   "  By default, FastTree combines the 'visible set' of fast neighbor-joining with\n"
   "      local hill-climbing as in relaxed neighbor-joining\n"
@@ -567,6 +641,72 @@ char *expertUsage =
   "       means a penalty of 1 in tree length for violating a constraint\n"
   "       Default: 100.0\n"
   "\n"
+  "Model sweep (not on Windows):\n"
+  "  -models spec -- compare maximum-likelihood models on the same topology.\n"
+  "       spec is a comma-separated list of jtt, wag, or lg (protein) or of\n"
+  "       jc or gtr (nucleotide), each optionally followed by :ncat for its\n"
+  "       number of rate categories (default -cat), e.g. -models jtt,lg,lg:4\n"
+  "       The alignment is read and the minimum-evolution topology search is\n"
+  "       done once, then the ML phase of each model runs in a process of its\n"
+  "       own. Models are compared by their Gamma log likelihoods (so -models\n"
+  "       implies -gamma), and the tree of the best model is written\n"
+  "  -modelprocs n -- run up to n ML phases at once (default: the number of\n"
+  "       ML threads). Each is single-threaded and has its own copy of the\n"
+  "       internal profiles\n"
+  "  -modelsout file -- write the model, ncat, log likelihood, and whether it\n"
+  "       was chosen (1 or 0) of each model, tab-delimited. With -n, the\n"
+  "       tables for the alignments are written one after another\n"
+  "\n"
+  "Thread options (with OpenMP):\n"
+  "  -threads spec -- the number of threads for each phase: top-hit lists\n"
+  "       (tophits), the best-hit search of exhaustive neighbor joining (nj),\n"
+  "       and the likelihood computations (ml). spec is a comma-separated list\n"
+  "       of a count or auto for all phases, or phase=count or phase=auto,\n"
+  "       and later items override earlier ones, e.g. -threads 4,ml=8\n"
+  "       auto chooses a count for each alignment from its size\n"
+  "       By default, all phases use OpenMP's default (OMP_NUM_THREADS)\n"
+  "  -threadtable file -- calibration table for -threads auto, with lines\n"
+  "       of phase, nSeq, nPos, and threads; the nearest entry is used.\n"
+  "       Without it, auto uses 1 thread per 100,000 alignment cells\n"
+  "  -deterministic -- give the same tree for any number of threads. The\n"
+  "       seeds of the initial top-hit lists are handled in order, with each\n"
+  "       seed's distances computed in parallel, instead of handling many\n"
+  "       seeds at once, whose lists may then depend on thread timing\n"
+  "\n"
+  "Memory options:\n"
+  "  By default, profiles and top-hit lists are allocated from per-thread slabs\n"
+  "  (size-classed free lists carved from 2 MB chunks), which avoids most\n"
+  "  malloc calls and heap fragmentation. Slab statistics are reported with\n"
+  "  -verbose 2 or in the -log file\n"
+  "  -noslab -- use malloc for every profile and top-hit list instead\n"
+  "  -hugepages -- ask the kernel to back slab chunks and large per-node\n"
+  "       arrays with transparent huge pages (Linux only)\n"
+  "  -sparse -- index the non-gap runs of each leaf profile (and of mostly-gap\n"
+  "       internal profiles), so that distances only visit the positions\n"
+  "       that have data, and store the leaves without their gaps. This is on\n"
+  "       by default if over half of the alignment is gaps; trees are the\n"
+  "       same either way\n"
+  "  -nosparse -- never use sparse profiles\n"
+  "  -ooc dir -- keep the large arrays of the profiles in a memory-mapped file\n"
+  "       in dir, for trees whose profiles do not fit in memory. The ML phases\n"
+  "       keep their recently used profiles resident and page out the rest,\n"
+  "       reading ahead in traversal order. Cache hit rates are reported with\n"
+  "       -verbose 2 or in the -log file. Not supported on Windows, or with\n"
+  "       -models or -gboot\n"
+  "  -oocmem MB -- memory for resident profiles with -ooc (default: half of RAM)\n"
+  "  -patterns -- collapse identical alignment columns into weighted site\n"
+  "       patterns before building the profiles. This saves time and memory\n"
+  "       for alignments of closely-related sequences. Trees, likelihoods,\n"
+  "       and supports are the same up to round-off, and the per-site rates\n"
+  "       and likelihoods in the -log file are still reported per column\n"
+  "\n"
+  "Profiling options:\n"
+  "  -profile file -- time the hot functions (profile and sequence distances,\n"
+  "       out-distances, top-hit refreshes, posterior profiles, ML quartet and\n"
+  "       pair optimizations, and rate exponentials) and save the calls and\n"
+  "       total and self times of each call path and thread as JSON.\n"
+  "       Needs a build with GCC or Clang, and costs a few percent\n"
+  "\n"
   "For more information, see http://www.microbesonline.org/fasttree/\n"
   "   or the comments in the source code\n";
 ;
@@ -598,8 +738,19 @@ typedef struct {
    To speed up comparison of outprofile to a sequence or other simple profile, we also
    (for outprofiles) store codeDist[iPos*nCodes+k] = dist(k,profile[iPos])
 
-   For constraints, we store a vector of nOn and nOff
-   If not using constraints, those will be NULL
+   For gappy alignments (see useSparse), leaf profiles and mostly-gap averaged
+   profiles also store a sparse index: the runs of positions with weight > 0,
+   as [start,end) pairs. Distances involving a profile with an index only visit
+   its runs. Leaves with an index are also packed: weights is NULL (the weight
+   is 1 inside the runs and 0 outside), and codes only holds the nOccupied
+   codes inside the runs, in order. Code that indexes a leaf by position
+   expands it with DenseProfile first, or reads it with a site_reader_t.
+
+   For constraints, we store a vector of nOn and nOff, and bitsets onBits and offBits
+   with bit iC set if nOn[iC] > 0 (or nOff[iC] > 0). Leaves only store the bitsets (their
+   counts are 0 or 1), so nOn and nOff are NULL for leaves; use CONSTRAINT_ON and
+   CONSTRAINT_OFF to read the counts of any profile.
+   If not using constraints, all of those will be NULL
 */
 typedef struct {
   /* alignment profile */
@@ -609,11 +760,33 @@ typedef struct {
   int nVectors;
   numeric_t *codeDist;		/* Optional -- distance to each code at each position */
 
+  /* sparse index */
+  int *runs;			/* NULL, or start and end of each run of non-gap positions */
+  int nRuns;
+  int nOccupied;		/* positions in the runs */
+
   /* constraint profile */
   int *nOn;
   int *nOff;
+  uint64_t *onBits;
+  uint64_t *offBits;
+
+  int oocEntry;			/* -1, or the entry of the profile in the -ooc LRU list */
 } profile_t;
 
+#define BITSET_WORDS(n) (((n)+63)/64)
+#define BITSET_GET(bits,i) ((int)(((bits)[(i)/64] >> ((i)%64)) & 1))
+#define CONSTRAINT_ON(p,iC) ((p)->nOn != NULL ? (p)->nOn[iC] : BITSET_GET((p)->onBits,iC))
+#define CONSTRAINT_OFF(p,iC) ((p)->nOff != NULL ? (p)->nOff[iC] : BITSET_GET((p)->offBits,iC))
+#define PACKED_LEAF(p) ((p)->weights == NULL)
+#if defined(__GNUC__)
+#define POPCOUNT64(x) __builtin_popcountll(x)
+#define LOWBIT64(x) __builtin_ctzll(x)
+#else
+static inline int POPCOUNT64(uint64_t x) { int n = 0; for (; x != 0; x &= x - 1) n++; return(n); }
+static inline int LOWBIT64(uint64_t x) { int n = 0; for (; (x & 1) == 0; x >>= 1) n++; return(n); }
+#endif
+
 /* A visible node is a pair of nodes i, j such that j is the best hit of i,
    using the neighbor-joining criterion, at the time the comparison was made,
    or approximately so since then.
@@ -764,6 +937,10 @@ typedef struct {
   profile_t *outprofile;
   double totdiam;
 
+  /* During FastNJ, the codes of the leaves transposed in blocks of DIST_BLOCK
+     leaves, as in dist_block_t, or NULL (e.g. with sparse profiles) */
+  unsigned char *leafBlocks;
+
   /* We sometimes use stale out-distances, so we remember what nActive was  */
   numeric_t *outDistances;		/* Sum of distances to other active (parent==-1) nodes */
   int *nOutDistActive;		/* What nActive was when this outDistance was computed */
@@ -787,7 +964,8 @@ typedef struct {
   int nUnique;
   int *uniqueFirst;		/* iUnique -> iAln */
   int *alnNext;			/* iAln -> next, or -1  */
-  int *alnToUniq;		/* iAln -> iUnique, or -1 if another was the exemplar */
+  int *alnToUniq;		/* iAln -> iUnique */
+  int *uniqueCount;		/* iUnique -> number of copies in the alignment */
   char **uniqueSeq;		/* indexed by iUniq -- points to strings allocated elsewhere */
 } uniquify_t;
 
@@ -859,6 +1037,7 @@ int nBootstrap = 1000;		/* If set, number of replicates of local bootstrap to do
 /* Options */
 int verbose = 1;
 int showProgress = 1;
+bool showWarnings = true;	/* false in the replicates of -gboot, as the main tree warns */
 int slow = 0;
 int fastest = 0;
 bool useTopHits2nd = false;	/* use the second-level top hits heuristic? */
@@ -959,6 +1138,21 @@ long nPosteriorCompute = 0;	/* # of computations of posterior probabilities */
 long nAAPosteriorExact = 0;	/* # of times compute exact AA posterior */
 long nAAPosteriorRough = 0;	/* # of times use rough approximation */
 long nStarTests = 0;		/* # of times we use star test to avoid testing an NNI */
+int tcacheSize = 512;		/* Entries per thread in the transition-probability cache */
+bool useSlab = true;		/* Allocate profiles and top-hit lists from per-thread slabs */
+bool useHugePages = false;	/* madvise(MADV_HUGEPAGE) for slab chunks and big per-node arrays */
+bool batchedMLLengths = false;	/* Optimize all branch lengths in parallel batches of nodes */
+bool usePatterns = false;	/* Collapse identical alignment columns into weighted site patterns */
+int *patternCount = NULL;	/* With usePatterns, # of alignment columns with each site pattern */
+int *posToPattern = NULL;	/* With usePatterns, the site pattern of each alignment column */
+int nPatternSites = 0;		/* With usePatterns, # of alignment columns before compression */
+char *threadTableFile = NULL;	/* Calibration table for -threads auto */
+bool deterministic = false;	/* -deterministic: same tree for any number of threads */
+int sparseMode = -1;		/* -sparse (1), -nosparse (0), or automatic (-1) */
+bool useSparse = false;		/* Index the non-gap runs of profiles for this alignment */
+char *oocDir = NULL;		/* -ooc: directory for the out-of-core profile store */
+double oocBudget = 0;		/* -oocmem: resident bytes of ML profiles before paging out (0 for half of RAM) */
+FILE *fpJsonLog = NULL;		/* -jsonlog: one JSON record per event, see JsonLogStart() */
 
 /* Protein character set */
 unsigned char *codesStringAA = (unsigned char*) "ARNDCQEGHILKMFPSTWYV";
@@ -970,6 +1164,23 @@ void SetupDistanceMatrix(/*IN/OUT*/distance_matrix_t *); /* set eigentot, codeFr
 void ReadMatrix(char *filename, /*OUT*/numeric_t codes[MAXCODES][MAXCODES], bool check_codes);
 void ReadVector(char *filename, /*OUT*/numeric_t codes[MAXCODES]);
 alignment_t *ReadAlignment(/*READ*/FILE *fp, bool bQuote); /* Returns a list of strings (exits on failure) */
+
+/* Input files may be compressed with gzip, bzip2, xz, or zstd, which is detected
+   from the magic bytes at the start of the file. OpenInput returns a stream of
+   the decompressed text: a background thread decompresses the file and writes
+   to a pipe that the parser reads from, so decompression overlaps parsing and
+   nothing is written to disk. Each format needs its library at compile time
+   (USE_ZLIB, USE_BZIP2, USE_LZMA, USE_ZSTD); other files are opened as usual.
+   Returns NULL if the file cannot be read, and exits if it is compressed in
+   a format that this build does not support.
+   CheckInput exits if decompression failed, which shows up as an early end
+   of file to the parser, so call it after parsing from the stream.
+   RewindInput goes back to the start, reopening compressed files.
+*/
+FILE *OpenInput(/*IN*/char *filename);
+void CheckInput(/*IN*/FILE *fp, /*IN*/char *filename);
+FILE *RewindInput(/*IN/OUT*/FILE *fp, /*IN*/char *filename);
+void CloseInput(/*IN/OUT*/FILE *fp);
 alignment_t *FreeAlignment(alignment_t *); /* returns NULL */
 void FreeAlignmentSeqs(/*IN/OUT*/alignment_t *);
 
@@ -994,6 +1205,22 @@ NJ_t *FreeNJ(NJ_t *NJ); /* returns NULL */
 void FastNJ(/*IN/OUT*/NJ_t *NJ); /* Does the joins */
 void ReliabilityNJ(/*IN/OUT*/NJ_t *NJ, int nBootstrap);	  /* Estimates the reliability of the joins */
 
+/* ReliabilityNJ and TestSplitsMinEvo set up the profiles of a batch of nodes at a
+   time, and then score them in parallel. The up-profiles of a batch stay in memory
+   until it is scored, so MESupportBatch allows ME_SUPPORT_PER_THREAD nodes per
+   thread, no more than fit in ME_SUPPORT_MEMORY bytes (at about two up-profiles
+   per node), and at most ME_SUPPORT_BATCH. DeleteBatchUpProfile deletes an
+   up-profile at once unless a node of the batch still uses it, and otherwise
+   adds it to the list of those to delete after the batch is scored.
+*/
+#define ME_SUPPORT_BATCH 256
+#define ME_SUPPORT_PER_THREAD 4
+#define ME_SUPPORT_MEMORY ((size_t)64 << 20)
+int MESupportBatch(NJ_t *NJ);
+void DeleteBatchUpProfile(/*IN/OUT*/profile_t **upProfiles, NJ_t *NJ, int node,
+			  /*IN*/int *batch, int nBatch,
+			  /*IN/OUT*/int *deferred, /*IN/OUT*/int *nDeferred);
+
 /* nni_stats_t is meaningless for leaves and root, so all of those entries
    will just be high (for age) or 0 (for delta)
 */
@@ -1016,8 +1243,9 @@ int NNI(/*IN/OUT*/NJ_t *NJ, int iRound, int nRounds, bool useML,
 nni_stats_t *InitNNIStats(NJ_t *NJ);
 nni_stats_t *FreeNNIStats(nni_stats_t *, NJ_t *NJ);	/* returns NULL */
 
-/* One round of subtree-prune-regraft moves (minimum evolution) */
-void SPR(/*IN/OUT*/NJ_t *NJ, int maxSPRLength, int iRound, int nRounds);
+/* One round of subtree-prune-regraft moves (minimum evolution).
+   Returns the number of moves */
+int SPR(/*IN/OUT*/NJ_t *NJ, int maxSPRLength, int iRound, int nRounds);
 
 /* Recomputes all branch lengths by minimum evolution criterion*/
 void UpdateBranchLengths(/*IN/OUT*/NJ_t *NJ);
@@ -1085,6 +1313,15 @@ int ActiveAncestor(/*IN*/NJ_t *NJ, int node);
 int JoinConstraintPenalty(/*IN*/NJ_t *NJ, int node1, int node2);
 int JoinConstraintPenaltyPiece(NJ_t *NJ, int node1, int node2, int iConstraint);
 
+/* The constraint bits are used to find the constraints that can contribute to a
+   penalty, 64 at a time, so that the counts are only looked at for those.
+   QuartetConstraintViolations counts the constraints for which
+   SplitViolatesConstraint is true from the bits alone, with popcount.
+*/
+void SetConstraintBits(/*IN/OUT*/profile_t *profile, int nConstraints);
+uint64_t QuartetConstraintMask(profile_t *profiles[4], int iWord, bool bViolations);
+int QuartetConstraintViolations(profile_t *profiles[4], int nConstraints);
+
 /* Helper function for computing the number of constraints violated by
    a split, represented as counts of on and off on each side */
 int SplitConstraintPenalty(int nOn1, int nOff1, int nOn2, int nOff2);
@@ -1121,6 +1358,52 @@ void ProfileDist(profile_t *profile1, profile_t *profile2, int nPos,
 void SeqDist(unsigned char *codes1, unsigned char *codes2, int nPos,
 	     /*OPTIONAL*/distance_matrix_t *distance_matrix,
 	     /*OUT*/besthit_t *hit);
+/* SeqDist for two leaf profiles, using their sparse indexes if either has one */
+void SeqDistLeaves(profile_t *profile1, profile_t *profile2, int nPos,
+		   /*OPTIONAL*/distance_matrix_t *distance_matrix,
+		   /*OUT*/besthit_t *hit);
+
+/* Sparse profiles. With -sparse, or by default if more than SPARSE_AUTO_GAPS of
+   the alignment is gaps, SetSparseIndex gives each leaf profile, and each
+   averaged profile with at most SPARSE_MAX_OCCUPANCY of its positions non-gap,
+   an index of its non-gap runs, and packs the leaves (see profile_t), so their
+   memory is proportional to their occupancy. SparseDistSums is the inner loop
+   of ProfileDist and SeqDist over the intersection of the runs (a profile
+   without an index is one run); it adds up the same terms in the same order as
+   the dense loops, so distances do not change.
+   DenseProfile returns the profile itself, or for a packed leaf, a temporary
+   copy with dense codes and weights, to be freed with FreeDenseProfile; the
+   profile-update code and the other ML code use it for their inputs. LeafCodes
+   writes the codes of any leaf at every position.
+*/
+#define SPARSE_AUTO_GAPS 0.5
+#define SPARSE_MAX_OCCUPANCY 0.5
+double GapFraction(char **seqs, int nSeq, int nPos);
+void SetSparseIndex(/*IN/OUT*/profile_t *profile, int nPos, bool bLeaf);
+void SparseDistSums(profile_t *profile1, profile_t *profile2, int nPos,
+		    /*OPTIONAL*/distance_matrix_t *dmat,
+		    /*OUT*/double *top, /*OUT*/double *denom);
+profile_t *DenseProfile(profile_t *profile, int nPos);
+profile_t *FreeDenseProfile(profile_t *dense, profile_t *profile, int nPos); /* returns NULL */
+void LeafCodes(profile_t *leaf, int nPos, /*OUT*/unsigned char *codes);
+
+/* PosteriorProfile and PairLogLk read their inputs through a site_reader_t
+   instead, which walks the runs of a packed leaf as the position goes up, so
+   they need no dense copies. With two packed leaves, they skip the positions
+   where both are gaps in one step (except PairLogLk for Jukes-Cantor, which
+   counts those positions) */
+typedef struct {
+  profile_t *profile;
+  bool bPacked;
+  int iRun;			/* the first run that ends after the position */
+  int base;			/* the index in codes of the start of run iRun */
+} site_reader_t;
+
+void InitSiteReader(/*OUT*/site_reader_t *reader, /*IN*/profile_t *profile);
+
+/* A new leaf profile with positions iStart to iStart+nPos-1 of leaf, packed if
+   leaf is packed, for computing site likelihoods by blocks of positions */
+profile_t *LeafSlice(/*IN*/profile_t *leaf, int iStart, int nPos, int nConstraints);
 
 /* Computes all pairs of profile distances, applies pseudocounts
    if pseudoWeight > 0, and applies log-correction if logdist is true.
@@ -1238,6 +1521,51 @@ void SetCodeDist(/*IN/OUT*/profile_t *profile, int nPos, distance_matrix_t *dmat
 void SetBestHit(int node, NJ_t *NJ, int nActive,
 		/*OUT*/besthit_t *bestjoin,
 		/*OUT OPTIONAL*/besthit_t *allhits);
+
+/* Batched distances from one node to many others, for the one-vs-many loops of
+   the NJ phase (SetBestHit, TransferBestHits and UniqueBestHits).
+   A dist_block_t holds up to DIST_BLOCK candidates, and DistBlockSums reads
+   the query once per position with the inner loop over the candidates.
+   Leaves and averaged profiles go in separate blocks. A block of leaves only
+   needs their codes, in structure-of-arrays layout: the codes of all of them
+   at position i are contiguous, at [i*DIST_BLOCK + column]. The leaves do not
+   change during FastNJ, so it transposes their codes once into
+   NJ->leafBlocks, and leaves that fall in the same DIST_BLOCK-aligned range
+   use those columns as they are. Averaged profiles are replaced at every
+   join, and comparing them is dominated by the vector products, so they are
+   read in place rather than copied.
+
+   DistBlockSums adds up the same terms in the same order as ProfileDist (or
+   SeqDist, for a leaf against leaves), so distances do not change. Pairs that
+   both have a sparse index still go through SetDistCriterion.
+*/
+#define DIST_BLOCK 16
+typedef struct {
+  int nPos;
+  int nHits;			/* candidates in the block */
+  int col[DIST_BLOCK];		/* column of each candidate */
+  bool bLeaves;
+  /* for leaves, codes[i*DIST_BLOCK+col], into codesBuf or NJ->leafBlocks */
+  unsigned char *codes;
+  unsigned char *codesBuf;	/* allocated when first needed */
+  /* for averaged profiles */
+  profile_t *profiles[DIST_BLOCK];
+} dist_block_t;
+
+dist_block_t *NewDistBlock(int nPos);
+dist_block_t *FreeDistBlock(dist_block_t *block); /* returns NULL */
+unsigned char *TransposeLeafCodes(NJ_t *NJ); /* for NJ->leafBlocks */
+void PackDistBlock(/*IN*/NJ_t *NJ, /*IN*/int *nodes, int nNodes, bool bLeaves,
+		   /*OUT*/dist_block_t *block);
+void DistBlockSums(profile_t *query, bool bQueryLeaf, /*IN*/dist_block_t *block,
+		   /*OPTIONAL*/distance_matrix_t *dmat,
+		   /*OUT*/double *top, /*OUT*/double *denom);
+
+/* Like SetDistCriterion for each hit, using the batched distances. Hits with
+   the same i should be adjacent. block is scratch space, as from NewDistBlock */
+void SetDistCriteria(/*IN/UPDATE*/NJ_t *NJ, int nActive,
+		     /*IN/OUT*/besthit_t **hits, int nHits,
+		     /*BUFFER*/dist_block_t *block);
 void ExhaustiveNJSearch(NJ_t *NJ, int nActive, /*OUT*/besthit_t *bestjoin);
 
 /* Searches the visible set */
@@ -1356,7 +1684,40 @@ nni_t MLQuartetNNI(profile_t *profiles[4],
 		   bool bFast);
 
 void OptimizeAllBranchLengths(/*IN/OUT*/NJ_t *NJ);
+
+/* Optimizes the 2 or 3 branches around an internal node, with two iterations,
+   given the node's up-profile (which is ignored for the root) */
+void OptimizeNodeBranchLengths(/*IN/OUT*/NJ_t *NJ, int node, /*OPTIONAL*/profile_t *upProfile);
+
+/* The parallel variant of OptimizeAllBranchLengths, used with -mlbatch. It
+   visits the internal nodes by height, in batches of up to ML_LENGTH_BATCH
+   nodes of the same height. Nodes of the same height share no branches, so a
+   batch is optimized in parallel, after the up-profiles for all of its nodes
+   are computed. Each thread keeps its own cache of up-profiles (as from
+   GetUpProfile) and drops any that depend on a branch or profile that a
+   later batch changed, so the results do not depend on the number of
+   threads. The results are not identical to OptimizeAllBranchLengths, which
+   updates each up-profile as it goes. On a fixed topology, repeated passes
+   converge to about the same likelihood, but the small differences in the
+   lengths steer the NNIs, so the final tree and its likelihood may be a
+   little worse (or better) than with the serial order.
+*/
+#define ML_LENGTH_BATCH 256
+void OptimizeAllBranchLengthsBatched(/*IN/OUT*/NJ_t *NJ);
 double TreeLogLk(/*IN*/NJ_t *NJ, /*OPTIONAL OUT*/double *site_loglk);
+
+/* Like TreeLogLk, but with the given profiles and rates. If recompute is set,
+   profiles[] need only hold the leaves on entry; the posterior profiles of the
+   internal nodes are computed in postorder as in RecomputeMLProfiles, and each is
+   freed as soon as its parent is done. This does not modify NJ, so calls with
+   different rates can run in parallel, and the result is identical to
+   RecomputeMLProfiles followed by TreeLogLk.
+   nPos is NJ->nPos, or the width of a block of positions, with leaves from
+   LeafSlice and rates->ratecat starting at the block. For a block, only the
+   site log likelihoods are meaningful, as -patterns counts are by position.
+*/
+double TreeLogLkProfiles(/*IN*/NJ_t *NJ, /*IN/OUT*/profile_t **profiles, rates_t *rates, int nPos,
+			 bool recompute, /*OPTIONAL OUT*/double *site_loglk);
 double MLQuartetLogLk(profile_t *pA, profile_t *pB, profile_t *pC, profile_t *pD,
 		      int nPos, /*OPTIONAL*/transition_matrix_t *transmat, rates_t *rates,
 		      /*IN*/double branch_lengths[5],
@@ -1370,8 +1731,14 @@ numeric_t *MLSiteRates(int nRateCategories);
 
 /* returns site_loglk so that
    site_loglk[nPos*iRate + j] is the log likelihood of site j with rate iRate
-   The caller must free it.
+   The caller must free it. The rate categories are computed in parallel, each
+   with its own copy of the internal profiles. With more than a few threads per
+   rate category, the positions are also split into blocks (of at least
+   ML_SITE_BLOCK positions), and each task is one rate category for one block.
+   The sites are independent, so the results do not depend on the number of
+   threads.
 */
+#define ML_SITE_BLOCK 250
 double *MLSiteLikelihoodsByRate(/*IN*/NJ_t *NJ, /*IN*/numeric_t *rates, int nRateCategories);
 
 typedef struct {
@@ -1388,11 +1755,13 @@ double GammaLogLk(/*IN*/siteratelk_t *s, /*OPTIONAL OUT*/double *gamma_loglk_sit
 /* Input site_loglk must be for each rate. Note that FastTree does not reoptimize
    the branch lengths under the Gamma model -- it optimizes the overall scale.
    Reports the gamma log likelihhod (and logs site likelihoods if fpLog is set),
-   and reports the rescaling value.
+   and reports the rescaling value. Saves the Gamma log likelihood of each
+   site (pattern) to gamma_site_loglk if set.
 */
 double RescaleGammaLogLk(int nPos, int nRateCats,
 			/*IN*/numeric_t *rates, /*IN*/double *site_loglk,
-			/*OPTIONAL*/FILE *fpLog);
+			/*OPTIONAL*/FILE *fpLog,
+			/*OPTIONAL OUT*/double *gamma_site_loglk);
 
 /* P(value<=x) for the gamma distribution with shape parameter alpha and scale 1/alpha */
 double PGamma(double x, double alpha);
@@ -1515,15 +1884,101 @@ double *PDiffVector(double *pSame, rates_t *rates);
 /* expeigen[iRate*nCodes + j] = exp(length * rate iRate * eigenvalue j) */
 numeric_t *ExpEigenRates(double length, transition_matrix_t *transmat, rates_t *rates);
 
+/* Per-thread cache of the exponentials computed by PSameVector and ExpEigenRates,
+   keyed by the exact branch length and valid for one rate set (and, for
+   ExpEigenRates, one set of eigenvalues); a different rate set or transition
+   matrix flushes the cache. Each thread's cache is 4-way set associative
+   with least-recently-used eviction, so hits return bit-identical values.
+   If tcacheSize is 0, nothing is cached.
+*/
+void TransCacheInit(void);
+void TransCacheFree(void);
+void TransCacheReport(/*WRITE*/FILE *fp);
+
 /* Print a progress report if more than 0.1 second has gone by since the progress report */
 /* Format should include 0-4 %d references and no newlines */
 void ProgressReport(char *format, int iArg1, int iArg2, int iArg3, int iArg4);
 void LogTree(char *format, int round, /*OPTIONAL WRITE*/FILE *fp, NJ_t *NJ, char **names, uniquify_t *unique, bool bQuote);
 void LogMLRates(/*OPTIONAL WRITE*/FILE *fpLog, NJ_t *NJ);
 
+/* Structured run log (-jsonlog file): one JSON object per line, flushed as it
+   is written, so that it may be followed while FastTree runs. Every record
+   has the event, the 0-based alignment, and the seconds since the alignment
+   was read. The events are:
+   start -- with the number of sequences, unique sequences and positions
+   tree -- each intermediate tree that LogTree writes, with phase and round
+   round -- after each round of NNIs, SPRs or ML branch lengths, with the
+     log likelihood, number of changes, and maximum change when known, and
+     the counters of operations so far (over all alignments). The rounds of
+     each phase are numbered from 1, as are the trees of that phase
+   rates -- the rates of the ML rate categories
+   done -- with the counters, once the tree is complete
+   These do nothing if fpJsonLog is NULL.
+*/
+void JsonLogStart(/*IN*/struct timeval *clock_start, int iAln, int nSeq, int nUnique, int nPos);
+void JsonLogTree(char *format, int round, NJ_t *NJ, char **names, uniquify_t *unique, bool bQuote);
+/* loglk and maxChange may be NAN and nChanges -1, if not known */
+void JsonLogRound(char *phase, int round, double loglk, int nChanges, double maxChange);
+void JsonLogRates(NJ_t *NJ);
+void JsonLogDone(void);
+
 void *mymalloc(size_t sz);       /* Prints "Out of memory" and exits on failure */
 void *myfree(void *, size_t sz); /* Always returns NULL */
 
+/* Size-classed slab allocation for the small arrays that make up profiles
+   and top-hit lists. Each thread carves blocks out of its own large chunks,
+   and freed blocks are kept on per-size-class free lists for reuse, so the
+   many short-lived profiles do not each cost several calls to malloc.
+   Requests above SLAB_MAX_SIZE go to mymalloc (page-aligned and marked for
+   huge pages if useHugePages is set). Blocks must be freed with SlabFree and
+   the same size; all chunks are released at once by SlabReleaseAll().
+   If useSlab is false, these just call mymalloc and myfree.
+*/
+void SlabInit(void);
+void *SlabAlloc(size_t sz);
+void *SlabFree(void *p, size_t sz); /* Always returns NULL */
+void SlabReleaseAll(void);
+void SlabReport(/*WRITE*/FILE *fp);
+
+/* Out-of-core profile storage (-ooc dir). Arrays of at least OOC_MIN_SIZE
+   bytes, which are the per-position arrays of the profiles, are carved out of
+   a memory-mapped file in dir instead of the heap, so the kernel can write
+   them back to the file instead of swapping. SlabAlloc and SlabFree route
+   them here by size. The profiles that the ML phases visit (as found by
+   TraversePostorder) are kept on an LRU list; when their resident size
+   exceeds oocBudget, the least-recently used ones are paged out, and the next
+   few profiles in postorder are read ahead. The NJ phase pages out the two
+   joined profiles once the store outgrows the budget, as they are not used
+   again until the NNIs. OocReport gives the hit rates of the working set.
+   Not supported on Windows, or with -models or -gboot, which fork.
+*/
+void OocInit(void);
+void OocExpect(int nSeq, int nPos); /* sizes the first segment of the file */
+void *OocAlloc(size_t sz);
+void *OocFree(void *p, size_t sz); /* Always returns NULL */
+void OocTouch(profile_t *profile, int nPos); /* counts a hit or a miss */
+void OocEvict(profile_t *profile, int nPos);
+void OocReadahead(profile_t *profile, int nPos);
+void OocForget(profile_t *profile); /* before it is freed */
+void OocRelease(void);
+void OocReport(/*WRITE*/FILE *fp);
+
+/* Site-pattern compression (-patterns). CompressPatterns collapses identical
+   columns of the unique sequences into one column per site pattern, in order
+   of first occurrence, and rewrites the sequences in place. It sets
+   patternCount, posToPattern, and nPatternSites, and returns the number of
+   patterns, which is then used as nPos everywhere. Sums over positions weight
+   each pattern by PATTERN_COUNT(), SITES() is the number of alignment columns
+   behind nPos patterns, and SITE_PATTERN() maps a column back to its pattern
+   (for resampling and for per-site output). Without -patterns, patternCount is
+   NULL and all three are trivial.
+*/
+#define PATTERN_COUNT(I) (patternCount != NULL ? patternCount[I] : 1)
+#define SITES(NPOS) (patternCount != NULL ? nPatternSites : (NPOS))
+#define SITE_PATTERN(I) (posToPattern != NULL ? posToPattern[I] : (I))
+int CompressPatterns(/*IN/OUT*/char **seqs, int nSeq, int nPos);
+void FreePatterns(void);
+
 /* One-dimensional minimization using brent's function, with
    a fractional and an absolute tolerance */
 double onedimenmin(double xmin, double xguess, double xmax, double (*f)(double,void*), void *data,
@@ -1558,6 +2013,154 @@ int timeval_subtract (/*OUT*/struct timeval *result, /*IN*/struct timeval *x, /*
 
 char *OpenMPString(void);
 
+/* Per-phase thread counts (-threads). Each parallel loop belongs to a phase:
+   top-hit lists (PHASE_TOPHITS), the best-hit search of exhaustive neighbor
+   joining and the minimum-evolution supports (PHASE_NJ), or the likelihood
+   computations (PHASE_ML), and asks for
+   PHASE_THREADS() threads. A phase may have a fixed count, the OpenMP default,
+   or -1 for auto, which SetPhaseThreads resolves for each alignment from the
+   number of unique sequences and positions. Auto uses the nearest entry
+   (in log scale) of the calibration table if one was given with -threadtable,
+   and otherwise one thread per AUTO_THREAD_WORK cells of the alignment.
+   The table is whitespace-delimited with the columns
+   phase (tophits, nj, or ml), nSeq, nPos, and threads; # starts a comment.
+   The counts are only given to the parallel regions, and the OpenMP default is
+   left alone: per-thread arrays have maxThreads entries, enough for any phase,
+   and the few loops outside the phases use otherThreads, which is the largest
+   phase count if every phase is fixed, and otherwise the OpenMP default.
+*/
+#define PHASE_TOPHITS 0
+#define PHASE_NJ 1
+#define PHASE_ML 2
+#define N_PHASES 3
+#define AUTO_THREAD_WORK 100000
+#define PHASE_THREADS(P) (phaseThreads[P] > 0 ? phaseThreads[P] : omp_get_max_threads())
+void ParseThreadsOption(/*IN*/char *spec); /* exits on errors */
+void ApplyThreadOptions(void);		   /* after the options are parsed */
+void SetPhaseThreads(int nSeq, int nPos);
+int AutoThreads(int phase, int nSeq, int nPos);
+void ReadThreadTable(/*IN*/char *file);
+char *PhaseThreadsString(void);
+int phaseThreadsOption[N_PHASES] = {0,0,0}; /* -threads: >0 fixed, 0 OpenMP default, -1 auto */
+int phaseThreads[N_PHASES] = {0,0,0}; /* Threads per phase for the current alignment, or 0 */
+int maxThreads = 1;		/* The most threads of any parallel region */
+int otherThreads = 1;		/* Threads for the parallel regions outside the phases */
+
+/* Hot-path profiler (-profile). PROF_SCOPE(PROF_X) at the start of a block
+   times that block until it is left, by any path, using the cleanup attribute
+   of GCC and Clang; with other compilers, or with -DNO_PROFILER, it compiles
+   to nothing. Without -profile, a scope costs one test of a global flag.
+   Each thread keeps its own stack of open scopes and its own table of calls,
+   total time, and self time (total minus nested scopes) for each call path,
+   so the hot path takes no locks. A call path is a stack of scope ids,
+   4 bits per level with the innermost scope in the low bits; scopes nested
+   deeper than PROF_MAX_DEPTH are not timed on their own.
+*/
+#define PROF_PROFILEDIST 0
+#define PROF_SEQDIST 1
+#define PROF_POSTERIORPROFILE 2
+#define PROF_MLQUARTETLOGLK 3
+#define PROF_MLPAIROPTIMIZE 4
+#define PROF_SETOUTDISTANCE 5
+#define PROF_TOPHITSREFRESH 6
+#define PROF_EXPEIGENRATES 7
+#define PROF_DISTBLOCK 8
+#define N_PROF_SCOPES 9
+#define PROF_MAX_DEPTH 16
+#define PROF_PATHS 256		/* call paths per thread, a power of 2 */
+
+typedef struct {
+  uint64_t path;		/* 0 if unused */
+  long calls;
+  int64_t total;		/* nanoseconds */
+  int64_t self;
+} prof_entry_t;
+
+typedef struct prof_thread_s {
+  int id;			/* in order of first use */
+  int depth;
+  uint64_t path;
+  int64_t start[PROF_MAX_DEPTH];
+  int64_t nested[PROF_MAX_DEPTH]; /* time in scopes nested in each open scope */
+  prof_entry_t entries[PROF_PATHS];
+  struct prof_thread_s *next;
+} prof_thread_t;
+
+typedef struct {
+  prof_thread_t *thread;	/* NULL if this scope is not timed */
+} prof_scope_t;
+
+bool profiling = false;
+char *profNames[N_PROF_SCOPES] = {
+  "ProfileDist", "SeqDist", "PosteriorProfile", "MLQuartetLogLk",
+  "MLPairOptimize", "SetOutDistance", "TopHitsRefresh", "ExpEigenRates",
+  "DistBlock"
+};
+prof_thread_t *profThreads = NULL; /* all threads that have timed a scope */
+
+prof_thread_t *ProfThread(void);	/* this thread's state, created on first use */
+void ProfReset(void);			/* zero the totals of all threads */
+void WriteProfile(/*WRITE*/FILE *fp);	/* JSON, see the comment at its definition */
+
+static inline int64_t ProfNow(void) {
+#ifdef _WIN32
+  static LARGE_INTEGER frequency;
+  LARGE_INTEGER counter;
+  if (frequency.QuadPart == 0)
+    QueryPerformanceFrequency(&frequency);
+  QueryPerformanceCounter(&counter);
+  return (int64_t)(counter.QuadPart * (1e9 / frequency.QuadPart));
+#else
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (int64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+#endif
+}
+
+static inline prof_scope_t ProfBegin(int id) {
+  prof_scope_t scope = { NULL };
+  if (profiling) {
+    prof_thread_t *t = ProfThread();
+    if (t->depth < PROF_MAX_DEPTH) {
+      t->path = (t->path << 4) | (uint64_t)(id + 1);
+      t->nested[t->depth] = 0;
+      t->start[t->depth++] = ProfNow();
+      scope.thread = t;
+    }
+  }
+  return scope;
+}
+
+static inline void ProfEnd(prof_scope_t *scope) {
+  prof_thread_t *t = scope->thread;
+  if (t == NULL)
+    return;
+  t->depth--;
+  int64_t elapsed = ProfNow() - t->start[t->depth];
+  unsigned int slot = (unsigned int)((t->path * 0x9E3779B97F4A7C15ULL) >> 56) & (PROF_PATHS-1);
+  int probe;
+  for (probe = 0; probe < PROF_PATHS; probe++) {
+    prof_entry_t *e = &t->entries[(slot + probe) & (PROF_PATHS-1)];
+    if (e->path == 0)
+      e->path = t->path;
+    if (e->path == t->path) {
+      e->calls++;
+      e->total += elapsed;
+      e->self += elapsed - t->nested[t->depth];
+      break;
+    }
+  }
+  if (t->depth > 0)
+    t->nested[t->depth-1] += elapsed;
+  t->path >>= 4;
+}
+
+#if (defined(__GNUC__) || defined(__clang__)) && !defined(NO_PROFILER)
+#define PROF_SCOPE(ID) prof_scope_t profScope __attribute__((cleanup(ProfEnd))) = ProfBegin(ID)
+#else
+#define PROF_SCOPE(ID)
+#endif
+
 void ran_start(long seed);
 double knuth_rand();		/* Random number between 0 and 1 */
 void tred2 (double *a, const int n, const int np, double *d, double *e);
@@ -1599,8 +2202,189 @@ void PrintNJ(/*WRITE*/FILE *, NJ_t *NJ, char **names, uniquify_t *unique, bool b
 /* Print topology using node indices as node names */
 void PrintNJInternal(/*WRITE*/FILE *, NJ_t *NJ, bool useLen);
 
+/* UniquifyAln hashes the sequences (in parallel) with SeqDigest, groups them by
+   digest, and keeps the tail of each group's alnNext chain, so it takes linear time
+   even if a sequence has many copies. Groups are confirmed with strcmp, and if two
+   different sequences share a digest, it falls back to comparing the sequences
+   during the lookup.
+*/
 uniquify_t *UniquifyAln(/*IN*/alignment_t *aln);
 uniquify_t *FreeUniquify(uniquify_t *);	/* returns NULL */
+uint64_t SeqDigest(/*IN*/char *seq);
+
+/* Writes name, haplotype (0-based unique index), and haplotype size for each
+   sequence, in alignment order, tab-delimited (-haplotypes). If iAln >= 0
+   (with -n), each line starts with that 0-based alignment index */
+void PrintHaplotypes(/*WRITE*/FILE *fp, int iAln, /*IN*/alignment_t *aln, /*IN*/uniquify_t *unique);
+
+/* Writes one record of per-site results to fp (-sitelk): a text header line
+   "SiteLk <label> <nSites> <nRateCats> <hasGamma> <loglk>" (tab-delimited),
+   then the rates of the categories (double), the 0-based rate category of
+   each site (int32), the log likelihood of each site (double) and, if
+   gamma_site_loglk is set, the Gamma log likelihood of each site (double),
+   in native byte order. Sites are alignment columns, even with patterns.
+   site_loglk and gamma_site_loglk are indexed by pattern, as from TreeLogLk.
+*/
+void WriteSiteLogLk(/*WRITE*/FILE *fp, char *label, /*IN*/NJ_t *NJ,
+		    /*IN*/double *site_loglk, double loglk,
+		    /*OPTIONAL IN*/double *gamma_site_loglk);
+
+/* Reads each tree of fpTrees, optimizes its branch lengths with the model and
+   the rate categories of NJ held fixed, and writes its site log likelihoods
+   as records "tree1", "tree2", ... (-sitelktrees). Replaces the topology of NJ.
+*/
+void ScoreTopologies(/*IN/OUT*/NJ_t *NJ,
+		     /*IN*/uniquify_t *unique,
+		     /*IN*/hashstrings_t *hashnames,
+		     /*READ*/FILE *fpTrees,
+		     /*WRITE*/FILE *fpSiteLk);
+
+/* Model sweep (-models): after the minimum-evolution phase, the ML phase is
+   run once for each candidate model, by the process itself for the first
+   model and by a forked child process for each of the others. At most nProcs
+   of them run at once, each with a single thread, as OpenMP's threads cannot
+   be used again after fork(); a pipe holds a token for each free slot.
+   Models are compared by their Gamma log likelihoods, or by their log
+   likelihoods without rate variation if ncat is 1.
+*/
+typedef struct {
+  char *name;			/* jtt, wag, lg, jc, or gtr */
+  int nRateCats;
+  double loglk;
+  bool ok;			/* false if its process failed */
+  FILE *fpResult;		/* log likelihood and tree from a child process */
+  int pid;
+} sweep_model_t;
+
+typedef struct {
+  int nModels;
+  sweep_model_t *models;
+  char *names;			/* storage for the model names */
+  int iModel;			/* the model of this process, 0 in the parent */
+  int tokens[2];		/* pipe of free process slots */
+} sweep_t;
+
+sweep_t *ParseModels(/*IN*/char *spec); /* exits on errors */
+sweep_t *FreeSweep(sweep_t *sweep);	 /* returns NULL */
+
+/* Sets bUseGtr, bUseLg, bUseWag, and nRateCats for model, and returns its
+   transition matrix, or NULL for Jukes-Cantor or for GTR with rates yet to
+   be optimized (bFixedGtr is false) */
+transition_matrix_t *SetModel(/*IN*/sweep_model_t *model, bool bFixedGtr,
+			      /*IN*/double *gtrrates, /*IN*/double *gtrfreq);
+
+/* The number of processes to run at once for -models or -gboot: nProcs, or
+   the number of ML threads if nProcs is 0 */
+int ProcessBudget(int nProcs);
+
+/* Waits until one of the child processes pids[0..nPids-1] exits (entries < 0
+   are skipped) and returns its index, with its status, or -1 if waitpid()
+   failed. Other children of this process, such as those of a Python program
+   that embeds FastTree, are left alone */
+int WaitForChild(int nPids, /*IN*/int *pids, /*OUT*/int *status);
+
+/* Forks a process for each model but the first; returns in each of them with
+   sweep->iModel set, once there is a free slot. nProcs may be 0 for the
+   number of ML threads */
+void StartSweep(/*IN/OUT*/sweep_t *sweep, int nProcs);
+
+/* In a child, writes its log likelihood and tree, frees its slot, and exits */
+void EndSweepChild(/*IN*/sweep_t *sweep, /*IN*/NJ_t *NJ, /*IN*/char **names, /*IN*/uniquify_t *unique);
+
+/* In the parent, frees its slot, waits for the children, reports the log
+   likelihood of each model, and returns the tree of the best model as a
+   newick string if it came from a child, or NULL if it is the parent's own */
+char *FinishSweep(/*IN/OUT*/sweep_t *sweep, /*OPTIONAL WRITE*/FILE *fpLog,
+		  /*OPTIONAL WRITE*/FILE *fpModels);
+
+/* Global bootstrap (-gboot). A replicate reweights the site patterns of the
+   shared unique sequences (PATTERN_COUNT) by how often each column is drawn,
+   so the alignment is never copied. Before the first profiles are built,
+   nWorkers worker processes are forked; worker k handles replicates k,
+   k+nWorkers, ... in turn, forking a process for each, which builds its tree
+   with the same options as the main tree and writes a hash of each of its
+   splits. With a budget of one process, there are no workers: the parent
+   forks the replicates one at a time itself and waits for each, before it
+   builds the main tree with its own threads. After the main tree is done, the
+   parent sets the support of each of its splits to the fraction of replicates
+   that have it.
+*/
+typedef struct {
+  int nReplicates;
+  int nWorkers;			/* 1 if inline */
+  bool bInline;			/* the parent runs the replicates, with no workers */
+  int *pids;			/* of the workers */
+  FILE **fpSplits;		/* records of the replicates of each worker */
+  int iReplicate;		/* the replicate of this process, or -1 in the parent */
+} gboot_t;
+
+/* Forks the workers, or runs the replicates if inline; returns in the parent
+   and in each replicate process, with its column weights set */
+gboot_t *StartGlobalBootstrap(int nReplicates, int nProcs, int nPos, long seed);
+
+/* Forks replicates iWorker, iWorker+nWorkers, ... one at a time and waits for
+   each. Returns true in a replicate process, with its column weights set, or
+   false once all of them are done */
+bool ForkReplicates(/*IN/OUT*/gboot_t *gboot, int iWorker, int nPos, long seed);
+
+/* Sets patternCount to the number of times each pattern is drawn by a
+   resample of the columns (as in ResampleColumns) */
+void SetReplicateWeights(int nPos);
+
+/* For each node of NJ, a 64-bit hash of the split above it: the sum of random
+   keys of the leaves on one side, or of the other side if that is smaller */
+uint64_t *SplitHashes(/*IN*/NJ_t *NJ);
+
+/* In a replicate process, writes the hashes of its splits and exits */
+void EndReplicate(/*IN*/gboot_t *gboot, /*IN*/NJ_t *NJ);
+
+/* In the parent, waits for the replicates and sets the supports of NJ */
+void GlobalBootstrapSupport(/*IN*/gboot_t *gboot, /*IN/OUT*/NJ_t *NJ);
+gboot_t *FreeGlobalBootstrap(gboot_t *gboot); /* returns NULL */
+
+/* Concurrent alignments (-nprocs, with -n). The parent reads the alignments
+   and forks a process for each, once fewer than nProcs are running, which
+   builds its tree with a single thread and writes its part of each output
+   (the tree, log, run log, haplotypes, site likelihoods, and models table)
+   to temporary files. The parent copies these parts to the outputs in input
+   order as the processes finish, keeping at most nWindow alignments in
+   flight, so that a slow alignment does not leave too many parts open.
+   As alignment i uses the stream seed+i of the random number generator (set
+   by the loop over the alignments, before the fork), the trees do not
+   depend on the number of processes.
+*/
+#define ALN_STREAMS 6
+typedef struct {
+  int pid;			/* or -1 once it finished */
+  bool ok;			/* false if its process failed */
+  FILE *fpParts[ALN_STREAMS];	/* its part of each output, or NULL */
+} aln_job_t;
+
+typedef struct {
+  int nProcs;
+  int nWindow;
+  aln_job_t *jobs;		/* alignment iAln is jobs[iAln % nWindow] */
+  int nStarted;
+  int nWritten;			/* alignments whose parts were copied */
+  int nRunning;
+  FILE *fpIn;			/* the alignments, read by the parent */
+  FILE **streams[ALN_STREAMS];	/* the outputs; the parts replace them in a child */
+  int iAln;			/* the alignment of this process, or -1 in the parent */
+} aln_jobs_t;
+
+aln_jobs_t *StartAlnJobs(int nProcs, /*IN*/FILE *fpIn, /*IN*/FILE **streams[ALN_STREAMS]);
+
+/* Waits for a free slot and forks a process for alignment iAln. Returns true
+   in that process, with the outputs redirected to its parts, and false in
+   the parent */
+bool StartAlnJob(/*IN/OUT*/aln_jobs_t *jobs, int iAln);
+
+/* In a child, flushes its parts and exits */
+void EndAlnJob(/*IN*/aln_jobs_t *jobs);
+
+/* In the parent, waits for the children and copies the rest of the parts;
+   returns NULL */
+aln_jobs_t *FinishAlnJobs(/*IN/OUT*/aln_jobs_t *jobs);
 
 /* Convert a constraint alignment to a list of sequences. The returned array is indexed
    by iUnique and points to values in the input alignment
@@ -1645,6 +2429,10 @@ traversal_t FreeTraversal(traversal_t, NJ_t*); /*returns NULL*/
 int TraversePostorder(int lastnode, NJ_t *NJ, /*IN/OUT*/traversal_t,
 		      /*OUT OPTIONAL*/bool *pUp);
 
+/* With -ooc, marks the profiles of node and its children as used, and reads
+   ahead the profiles of the next OOC_READAHEAD nodes in postorder */
+void OocTraverse(NJ_t *NJ, traversal_t traversal, int node);
+
 /* Routines to support storing up-profiles during tree traversal
    Eventually these should be smart enough to do weighted joins and
    to minimize memory usage
@@ -1708,11 +2496,23 @@ int FastTree(int argc, char **argv) {
   int maxSPRLength = 10;	/* maximum distance to move a node */
   bool MLlen = false;		/* optimize branch lengths; no topology changes */
   char *logfile = NULL;
+  char *jsonLogFile = NULL;
   bool bUseGtrRates = false;
   double gtrrates[6] = {1,1,1,1,1,1};
   bool bUseGtrFreq = false;
   double gtrfreq[4] = {0.25,0.25,0.25,0.25};
   FILE *fpOut = stdout;
+  FILE *fpHaplotypes = NULL;
+  FILE *fpSiteLk = NULL;
+  char *siteLkTreesFile = NULL;
+  char *profileFile = NULL;
+  char *modelsSpec = NULL;
+  int modelProcs = 0;
+  FILE *fpModels = NULL;
+  int nGlobalBoot = 0;
+  int gbootProcs = 0;
+  int nAlnProcs = 0;		/* build trees for several alignments at once */
+  long seed = 314159;		/* as ran_arr_next() without ran_start() */
 #ifndef ismodule
   if (isatty(STDIN_FILENO) && argc == 1) {
     fprintf(stderr,"Usage for FastTree version %s %s%s:\n%s",
@@ -1770,6 +2570,13 @@ int FastTree(int argc, char **argv) {
 	fprintf(stderr, "-n argument for #input alignments must be > 0 not %s\n", argv[iArg]);
 	exit(1);
       }
+    } else if (strcmp(argv[iArg], "-nprocs") == 0 && iArg < argc-1) {
+      iArg++;
+      nAlnProcs = atoi(argv[iArg]);
+      if (nAlnProcs < 1) {
+	fprintf(stderr, "Illegal argument to -nprocs (must be 1 or more): %s\n", argv[iArg]);
+	exit(1);
+      }
     } else if (strcmp(argv[iArg], "-quote") == 0) {
       bQuote = true;
     } else if (strcmp(argv[iArg], "-nt") == 0) {
@@ -1792,7 +2599,7 @@ int FastTree(int argc, char **argv) {
       nBootstrap = 0;
     } else if (strcmp(argv[iArg], "-seed") == 0 && iArg < argc-1) {
       iArg++;
-      long seed = atol(argv[iArg]);
+      seed = atol(argv[iArg]);
       ran_start(seed);
     } else if (strcmp(argv[iArg],"-top") == 0) {
       if(tophitsMult < 0.01)
@@ -1935,8 +2742,99 @@ int FastTree(int argc, char **argv) {
     } else if (strcmp(argv[iArg],"-log") == 0 && iArg < argc-1) {
       iArg++;
       logfile = argv[iArg];
+    } else if (strcmp(argv[iArg],"-jsonlog") == 0 && iArg < argc-1) {
+      iArg++;
+      jsonLogFile = argv[iArg];
     } else if (strcmp(argv[iArg],"-gamma") == 0) {
       gammaLogLk = true;
+    } else if (strcmp(argv[iArg],"-mlbatch") == 0) {
+      batchedMLLengths = true;
+    } else if (strcmp(argv[iArg],"-tcache") == 0 && iArg < argc-1) {
+      iArg++;
+      tcacheSize = atoi(argv[iArg]);
+      if (tcacheSize < 0) {
+	fprintf(stderr, "Illegal argument to -tcache (must be 0 or more): %s\n", argv[iArg]);
+	exit(1);
+      }
+    } else if (strcmp(argv[iArg],"-noslab") == 0) {
+      useSlab = false;
+    } else if (strcmp(argv[iArg],"-hugepages") == 0) {
+      useHugePages = true;
+    } else if (strcmp(argv[iArg],"-patterns") == 0) {
+      usePatterns = true;
+    } else if (strcmp(argv[iArg],"-sparse") == 0) {
+      sparseMode = 1;
+    } else if (strcmp(argv[iArg],"-nosparse") == 0) {
+      sparseMode = 0;
+    } else if (strcmp(argv[iArg],"-ooc") == 0 && iArg < argc-1) {
+      iArg++;
+      oocDir = argv[iArg];
+    } else if (strcmp(argv[iArg],"-oocmem") == 0 && iArg < argc-1) {
+      iArg++;
+      oocBudget = atof(argv[iArg]) * 1.0e6;
+      if (oocBudget <= 0) {
+	fprintf(stderr, "Illegal argument to -oocmem (must be more than 0): %s\n", argv[iArg]);
+	exit(1);
+      }
+    } else if (strcmp(argv[iArg],"-threads") == 0 && iArg < argc-1) {
+      iArg++;
+      ParseThreadsOption(argv[iArg]);
+    } else if (strcmp(argv[iArg],"-threadtable") == 0 && iArg < argc-1) {
+      iArg++;
+      threadTableFile = argv[iArg];
+    } else if (strcmp(argv[iArg],"-deterministic") == 0) {
+      deterministic = true;
+    } else if (strcmp(argv[iArg],"-haplotypes") == 0 && iArg < argc-1) {
+      iArg++;
+      fpHaplotypes = fopen(argv[iArg],"w");
+      if(fpHaplotypes==NULL) {
+	fprintf(stderr,"Cannot write to %s\n",argv[iArg]);
+	exit(1);
+      }
+    } else if (strcmp(argv[iArg],"-profile") == 0 && iArg < argc-1) {
+      iArg++;
+      profileFile = argv[iArg];
+    } else if (strcmp(argv[iArg],"-sitelk") == 0 && iArg < argc-1) {
+      iArg++;
+      fpSiteLk = fopen(argv[iArg],"wb");
+      if(fpSiteLk==NULL) {
+	fprintf(stderr,"Cannot write to %s\n",argv[iArg]);
+	exit(1);
+      }
+    } else if (strcmp(argv[iArg],"-sitelktrees") == 0 && iArg < argc-1) {
+      iArg++;
+      siteLkTreesFile = argv[iArg];
+    } else if (strcmp(argv[iArg],"-gboot") == 0 && iArg < argc-1) {
+      iArg++;
+      nGlobalBoot = atoi(argv[iArg]);
+      if (nGlobalBoot < 1) {
+	fprintf(stderr, "Illegal argument to -gboot (must be 1 or more): %s\n", argv[iArg]);
+	exit(1);
+      }
+    } else if (strcmp(argv[iArg],"-gbootprocs") == 0 && iArg < argc-1) {
+      iArg++;
+      gbootProcs = atoi(argv[iArg]);
+      if (gbootProcs < 1) {
+	fprintf(stderr, "Illegal argument to -gbootprocs (must be 1 or more): %s\n", argv[iArg]);
+	exit(1);
+      }
+    } else if (strcmp(argv[iArg],"-models") == 0 && iArg < argc-1) {
+      iArg++;
+      modelsSpec = argv[iArg];
+    } else if (strcmp(argv[iArg],"-modelprocs") == 0 && iArg < argc-1) {
+      iArg++;
+      modelProcs = atoi(argv[iArg]);
+      if (modelProcs < 1) {
+	fprintf(stderr, "Illegal argument to -modelprocs (must be 1 or more): %s\n", argv[iArg]);
+	exit(1);
+      }
+    } else if (strcmp(argv[iArg],"-modelsout") == 0 && iArg < argc-1) {
+      iArg++;
+      fpModels = fopen(argv[iArg],"w");
+      if(fpModels==NULL) {
+	fprintf(stderr,"Cannot write to %s\n",argv[iArg]);
+	exit(1);
+      }
     } else if (strcmp(argv[iArg],"-out") == 0 && iArg < argc-1) {
       iArg++;
       fpOut = fopen(argv[iArg],"w");
@@ -1954,6 +2852,7 @@ int FastTree(int argc, char **argv) {
     fprintf(stderr, "%s", usage);
     exit(1);
   }
+  ApplyThreadOptions();
 
   codesString = nCodes == 20 ? codesStringAA : codesStringNT;
   if (nCodes == 4 && matrixPrefix == NULL)
@@ -1962,6 +2861,56 @@ int FastTree(int argc, char **argv) {
     fprintf(stderr, "The -trans option is only supported for amino acid alignments\n");
     exit(1);
   }
+  sweep_t *sweep = NULL;
+  if (modelsSpec != NULL) {
+#ifdef _WIN32
+    fprintf(stderr, "The -models option is not supported on Windows\n");
+    exit(1);
+#endif
+    if (MLnni == 0 && !MLlen) {
+      fprintf(stderr, "The -models option cannot be used with -noml\n");
+      exit(1);
+    }
+    if (transitionFile != NULL || fpSiteLk != NULL) {
+      fprintf(stderr, "The -models option cannot be used with -trans or -sitelk\n");
+      exit(1);
+    }
+    sweep = ParseModels(modelsSpec);
+    gammaLogLk = true;
+  }
+  if (nGlobalBoot > 0) {
+#ifdef _WIN32
+    fprintf(stderr, "The -gboot option is not supported on Windows\n");
+    exit(1);
+#endif
+    if (sweep != NULL) {
+      fprintf(stderr, "The -gboot and -models options cannot be used together\n");
+      exit(1);
+    }
+    nBootstrap = 0;		/* the local supports would be replaced */
+  }
+  if (oocDir != NULL) {
+#ifdef _WIN32
+    fprintf(stderr, "The -ooc option is not supported on Windows\n");
+    exit(1);
+#endif
+    /* the forked processes would share the mapped store */
+    if (sweep != NULL || nGlobalBoot > 0) {
+      fprintf(stderr, "The -ooc option cannot be used with -models or -gboot\n");
+      exit(1);
+    }
+  }
+  if (nAlnProcs > 0) {
+#ifdef _WIN32
+    fprintf(stderr, "The -nprocs option is not supported on Windows\n");
+    exit(1);
+#endif
+    /* the forked processes cannot read these inputs in turn */
+    if (intreeFile != NULL || constraintsFile != NULL || siteLkTreesFile != NULL || make_matrix) {
+      fprintf(stderr, "The -nprocs option cannot be used with -intree, -intree1, -constraints, -sitelktrees, or -makematrix\n");
+      exit(1);
+    }
+  }
 #ifndef USE_DOUBLE
   if (transitionFile)
     fprintf(stderr,
@@ -1993,6 +2942,13 @@ int FastTree(int argc, char **argv) {
     fprintf(fpLog,"\n");
     fflush(fpLog);
   }
+  if (jsonLogFile != NULL) {
+    fpJsonLog = fopen(jsonLogFile, "w");
+    if (fpJsonLog == NULL) {
+      fprintf(stderr, "Cannot write to: %s\n", jsonLogFile);
+      exit(1);
+    }
+  }
 
     int i;
   FILE *fps[2] = {NULL,NULL};
@@ -2009,7 +2965,9 @@ int FastTree(int argc, char **argv) {
     if(tophitsMult>0) sprintf(tophitString,"%.2f*sqrtN close=%s refresh=%.2f",
 			      tophitsMult, tophitsCloseStr, tophitsRefresh);
     char supportString[100] = "none";
-    if (nBootstrap>0) {
+    if (nGlobalBoot > 0) {
+      sprintf(supportString, "Global boot %d", nGlobalBoot);
+    } else if (nBootstrap>0) {
       if (MLnni != 0 || MLlen)
 	sprintf(supportString, "SH-like %d", nBootstrap);
       else
@@ -2056,7 +3014,9 @@ int FastTree(int argc, char **argv) {
       else
 	fprintf(fp, "Start at tree from %s %s %s\n", intreeFile, nniString, sprString);
 
-      if (MLnni != 0 || MLlen) {
+      if (sweep != NULL) {
+	fprintf(fp, "ML Models: %s, compared by Gamma log likelihoods\n", modelsSpec);
+      } else if (MLnni != 0 || MLlen) {
 	fprintf(fp, "ML Model: %s,",
 		(nCodes == 4) ?
                 (bUseGtr ? "Generalized Time-Reversible" : "Jukes-Cantor") :
@@ -2095,15 +3055,27 @@ int FastTree(int argc, char **argv) {
     distance_matrix = NULL;
   }
 
+  /* Fixed models are the same for every alignment, so their eigendecompositions
+     are done once; each NJ gets a copy, as it may replace its model */
+  transition_matrix_t *fixedTransmat = NULL;
+  if (!make_matrix && nCodes == 20) {
+    fixedTransmat = transitionFile? ReadAATransitionMatrix(transitionFile) :
+      (bUseLg? CreateTransitionMatrix(matrixLG08,statLG08) :
+       (bUseWag? CreateTransitionMatrix(matrixWAG01,statWAG01) :
+	CreateTransitionMatrix(matrixJTT92,statJTT92)));
+  } else if (!make_matrix && nCodes == 4 && bUseGtr && (bUseGtrRates || bUseGtrFreq)) {
+    fixedTransmat = CreateGTR(gtrrates,gtrfreq);
+  }
+
   int iAln;
-  FILE *fpIn = fileName != NULL ? fopen(fileName, "r") : stdin;
+  FILE *fpIn = fileName != NULL ? OpenInput(fileName) : stdin;
   if (fpIn == NULL) {
     fprintf(stderr, "Cannot read %s\n", fileName);
     exit(1);
   }
   FILE *fpConstraints = NULL;
   if (constraintsFile != NULL) {
-    fpConstraints = fopen(constraintsFile, "r");
+    fpConstraints = OpenInput(constraintsFile);
     if (fpConstraints == NULL) {
       fprintf(stderr, "Cannot read %s\n", constraintsFile);
       exit(1);
@@ -2112,19 +3084,64 @@ int FastTree(int argc, char **argv) {
 
   FILE *fpInTree = NULL;
   if (intreeFile != NULL) {
-    fpInTree = fopen(intreeFile,"r");
+    fpInTree = OpenInput(intreeFile);
     if (fpInTree == NULL) {
       fprintf(stderr, "Cannot read %s\n", intreeFile);
       exit(1);
     }
   }
 
+  FILE *fpProfile = NULL;
+  if (profileFile != NULL) {
+    fpProfile = fopen(profileFile, "w");
+    if (fpProfile == NULL) {
+      fprintf(stderr, "Cannot write to %s\n", profileFile);
+      exit(1);
+    }
+    ProfReset();
+    profiling = true;
+  }
+
+  FILE *fpSiteLkTrees = NULL;
+  if (siteLkTreesFile != NULL) {
+    if (fpSiteLk == NULL) {
+      fprintf(stderr, "-sitelktrees requires -sitelk\n");
+      exit(1);
+    }
+    fpSiteLkTrees = OpenInput(siteLkTreesFile);
+    if (fpSiteLkTrees == NULL) {
+      fprintf(stderr, "Cannot read %s\n", siteLkTreesFile);
+      exit(1);
+    }
+  }
+
+  aln_jobs_t *jobs = NULL;
+  if (nAlnProcs > 0 && nAlign > 1) {
+    FILE **streams[ALN_STREAMS] = { &fpOut, &fpLog, &fpJsonLog, &fpHaplotypes, &fpSiteLk, &fpModels };
+    jobs = StartAlnJobs(nAlnProcs, fpIn, streams);
+  }
+
   for(iAln = 0; iAln < nAlign; iAln++) {
+    /* Each alignment has its own stream, so that -nprocs does not change the results */
+    if (nAlign > 1)
+      ran_start((seed + iAln) % 1073741821L);
     alignment_t *aln = ReadAlignment(fpIn, bQuote);
+    if (fileName != NULL)
+      CheckInput(fpIn, fileName);
     if (aln->nSeq < 1) {
       fprintf(stderr, "No alignment sequences\n");
       exit(1);
     }
+    if (jobs != NULL) {
+      if (!StartAlnJob(/*IN/OUT*/jobs, iAln)) {
+	/* the parent goes on reading while the forked process builds the tree */
+	aln = FreeAlignment(aln);
+	continue;
+      }
+      nFPs = 0;			/* the outputs were redirected and verbose is 0 */
+      if (fpLog != NULL)
+	fps[nFPs++] = fpLog;
+    }
     if (fpLog) {
       fprintf(fpLog, "Read %d sequences, %d positions\n", aln->nSeq, aln->nPos);
       fflush(fpLog);
@@ -2147,6 +3164,19 @@ int FastTree(int argc, char **argv) {
 
     /* Make a list of unique sequences -- note some lists are bigger than required */
     ProgressReport("Hashed the names",0,0,0,0);
+    SlabInit();
+    OocInit();
+    TransCacheInit();
+    if (sparseMode >= 0) {
+      useSparse = sparseMode == 1;
+    } else {
+      double gapFraction = GapFraction(aln->seqs, aln->nSeq, aln->nPos);
+      useSparse = gapFraction > SPARSE_AUTO_GAPS;
+      if (useSparse)
+	for (i = 0; i < nFPs; i++)
+	  if (verbose > 0 || fps[i] == fpLog)
+	    fprintf(fps[i], "Alignment is %.1f%% gaps: using sparse profiles\n", 100.0 * gapFraction);
+    }
     if (make_matrix) {
       NJ_t *NJ = InitNJ(aln->seqs, aln->nSeq, aln->nPos,
 			/*constraintSeqs*/NULL, /*nConstraints*/0,
@@ -2157,7 +3187,7 @@ int FastTree(int argc, char **argv) {
 	printf("%s",aln->names[i]);
 	for (j = 0; j < NJ->nSeq; j++) {
 	  besthit_t hit;
-	  SeqDist(NJ->profiles[i]->codes,NJ->profiles[j]->codes,NJ->nPos,NJ->distance_matrix,/*OUT*/&hit);
+	  SeqDistLeaves(NJ->profiles[i],NJ->profiles[j],NJ->nPos,NJ->distance_matrix,/*OUT*/&hit);
 	  if (logdist)
 	    hit.dist = LogCorrect(hit.dist);
 	  /* Make sure -0 prints as 0 */
@@ -2191,12 +3221,32 @@ int FastTree(int argc, char **argv) {
 
       uniquify_t *unique = UniquifyAln(aln);
       ProgressReport("Identified unique sequences",0,0,0,0);
+      if (fpHaplotypes != NULL)
+	PrintHaplotypes(fpHaplotypes, nAlign > 1 ? iAln : -1, aln, unique);
+
+      int nPatterns = aln->nPos;
+      if (usePatterns) {
+	nPatterns = CompressPatterns(/*IN/OUT*/unique->uniqueSeq, unique->nUnique, aln->nPos);
+	ProgressReport("Compressed site patterns",0,0,0,0);
+	for (i = 0; i < nFPs; i++)
+	  if (verbose > 0 || fps[i] == fpLog)
+	    fprintf(fps[i], "Compressed %d positions to %d site patterns\n", aln->nPos, nPatterns);
+      }
+      SetPhaseThreads(unique->nUnique, nPatterns);
+      OocExpect(unique->nUnique, nPatterns);
+#ifdef USE_OPENMP
+      if (phaseThreads[PHASE_TOPHITS] > 0 || phaseThreads[PHASE_NJ] > 0 || phaseThreads[PHASE_ML] > 0)
+	for (i = 0; i < nFPs; i++)
+	  if (verbose > 0 || fps[i] == fpLog)
+	    fprintf(fps[i], "Threads: %s\n", PhaseThreadsString());
+#endif
 
       /* read constraints */
       alignment_t *constraints = NULL;
       char **uniqConstraints = NULL;
       if (constraintsFile != NULL) {
 	constraints = ReadAlignment(fpConstraints, bQuote);
+	CheckInput(fpConstraints, constraintsFile);
 	if (constraints->nSeq < 4) {
 	  fprintf(stderr, "Warning: constraints file with less than 4 sequences ignored:\nalignment #%d in %s\n",
 		  iAln+1, constraintsFile);
@@ -2207,16 +3257,26 @@ int FastTree(int argc, char **argv) {
 	}
       }	/* end load constraints */
 
+      gboot_t *gboot = NULL;
+      if (nGlobalBoot > 0) {
+	gboot = StartGlobalBootstrap(nGlobalBoot, gbootProcs, nPatterns, seed);
+	if (gboot->iReplicate >= 0) {
+	  /* A replicate builds its tree from scratch, quietly */
+	  fpLog = NULL;
+	  fpJsonLog = NULL;
+	  nFPs = 0;
+	  fpInTree = NULL;
+	  fpSiteLk = NULL;
+	  fpSiteLkTrees = NULL;
+	}
+      }
+
       transition_matrix_t *transmat = NULL;
-      if (nCodes == 20) {
-        transmat = transitionFile? ReadAATransitionMatrix(transitionFile) :
-          (bUseLg? CreateTransitionMatrix(matrixLG08,statLG08) :
-           (bUseWag? CreateTransitionMatrix(matrixWAG01,statWAG01) :
-            CreateTransitionMatrix(matrixJTT92,statJTT92)));
-      } else if (nCodes == 4 && bUseGtr && (bUseGtrRates || bUseGtrFreq)) {
-	transmat = CreateGTR(gtrrates,gtrfreq);
-      }
-      NJ_t *NJ = InitNJ(unique->uniqueSeq, unique->nUnique, aln->nPos,
+      if (fixedTransmat != NULL) {
+	transmat = (transition_matrix_t*)mymalloc(sizeof(transition_matrix_t));
+	memcpy(transmat, fixedTransmat, sizeof(transition_matrix_t));
+      }
+      NJ_t *NJ = InitNJ(unique->uniqueSeq, unique->nUnique, nPatterns,
 			uniqConstraints,
 			uniqConstraints != NULL ? constraints->nPos : 0, /* nConstraints */
 			distance_matrix,
@@ -2225,10 +3285,12 @@ int FastTree(int argc, char **argv) {
 			     fileName ? fileName : "standard input",
 			     aln->nSeq, unique->nUnique, aln->nPos, aln->names[aln->nSeq-1], aln->seqs[aln->nSeq-1]);
       FreeAlignmentSeqs(/*IN/OUT*/aln); /*no longer needed*/
+      JsonLogStart(&clock_start, iAln, aln->nSeq, unique->nUnique, aln->nPos);
       if (fpInTree != NULL) {
 	if (intree1)
-	  fseek(fpInTree, 0L, SEEK_SET);
+	  fpInTree = RewindInput(fpInTree, intreeFile);
 	ReadTree(/*IN/OUT*/NJ, /*IN*/unique, /*IN*/hashnames, /*READ*/fpInTree);
+	CheckInput(fpInTree, intreeFile);
 	if (verbose > 2)
 	  fprintf(stderr, "Read tree from %s\n", intreeFile);
 	if (verbose > 2)
@@ -2259,13 +3321,16 @@ int FastTree(int argc, char **argv) {
 
       if (nniToDo>0) {
 	int i;
+	int nRoundsDone = 0;	/* rounds are skipped once converged, so count them */
 	bool bConverged = false;
 	nni_stats_t *nni_stats = InitNNIStats(NJ);
 	for (i=0; i < nniToDo; i++) {
 	  double maxDelta;
 	  if (!bConverged) {
 	    int nChange = NNI(/*IN/OUT*/NJ, i, nniToDo, /*use ml*/false, /*IN/OUT*/nni_stats, /*OUT*/&maxDelta);
-	    LogTree("ME_NNI%d",i+1, fpLog, NJ, aln->names, unique, bQuote);
+	    nRoundsDone++;
+	    LogTree("ME_NNI%d",nRoundsDone, fpLog, NJ, aln->names, unique, bQuote);
+	    JsonLogRound("ME_NNI", nRoundsDone, /*loglk*/NAN, nChange, maxDelta);
 	    if (nChange == 0) {
 	      bConverged = true;
 	      if (verbose>1)
@@ -2277,8 +3342,9 @@ int FastTree(int argc, char **argv) {
 
 	  /* Interleave SPRs with NNIs (typically 1/3rd NNI, SPR, 1/3rd NNI, SPR, 1/3rd NNI */
 	  if (sprRemaining > 0 && (nniToDo/(spr+1) > 0 && ((i+1) % (nniToDo/(spr+1))) == 0)) {
-	    SPR(/*IN/OUT*/NJ, maxSPRLength, spr-sprRemaining, spr);
+	    int nChange = SPR(/*IN/OUT*/NJ, maxSPRLength, spr-sprRemaining, spr);
 	    LogTree("ME_SPR%d",spr-sprRemaining+1, fpLog, NJ, aln->names, unique, bQuote);
+	    JsonLogRound("ME_SPR", spr-sprRemaining+1, /*loglk*/NAN, nChange, /*maxChange*/NAN);
 	    sprRemaining--;
 	    /* Restart the NNIs -- set all ages to 0, etc. */
 	    bConverged = false;
@@ -2289,8 +3355,9 @@ int FastTree(int argc, char **argv) {
 	nni_stats = FreeNNIStats(nni_stats, NJ);
       }
       while(sprRemaining > 0) {	/* do any remaining SPR rounds */
-	SPR(/*IN/OUT*/NJ, maxSPRLength, spr-sprRemaining, spr);
+	int nChange = SPR(/*IN/OUT*/NJ, maxSPRLength, spr-sprRemaining, spr);
 	LogTree("ME_SPR%d",spr-sprRemaining+1, fpLog, NJ, aln->names, unique, bQuote);
+	JsonLogRound("ME_SPR", spr-sprRemaining+1, /*loglk*/NAN, nChange, /*maxChange*/NAN);
 	sprRemaining--;
       }
 
@@ -2329,13 +3396,14 @@ int FastTree(int argc, char **argv) {
 #endif
 
       SplitCount_t splitcount = {0,0,0,0,0.0,0.0};
+      char *bestModelTree = NULL; /* with -models, if a child had the best model */
 
       if (MLnniToDo > 0 || MLlen) {
 	bool warn_len = total_len/NJ->maxnode < 0.001 && MLMinBranchLengthTolerance > 1.0/aln->nPos;
-	bool warn = warn_len || (total_len/NJ->maxnode < 0.001 && aln->nPos >= 10000);
+	bool warn = showWarnings && (warn_len || (total_len/NJ->maxnode < 0.001 && aln->nPos >= 10000));
 	if (warn)
 	  fprintf(stderr, "\nWARNING! This alignment consists of closely-related and very-long sequences.\n");
-	if (warn_len)
+	if (warn && warn_len)
 	  fprintf(stderr,
 		  "This version of FastTree may not report reasonable branch lengths!\n"
 #ifdef USE_DOUBLE
@@ -2350,6 +3418,17 @@ int FastTree(int argc, char **argv) {
 		  "may not be appropriate for aligments of very closely-related sequences\n"
 		  "like this one, as FastTree does not account for recombination or gene conversion\n\n");
 
+	if (sweep != NULL) {
+	  StartSweep(/*IN/OUT*/sweep, modelProcs);
+	  if (sweep->iModel > 0) {
+	    fpLog = NULL;	/* the logs are the parent's */
+	    fpJsonLog = NULL;
+	  }
+	  NJ->transmat = myfree(NJ->transmat, sizeof(transition_matrix_t));
+	  NJ->transmat = SetModel(&sweep->models[sweep->iModel], bUseGtrRates || bUseGtrFreq,
+				  gtrrates, gtrfreq);
+	}
+
 	/* Do maximum-likelihood computations */
 	/* Convert profiles to use the transition matrix */
 	distance_matrix_t *tmatAsDist = TransMatToDistanceMat(/*OPTIONAL*/NJ->transmat);
@@ -2390,11 +3469,13 @@ int FastTree(int argc, char **argv) {
 	    if (fpLog)
 	      fprintf(fpLog, "TreeLogLk\tLength%d\t%.4lf\tMaxChange\t%.4lf\n",
 		      iRound, loglk, dMaxChange);
+	    JsonLogRound("ML_Lengths", iRound, loglk, /*nChanges*/-1, dMaxChange);
 	    if (iRound == 1) {
 	      if (resetGtr)
 		SetMLGtr(/*IN/OUT*/NJ, bUseGtrFreq ? gtrfreq : NULL, fpLog);
 	      SetMLRates(/*IN/OUT*/NJ, nRateCats);
 	      LogMLRates(fpLog, NJ);
+	      JsonLogRates(NJ);
 	    }
 	    if (bConverged)
 	      break;
@@ -2405,6 +3486,7 @@ int FastTree(int argc, char **argv) {
 	  /* This may help us converge faster, and is fast */
 	  OptimizeAllBranchLengths(/*IN/OUT*/NJ);
 	  LogTree("ML_Lengths%d",1, fpLog, NJ, aln->names, unique, bQuote);
+	  JsonLogRound("ML_Lengths", 1, /*loglk*/NAN, /*nChanges*/-1, /*maxChange*/NAN);
 	}
 
 	int iMLnni;
@@ -2423,6 +3505,7 @@ int FastTree(int argc, char **argv) {
 		    bConverged ? " (final)" : "");
 	  if (fpLog)
 	    fprintf(fpLog, "TreeLogLk\tML_NNI%d\t%.4lf\tMaxChange\t%.4lf\n", iMLnni+1, loglk, maxDelta);
+	  JsonLogRound("ML_NNI", iMLnni+1, loglk, changes, maxDelta);
 	  if (bConverged)
 	    break;		/* we did our extra round */
 	  if (bConvergedHere)
@@ -2444,6 +3527,7 @@ int FastTree(int argc, char **argv) {
 	      SetMLGtr(/*IN/OUT*/NJ, bUseGtrFreq ? gtrfreq : NULL, fpLog);
 	    SetMLRates(/*IN/OUT*/NJ, nRateCats);
 	    LogMLRates(fpLog, NJ);
+	    JsonLogRates(NJ);
 	  }
 	}
 	nni_stats = FreeNNIStats(nni_stats, NJ);
@@ -2452,7 +3536,7 @@ int FastTree(int argc, char **argv) {
 	if (MLnniToDo > 0) {
 	  OptimizeAllBranchLengths(/*IN/OUT*/NJ);
 	  LogTree("ML_Lengths%d",2, fpLog, NJ, aln->names, unique, bQuote);
-	  if (verbose || fpLog) {
+	  if (verbose || fpLog || fpJsonLog) {
 	    double loglk = TreeLogLk(NJ, /*site_likelihoods*/NULL);
 	    if (verbose)
 	      fprintf(stderr, "Optimize all lengths: LogLk %s= %.3f Time %.2f\n",
@@ -2463,6 +3547,7 @@ int FastTree(int argc, char **argv) {
 	      fprintf(fpLog, "TreeLogLk\tML_Lengths%d\t%.4f\n", 2, loglk);
 	      fflush(fpLog);
 	    }
+	    JsonLogRound("ML_Lengths", 2, loglk, /*nChanges*/-1, /*maxChange*/NAN);
 	  }
 	}
 
@@ -2470,17 +3555,51 @@ int FastTree(int argc, char **argv) {
 	if ((MLnniToDo > 0 && !fastest) || nBootstrap > 0)
 	  TestSplitsML(NJ, /*OUT*/&splitcount, nBootstrap);
 
+	/* Site likelihoods for -sitelk, before the Gamma rescaling of the lengths */
+	double *site_loglk = NULL;
+	double *gamma_site_loglk = NULL;
+	double siteLogLkTotal = 0;
+	if (fpSiteLk != NULL) {
+	  site_loglk = (double*)mymalloc(sizeof(double) * NJ->nPos);
+	  siteLogLkTotal = TreeLogLk(NJ, /*OUT*/site_loglk);
+	}
+	if ((fpSiteLk != NULL || sweep != NULL) && gammaLogLk && nRateCats > 1)
+	  gamma_site_loglk = (double*)mymalloc(sizeof(double) * NJ->nPos);
+
 	/* Compute gamma-based likelihood? */
 	if (gammaLogLk && nRateCats > 1) {
 	  numeric_t *rates = MLSiteRates(nRateCats);
 	  double *site_loglk = MLSiteLikelihoodsByRate(NJ, rates, nRateCats);
-	  double scale = RescaleGammaLogLk(NJ->nPos, nRateCats, rates, /*IN*/site_loglk, /*OPTIONAL*/fpLog);
+	  double scale = RescaleGammaLogLk(NJ->nPos, nRateCats, rates, /*IN*/site_loglk, /*OPTIONAL*/fpLog,
+					   /*OPTIONAL OUT*/gamma_site_loglk);
 	  rates = myfree(rates, sizeof(numeric_t) * nRateCats);
 	  site_loglk = myfree(site_loglk, sizeof(double) * nRateCats * NJ->nPos);
 
 	  for (i = 0; i < NJ->maxnodes; i++)
 	    NJ->branchlength[i] *= scale;
 	}
+
+	if (fpSiteLk != NULL) {
+	  WriteSiteLogLk(fpSiteLk, "best", NJ, site_loglk, siteLogLkTotal, gamma_site_loglk);
+	  site_loglk = myfree(site_loglk, sizeof(double) * NJ->nPos);
+	}
+	if (sweep != NULL) {
+	  sweep_model_t *model = &sweep->models[sweep->iModel];
+	  if (gamma_site_loglk != NULL) {
+	    model->loglk = 0;
+	    for (i = 0; i < NJ->nPos; i++)
+	      model->loglk += PATTERN_COUNT(i) * gamma_site_loglk[i];
+	  } else {
+	    model->loglk = TreeLogLk(NJ, /*site_likelihoods*/NULL);
+	  }
+	}
+	gamma_site_loglk = myfree(gamma_site_loglk, sizeof(double) * NJ->nPos);
+
+	if (sweep != NULL) {
+	  if (sweep->iModel > 0)
+	    EndSweepChild(sweep, NJ, aln->names, unique); /* does not return */
+	  bestModelTree = FinishSweep(/*IN/OUT*/sweep, fpLog, fpModels);
+	}
       } else {
 	/* Minimum evolution supports */
 	TestSplitsMinEvo(NJ, /*OUT*/&splitcount);
@@ -2488,6 +3607,12 @@ int FastTree(int argc, char **argv) {
 	  ReliabilityNJ(NJ, nBootstrap);
       }
 
+      if (gboot != NULL) {
+	if (gboot->iReplicate >= 0)
+	  EndReplicate(gboot, NJ); /* does not return */
+	GlobalBootstrapSupport(gboot, /*IN/OUT*/NJ);
+      }
+
       for (i = 0; i < nFPs; i++) {
 	FILE *fp = fps[i];
 	fprintf(fp, "Total time: %.2f seconds Unique: %d/%d Bad splits: %d/%d",
@@ -2527,7 +3652,10 @@ int FastTree(int argc, char **argv) {
 	    if (mlAccuracy < 2)
 	      fprintf(fp, " star-only %ld", nStarTests);
 	    fprintf(fp, "\n");
+	    TransCacheReport(fp);
 	  }
+	  SlabReport(fp);
+	  OocReport(fp);
 	}
 #ifdef TRACK_MEMORY
 	fprintf(fp, "Memory: %.2f MB (%.1f byte/pos) ",
@@ -2541,24 +3669,67 @@ int FastTree(int argc, char **argv) {
 #endif
 	fflush(fp);
       }
-      PrintNJ(fpOut, NJ, aln->names, unique, /*support*/nBootstrap > 0, bQuote);
+      if (bestModelTree != NULL) {
+	fputs(bestModelTree, fpOut);
+	bestModelTree = myfree(bestModelTree, strlen(bestModelTree)+1);
+      } else {
+	PrintNJ(fpOut, NJ, aln->names, unique, /*support*/nBootstrap > 0 || gboot != NULL, bQuote);
+      }
       fflush(fpOut);
+      gboot = FreeGlobalBootstrap(gboot);
+      if (fpSiteLkTrees != NULL && (MLnniToDo > 0 || MLlen)) {
+	if (iAln > 0)
+	  fpSiteLkTrees = RewindInput(fpSiteLkTrees, siteLkTreesFile);
+	ScoreTopologies(/*IN/OUT*/NJ, unique, hashnames, /*READ*/fpSiteLkTrees, /*WRITE*/fpSiteLk);
+	CheckInput(fpSiteLkTrees, siteLkTreesFile);
+      }
       if (fpLog) {
 	fprintf(fpLog,"TreeCompleted\n");
 	fflush(fpLog);
       }
+      JsonLogDone();
       FreeNJ(NJ);
       if (uniqConstraints != NULL)
 	uniqConstraints = myfree(uniqConstraints, sizeof(char*) * unique->nUnique);
       constraints = FreeAlignment(constraints);
       unique = FreeUniquify(unique);
     } /* end build tree */
+    SlabReleaseAll();
+    OocRelease();
+    TransCacheFree();
+    FreePatterns();
     hashnames = FreeHashtable(hashnames);
     aln = FreeAlignment(aln);
+    if (jobs != NULL)
+      EndAlnJob(jobs);		/* does not return */
   } /* end loop over alignments */
+  jobs = FinishAlnJobs(jobs);
+  if (fixedTransmat != NULL)
+    fixedTransmat = myfree(fixedTransmat, sizeof(transition_matrix_t));
+  if (fpIn != stdin)
+    CloseInput(fpIn);
+  if (fpConstraints != NULL)
+    CloseInput(fpConstraints);
+  if (fpInTree != NULL)
+    CloseInput(fpInTree);
   if (fpLog != NULL)
     fclose(fpLog);
+  if (fpJsonLog != NULL) {
+    fclose(fpJsonLog);
+    fpJsonLog = NULL;
+  }
   if (fpOut != stdout) fclose(fpOut);
+  if (fpHaplotypes != NULL) fclose(fpHaplotypes);
+  if (fpSiteLkTrees != NULL)
+    CloseInput(fpSiteLkTrees);
+  if (fpSiteLk != NULL) fclose(fpSiteLk);
+  if (fpModels != NULL) fclose(fpModels);
+  sweep = FreeSweep(sweep);
+  if (fpProfile != NULL) {
+    profiling = false;
+    WriteProfile(fpProfile);
+    fclose(fpProfile);
+  }
   return 0;
 }
 
@@ -2603,8 +3774,8 @@ void LogMLRates(/*OPTIONAL WRITE*/FILE *fpLog, NJ_t *NJ) {
       fprintf(fpLog, " %f", rates->rates[iRate]);
     fprintf(fpLog,"\nSiteCategories");
     int iPos;
-    for (iPos = 0; iPos < NJ->nPos; iPos++) {
-      iRate = rates->ratecat[iPos];
+    for (iPos = 0; iPos < SITES(NJ->nPos); iPos++) {
+      iRate = rates->ratecat[SITE_PATTERN(iPos)];
       fprintf(fpLog," %d",iRate+1);
     }
     fprintf(fpLog,"\n");
@@ -2619,6 +3790,122 @@ void LogTree(char *format, int i, /*OPTIONAL WRITE*/FILE *fpLog, NJ_t *NJ, char
     PrintNJ(fpLog, NJ, names, unique, /*support*/false, bQuote);
     fflush(fpLog);
   }
+  JsonLogTree(format, i, NJ, names, unique, bQuote);
+}
+
+/* The run log -- see the comment at the declaration of JsonLogStart */
+struct timeval jsonLogStart;
+int jsonLogAln = 0;
+FILE *jsonLogTreeFile = NULL;	/* scratch file for the Newick strings of the trees */
+
+void JsonLogBegin(char *event) {
+  fprintf(fpJsonLog, "{\"event\": \"%s\", \"alignment\": %d, \"time\": %.3f",
+	  event, jsonLogAln, clockDiff(&jsonLogStart));
+}
+
+/* Ends the record and flushes it */
+void JsonLogEnd(void) {
+  fprintf(fpJsonLog, "}\n");
+  fflush(fpJsonLog);
+}
+
+/* Writes null for NAN, which is not valid JSON */
+void JsonLogNumber(char *key, double value) {
+  if (isfinite(value))
+    fprintf(fpJsonLog, ", \"%s\": %.6f", key, value);
+  else
+    fprintf(fpJsonLog, ", \"%s\": null", key);
+}
+
+void JsonLogCounters(void) {
+  fprintf(fpJsonLog, ", \"counters\": {\"profile_ops\": %ld, \"outprofile_ops\": %ld,"
+	  " \"refresh_tophits\": %ld, \"nni\": %ld, \"spr\": %ld, \"ml_nni\": %ld,"
+	  " \"lk\": %ld, \"posterior\": %ld}",
+	  profileOps, outprofileOps, nRefreshTopHits, nNNI, nSPR, nML_NNI,
+	  nLkCompute, nPosteriorCompute);
+}
+
+void JsonLogStart(/*IN*/struct timeval *clock_start, int iAln, int nSeq, int nUnique, int nPos) {
+  if (fpJsonLog == NULL)
+    return;
+  jsonLogStart = *clock_start;
+  jsonLogAln = iAln;
+  JsonLogBegin("start");
+  fprintf(fpJsonLog, ", \"sequences\": %d, \"unique\": %d, \"positions\": %d", nSeq, nUnique, nPos);
+  JsonLogEnd();
+}
+
+void JsonLogTree(char *format, int round, NJ_t *NJ, char **names, uniquify_t *unique, bool bQuote) {
+  if (fpJsonLog == NULL)
+    return;
+  if (jsonLogTreeFile == NULL) {
+    jsonLogTreeFile = tmpfile();
+    if (jsonLogTreeFile == NULL) {
+      fprintf(stderr, "Cannot create a temporary file for -jsonlog\n");
+      exit(1);
+    }
+  }
+  rewind(jsonLogTreeFile);
+  PrintNJ(jsonLogTreeFile, NJ, names, unique, /*support*/false, bQuote);
+  long len = ftell(jsonLogTreeFile);
+  rewind(jsonLogTreeFile);
+
+  JsonLogBegin("tree");
+  /* the phase is the format without the round */
+  fprintf(fpJsonLog, ", \"phase\": \"");
+  char *p;
+  for (p = format; *p != '\0' && *p != '%'; p++)
+    fputc(*p, fpJsonLog);
+  fprintf(fpJsonLog, "\", \"round\": %d, \"tree\": \"", round);
+  long i;
+  for (i = 0; i < len; i++) {
+    int c = getc(jsonLogTreeFile);
+    if (c == EOF || c == '\n')
+      break;
+    if (c == '"' || c == '\\')
+      fprintf(fpJsonLog, "\\%c", c);
+    else if (c < 0x20)
+      fprintf(fpJsonLog, "\\u%04x", c);
+    else
+      fputc(c, fpJsonLog);
+  }
+  fprintf(fpJsonLog, "\"");
+  JsonLogEnd();
+}
+
+void JsonLogRound(char *phase, int round, double loglk, int nChanges, double maxChange) {
+  if (fpJsonLog == NULL)
+    return;
+  JsonLogBegin("round");
+  fprintf(fpJsonLog, ", \"phase\": \"%s\", \"round\": %d", phase, round);
+  JsonLogNumber("loglk", loglk);
+  if (nChanges >= 0)
+    fprintf(fpJsonLog, ", \"changes\": %d", nChanges);
+  else
+    fprintf(fpJsonLog, ", \"changes\": null");
+  JsonLogNumber("max_change", maxChange);
+  JsonLogCounters();
+  JsonLogEnd();
+}
+
+void JsonLogRates(NJ_t *NJ) {
+  if (fpJsonLog == NULL)
+    return;
+  JsonLogBegin("rates");
+  fprintf(fpJsonLog, ", \"rates\": [");
+  int iRate;
+  for (iRate = 0; iRate < NJ->rates.nRateCategories; iRate++)
+    fprintf(fpJsonLog, "%s%f", iRate > 0 ? ", " : "", NJ->rates.rates[iRate]);
+  fprintf(fpJsonLog, "]");
+  JsonLogEnd();
+}
+
+void JsonLogDone(void) {
+  if (fpJsonLog == NULL)
+    return;
+  JsonLogBegin("done");
+  JsonLogCounters();
+  JsonLogEnd();
 }
 
 NJ_t *InitNJ(char **sequences, int nSeq, int nPos,
@@ -2637,6 +3924,7 @@ NJ_t *InitNJ(char **sequences, int nSeq, int nPos,
   NJ->transmat = transmat;
   NJ->nConstraints = nConstraints;
   NJ->constraintSeqs = constraintSeqs;
+  NJ->leafBlocks = NULL;
 
   NJ->profiles = (profile_t **)mymalloc(sizeof(profile_t*) * NJ->maxnodes);
 
@@ -2667,7 +3955,7 @@ NJ_t *InitNJ(char **sequences, int nSeq, int nPos,
 	break;
       }
     }
-    if (!bMatched)
+    if (!bMatched && showWarnings)
       fprintf(stderr, "Ignored unknown character %c (seen %lu times)\n", i, counts[i]);
   }
 
@@ -2705,7 +3993,7 @@ NJ_t *InitNJ(char **sequences, int nSeq, int nPos,
 
   NJ->selfweight = (numeric_t *)mymalloc(sizeof(numeric_t)*NJ->maxnodes);
   for (iNode = 0; iNode < NJ->nSeq; iNode++)
-    NJ->selfweight[iNode] = NJ->nPos - NGaps(NJ,iNode);
+    NJ->selfweight[iNode] = SITES(NJ->nPos) - NGaps(NJ,iNode);
 
   NJ->outDistances = (numeric_t *)mymalloc(sizeof(numeric_t)*NJ->maxnodes);
   NJ->nOutDistActive = (int *)mymalloc(sizeof(int)*NJ->maxnodes);
@@ -2799,7 +4087,7 @@ void FastNJ(NJ_t *NJ) {
     } else {
       assert (NJ->nSeq == 2);
       besthit_t hit;
-      SeqDist(NJ->profiles[0]->codes,NJ->profiles[1]->codes,NJ->nPos,NJ->distance_matrix,/*OUT*/&hit);
+      SeqDistLeaves(NJ->profiles[0],NJ->profiles[1],NJ->nPos,NJ->distance_matrix,/*OUT*/&hit);
       NJ->branchlength[0] = hit.dist/2.0;
       NJ->branchlength[1] = hit.dist/2.0;
     }
@@ -2827,6 +4115,10 @@ void FastNJ(NJ_t *NJ) {
   }
   assert(!(slow && m>0));
 
+  /* Leaves with a sparse index are compared through it instead */
+  if (!slow && !useSparse)
+    NJ->leafBlocks = TransposeLeafCodes(NJ);
+
   /* Initialize top-hits or visible set */
   if (m>0) {
     tophits = InitTopHits(NJ, m);
@@ -2867,12 +4159,12 @@ void FastNJ(NJ_t *NJ) {
 	  int local = JoinConstraintPenaltyPiece(NJ, join.i, join.j, iC);
 	  if (local > 0)
 	    fprintf(stderr, "Constraint %d piece %d %d/%d %d/%d %d/%d\n", iC, local,
-		    NJ->profiles[join.i]->nOn[iC],
-		    NJ->profiles[join.i]->nOff[iC],
-		    NJ->profiles[join.j]->nOn[iC],
-		    NJ->profiles[join.j]->nOff[iC],
-		    NJ->outprofile->nOn[iC] - NJ->profiles[join.i]->nOn[iC] - NJ->profiles[join.j]->nOn[iC],
-		    NJ->outprofile->nOff[iC] - NJ->profiles[join.i]->nOff[iC] - NJ->profiles[join.j]->nOff[iC]);
+		    CONSTRAINT_ON(NJ->profiles[join.i],iC),
+		    CONSTRAINT_OFF(NJ->profiles[join.i],iC),
+		    CONSTRAINT_ON(NJ->profiles[join.j],iC),
+		    CONSTRAINT_OFF(NJ->profiles[join.j],iC),
+		    NJ->outprofile->nOn[iC] - CONSTRAINT_ON(NJ->profiles[join.i],iC) - CONSTRAINT_ON(NJ->profiles[join.j],iC),
+		    NJ->outprofile->nOff[iC] - CONSTRAINT_OFF(NJ->profiles[join.i],iC) - CONSTRAINT_OFF(NJ->profiles[join.j],iC));
 	}
       }
     }
@@ -2985,6 +4277,10 @@ void FastNJ(NJ_t *NJ) {
 					   NJ->nPos, NJ->nConstraints,
 					   NJ->distance_matrix,
 					   bionj ? bionjWeight : /*noweight*/-1.0);
+    if (oocDir != NULL) {
+      OocEvict(NJ->profiles[join.i], NJ->nPos);
+      OocEvict(NJ->profiles[join.j], NJ->nPos);
+    }
 
     /* Update out-distances and total diameters */
     int changedActiveOutProfile = nActiveOutProfileReset - (nActive-1);
@@ -3084,6 +4380,9 @@ void FastNJ(NJ_t *NJ) {
   if (visible != NULL) visible = myfree(visible,sizeof(besthit_t)*NJ->maxnodes);
   if (besthitNew != NULL) besthitNew = myfree(besthitNew,sizeof(besthit_t)*NJ->maxnodes);
   tophits = FreeTopHits(tophits);
+  if (NJ->leafBlocks != NULL)
+    NJ->leafBlocks = myfree(NJ->leafBlocks,
+			    (size_t)NJ->nPos * DIST_BLOCK * ((NJ->nSeq + DIST_BLOCK - 1)/DIST_BLOCK));
 
   /* Add a root for the 3 remaining nodes */
   int top[3];
@@ -3947,21 +5246,355 @@ alignment_t *FreeAlignment(alignment_t *aln) {
   return(NULL);
 }
 
-char **AlnToConstraints(alignment_t *constraints, uniquify_t *unique, hashstrings_t *hashnames) {
-  /* look up constraints as names and map to unique-space */
-  char **  uniqConstraints = (char**)mymalloc(sizeof(char*) * unique->nUnique);
+#define INPUT_PLAIN 0
+#define INPUT_GZIP 1
+#define INPUT_BZIP2 2
+#define INPUT_XZ 3
+#define INPUT_ZSTD 4
+#define INFLATE_CHUNK 65536
+#define MAX_INFLATERS 8
+
+char *inputFormatNames[] = { "plain", "gzip", "bzip2", "xz", "zstd" };
+
+int InputFormat(unsigned char *magic, size_t n) {
+  if (n >= 2 && magic[0] == 0x1f && magic[1] == 0x8b)
+    return(INPUT_GZIP);
+  if (n >= 3 && magic[0] == 'B' && magic[1] == 'Z' && magic[2] == 'h')
+    return(INPUT_BZIP2);
+  if (n >= 6 && memcmp(magic, "\xfd" "7zXZ\0", 6) == 0)
+    return(INPUT_XZ);
+  if (n >= 4 && magic[0] == 0x28 && magic[1] == 0xb5 && magic[2] == 0x2f && magic[3] == 0xfd)
+    return(INPUT_ZSTD);
+  return(INPUT_PLAIN);
+}
+
+#ifdef USE_INFLATE
+/* A background decompressor. The thread must not print (stderr may be
+   redirected to Python), so it leaves a message in error instead. */
+typedef struct {
+  FILE *fp;			/* the read end of the pipe, given to the parser */
+  FILE *fpCompressed;
+  int format;
+  int fdWrite;
+  volatile bool stop;		/* set by CloseInput */
+  char *error;			/* static string, or NULL */
+  pthread_t thread;
+} inflater_t;
+
+inflater_t *inflaters[MAX_INFLATERS] = { NULL };
+
+inflater_t *FindInflater(FILE *fp) {
   int i;
-  for (i = 0; i < unique->nUnique; i++)
-    uniqConstraints[i] = NULL;
-  for (i = 0; i < constraints->nSeq; i++) {
-    char *name = constraints->names[i];
-    char *constraintSeq = constraints->seqs[i];
-    hashiterator_t hi = FindMatch(hashnames,name);
-    if (HashCount(hashnames,hi) != 1) {
-      fprintf(stderr, "Sequence %s from constraints file is not in the alignment\n", name);
-      exit(1);
-    }
-    int iSeqNonunique = HashFirst(hashnames,hi);
+  for (i = 0; i < MAX_INFLATERS; i++)
+    if (inflaters[i] != NULL && inflaters[i]->fp == fp)
+      return(inflaters[i]);
+  return(NULL);
+}
+
+/* Returns false if the reader went away */
+bool InflateWrite(inflater_t *inf, char *buf, size_t n) {
+  while (n > 0) {
+    if (inf->stop)
+      return(false);
+    ssize_t nWrite = write(inf->fdWrite, buf, n);
+    if (nWrite < 0) {
+      if (errno == EINTR)
+	continue;
+      return(false);
+    }
+    buf += nWrite;
+    n -= nWrite;
+  }
+  return(true);
+}
+
+void *InflateThread(void *data) {
+  inflater_t *inf = (inflater_t*)data;
+  char *in = (char*)malloc(INFLATE_CHUNK);
+  char *out = (char*)malloc(INFLATE_CHUNK);
+  size_t nIn = 0;
+  bool bEOF = false;
+  if (in == NULL || out == NULL) {
+    inf->error = "out of memory";
+  }
+#ifdef USE_ZLIB
+  else if (inf->format == INPUT_GZIP) {
+    z_stream z;
+    memset(&z, 0, sizeof(z));
+    if (inflateInit2(&z, 15+32) != Z_OK)	/* +32: gzip header */
+      inf->error = "cannot initialize zlib";
+    while (inf->error == NULL) {
+      if (z.avail_in == 0 && !bEOF) {
+	nIn = fread(in, 1, INFLATE_CHUNK, inf->fpCompressed);
+	bEOF = nIn < INFLATE_CHUNK;
+	z.next_in = (Bytef*)in;
+	z.avail_in = nIn;
+      }
+      z.next_out = (Bytef*)out;
+      z.avail_out = INFLATE_CHUNK;
+      int ret = inflate(&z, Z_NO_FLUSH);
+      if (ret != Z_OK && ret != Z_STREAM_END && !(ret == Z_BUF_ERROR && z.avail_in == 0 && !bEOF)) {
+	inf->error = "corrupt or truncated gzip data";
+	break;
+      }
+      if (!InflateWrite(inf, out, INFLATE_CHUNK - z.avail_out))
+	break;
+      if (ret == Z_STREAM_END) {
+	if (z.avail_in == 0 && !bEOF) {
+	  nIn = fread(in, 1, INFLATE_CHUNK, inf->fpCompressed);
+	  bEOF = nIn < INFLATE_CHUNK;
+	  z.next_in = (Bytef*)in;
+	  z.avail_in = nIn;
+	}
+	if (z.avail_in == 0)
+	  break;
+	inflateReset(&z);	/* concatenated members */
+      }
+    }
+    inflateEnd(&z);
+  }
+#endif
+#ifdef USE_BZIP2
+  else if (inf->format == INPUT_BZIP2) {
+    bz_stream bz;
+    memset(&bz, 0, sizeof(bz));
+    if (BZ2_bzDecompressInit(&bz, 0, 0) != BZ_OK)
+      inf->error = "cannot initialize bzip2";
+    while (inf->error == NULL) {
+      if (bz.avail_in == 0 && !bEOF) {
+	nIn = fread(in, 1, INFLATE_CHUNK, inf->fpCompressed);
+	bEOF = nIn < INFLATE_CHUNK;
+	bz.next_in = in;
+	bz.avail_in = nIn;
+      }
+      bz.next_out = out;
+      bz.avail_out = INFLATE_CHUNK;
+      int ret = BZ2_bzDecompress(&bz);
+      if (ret != BZ_OK && ret != BZ_STREAM_END) {
+	inf->error = "corrupt bzip2 data";
+	break;
+      }
+      if (!InflateWrite(inf, out, INFLATE_CHUNK - bz.avail_out))
+	break;
+      if (ret == BZ_STREAM_END) {
+	if (bz.avail_in == 0 && !bEOF) {
+	  nIn = fread(in, 1, INFLATE_CHUNK, inf->fpCompressed);
+	  bEOF = nIn < INFLATE_CHUNK;
+	  bz.next_in = in;
+	  bz.avail_in = nIn;
+	}
+	if (bz.avail_in == 0)
+	  break;
+	BZ2_bzDecompressEnd(&bz);	/* concatenated streams */
+	char *next_in = bz.next_in;
+	unsigned int avail_in = bz.avail_in;
+	memset(&bz, 0, sizeof(bz));
+	if (BZ2_bzDecompressInit(&bz, 0, 0) != BZ_OK)
+	  inf->error = "cannot initialize bzip2";
+	bz.next_in = next_in;
+	bz.avail_in = avail_in;
+      } else if (bz.avail_in == 0 && bEOF && bz.avail_out == INFLATE_CHUNK) {
+	inf->error = "truncated bzip2 data";
+      }
+    }
+    BZ2_bzDecompressEnd(&bz);
+  }
+#endif
+#ifdef USE_LZMA
+  else if (inf->format == INPUT_XZ) {
+    lzma_stream xz = LZMA_STREAM_INIT;
+    if (lzma_stream_decoder(&xz, UINT64_MAX, LZMA_CONCATENATED) != LZMA_OK)
+      inf->error = "cannot initialize xz";
+    while (inf->error == NULL) {
+      if (xz.avail_in == 0 && !bEOF) {
+	nIn = fread(in, 1, INFLATE_CHUNK, inf->fpCompressed);
+	bEOF = nIn < INFLATE_CHUNK;
+	xz.next_in = (uint8_t*)in;
+	xz.avail_in = nIn;
+      }
+      xz.next_out = (uint8_t*)out;
+      xz.avail_out = INFLATE_CHUNK;
+      lzma_ret ret = lzma_code(&xz, bEOF ? LZMA_FINISH : LZMA_RUN);
+      if (ret != LZMA_OK && ret != LZMA_STREAM_END) {
+	inf->error = "corrupt or truncated xz data";
+	break;
+      }
+      if (!InflateWrite(inf, out, INFLATE_CHUNK - xz.avail_out))
+	break;
+      if (ret == LZMA_STREAM_END)
+	break;
+    }
+    lzma_end(&xz);
+  }
+#endif
+#ifdef USE_ZSTD
+  else if (inf->format == INPUT_ZSTD) {
+    ZSTD_DStream *zs = ZSTD_createDStream();
+    size_t ret = 0;
+    ZSTD_inBuffer zin = { in, 0, 0 };
+    if (zs == NULL || ZSTD_isError(ZSTD_initDStream(zs)))
+      inf->error = "cannot initialize zstd";
+    while (inf->error == NULL) {
+      if (zin.pos == zin.size) {
+	if (bEOF) {
+	  if (ret != 0)
+	    inf->error = "truncated zstd data";
+	  break;
+	}
+	nIn = fread(in, 1, INFLATE_CHUNK, inf->fpCompressed);
+	bEOF = nIn < INFLATE_CHUNK;
+	zin.size = nIn;
+	zin.pos = 0;
+      }
+      ZSTD_outBuffer zout = { out, INFLATE_CHUNK, 0 };
+      ret = ZSTD_decompressStream(zs, &zout, &zin);
+      if (ZSTD_isError(ret)) {
+	inf->error = "corrupt zstd data";
+	break;
+      }
+      if (!InflateWrite(inf, out, zout.pos))
+	break;
+    }
+    ZSTD_freeDStream(zs);
+  }
+#endif
+  if (inf->error == NULL && ferror(inf->fpCompressed))
+    inf->error = "read error";
+  free(in);
+  free(out);
+  close(inf->fdWrite);		/* the parser sees the end of file */
+  return(NULL);
+}
+#endif /* USE_INFLATE */
+
+FILE *OpenInput(char *filename) {
+  FILE *fp = fopen(filename, "rb");
+  if (fp == NULL)
+    return(NULL);
+  /* Only look at the magic bytes of files that can be rewound (not fifos) */
+  unsigned char magic[6];
+  size_t nMagic = 0;
+  if (fseek(fp, 0L, SEEK_CUR) == 0) {
+    nMagic = fread(magic, 1, sizeof(magic), fp);
+    rewind(fp);
+  }
+  int format = InputFormat(magic, nMagic);
+  if (format == INPUT_PLAIN) {
+    fclose(fp);
+    return(fopen(filename, "r"));
+  }
+  bool bSupported = false;
+#ifdef USE_INFLATE
+#ifdef USE_ZLIB
+  bSupported = bSupported || format == INPUT_GZIP;
+#endif
+#ifdef USE_BZIP2
+  bSupported = bSupported || format == INPUT_BZIP2;
+#endif
+#ifdef USE_LZMA
+  bSupported = bSupported || format == INPUT_XZ;
+#endif
+#ifdef USE_ZSTD
+  bSupported = bSupported || format == INPUT_ZSTD;
+#endif
+#endif
+  if (!bSupported) {
+    fprintf(stderr, "Cannot read %s: this build of FastTree does not support %s compressed input\n",
+	    filename, inputFormatNames[format]);
+    exit(1);
+  }
+#ifdef USE_INFLATE
+  int iFree;
+  for (iFree = 0; iFree < MAX_INFLATERS; iFree++)
+    if (inflaters[iFree] == NULL)
+      break;
+  int fds[2];
+  if (iFree == MAX_INFLATERS || pipe(fds) != 0) {
+    fprintf(stderr, "Cannot read %s: too many compressed inputs\n", filename);
+    exit(1);
+  }
+  inflater_t *inf = (inflater_t*)mymalloc(sizeof(inflater_t));
+  inf->fp = fdopen(fds[0], "r");
+  inf->fpCompressed = fp;
+  inf->format = format;
+  inf->fdWrite = fds[1];
+  inf->stop = false;
+  inf->error = NULL;
+  if (inf->fp == NULL || pthread_create(&inf->thread, NULL, InflateThread, inf) != 0) {
+    fprintf(stderr, "Cannot start decompressing %s\n", filename);
+    exit(1);
+  }
+  inflaters[iFree] = inf;
+  return(inf->fp);
+#else
+  return(NULL);
+#endif
+}
+
+void CheckInput(FILE *fp, char *filename) {
+#ifdef USE_INFLATE
+  inflater_t *inf = FindInflater(fp);
+  if (inf != NULL && inf->error != NULL) {
+    fprintf(stderr, "Cannot read %s: %s\n", filename, inf->error);
+    exit(1);
+  }
+#endif
+}
+
+FILE *RewindInput(FILE *fp, char *filename) {
+#ifdef USE_INFLATE
+  if (FindInflater(fp) != NULL) {
+    CloseInput(fp);
+    fp = OpenInput(filename);
+    if (fp == NULL) {
+      fprintf(stderr, "Cannot read %s\n", filename);
+      exit(1);
+    }
+    return(fp);
+  }
+#endif
+  fseek(fp, 0L, SEEK_SET);
+  return(fp);
+}
+
+void CloseInput(FILE *fp) {
+#ifdef USE_INFLATE
+  inflater_t *inf = FindInflater(fp);
+  if (inf != NULL) {
+    /* Drain the pipe so that the thread is not stuck in write() */
+    inf->stop = true;
+    char buf[BUFFER_SIZE];
+    while (fread(buf, 1, sizeof(buf), fp) > 0)
+      ;
+    pthread_join(inf->thread, NULL);
+    fclose(inf->fpCompressed);
+    fclose(fp);
+    int i;
+    for (i = 0; i < MAX_INFLATERS; i++)
+      if (inflaters[i] == inf)
+	inflaters[i] = NULL;
+    myfree(inf, sizeof(inflater_t));
+    return;
+  }
+#endif
+  fclose(fp);
+}
+
+char **AlnToConstraints(alignment_t *constraints, uniquify_t *unique, hashstrings_t *hashnames) {
+  /* look up constraints as names and map to unique-space */
+  char **  uniqConstraints = (char**)mymalloc(sizeof(char*) * unique->nUnique);
+  int i;
+  for (i = 0; i < unique->nUnique; i++)
+    uniqConstraints[i] = NULL;
+  for (i = 0; i < constraints->nSeq; i++) {
+    char *name = constraints->names[i];
+    char *constraintSeq = constraints->seqs[i];
+    hashiterator_t hi = FindMatch(hashnames,name);
+    if (HashCount(hashnames,hi) != 1) {
+      fprintf(stderr, "Sequence %s from constraints file is not in the alignment\n", name);
+      exit(1);
+    }
+    int iSeqNonunique = HashFirst(hashnames,hi);
     assert(iSeqNonunique >= 0 && iSeqNonunique < unique->nSeq);
     int iSeqUnique = unique->alnToUniq[iSeqNonunique];
     assert(iSeqUnique >= 0 && iSeqUnique < unique->nUnique);
@@ -4008,7 +5641,7 @@ profile_t *SeqToProfile(/*IN/OUT*/NJ_t *NJ,
 
   for (i = 0; i < nPos; i++) {
     unsigned int character = (unsigned int) seq[i];
-    counts[character]++;
+    counts[character] += PATTERN_COUNT(i);
     c = charToCode[character];
     if(verbose>10 && i < 2) fprintf(stderr,"pos %d char %c code %d\n", i, seq[i], c);
     /* treat unknowns as gaps */
@@ -4021,18 +5654,19 @@ profile_t *SeqToProfile(/*IN/OUT*/NJ_t *NJ,
     }
   }
   if (nConstraints > 0) {
-    for (i = 0; i < nConstraints; i++) {
-      profile->nOn[i] = 0;
-      profile->nOff[i] = 0;
-    }
+    /* leaves only need the bits */
+    SlabFree(profile->nOn, sizeof(int)*nConstraints);
+    SlabFree(profile->nOff, sizeof(int)*nConstraints);
+    profile->nOn = NULL;
+    profile->nOff = NULL;
     bool bWarn = false;
     if (constraintSeq != NULL) {
       assert(strlen(constraintSeq) == nConstraints);
       for (i = 0; i < nConstraints; i++) {
 	if (constraintSeq[i] == '1') {
-	  profile->nOn[i] = 1;
+	  profile->onBits[i/64] |= (uint64_t)1 << (i%64);
 	} else if (constraintSeq[i] == '0') {
-	  profile->nOff[i] = 1;
+	  profile->offBits[i/64] |= (uint64_t)1 << (i%64);
 	} else if (constraintSeq[i] != '-') {
 	  if (!bWarn) {
 	    fprintf(stderr, "Constraint characters in unique sequence %d replaced with gap:", iNode+1);
@@ -4049,12 +5683,15 @@ profile_t *SeqToProfile(/*IN/OUT*/NJ_t *NJ,
 	fprintf(stderr, "\n");
     }
   }
+  if (useSparse)
+    SetSparseIndex(/*IN/OUT*/profile, nPos, /*bLeaf*/true);
   return profile;
 }
 
 void SeqDist(unsigned char *codes1, unsigned char *codes2, int nPos,
 	     distance_matrix_t *dmat,
 	     /*OUT*/besthit_t *hit) {
+  PROF_SCOPE(PROF_SEQDIST);
   double top = 0;		/* summed over positions */
   int nUse = 0;
   int i;
@@ -4062,16 +5699,16 @@ void SeqDist(unsigned char *codes1, unsigned char *codes2, int nPos,
     int nDiff = 0;
     for (i = 0; i < nPos; i++) {
       if (codes1[i] != NOCODE && codes2[i] != NOCODE) {
-	nUse++;
-	if (codes1[i] != codes2[i]) nDiff++;
+	nUse += PATTERN_COUNT(i);
+	if (codes1[i] != codes2[i]) nDiff += PATTERN_COUNT(i);
       }
     }
     top = (double)nDiff;
   } else {
     for (i = 0; i < nPos; i++) {
       if (codes1[i] != NOCODE && codes2[i] != NOCODE) {
-	nUse++;
-	top += dmat->distances[(unsigned int)codes1[i]][(unsigned int)codes2[i]];
+	nUse += PATTERN_COUNT(i);
+	top += PATTERN_COUNT(i) * dmat->distances[(unsigned int)codes1[i]][(unsigned int)codes2[i]];
       }
     }
   }
@@ -4080,6 +5717,269 @@ void SeqDist(unsigned char *codes1, unsigned char *codes2, int nPos,
   seqOps++;
 }
 
+void SeqDistLeaves(profile_t *profile1, profile_t *profile2, int nPos,
+		   /*OPTIONAL*/distance_matrix_t *dmat,
+		   /*OUT*/besthit_t *hit) {
+  if (profile1->runs == NULL && profile2->runs == NULL) {
+    SeqDist(profile1->codes, profile2->codes, nPos, dmat, /*OUT*/hit);
+    return;
+  }
+  double top = 0;
+  double nUse = 0;
+  SparseDistSums(profile1, profile2, nPos, dmat, /*OUT*/&top, /*OUT*/&nUse);
+  hit->weight = nUse;
+  hit->dist = nUse > 0 ? top/nUse : 1.0;
+  seqOps++;
+}
+
+double GapFraction(char **seqs, int nSeq, int nPos) {
+  bool isCode[256];
+  int c, i;
+  for (c = 0; c < 256; c++)
+    isCode[c] = false;
+  for (i = 0; codesString[i]; i++) {
+    isCode[codesString[i]] = true;
+    isCode[tolower(codesString[i])] = true;
+  }
+  double nGaps = 0;
+  int iSeq;
+  for (iSeq = 0; iSeq < nSeq; iSeq++) {
+    unsigned char *seq = (unsigned char*)seqs[iSeq];
+    long nSeqGaps = 0;
+    for (i = 0; i < nPos; i++)
+      if (!isCode[seq[i]])
+	nSeqGaps++;
+    nGaps += nSeqGaps;
+  }
+  return(nSeq > 0 && nPos > 0 ? nGaps / ((double)nSeq * nPos) : 0.0);
+}
+
+void SetSparseIndex(profile_t *profile, int nPos, bool bLeaf) {
+  int nOccupied = 0;
+  int nRuns = 0;
+  int i;
+  for (i = 0; i < nPos; i++) {
+    if (profile->weights[i] > 0) {
+      nOccupied++;
+      if (i == 0 || profile->weights[i-1] <= 0)
+	nRuns++;
+    }
+  }
+  if (!bLeaf && nOccupied > SPARSE_MAX_OCCUPANCY * nPos)
+    return;
+  profile->runs = (int*)SlabAlloc(sizeof(int)*2*MAX(nRuns,1));
+  profile->nRuns = nRuns;
+  profile->nOccupied = nOccupied;
+  int iRun = 0;
+  for (i = 0; i < nPos; i++) {
+    if (profile->weights[i] > 0 && (i == 0 || profile->weights[i-1] <= 0))
+      profile->runs[2*iRun] = i;
+    if (profile->weights[i] > 0 && (i == nPos-1 || profile->weights[i+1] <= 0))
+      profile->runs[2*(iRun++)+1] = i+1;
+  }
+  assert(iRun == nRuns);
+  if (bLeaf) {
+    /* Pack the leaf: it has no vectors, and its weights are 1 inside the runs */
+    assert(profile->nVectors == 0);
+    unsigned char *codes = (unsigned char*)SlabAlloc(sizeof(unsigned char)*nOccupied);
+    int j = 0;
+    for (iRun = 0; iRun < nRuns; iRun++)
+      for (i = profile->runs[2*iRun]; i < profile->runs[2*iRun+1]; i++)
+	codes[j++] = profile->codes[i];
+    SlabFree(profile->codes, sizeof(unsigned char)*nPos);
+    SlabFree(profile->weights, sizeof(numeric_t)*nPos);
+    profile->codes = codes;
+    profile->weights = NULL;
+  }
+}
+
+void SparseDistSums(profile_t *profile1, profile_t *profile2, int nPos,
+		    /*OPTIONAL*/distance_matrix_t *dmat,
+		    /*OUT*/double *top, /*OUT*/double *denom) {
+  /* A profile without an index is one run over all positions; only then may a
+     position inside a run have weight 0, and it is skipped as in ProfileDist.
+     cur1 and cur2 are the first positions whose vectors are not yet counted in
+     iFreq1 and iFreq2. The code of a packed leaf at position i is at i+off1
+     (or i+off2), as its codes start at 0 and skip the gaps between runs */
+  int whole[2] = { 0, nPos };
+  int *runs1 = profile1->runs != NULL ? profile1->runs : whole;
+  int *runs2 = profile2->runs != NULL ? profile2->runs : whole;
+  int nRuns1 = profile1->runs != NULL ? profile1->nRuns : 1;
+  int nRuns2 = profile2->runs != NULL ? profile2->nRuns : 1;
+  bool bPacked1 = PACKED_LEAF(profile1);
+  bool bPacked2 = PACKED_LEAF(profile2);
+  int k1 = 0, k2 = 0;
+  int iFreq1 = 0, iFreq2 = 0;
+  int cur1 = nRuns1 > 0 ? runs1[0] : 0;
+  int cur2 = nRuns2 > 0 ? runs2[0] : 0;
+  int off1 = bPacked1 ? -cur1 : 0;
+  int off2 = bPacked2 ? -cur2 : 0;
+  bool bVec1 = profile1->nVectors > 0;
+  bool bVec2 = profile2->nVectors > 0;
+  double sumTop = 0;
+  double sumDenom = 0;
+  int i;
+  while (k1 < nRuns1 && k2 < nRuns2) {
+    int end1 = runs1[2*k1+1];
+    int end2 = runs2[2*k2+1];
+    int lo = MAX(runs1[2*k1], runs2[2*k2]);
+    int hi = MIN(end1, end2);
+    if (lo < hi) {
+      if (bVec1)
+	for (; cur1 < lo; cur1++)
+	  if (profile1->weights[cur1] > 0 && profile1->codes[cur1] == NOCODE) iFreq1++;
+      if (bVec2)
+	for (; cur2 < lo; cur2++)
+	  if (profile2->weights[cur2] > 0 && profile2->codes[cur2] == NOCODE) iFreq2++;
+      for (i = lo; i < hi; i++) {
+	numeric_t w1 = bPacked1 ? 1.0 : profile1->weights[i];
+	numeric_t w2 = bPacked2 ? 1.0 : profile2->weights[i];
+	unsigned int code1 = profile1->codes[i+off1];
+	unsigned int code2 = profile2->codes[i+off2];
+	numeric_t *f1 = w1 > 0 && code1 == NOCODE ? &profile1->vectors[nCodes*(iFreq1++)] : NULL;
+	numeric_t *f2 = w2 > 0 && code2 == NOCODE ? &profile2->vectors[nCodes*(iFreq2++)] : NULL;
+	if (w1 <= 0 || w2 <= 0)
+	  continue;
+	double weight = PATTERN_COUNT(i) * w1 * w2;
+	sumDenom += weight;
+	double piece = ProfileDistPiece(code1, code2, f1, f2, dmat,
+					profile2->codeDist ? &profile2->codeDist[i*nCodes] : NULL);
+	sumTop += weight * piece;
+      }
+      cur1 = cur2 = hi;
+    }
+    if (end1 <= end2) {
+      if (bVec1)
+	for (; cur1 < end1; cur1++)
+	  if (profile1->weights[cur1] > 0 && profile1->codes[cur1] == NOCODE) iFreq1++;
+      if (++k1 < nRuns1) {
+	cur1 = runs1[2*k1];
+	if (bPacked1)
+	  off1 += end1 - cur1;
+      }
+    } else {
+      if (bVec2)
+	for (; cur2 < end2; cur2++)
+	  if (profile2->weights[cur2] > 0 && profile2->codes[cur2] == NOCODE) iFreq2++;
+      if (++k2 < nRuns2) {
+	cur2 = runs2[2*k2];
+	if (bPacked2)
+	  off2 += end2 - cur2;
+      }
+    }
+  }
+  *top = sumTop;
+  *denom = sumDenom;
+}
+
+profile_t *DenseProfile(profile_t *profile, int nPos) {
+  if (!PACKED_LEAF(profile))
+    return(profile);
+  profile_t *dense = (profile_t*)SlabAlloc(sizeof(profile_t));
+  *dense = *profile;
+  dense->weights = (numeric_t*)SlabAlloc(sizeof(numeric_t)*nPos);
+  dense->codes = (unsigned char*)SlabAlloc(sizeof(unsigned char)*nPos);
+  dense->runs = NULL;
+  dense->nRuns = 0;
+  dense->oocEntry = -1;
+  LeafCodes(profile, nPos, /*OUT*/dense->codes);
+  int i;
+  for (i = 0; i < nPos; i++)
+    dense->weights[i] = dense->codes[i] == NOCODE ? 0.0 : 1.0;
+  return(dense);
+}
+
+profile_t *FreeDenseProfile(profile_t *dense, profile_t *profile, int nPos) {
+  if (dense != profile) {
+    SlabFree(dense->weights, sizeof(numeric_t)*nPos);
+    SlabFree(dense->codes, sizeof(unsigned char)*nPos);
+    SlabFree(dense, sizeof(profile_t));
+  }
+  return(NULL);
+}
+
+void LeafCodes(profile_t *leaf, int nPos, /*OUT*/unsigned char *codes) {
+  if (!PACKED_LEAF(leaf)) {
+    memcpy(codes, leaf->codes, sizeof(unsigned char)*nPos);
+    return;
+  }
+  memset(codes, NOCODE, sizeof(unsigned char)*nPos);
+  int iRun, i, j = 0;
+  for (iRun = 0; iRun < leaf->nRuns; iRun++)
+    for (i = leaf->runs[2*iRun]; i < leaf->runs[2*iRun+1]; i++)
+      codes[i] = leaf->codes[j++];
+}
+
+void InitSiteReader(site_reader_t *reader, profile_t *profile) {
+  reader->profile = profile;
+  reader->bPacked = PACKED_LEAF(profile);
+  reader->iRun = 0;
+  reader->base = 0;
+}
+
+/* Moves a packed leaf's reader to the first run that ends after position i */
+static inline void SiteReaderSeek(site_reader_t *reader, int i) {
+  profile_t *p = reader->profile;
+  while (reader->iRun < p->nRuns && p->runs[2*reader->iRun+1] <= i) {
+    reader->base += p->runs[2*reader->iRun+1] - p->runs[2*reader->iRun];
+    reader->iRun++;
+  }
+}
+
+/* The code and weight at position i, which may not be below the last position read */
+static inline void ReadSite(site_reader_t *reader, int i, /*OUT*/int *code, /*OUT*/double *weight) {
+  profile_t *p = reader->profile;
+  if (!reader->bPacked) {
+    *code = p->codes[i];
+    *weight = p->weights[i];
+    return;
+  }
+  SiteReaderSeek(reader, i);
+  if (reader->iRun < p->nRuns && p->runs[2*reader->iRun] <= i)
+    *code = p->codes[reader->base + i - p->runs[2*reader->iRun]];
+  else
+    *code = NOCODE;
+  *weight = *code == NOCODE ? 0.0 : 1.0; /* as in DenseProfile */
+}
+
+/* For two packed leaves, the first position at or after i where either is not
+   a gap, or nPos; otherwise i */
+static inline int NextSharedSite(site_reader_t *r1, site_reader_t *r2, int i, int nPos) {
+  if (!r1->bPacked || !r2->bPacked)
+    return(i);
+  SiteReaderSeek(r1, i);
+  SiteReaderSeek(r2, i);
+  int next1 = r1->iRun < r1->profile->nRuns ? r1->profile->runs[2*r1->iRun] : nPos;
+  int next2 = r2->iRun < r2->profile->nRuns ? r2->profile->runs[2*r2->iRun] : nPos;
+  return(MAX(i, MIN(next1, next2)));
+}
+
+profile_t *LeafSlice(profile_t *leaf, int iStart, int nPos, int nConstraints) {
+  profile_t *slice = NewProfile(nPos, nConstraints);
+  site_reader_t reader;
+  InitSiteReader(/*OUT*/&reader, leaf);
+  int i;
+  for (i = 0; i < nPos; i++) {
+    int code;
+    double weight;
+    ReadSite(&reader, iStart+i, /*OUT*/&code, /*OUT*/&weight);
+    slice->codes[i] = code;
+    slice->weights[i] = weight;
+  }
+  if (nConstraints > 0) {
+    /* leaves only need the bits */
+    SlabFree(slice->nOn, sizeof(int)*nConstraints);
+    SlabFree(slice->nOff, sizeof(int)*nConstraints);
+    slice->nOn = NULL;
+    slice->nOff = NULL;
+    memcpy(slice->onBits, leaf->onBits, sizeof(uint64_t)*BITSET_WORDS(nConstraints));
+    memcpy(slice->offBits, leaf->offBits, sizeof(uint64_t)*BITSET_WORDS(nConstraints));
+  }
+  if (PACKED_LEAF(leaf))
+    SetSparseIndex(/*IN/OUT*/slice, nPos, /*bLeaf*/true);
+  return(slice);
+}
+
 void CorrectedPairDistances(profile_t **profiles, int nProfiles,
 			    /*OPTIONAL*/distance_matrix_t *distance_matrix,
 			    int nPos,
@@ -4122,10 +6022,25 @@ void CorrectedPairDistances(profile_t **profiles, int nProfiles,
 int JoinConstraintPenalty(/*IN*/NJ_t *NJ, int node1, int node2) {
   if (NJ->nConstraints == 0)
     return(0.0);
+  profile_t *p1 = NJ->profiles[node1];
+  profile_t *p2 = NJ->profiles[node2];
   int penalty = 0;
-  int iC;
-  for (iC = 0; iC < NJ->nConstraints; iC++)
-    penalty += JoinConstraintPenaltyPiece(NJ, node1, node2, iC);
+  int iWord;
+  for (iWord = 0; iWord < BITSET_WORDS(NJ->nConstraints); iWord++) {
+    /* A piece is non-zero only if the three sides are one on, one off and one split,
+       so both nodes need data, and they cannot both be split or both be all-on or all-off */
+    uint64_t on1 = p1->onBits[iWord], off1 = p1->offBits[iWord];
+    uint64_t on2 = p2->onBits[iWord], off2 = p2->offBits[iWord];
+    uint64_t mask = (on1|off1) & (on2|off2)
+      & ~(on1 & off1 & on2 & off2)
+      & ~(on1 & ~off1 & on2 & ~off2)
+      & ~(off1 & ~on1 & off2 & ~on2);
+    while (mask != 0) {
+      int iC = iWord*64 + LOWBIT64(mask);
+      mask &= mask - 1;
+      penalty += JoinConstraintPenaltyPiece(NJ, node1, node2, iC);
+    }
+  }
   return(penalty);
 }
 
@@ -4133,10 +6048,10 @@ int JoinConstraintPenaltyPiece(NJ_t *NJ, int node1, int node2, int iC) {
   profile_t *pOut = NJ->outprofile;
   profile_t *p1 = NJ->profiles[node1];
   profile_t *p2 = NJ->profiles[node2];
-  int nOn1 = p1->nOn[iC];
-  int nOff1 = p1->nOff[iC];
-  int nOn2 = p2->nOn[iC];
-  int nOff2 = p2->nOff[iC];
+  int nOn1 = CONSTRAINT_ON(p1,iC);
+  int nOff1 = CONSTRAINT_OFF(p1,iC);
+  int nOn2 = CONSTRAINT_ON(p2,iC);
+  int nOff2 = CONSTRAINT_OFF(p2,iC);
   int nOnOut = pOut->nOn[iC] - nOn1 - nOn2;
   int nOffOut = pOut->nOff[iC] - nOff1 - nOff2;
 
@@ -4160,10 +6075,15 @@ void QuartetConstraintPenalties(profile_t *profiles[4], int nConstraints, /*OUT*
     penalty[i] = 0.0;
   if(nConstraints == 0)
     return;
-  int iC;
-  for (iC = 0; iC < nConstraints; iC++) {
-    double part[3];
-    if (QuartetConstraintPenaltiesPiece(profiles, iC, /*OUT*/part)) {
+  int iWord;
+  for (iWord = 0; iWord < BITSET_WORDS(nConstraints); iWord++) {
+    uint64_t mask = QuartetConstraintMask(profiles, iWord, /*bViolations*/false);
+    while (mask != 0) {
+      int iC = iWord*64 + LOWBIT64(mask);
+      mask &= mask - 1;
+      double part[3];
+      if (!QuartetConstraintPenaltiesPiece(profiles, iC, /*OUT*/part))
+	continue;
       for (i=0;i<3;i++)
 	penalty[i] += part[i];
 
@@ -4171,10 +6091,10 @@ void QuartetConstraintPenalties(profile_t *profiles[4], int nConstraints, /*OUT*
 	  && (fabs(part[ABvsCD]-part[ACvsBD]) > 0.001 || fabs(part[ABvsCD]-part[ADvsBC]) > 0.001))
 	fprintf(stderr, "Constraint Penalties at %d: ABvsCD %.3f ACvsBD %.3f ADvsBC %.3f %d/%d %d/%d %d/%d %d/%d\n",
 		iC, part[ABvsCD], part[ACvsBD], part[ADvsBC],
-		profiles[0]->nOn[iC], profiles[0]->nOff[iC],
-		profiles[1]->nOn[iC], profiles[1]->nOff[iC],
-		profiles[2]->nOn[iC], profiles[2]->nOff[iC],
-		profiles[3]->nOn[iC], profiles[3]->nOff[iC]);
+		CONSTRAINT_ON(profiles[0],iC), CONSTRAINT_OFF(profiles[0],iC),
+		CONSTRAINT_ON(profiles[1],iC), CONSTRAINT_OFF(profiles[1],iC),
+		CONSTRAINT_ON(profiles[2],iC), CONSTRAINT_OFF(profiles[2],iC),
+		CONSTRAINT_ON(profiles[3],iC), CONSTRAINT_OFF(profiles[3],iC));
     }
   }
   if (verbose>2)
@@ -4198,8 +6118,8 @@ bool QuartetConstraintPenaltiesPiece(profile_t *profiles[4], int iC, /*OUT*/doub
   int nMinus = 0;
 
   for (i=0; i < 4; i++) {
-    nOn[i] = profiles[i]->nOn[iC];
-    nOff[i] = profiles[i]->nOff[iC];
+    nOn[i] = CONSTRAINT_ON(profiles[i],iC);
+    nOff[i] = CONSTRAINT_OFF(profiles[i],iC);
     if (nOn[i] + nOff[i] == 0)
       return(false);		/* ignore */
     else if (nOn[i] > 0 && nOff[i] > 0)
@@ -4235,15 +6155,58 @@ int SplitConstraintPenalty(int nOn1, int nOff1, int nOn2, int nOff2) {
 	 : (nOn2 < nOff1 ? nOn2 : nOff1));
 }
 
+void SetConstraintBits(profile_t *profile, int nConstraints) {
+  int iWord;
+  for (iWord = 0; iWord < BITSET_WORDS(nConstraints); iWord++) {
+    uint64_t on = 0, off = 0;
+    int iC;
+    int last = MIN(64, nConstraints - iWord*64);
+    for (iC = 0; iC < last; iC++) {
+      on |= (uint64_t)(profile->nOn[iWord*64+iC] > 0) << iC;
+      off |= (uint64_t)(profile->nOff[iWord*64+iC] > 0) << iC;
+    }
+    profile->onBits[iWord] = on;
+    profile->offBits[iWord] = off;
+  }
+}
+
+uint64_t QuartetConstraintMask(profile_t *profiles[4], int iWord, bool bViolations) {
+  uint64_t all = ~(uint64_t)0;
+  uint64_t pureOn[4], pureOff[4];
+  int i;
+  for (i = 0; i < 4; i++) {
+    uint64_t on = profiles[i]->onBits[iWord];
+    uint64_t off = profiles[i]->offBits[iWord];
+    all &= on | off;
+    pureOn[i] = on & ~off;
+    pureOff[i] = off & ~on;
+  }
+#define ATLEAST3(b) ((b[0]&b[1]&b[2]) | (b[0]&b[1]&b[3]) | (b[0]&b[2]&b[3]) | (b[1]&b[2]&b[3]))
+  uint64_t mask = all & ~ATLEAST3(pureOn) & ~ATLEAST3(pureOff);
+#undef ATLEAST3
+  if (bViolations)		/* AB|CD = 11|00 or 00|11 is consistent */
+    mask &= ~(pureOn[0] & pureOn[1] & pureOff[2] & pureOff[3])
+      & ~(pureOff[0] & pureOff[1] & pureOn[2] & pureOn[3]);
+  return(mask);
+}
+
+int QuartetConstraintViolations(profile_t *profiles[4], int nConstraints) {
+  int nViolations = 0;
+  int iWord;
+  for (iWord = 0; iWord < BITSET_WORDS(nConstraints); iWord++)
+    nViolations += POPCOUNT64(QuartetConstraintMask(profiles, iWord, /*bViolations*/true));
+  return(nViolations);
+}
+
 bool SplitViolatesConstraint(profile_t *profiles[4], int iConstraint) {
   int i;
   int codes[4]; /* 0 for off, 1 for on, -1 for split (quit if not constrained at all) */
   for (i = 0; i < 4; i++) {
-    if (profiles[i]->nOn[iConstraint] + profiles[i]->nOff[iConstraint] == 0)
+    if (CONSTRAINT_ON(profiles[i],iConstraint) + CONSTRAINT_OFF(profiles[i],iConstraint) == 0)
       return(false);
-    else if (profiles[i]->nOn[iConstraint] > 0 && profiles[i]->nOff[iConstraint] == 0)
+    else if (CONSTRAINT_ON(profiles[i],iConstraint) > 0 && CONSTRAINT_OFF(profiles[i],iConstraint) == 0)
       codes[i] = 1;
-    else if (profiles[i]->nOn[iConstraint] == 0 && profiles[i]->nOff[iConstraint] > 0)
+    else if (CONSTRAINT_ON(profiles[i],iConstraint) == 0 && CONSTRAINT_OFF(profiles[i],iConstraint) > 0)
       codes[i] = 0;
     else
       codes[i] = -1;
@@ -4331,20 +6294,42 @@ double ProfileDistPiece(unsigned int code1, unsigned int code2,
 */
 #define GET_FREQ(P,I,IVECTOR) \
 (P->weights[I] > 0 && P->codes[I] == NOCODE ? &P->vectors[nCodes*(IVECTOR++)] : NULL)
+/* The same, for a code and weight read with ReadSite */
+#define GET_SITE_FREQ(P,CODE,W,IVECTOR) \
+((W) > 0 && (CODE) == NOCODE ? &P->vectors[nCodes*(IVECTOR++)] : NULL)
+
+/* Marks the positions from i on where two packed leaves are both gaps as gaps
+   of out (as PosteriorProfile does), and returns the next position to compute */
+static inline int SkipSharedGaps(site_reader_t *r1, site_reader_t *r2, int i, int nPos,
+				 /*IN/OUT*/profile_t *out) {
+  int next = NextSharedSite(r1, r2, i, nPos);
+  for (; i < next; i++) {
+    out->codes[i] = NOCODE;
+    out->weights[i] = 0.0;
+  }
+  return(next);
+}
 
 void ProfileDist(profile_t *profile1, profile_t *profile2, int nPos,
 		 /*OPTIONAL*/distance_matrix_t *dmat,
 		 /*OUT*/besthit_t *hit) {
+  PROF_SCOPE(PROF_PROFILEDIST);
   double top = 0;
   double denom = 0;
   int iFreq1 = 0;
   int iFreq2 = 0;
   int i = 0;
+  if (profile1->runs != NULL || profile2->runs != NULL) {
+    SparseDistSums(profile1, profile2, nPos, dmat, /*OUT*/&top, /*OUT*/&denom);
+    iFreq1 = profile1->nVectors;
+    iFreq2 = profile2->nVectors;
+    nPos = 0;			/* skip the dense loop */
+  }
   for (i = 0; i < nPos; i++) {
       numeric_t *f1 = GET_FREQ(profile1,i,/*IN/OUT*/iFreq1);
       numeric_t *f2 = GET_FREQ(profile2,i,/*IN/OUT*/iFreq2);
       if (profile1->weights[i] > 0 && profile2->weights[i] > 0) {
-	double weight = profile1->weights[i] * profile2->weights[i];
+	double weight = PATTERN_COUNT(i) * profile1->weights[i] * profile2->weights[i];
 	denom += weight;
 	double piece = ProfileDistPiece(profile1->codes[i],profile2->codes[i],f1,f2,dmat,
 					profile2->codeDist ? &profile2->codeDist[i*nCodes] : NULL);
@@ -4358,6 +6343,237 @@ void ProfileDist(profile_t *profile1, profile_t *profile2, int nPos,
   profileOps++;
 }
 
+dist_block_t *NewDistBlock(int nPos) {
+  dist_block_t *block = (dist_block_t*)mymalloc(sizeof(dist_block_t));
+  block->nPos = nPos;
+  block->nHits = 0;
+  block->bLeaves = false;
+  block->codes = NULL;
+  block->codesBuf = NULL;
+  return(block);
+}
+
+dist_block_t *FreeDistBlock(dist_block_t *block) {
+  if (block == NULL)
+    return(NULL);
+  size_t n = (size_t)block->nPos * DIST_BLOCK;
+  myfree(block->codesBuf, sizeof(unsigned char)*n);
+  return(myfree(block, sizeof(dist_block_t)));
+}
+
+unsigned char *TransposeLeafCodes(NJ_t *NJ) {
+  int nBlocks = (NJ->nSeq + DIST_BLOCK - 1)/DIST_BLOCK;
+  size_t blockSize = (size_t)NJ->nPos * DIST_BLOCK;
+  unsigned char *leafBlocks = (unsigned char*)mymalloc(blockSize * nBlocks);
+  memset(leafBlocks, NOCODE, blockSize * nBlocks);
+  int iNode, i;
+  for (iNode = 0; iNode < NJ->nSeq; iNode++) {
+    unsigned char *codes = NJ->profiles[iNode]->codes;
+    unsigned char *out = &leafBlocks[(iNode/DIST_BLOCK) * blockSize + iNode % DIST_BLOCK];
+    for (i = 0; i < NJ->nPos; i++)
+      out[i*DIST_BLOCK] = codes[i];
+  }
+  return(leafBlocks);
+}
+
+void PackDistBlock(/*IN*/NJ_t *NJ, /*IN*/int *nodes, int nNodes, bool bLeaves,
+		   /*OUT*/dist_block_t *block) {
+  assert(nNodes > 0 && nNodes <= DIST_BLOCK);
+  int nPos = block->nPos;
+  size_t n = (size_t)nPos * DIST_BLOCK;
+  int k, i;
+  block->nHits = nNodes;
+  block->bLeaves = bLeaves;
+  if (!bLeaves) {
+    for (k = 0; k < nNodes; k++) {
+      block->col[k] = k;
+      block->profiles[k] = NJ->profiles[nodes[k]];
+    }
+    return;
+  }
+  if (NJ->leafBlocks != NULL) {
+    int iBlock = nodes[0]/DIST_BLOCK;
+    for (k = 1; k < nNodes; k++)
+      if (nodes[k]/DIST_BLOCK != iBlock)
+	break;
+    if (k == nNodes) {		/* all in one block of NJ->leafBlocks */
+      block->codes = &NJ->leafBlocks[iBlock * n];
+      for (k = 0; k < nNodes; k++)
+	block->col[k] = nodes[k] % DIST_BLOCK;
+      return;
+    }
+  }
+  if (block->codesBuf == NULL)
+    block->codesBuf = (unsigned char*)mymalloc(sizeof(unsigned char)*n);
+  block->codes = block->codesBuf;
+  /* unused columns are gaps, so the loops can always cover DIST_BLOCK columns */
+  if (nNodes < DIST_BLOCK)
+    memset(block->codes, NOCODE, n);
+  for (k = 0; k < nNodes; k++) {
+    unsigned char *codes = NJ->profiles[nodes[k]]->codes;
+    block->col[k] = k;
+    for (i = 0; i < nPos; i++)
+      block->codes[i*DIST_BLOCK+k] = codes[i];
+  }
+}
+
+void DistBlockSums(profile_t *query, bool bQueryLeaf, /*IN*/dist_block_t *block,
+		   /*OPTIONAL*/distance_matrix_t *dmat,
+		   /*OUT*/double *top, /*OUT*/double *denom) {
+  PROF_SCOPE(PROF_DISTBLOCK);
+  int nPos = block->nPos;
+  int b, i;
+  for (b = 0; b < DIST_BLOCK; b++)
+    top[b] = denom[b] = 0;
+
+  if (bQueryLeaf && block->bLeaves) {
+    /* as in SeqDist */
+    if (dmat == NULL) {
+      int nUse[DIST_BLOCK], nDiff[DIST_BLOCK];
+      for (b = 0; b < DIST_BLOCK; b++)
+	nUse[b] = nDiff[b] = 0;
+      for (i = 0; i < nPos; i++) {
+	unsigned char code1 = query->codes[i];
+	if (code1 == NOCODE)
+	  continue;
+	int count = PATTERN_COUNT(i);
+	unsigned char *codes2 = &block->codes[i*DIST_BLOCK];
+	for (b = 0; b < DIST_BLOCK; b++) {
+	  int use = codes2[b] != NOCODE;
+	  nUse[b] += use * count;
+	  nDiff[b] += (use & (codes2[b] != code1)) * count;
+	}
+      }
+      for (b = 0; b < DIST_BLOCK; b++) {
+	top[b] = (double)nDiff[b];
+	denom[b] = (double)nUse[b];
+      }
+    } else {
+      for (i = 0; i < nPos; i++) {
+	unsigned int code1 = query->codes[i];
+	if (code1 == NOCODE)
+	  continue;
+	unsigned char *codes2 = &block->codes[i*DIST_BLOCK];
+	for (b = 0; b < DIST_BLOCK; b++) {
+	  if (codes2[b] != NOCODE) {
+	    denom[b] += PATTERN_COUNT(i);
+	    top[b] += PATTERN_COUNT(i) * dmat->distances[code1][(unsigned int)codes2[b]];
+	  }
+	}
+      }
+    }
+    return;
+  }
+
+  /* as in ProfileDist */
+  int iFreq1 = 0;
+  if (block->bLeaves) {
+    for (i = 0; i < nPos; i++) {
+      numeric_t *f1 = GET_FREQ(query,i,/*IN/OUT*/iFreq1);
+      numeric_t w1 = query->weights[i];
+      if (w1 <= 0)
+	continue;
+      unsigned int code1 = query->codes[i];
+      unsigned char *codes2 = &block->codes[i*DIST_BLOCK];
+      double weight = PATTERN_COUNT(i) * w1; /* leaf weights are 1 at non-gaps */
+      for (b = 0; b < DIST_BLOCK; b++) {
+	if (codes2[b] != NOCODE) {
+	  denom[b] += weight;
+	  top[b] += weight * ProfileDistPiece(code1, codes2[b], f1, NULL, dmat, NULL);
+	}
+      }
+    }
+  } else {
+    /* averaged profiles are read in place, each with its own vector index */
+    int nCols = block->nHits;
+    numeric_t *weights2[DIST_BLOCK], *vectors2[DIST_BLOCK], *codeDist2[DIST_BLOCK];
+    unsigned char *codes2[DIST_BLOCK];
+    for (b = 0; b < nCols; b++) {
+      weights2[b] = block->profiles[b]->weights;
+      codes2[b] = block->profiles[b]->codes;
+      vectors2[b] = block->profiles[b]->vectors;
+      codeDist2[b] = block->profiles[b]->codeDist;
+    }
+    for (i = 0; i < nPos; i++) {
+      numeric_t *f1 = GET_FREQ(query,i,/*IN/OUT*/iFreq1);
+      numeric_t w1 = query->weights[i];
+      unsigned int code1 = query->codes[i];
+      for (b = 0; b < nCols; b++) {
+	if (weights2[b][i] <= 0)
+	  continue;
+	unsigned int code2 = codes2[b][i];
+	numeric_t *f2 = NULL;
+	if (code2 == NOCODE) {
+	  f2 = vectors2[b];
+	  vectors2[b] += nCodes;
+	}
+	if (w1 > 0) {
+	  double weight = PATTERN_COUNT(i) * w1 * weights2[b][i];
+	  denom[b] += weight;
+	  top[b] += weight * ProfileDistPiece(code1, code2, f1, f2, dmat,
+					      codeDist2[b] ? &codeDist2[b][i*nCodes] : NULL);
+	}
+      }
+    }
+  }
+  assert(iFreq1 == query->nVectors);
+}
+
+void SetDistCriteria(/*IN/UPDATE*/NJ_t *NJ, int nActive,
+		     /*IN/OUT*/besthit_t **hits, int nHits,
+		     /*BUFFER*/dist_block_t *block) {
+  /* pending[0] are leaves and pending[1] are averaged profiles, both with
+     the same i; a list is scored when it is full, or when i changes */
+  besthit_t *pending[2][DIST_BLOCK];
+  int nPending[2] = {0, 0};
+  double top[DIST_BLOCK], denom[DIST_BLOCK];
+  int nodes[DIST_BLOCK];
+  int iHit, iList, k;
+  for (iHit = 0; iHit <= nHits; iHit++) {
+    besthit_t *hit = iHit < nHits ? hits[iHit] : NULL;
+    for (iList = 0; iList < 2; iList++) {
+      int n = nPending[iList];
+      if (n == 0
+	  || (hit != NULL && hit->i == pending[iList][0]->i && n < DIST_BLOCK))
+	continue;
+      int node = pending[iList][0]->i;
+      bool bQueryLeaf = node < NJ->nSeq;
+      bool bLeaves = iList == 0;
+      for (k = 0; k < n; k++)
+	nodes[k] = pending[iList][k]->j;
+      PackDistBlock(NJ, nodes, n, bLeaves, /*OUT*/block);
+      DistBlockSums(NJ->profiles[node], bQueryLeaf, block, NJ->distance_matrix,
+		    /*OUT*/top, /*OUT*/denom);
+      for (k = 0; k < n; k++) {
+	besthit_t *h = pending[iList][k];
+	int col = block->col[k];
+	if (bQueryLeaf && bLeaves) {
+	  h->weight = denom[col];
+	  h->dist = denom[col] > 0 ? top[col]/denom[col] : 1.0;
+	  seqOps++;
+	} else {
+	  h->weight = denom[col] > 0 ? denom[col] : 0.01;
+	  h->dist = denom[col] > 0 ? top[col]/denom[col] : 1;
+	  h->dist -= (NJ->diameter[h->i] + NJ->diameter[h->j]);
+	  profileOps++;
+	}
+	h->dist += constraintWeight
+	  * (double)JoinConstraintPenalty(NJ, h->i, h->j);
+	SetCriterion(NJ, nActive, /*IN/OUT*/h);
+      }
+      nPending[iList] = 0;
+    }
+    if (hit == NULL)
+      break;
+    if (NJ->profiles[hit->i]->runs != NULL || NJ->profiles[hit->j]->runs != NULL)
+      SetDistCriterion(NJ, nActive, /*IN/OUT*/hit);
+    else {
+      iList = hit->j < NJ->nSeq ? 0 : 1;
+      pending[iList][nPending[iList]++] = hit;
+    }
+  }
+}
+
 /* This should not be called if the update weight is 0, as
    in that case code==NOCODE and in=NULL is possible, and then
    it will fail.
@@ -4403,6 +6619,11 @@ profile_t *AverageProfile(profile_t *profile1, profile_t *profile2,
   if (bionjWeight < 0) {
     bionjWeight = 0.5;
   }
+  /* Packed leaves are read through dense copies */
+  profile_t *in1 = profile1;
+  profile_t *in2 = profile2;
+  profile1 = DenseProfile(in1, nPos);
+  profile2 = DenseProfile(in2, nPos);
 
   /* First, set codes and weights and see how big vectors will be */
   profile_t *out = NewProfile(nPos, nConstraints);
@@ -4425,7 +6646,7 @@ profile_t *AverageProfile(profile_t *profile1, profile_t *profile2,
   }
 
   /* Allocate and set the vectors */
-  out->vectors = (numeric_t*)mymalloc(sizeof(numeric_t)*nCodes*out->nVectors);
+  out->vectors = (numeric_t*)SlabAlloc(sizeof(numeric_t)*nCodes*out->nVectors);
   for (i = 0; i < nCodes * out->nVectors; i++) out->vectors[i] = 0;
   nProfileFreqAlloc += out->nVectors;
   nProfileFreqAvoid += nPos - out->nVectors;
@@ -4463,9 +6684,14 @@ profile_t *AverageProfile(profile_t *profile1, profile_t *profile2,
 
   /* compute total constraints */
   for (i = 0; i < nConstraints; i++) {
-    out->nOn[i] = profile1->nOn[i] + profile2->nOn[i];
-    out->nOff[i] = profile1->nOff[i] + profile2->nOff[i];
-  }
+    out->nOn[i] = CONSTRAINT_ON(profile1,i) + CONSTRAINT_ON(profile2,i);
+    out->nOff[i] = CONSTRAINT_OFF(profile1,i) + CONSTRAINT_OFF(profile2,i);
+  }
+  SetConstraintBits(/*IN/OUT*/out, nConstraints);
+  if (in1->runs != NULL && in2->runs != NULL)
+    SetSparseIndex(/*IN/OUT*/out, nPos, /*bLeaf*/false);
+  FreeDenseProfile(profile1, in1, nPos);
+  FreeDenseProfile(profile2, in2, nPos);
   profileAvgOps++;
   return(out);
 }
@@ -4512,34 +6738,42 @@ profile_t *OutProfile(profile_t **profiles, int nProfiles,
 
   double inweight = 1.0/(double)nProfiles;   /* The maximal output weight is 1.0 */
 
-  /* First, set weights -- code is always NOCODE, prevent weight=0 */
-  for (i = 0; i < nPos; i++) {
+  /* First, set weights -- code is always NOCODE, prevent weight=0.
+     Packed leaves are read through dense copies, one at a time */
+  for (i = 0; i < nPos; i++)
     out->weights[i] = 0;
-    for (in = 0; in < nProfiles; in++)
-      out->weights[i] += profiles[in]->weights[i] * inweight;
+  for (in = 0; in < nProfiles; in++) {
+    profile_t *dense = DenseProfile(profiles[in], nPos);
+    for (i = 0; i < nPos; i++)
+      out->weights[i] += dense->weights[i] * inweight;
+    FreeDenseProfile(dense, profiles[in], nPos);
+  }
+  for (i = 0; i < nPos; i++) {
     if (out->weights[i] <= 0) out->weights[i] = 1e-20; /* always store a vector */
     out->nVectors++;
     out->codes[i] = NOCODE;		/* outprofile is normally complicated */
   }
 
   /* Initialize the frequencies to 0 */
-  out->vectors = (numeric_t*)mymalloc(sizeof(numeric_t)*nCodes*out->nVectors);
+  out->vectors = (numeric_t*)SlabAlloc(sizeof(numeric_t)*nCodes*out->nVectors);
   for (i = 0; i < nCodes*out->nVectors; i++)
     out->vectors[i] = 0;
 
   /* Add up the weights, going through each sequence in turn */
   for (in = 0; in < nProfiles; in++) {
+    profile_t *dense = DenseProfile(profiles[in], nPos);
     int iFreqOut = 0;
     int iFreqIn = 0;
     for (i = 0; i < nPos; i++) {
-      numeric_t *fIn = GET_FREQ(profiles[in],i,/*IN/OUT*/iFreqIn);
+      numeric_t *fIn = GET_FREQ(dense,i,/*IN/OUT*/iFreqIn);
       numeric_t *fOut = GET_FREQ(out,i,/*IN/OUT*/iFreqOut);
-      if (profiles[in]->weights[i] > 0)
-	AddToFreq(/*IN/OUT*/fOut, profiles[in]->weights[i],
-		  profiles[in]->codes[i], fIn, dmat);
+      if (dense->weights[i] > 0)
+	AddToFreq(/*IN/OUT*/fOut, dense->weights[i],
+		  dense->codes[i], fIn, dmat);
     }
     assert(iFreqOut == out->nVectors);
-    assert(iFreqIn == profiles[in]->nVectors);
+    assert(iFreqIn == dense->nVectors);
+    FreeDenseProfile(dense, profiles[in], nPos);
   }
 
   /* And normalize the frequencies to sum to 1 */
@@ -4559,10 +6793,11 @@ profile_t *OutProfile(profile_t **profiles, int nProfiles,
     out->nOn[i] = 0;
     out->nOff[i] = 0;
     for (in = 0; in < nProfiles; in++) {
-      out->nOn[i] += profiles[in]->nOn[i];
-      out->nOff[i] += profiles[in]->nOff[i];
+      out->nOn[i] += CONSTRAINT_ON(profiles[in],i);
+      out->nOff[i] += CONSTRAINT_OFF(profiles[in],i);
     }
   }
+  SetConstraintBits(/*IN/OUT*/out, nConstraints);
   return(out);
 }
 
@@ -4576,6 +6811,13 @@ void UpdateOutProfile(/*IN/OUT*/profile_t *out, profile_t *old1, profile_t *old2
   int iFreq2 = 0;
   int iFreqNew = 0;
   assert(nActiveOld > 0);
+  /* Packed leaves are read through dense copies */
+  profile_t *in1 = old1;
+  profile_t *in2 = old2;
+  profile_t *inNew = new;
+  old1 = DenseProfile(in1, nPos);
+  old2 = DenseProfile(in2, nPos);
+  new = DenseProfile(inNew, nPos);
 
   for (i = 0; i < nPos; i++) {
     numeric_t *fOut = GET_FREQ(out,i,/*IN/OUT*/iFreqOut);
@@ -4623,15 +6865,19 @@ void UpdateOutProfile(/*IN/OUT*/profile_t *out, profile_t *old1, profile_t *old2
 
   /* update constraints -- note in practice this should be a no-op */
   for (i = 0; i < nConstraints; i++) {
-    out->nOn[i] += new->nOn[i] - old1->nOn[i] - old2->nOn[i];
-    out->nOff[i] += new->nOff[i] - old1->nOff[i] - old2->nOff[i];
+    out->nOn[i] += CONSTRAINT_ON(new,i) - CONSTRAINT_ON(old1,i) - CONSTRAINT_ON(old2,i);
+    out->nOff[i] += CONSTRAINT_OFF(new,i) - CONSTRAINT_OFF(old1,i) - CONSTRAINT_OFF(old2,i);
   }
+  SetConstraintBits(/*IN/OUT*/out, nConstraints);
+  FreeDenseProfile(old1, in1, nPos);
+  FreeDenseProfile(old2, in2, nPos);
+  FreeDenseProfile(new, inNew, nPos);
 }
 
 void SetCodeDist(/*IN/OUT*/profile_t *profile, int nPos,
 			   distance_matrix_t *dmat) {
   if (profile->codeDist == NULL)
-    profile->codeDist = (numeric_t*)mymalloc(sizeof(numeric_t)*nPos*nCodes);
+    profile->codeDist = (numeric_t*)SlabAlloc(sizeof(numeric_t)*nPos*nCodes);
   int i;
   int iFreq = 0;
   for (i = 0; i < nPos; i++) {
@@ -4656,30 +6902,57 @@ void SetBestHit(int node, NJ_t *NJ, int nActive,
   bestjoin->dist = 1e20;
   bestjoin->criterion = 1e20;
 
-  int j;
-  besthit_t tmp;
-
+  /* Each thread keeps the first best hit of the nodes it handled, in increasing
+     order of j, and then the best of those with the lowest j is kept. This is the
+     hit that a single thread would find, whatever the number of threads.
+     The nodes are handled in blocks of DIST_BLOCK, see SetDistCriteria. */
+  int nBlocks = (NJ->maxnode + DIST_BLOCK - 1)/DIST_BLOCK;
 #ifdef USE_OPENMP
   /* Note -- if we are already in a parallel region, this will be ignored */
-  #pragma omp parallel for schedule(dynamic, 50)
-#endif
-  for (j = 0; j < NJ->maxnode; j++) {
-    besthit_t *sv = allhits != NULL ? &allhits[j] : &tmp;
-    sv->i = node;
-    sv->j = j;
-    if (NJ->parent[j] >= 0) {
-      sv->i = -1;		/* illegal/empty join */
-      sv->weight = 0.0;
-      sv->criterion = sv->dist = 1e20;
-      continue;
+  #pragma omp parallel num_threads(PHASE_THREADS(PHASE_NJ))
+#endif
+  {
+    besthit_t tmp[DIST_BLOCK];
+    besthit_t *hits[DIST_BLOCK];
+    besthit_t best = *bestjoin;
+    dist_block_t *block = NewDistBlock(NJ->nPos);
+    int iBlock;
+#ifdef USE_OPENMP
+    #pragma omp for schedule(dynamic, 4) nowait
+#endif
+    for (iBlock = 0; iBlock < nBlocks; iBlock++) {
+      int jFirst = iBlock * DIST_BLOCK;
+      int nHits = 0;
+      int j, iHit;
+      for (j = jFirst; j < jFirst + DIST_BLOCK && j < NJ->maxnode; j++) {
+	besthit_t *sv = allhits != NULL ? &allhits[j] : &tmp[j - jFirst];
+	sv->i = node;
+	sv->j = j;
+	if (NJ->parent[j] >= 0) {
+	  sv->i = -1;		/* illegal/empty join */
+	  sv->weight = 0.0;
+	  sv->criterion = sv->dist = 1e20;
+	  continue;
+	}
+	hits[nHits++] = sv;
+      }
+      /* Note that we compute self-distances (allow j==node) because the top-hit heuristic
+	 expects self to be within its top hits, but we exclude those from the bestjoin
+	 that we return...
+      */
+      SetDistCriteria(NJ, nActive, /*IN/OUT*/hits, nHits, /*BUFFER*/block);
+      for (iHit = 0; iHit < nHits; iHit++)
+	if (hits[iHit]->criterion < best.criterion && hits[iHit]->j != node)
+	  best = *hits[iHit];
     }
-    /* Note that we compute self-distances (allow j==node) because the top-hit heuristic
-       expects self to be within its top hits, but we exclude those from the bestjoin
-       that we return...
-    */
-    SetDistCriterion(NJ, nActive, /*IN/OUT*/sv);
-    if (sv->criterion < bestjoin->criterion && node != j)
-      *bestjoin = *sv;
+    block = FreeDistBlock(block);
+#ifdef USE_OPENMP
+    #pragma omp critical(bestjoin)
+#endif
+    if (best.j >= 0
+	&& (best.criterion < bestjoin->criterion
+	    || (best.criterion == bestjoin->criterion && best.j < bestjoin->j)))
+      *bestjoin = best;
   }
   if (verbose>5) {
     fprintf(stderr, "SetBestHit %d %d %f %f\n", bestjoin->i, bestjoin->j, bestjoin->dist, bestjoin->criterion);
@@ -4866,10 +7139,10 @@ nni_t ChooseNNI(profile_t *profiles[4],
 	double new_penalty = ppart[choice];
 	if (new_penalty > old_penalty + 1e-6)
 	  fprintf(stderr, " %d (%d/%d %d/%d %d/%d %d/%d)", iC,
-		  profiles[0]->nOn[iC], profiles[0]->nOff[iC],
-		  profiles[1]->nOn[iC], profiles[1]->nOff[iC],
-		  profiles[2]->nOn[iC], profiles[2]->nOff[iC],
-		  profiles[3]->nOn[iC], profiles[3]->nOff[iC]);
+		  CONSTRAINT_ON(profiles[0],iC), CONSTRAINT_OFF(profiles[0],iC),
+		  CONSTRAINT_ON(profiles[1],iC), CONSTRAINT_OFF(profiles[1],iC),
+		  CONSTRAINT_ON(profiles[2],iC), CONSTRAINT_OFF(profiles[2],iC),
+		  CONSTRAINT_ON(profiles[3],iC), CONSTRAINT_OFF(profiles[3],iC));
       }
     }
     fprintf(stderr,"\n");
@@ -4886,10 +7159,14 @@ profile_t *PosteriorProfile(profile_t *p1, profile_t *p2,
 			    /*OPTIONAL*/transition_matrix_t *transmat,
 			    rates_t *rates,
 			    int nPos, int nConstraints) {
+  PROF_SCOPE(PROF_POSTERIORPROFILE);
   if (len1 < MLMinBranchLength)
     len1 = MLMinBranchLength;
   if (len2 < MLMinBranchLength)
     len2 = MLMinBranchLength;
+  site_reader_t r1, r2;
+  InitSiteReader(/*OUT*/&r1, p1);
+  InitSiteReader(/*OUT*/&r2, p2);
 
   int i,j,k;
   profile_t *out = NewProfile(nPos, nConstraints);
@@ -4898,7 +7175,7 @@ profile_t *PosteriorProfile(profile_t *p1, profile_t *p2,
     out->weights[i] = 1.0;
   }
   out->nVectors = nPos;
-  out->vectors = (numeric_t*)mymalloc(sizeof(numeric_t)*nCodes*out->nVectors);
+  out->vectors = (numeric_t*)SlabAlloc(sizeof(numeric_t)*nCodes*out->nVectors);
   for (i = 0; i < nCodes * out->nVectors; i++) out->vectors[i] = 0;
   int iFreqOut = 0;
   int iFreq1 = 0;
@@ -4921,13 +7198,15 @@ profile_t *PosteriorProfile(profile_t *p1, profile_t *p2,
     numeric_t mix1[4], mix2[4];
 
     for (i=0; i < nPos; i++) {
+      if ((i = SkipSharedGaps(&r1, &r2, i, nPos, /*IN/OUT*/out)) == nPos)
+	break;
       int iRate = rates->ratecat[i];
-      double w1 = p1->weights[i];
-      double w2 = p2->weights[i];
-      int code1 = p1->codes[i];
-      int code2 = p2->codes[i];
-      numeric_t *f1 = GET_FREQ(p1,i,/*IN/OUT*/iFreq1);
-      numeric_t *f2 = GET_FREQ(p2,i,/*IN/OUT*/iFreq2);
+      int code1, code2;
+      double w1, w2;
+      ReadSite(&r1, i, /*OUT*/&code1, /*OUT*/&w1);
+      ReadSite(&r2, i, /*OUT*/&code2, /*OUT*/&w2);
+      numeric_t *f1 = GET_SITE_FREQ(p1,code1,w1,/*IN/OUT*/iFreq1);
+      numeric_t *f2 = GET_SITE_FREQ(p2,code2,w2,/*IN/OUT*/iFreq2);
 
       /* First try to store a simple profile */
       if (f1 == NULL && f2 == NULL) {
@@ -5009,8 +7288,13 @@ profile_t *PosteriorProfile(profile_t *p1, profile_t *p2,
     numeric_t f1mix[4], f2mix[4];
 
     for (i=0; i < nPos; i++) {
-      if (p1->codes[i] == NOCODE && p2->codes[i] == NOCODE
-	  && p1->weights[i] == 0 && p2->weights[i] == 0) {
+      if ((i = SkipSharedGaps(&r1, &r2, i, nPos, /*IN/OUT*/out)) == nPos)
+	break;
+      int code1, code2;
+      double w1, w2;
+      ReadSite(&r1, i, /*OUT*/&code1, /*OUT*/&w1);
+      ReadSite(&r2, i, /*OUT*/&code2, /*OUT*/&w2);
+      if (code1 == NOCODE && code2 == NOCODE && w1 == 0 && w2 == 0) {
 	/* aligning gap with gap -- just output a gap
 	   out->codes[i] is already set to NOCODE so need not set that */
 	out->weights[i] = 0;
@@ -5019,14 +7303,14 @@ profile_t *PosteriorProfile(profile_t *p1, profile_t *p2,
       int iRate = rates->ratecat[i];
       numeric_t *expeigen1 = &expeigenRates1[iRate*4];
       numeric_t *expeigen2 = &expeigenRates2[iRate*4];
-      numeric_t *f1 = GET_FREQ(p1,i,/*IN/OUT*/iFreq1);
-      numeric_t *f2 = GET_FREQ(p2,i,/*IN/OUT*/iFreq2);
+      numeric_t *f1 = GET_SITE_FREQ(p1,code1,w1,/*IN/OUT*/iFreq1);
+      numeric_t *f2 = GET_SITE_FREQ(p2,code2,w2,/*IN/OUT*/iFreq2);
       numeric_t *fOut = GET_FREQ(out,i,/*IN/OUT*/iFreqOut);
       assert(fOut != NULL);
 
       if (f1 == NULL) {
-	f1 = &transmat->codeFreq[p1->codes[i]][0]; /* codeFreq includes an entry for NOCODE */
-	double w = p1->weights[i];
+	f1 = &transmat->codeFreq[code1][0]; /* codeFreq includes an entry for NOCODE */
+	double w = w1;
 	if (w > 0.0 && w < 1.0) {
 	  for (j = 0; j < 4; j++)
 	    f1mix[j] = w * f1[j] + (1.0-w) * fGap[j];
@@ -5034,8 +7318,8 @@ profile_t *PosteriorProfile(profile_t *p1, profile_t *p2,
 	}
       }
       if (f2 == NULL) {
-	f2 = &transmat->codeFreq[p2->codes[i]][0];
-	double w = p2->weights[i];
+	f2 = &transmat->codeFreq[code2][0];
+	double w = w2;
 	if (w > 0.0 && w < 1.0) {
 	  for (j = 0; j < 4; j++)
 	    f2mix[j] = w * f2[j] + (1.0-w) * fGap[j];
@@ -5089,8 +7373,13 @@ profile_t *PosteriorProfile(profile_t *p1, profile_t *p2,
     numeric_t f2mix[20] ALIGNED;
 
     for (i=0; i < nPos; i++) {
-      if (p1->codes[i] == NOCODE && p2->codes[i] == NOCODE
-	  && p1->weights[i] == 0 && p2->weights[i] == 0) {
+      if ((i = SkipSharedGaps(&r1, &r2, i, nPos, /*IN/OUT*/out)) == nPos)
+	break;
+      int code1, code2;
+      double w1, w2;
+      ReadSite(&r1, i, /*OUT*/&code1, /*OUT*/&w1);
+      ReadSite(&r2, i, /*OUT*/&code2, /*OUT*/&w2);
+      if (code1 == NOCODE && code2 == NOCODE && w1 == 0 && w2 == 0) {
 	/* aligning gap with gap -- just output a gap
 	   out->codes[i] is already set to NOCODE so need not set that */
 	out->weights[i] = 0;
@@ -5099,14 +7388,14 @@ profile_t *PosteriorProfile(profile_t *p1, profile_t *p2,
       int iRate = rates->ratecat[i];
       numeric_t *expeigen1 = &expeigenRates1[iRate*20];
       numeric_t *expeigen2 = &expeigenRates2[iRate*20];
-      numeric_t *f1 = GET_FREQ(p1,i,/*IN/OUT*/iFreq1);
-      numeric_t *f2 = GET_FREQ(p2,i,/*IN/OUT*/iFreq2);
+      numeric_t *f1 = GET_SITE_FREQ(p1,code1,w1,/*IN/OUT*/iFreq1);
+      numeric_t *f2 = GET_SITE_FREQ(p2,code2,w2,/*IN/OUT*/iFreq2);
       numeric_t *fOut = GET_FREQ(out,i,/*IN/OUT*/iFreqOut);
       assert(fOut != NULL);
 
       if (f1 == NULL) {
-	f1 = &transmat->codeFreq[p1->codes[i]][0]; /* codeFreq includes an entry for NOCODE */
-	double w = p1->weights[i];
+	f1 = &transmat->codeFreq[code1][0]; /* codeFreq includes an entry for NOCODE */
+	double w = w1;
 	if (w > 0.0 && w < 1.0) {
 	  for (j = 0; j < 20; j++)
 	    f1mix[j] = w * f1[j] + (1.0-w) * fGap[j];
@@ -5114,8 +7403,8 @@ profile_t *PosteriorProfile(profile_t *p1, profile_t *p2,
 	}
       }
       if (f2 == NULL) {
-	f2 = &transmat->codeFreq[p2->codes[i]][0];
-	double w = p2->weights[i];
+	f2 = &transmat->codeFreq[code2][0];
+	double w = w2;
 	if (w > 0.0 && w < 1.0) {
 	  for (j = 0; j < 20; j++)
 	    f2mix[j] = w * f2[j] + (1.0-w) * fGap[j];
@@ -5186,30 +7475,196 @@ profile_t *PosteriorProfile(profile_t *p1, profile_t *p2,
 
   /* Reallocate out->vectors to be the right size */
   out->nVectors = iFreqOut;
-  if (out->nVectors == 0)
-    out->vectors = (numeric_t*)myfree(out->vectors, sizeof(numeric_t)*nCodes*nPos);
-  else
-    out->vectors = (numeric_t*)myrealloc(out->vectors,
-				     /*OLDSIZE*/sizeof(numeric_t)*nCodes*nPos,
-				     /*NEWSIZE*/sizeof(numeric_t)*nCodes*out->nVectors,
-				     /*copy*/true); /* try to save space */
+  if (out->nVectors == 0) {
+    out->vectors = (numeric_t*)SlabFree(out->vectors, sizeof(numeric_t)*nCodes*nPos);
+  } else if (out->nVectors < nPos) { /* try to save space */
+    numeric_t *vectors = (numeric_t*)SlabAlloc(sizeof(numeric_t)*nCodes*out->nVectors);
+    memcpy(/*to*/vectors, /*from*/out->vectors, sizeof(numeric_t)*nCodes*out->nVectors);
+    SlabFree(out->vectors, sizeof(numeric_t)*nCodes*nPos);
+    out->vectors = vectors;
+  }
   nProfileFreqAlloc += out->nVectors;
   nProfileFreqAvoid += nPos - out->nVectors;
 
   /* compute total constraints */
   for (i = 0; i < nConstraints; i++) {
-    out->nOn[i] = p1->nOn[i] + p2->nOn[i];
-    out->nOff[i] = p1->nOff[i] + p2->nOff[i];
+    out->nOn[i] = CONSTRAINT_ON(p1,i) + CONSTRAINT_ON(p2,i);
+    out->nOff[i] = CONSTRAINT_OFF(p1,i) + CONSTRAINT_OFF(p2,i);
   }
+  SetConstraintBits(/*IN/OUT*/out, nConstraints);
   nPosteriorCompute++;
   return(out);
 }
 
-double *PSameVector(double length, rates_t *rates) {
+/* The transition-probability cache -- see the comment at TransCacheInit's declaration */
+#define TCACHE_WAYS 4
+typedef enum {tcacheEmpty, tcachePSame, tcacheExpEigen} tcache_kind_t;
+
+typedef struct {
+  /* The rate set and eigenvalues that the entries were computed for */
+  int nRateCategories;
+  numeric_t *rates;
+  bool hasEigen;
+  numeric_t eigenval[MAXCODES];
+  /* The entries, in sets of TCACHE_WAYS */
+  int nEntries;
+  int nValues;			/* nCodes * nRateCategories */
+  double *lengths;
+  tcache_kind_t *kinds;
+  unsigned long *lastUsed;
+  double *values;		/* nValues per entry, unrounded */
+  unsigned long clock;
+  /* statistics */
+  long nLookup;
+  long nHit;
+  long nEvict;
+  long nFlush;
+} tcache_t;
+
+tcache_t *tcaches = NULL;
+int nTCaches = 0;
+
+void TransCacheInit(void) {
+  TransCacheFree();
+  if (tcacheSize <= 0)
+    return;
+#ifdef USE_OPENMP
+  nTCaches = MAX(maxThreads, omp_get_num_procs());
+#else
+  nTCaches = 1;
+#endif
+  tcaches = (tcache_t*)mymalloc(sizeof(tcache_t) * nTCaches);
+  memset(tcaches, 0, sizeof(tcache_t) * nTCaches);
+}
+
+void TransCacheFree(void) {
+  int i;
+  for (i = 0; i < nTCaches; i++) {
+    tcache_t *c = &tcaches[i];
+    myfree(c->rates, sizeof(numeric_t) * c->nRateCategories);
+    myfree(c->lengths, sizeof(double) * c->nEntries);
+    myfree(c->kinds, sizeof(tcache_kind_t) * c->nEntries);
+    myfree(c->lastUsed, sizeof(unsigned long) * c->nEntries);
+    myfree(c->values, sizeof(double) * c->nEntries * c->nValues);
+  }
+  tcaches = myfree(tcaches, sizeof(tcache_t) * nTCaches);
+  nTCaches = 0;
+}
+
+/* Returns the slot for this length and kind, and whether it already holds the values.
+   On a miss the caller must fill in the slot. Returns NULL if caching is off.
+*/
+double *TransCacheLookup(double length, tcache_kind_t kind,
+			 /*OPTIONAL*/transition_matrix_t *transmat, rates_t *rates,
+			 /*OUT*/bool *pHit) {
+  *pHit = false;
+  if (tcaches == NULL)
+    return(NULL);
+  int iCache = 0;
+#ifdef USE_OPENMP
+  iCache = omp_get_thread_num();
+#endif
+  assert(iCache < nTCaches);
+  tcache_t *c = &tcaches[iCache];
+  int i;
+
+  /* Flush if the rate set or the eigenvalues have changed */
+  bool same = c->nRateCategories == rates->nRateCategories
+    && c->hasEigen == (transmat != NULL);
+  for (i = 0; same && i < rates->nRateCategories; i++)
+    same = c->rates[i] == rates->rates[i];
+  for (i = 0; same && transmat != NULL && i < nCodes; i++)
+    same = c->eigenval[i] == transmat->eigenval[i];
+  if (!same) {
+    if (c->nRateCategories != rates->nRateCategories) {
+      myfree(c->rates, sizeof(numeric_t) * c->nRateCategories);
+      c->rates = (numeric_t*)mymalloc(sizeof(numeric_t) * rates->nRateCategories);
+    }
+    c->nRateCategories = rates->nRateCategories;
+    for (i = 0; i < rates->nRateCategories; i++)
+      c->rates[i] = rates->rates[i];
+    c->hasEigen = transmat != NULL;
+    for (i = 0; i < MAXCODES; i++)
+      c->eigenval[i] = transmat != NULL && i < nCodes ? transmat->eigenval[i] : 0;
+    int nValues = nCodes * rates->nRateCategories;
+    if (c->nEntries == 0 || nValues != c->nValues) {
+      myfree(c->values, sizeof(double) * c->nEntries * c->nValues);
+      if (c->nEntries == 0) {
+	c->nEntries = TCACHE_WAYS * ((tcacheSize + TCACHE_WAYS - 1) / TCACHE_WAYS);
+	c->lengths = (double*)mymalloc(sizeof(double) * c->nEntries);
+	c->kinds = (tcache_kind_t*)mymalloc(sizeof(tcache_kind_t) * c->nEntries);
+	c->lastUsed = (unsigned long*)mymalloc(sizeof(unsigned long) * c->nEntries);
+      }
+      c->nValues = nValues;
+      c->values = (double*)mymalloc(sizeof(double) * c->nEntries * c->nValues);
+    }
+    for (i = 0; i < c->nEntries; i++) {
+      c->kinds[i] = tcacheEmpty;
+      c->lastUsed[i] = 0;
+    }
+    c->nFlush++;
+  }
+
+  /* Pick the set from the bits of the length */
+  unsigned long long bits;
+  memcpy(&bits, &length, sizeof(bits));
+  bits ^= (unsigned long long)kind;
+  bits *= 0x9E3779B97F4A7C15ULL;
+  int nSets = c->nEntries / TCACHE_WAYS;
+  int first = (int)((bits >> 32) % (unsigned long long)nSets) * TCACHE_WAYS;
+
+  c->nLookup++;
+  c->clock++;
+  int iOldest = first;
+  for (i = first; i < first + TCACHE_WAYS; i++) {
+    if (c->kinds[i] == kind && c->lengths[i] == length) {
+      c->nHit++;
+      c->lastUsed[i] = c->clock;
+      *pHit = true;
+      return(&c->values[(size_t)i * c->nValues]);
+    }
+    if (c->lastUsed[i] < c->lastUsed[iOldest])
+      iOldest = i;
+  }
+  if (c->kinds[iOldest] != tcacheEmpty)
+    c->nEvict++;
+  c->kinds[iOldest] = kind;
+  c->lengths[iOldest] = length;
+  c->lastUsed[iOldest] = c->clock;
+  return(&c->values[(size_t)iOldest * c->nValues]);
+}
+
+void TransCacheReport(/*WRITE*/FILE *fp) {
+  if (tcaches == NULL)
+    return;
+  long nLookup = 0, nHit = 0, nEvict = 0, nFlush = 0;
+  int i;
+  for (i = 0; i < nTCaches; i++) {
+    nLookup += tcaches[i].nLookup;
+    nHit += tcaches[i].nHit;
+    nEvict += tcaches[i].nEvict;
+    nFlush += tcaches[i].nFlush;
+  }
+  if (nLookup > 0)
+    fprintf(fp, "Transition cache: lookups %ld hits %.2f%% evictions %ld flushes %ld\n",
+	    nLookup, 100.0*nHit/(double)nLookup, nEvict, nFlush);
+}
+
+double *PSameVector(double length, rates_t *rates) {
   double *pSame = mymalloc(sizeof(double) * rates->nRateCategories);
   int iRate;
+  bool bHit;
+  double *cached = TransCacheLookup(length, tcachePSame, /*transmat*/NULL, rates, /*OUT*/&bHit);
+  if (bHit) {
+    for (iRate = 0; iRate < rates->nRateCategories; iRate++)
+      pSame[iRate] = cached[iRate];
+    return(pSame);
+  }
   for (iRate = 0; iRate < rates->nRateCategories; iRate++)
     pSame[iRate] = 0.25 + 0.75 * exp((-4.0/3.0) * fabs(length*rates->rates[iRate]));
+  if (cached != NULL)
+    for (iRate = 0; iRate < rates->nRateCategories; iRate++)
+      cached[iRate] = pSame[iRate];
   return(pSame);
 }
 
@@ -5222,15 +7677,26 @@ double *PDiffVector(double *pSame, rates_t *rates) {
 }
 
 numeric_t *ExpEigenRates(double length, transition_matrix_t *transmat, rates_t *rates) {
+  PROF_SCOPE(PROF_EXPEIGENRATES);
   numeric_t *expeigen = mymalloc(sizeof(numeric_t) * nCodes * rates->nRateCategories);
   int iRate, j;
+  bool bHit;
+  double *cached = TransCacheLookup(length, tcacheExpEigen, transmat, rates, /*OUT*/&bHit);
+  if (bHit) {
+    for (j = 0; j < nCodes * rates->nRateCategories; j++)
+      expeigen[j] = cached[j];
+    return(expeigen);
+  }
   for (iRate = 0; iRate < rates->nRateCategories; iRate++) {
     for (j = 0; j < nCodes; j++) {
       double relLen = length * rates->rates[iRate];
       /* very short branch lengths lead to numerical problems so prevent them */
       if (relLen < MLMinRelBranchLength)
 	relLen  = MLMinRelBranchLength;
-      expeigen[iRate*nCodes + j] = exp(relLen * transmat->eigenval[j]);
+      double e = exp(relLen * transmat->eigenval[j]);
+      expeigen[iRate*nCodes + j] = e;
+      if (cached != NULL)
+	cached[iRate*nCodes + j] = e;
     }
   }
   return(expeigen);
@@ -5244,6 +7710,9 @@ double PairLogLk(profile_t *pA, profile_t *pB, double length, int nPos,
   double loglk = 0.0;		/* stores underflow of lk during the loop over positions */
   int i,j;
   assert(rates != NULL && rates->nRateCategories > 0);
+  site_reader_t rA, rB;
+  InitSiteReader(/*OUT*/&rA, pA);
+  InitSiteReader(/*OUT*/&rB, pB);
   numeric_t *expeigenRates = NULL;
   if (transmat != NULL)
     expeigenRates = ExpEigenRates(length, transmat, rates);
@@ -5257,12 +7726,12 @@ double PairLogLk(profile_t *pA, profile_t *pB, double length, int nPos,
     int iFreqB = 0;
     for (i = 0; i < nPos; i++) {
       int iRate = rates->ratecat[i];
-      double wA = pA->weights[i];
-      double wB = pB->weights[i];
-      int codeA = pA->codes[i];
-      int codeB = pB->codes[i];
-      numeric_t *fA = GET_FREQ(pA,i,/*IN/OUT*/iFreqA);
-      numeric_t *fB = GET_FREQ(pB,i,/*IN/OUT*/iFreqB);
+      int codeA, codeB;
+      double wA, wB;
+      ReadSite(&rA, i, /*OUT*/&codeA, /*OUT*/&wA);
+      ReadSite(&rB, i, /*OUT*/&codeB, /*OUT*/&wB);
+      numeric_t *fA = GET_SITE_FREQ(pA,codeA,wA,/*IN/OUT*/iFreqA);
+      numeric_t *fB = GET_SITE_FREQ(pB,codeB,wB,/*IN/OUT*/iFreqB);
       double lkAB = 0;
 
       if (fA == NULL && fB == NULL) {
@@ -5299,6 +7768,8 @@ double PairLogLk(profile_t *pA, profile_t *pB, double length, int nPos,
 	  lkAB += fB[j] * (fA[j] * pSame[iRate] + (1-fA[j])* pDiff[iRate]); /* P(A|B) */
       }
       assert(lkAB > 0);
+      if (patternCount != NULL && patternCount[i] > 1)
+	loglk += (patternCount[i]-1) * log(lkAB); /* the other columns with this pattern */
       lk *= lkAB;
       while (lk < LkUnderflow) {
 	lk *= LkUnderflowInv;
@@ -5316,26 +7787,31 @@ double PairLogLk(profile_t *pA, profile_t *pB, double length, int nPos,
     numeric_t *fGap = &transmat->codeFreq[NOCODE][0];
 
     for (i = 0; i < nPos; i++) {
+      /* Likelihood of A vs B is 1 where both are gaps, so nothing changes */
+      if ((i = NextSharedSite(&rA, &rB, i, nPos)) == nPos)
+	break;
       int iRate = rates->ratecat[i];
       numeric_t *expeigen = &expeigenRates[iRate*4];
-      double wA = pA->weights[i];
-      double wB = pB->weights[i];
-      if (wA == 0 && wB == 0 && pA->codes[i] == NOCODE && pB->codes[i] == NOCODE) {
+      int codeA, codeB;
+      double wA, wB;
+      ReadSite(&rA, i, /*OUT*/&codeA, /*OUT*/&wA);
+      ReadSite(&rB, i, /*OUT*/&codeB, /*OUT*/&wB);
+      if (wA == 0 && wB == 0 && codeA == NOCODE && codeB == NOCODE) {
 	/* Likelihood of A vs B is 1, so nothing changes
 	   Do not need to advance iFreqA or iFreqB */
 	continue;
       }
-      numeric_t *fA = GET_FREQ(pA,i,/*IN/OUT*/iFreqA);
-      numeric_t *fB = GET_FREQ(pB,i,/*IN/OUT*/iFreqB);
+      numeric_t *fA = GET_SITE_FREQ(pA,codeA,wA,/*IN/OUT*/iFreqA);
+      numeric_t *fB = GET_SITE_FREQ(pB,codeB,wB,/*IN/OUT*/iFreqB);
       if (fA == NULL)
-	fA = &transmat->codeFreq[pA->codes[i]][0];
+	fA = &transmat->codeFreq[codeA][0];
       if (wA > 0.0 && wA < 1.0) {
 	for (j  = 0; j < 4; j++)
 	  fAmix[j] = wA*fA[j] + (1.0-wA)*fGap[j];
 	fA = fAmix;
       }
       if (fB == NULL)
-	fB = &transmat->codeFreq[pB->codes[i]][0];
+	fB = &transmat->codeFreq[codeB][0];
       if (wB > 0.0 && wB < 1.0) {
 	for (j  = 0; j < 4; j++)
 	  fBmix[j] = wB*fB[j] + (1.0-wB)*fGap[j];
@@ -5350,6 +7826,8 @@ double PairLogLk(profile_t *pA, profile_t *pB, double length, int nPos,
       assert(lkAB > 0);
       if (site_likelihoods != NULL)
 	site_likelihoods[i] *= lkAB;
+      if (patternCount != NULL && patternCount[i] > 1)
+	loglk += (patternCount[i]-1) * log(lkAB); /* the other columns with this pattern */
       lk *= lkAB;
       while (lk < LkUnderflow) {
 	lk *= LkUnderflowInv;
@@ -5367,26 +7845,31 @@ double PairLogLk(profile_t *pA, profile_t *pB, double length, int nPos,
     numeric_t *fGap = &transmat->codeFreq[NOCODE][0];
 
     for (i = 0; i < nPos; i++) {
+      /* Likelihood of A vs B is 1 where both are gaps, so nothing changes */
+      if ((i = NextSharedSite(&rA, &rB, i, nPos)) == nPos)
+	break;
       int iRate = rates->ratecat[i];
       numeric_t *expeigen = &expeigenRates[iRate*20];
-      double wA = pA->weights[i];
-      double wB = pB->weights[i];
-      if (wA == 0 && wB == 0 && pA->codes[i] == NOCODE && pB->codes[i] == NOCODE) {
+      int codeA, codeB;
+      double wA, wB;
+      ReadSite(&rA, i, /*OUT*/&codeA, /*OUT*/&wA);
+      ReadSite(&rB, i, /*OUT*/&codeB, /*OUT*/&wB);
+      if (wA == 0 && wB == 0 && codeA == NOCODE && codeB == NOCODE) {
 	/* Likelihood of A vs B is 1, so nothing changes
 	   Do not need to advance iFreqA or iFreqB */
 	continue;
       }
-      numeric_t *fA = GET_FREQ(pA,i,/*IN/OUT*/iFreqA);
-      numeric_t *fB = GET_FREQ(pB,i,/*IN/OUT*/iFreqB);
+      numeric_t *fA = GET_SITE_FREQ(pA,codeA,wA,/*IN/OUT*/iFreqA);
+      numeric_t *fB = GET_SITE_FREQ(pB,codeB,wB,/*IN/OUT*/iFreqB);
       if (fA == NULL)
-	fA = &transmat->codeFreq[pA->codes[i]][0];
+	fA = &transmat->codeFreq[codeA][0];
       if (wA > 0.0 && wA < 1.0) {
 	for (j  = 0; j < 20; j++)
 	  fAmix[j] = wA*fA[j] + (1.0-wA)*fGap[j];
 	fA = fAmix;
       }
       if (fB == NULL)
-	fB = &transmat->codeFreq[pB->codes[i]][0];
+	fB = &transmat->codeFreq[codeB][0];
       if (wB > 0.0 && wB < 1.0) {
 	for (j  = 0; j < 20; j++)
 	  fBmix[j] = wB*fB[j] + (1.0-wB)*fGap[j];
@@ -5403,7 +7886,7 @@ double PairLogLk(profile_t *pA, profile_t *pB, double length, int nPos,
 	fprintf(stderr, "Branch_length= %.8g\nalignment_position=%d\nnCodes=%d\nrate_category=%d\nrate=%.8g\n",
 		length, i, nCodes, iRate, rates->rates[iRate]);
 	fprintf(stderr, "wA=%.8g\nwB=%.8g\n", wA, wB);
-	fprintf(stderr, "codeA = %d\ncodeB = %d\n", pA->codes[i], pB->codes[i]);
+	fprintf(stderr, "codeA = %d\ncodeB = %d\n", codeA, codeB);
 
 	fprintf(stderr, "fA = c(");
 	for (j = 0; j < nCodes; j++) fprintf(stderr, "%s %.8g", j==0?"":",", fA[j]);
@@ -5446,6 +7929,8 @@ double PairLogLk(profile_t *pA, profile_t *pB, double length, int nPos,
       assert(lkAB > 0);
       if (site_likelihoods != NULL)
 	site_likelihoods[i] *= lkAB;
+      if (patternCount != NULL && patternCount[i] > 1)
+	loglk += (patternCount[i]-1) * log(lkAB); /* the other columns with this pattern */
       lk *= lkAB;
       while (lk < LkUnderflow) {
 	lk *= LkUnderflowInv;
@@ -5470,6 +7955,7 @@ double MLQuartetLogLk(profile_t *pA, profile_t *pB, profile_t *pC, profile_t *pD
 		      int nPos, /*OPTIONAL*/transition_matrix_t *transmat, rates_t *rates,
 		      /*IN*/double branch_lengths[5],
 		      /*OPTIONAL OUT*/double *site_likelihoods) {
+  PROF_SCOPE(PROF_MLQUARTETLOGLK);
   profile_t *pAB = PosteriorProfile(pA, pB,
 				    branch_lengths[0], branch_lengths[1],
 				    transmat,
@@ -5691,7 +8177,7 @@ nni_t MLQuartetNNI(profile_t *profiles[4],
     bool bStarTest = false;
     {
 #ifdef USE_OPENMP
-      #pragma omp parallel
+      #pragma omp parallel num_threads(PHASE_THREADS(PHASE_ML))
       #pragma omp sections
 #endif
       {
@@ -5796,14 +8282,19 @@ double TreeLength(/*IN/OUT*/NJ_t *NJ, bool recomputeProfiles) {
 }
 
 double TreeLogLk(/*IN*/NJ_t *NJ, /*OPTIONAL OUT*/double *site_loglk) {
+  return(TreeLogLkProfiles(NJ, NJ->profiles, &NJ->rates, NJ->nPos, /*recompute*/false, site_loglk));
+}
+
+double TreeLogLkProfiles(/*IN*/NJ_t *NJ, /*IN/OUT*/profile_t **profiles, rates_t *rates, int nPos,
+			 bool recompute, /*OPTIONAL OUT*/double *site_loglk) {
   int i;
   if (NJ->nSeq < 2)
     return(0.0);
   double loglk = 0.0;
   double *site_likelihood = NULL;
   if (site_loglk != NULL) {
-    site_likelihood = mymalloc(sizeof(double)*NJ->nPos);
-    for (i = 0; i < NJ->nPos; i++) {
+    site_likelihood = mymalloc(sizeof(double)*nPos);
+    for (i = 0; i < nPos; i++) {
       site_likelihood[i] = 1.0;
       site_loglk[i] = 0.0;
     }
@@ -5816,13 +8307,13 @@ double TreeLogLk(/*IN*/NJ_t *NJ, /*OPTIONAL OUT*/double *site_loglk) {
       continue;
     assert(nChild >= 2);
     int *children = NJ->child[node].child;
-    double loglkchild = PairLogLk(NJ->profiles[children[0]], NJ->profiles[children[1]],
+    double loglkchild = PairLogLk(profiles[children[0]], profiles[children[1]],
 				  NJ->branchlength[children[0]]+NJ->branchlength[children[1]],
-				  NJ->nPos, NJ->transmat, &NJ->rates, /*IN/OUT*/site_likelihood);
+				  nPos, NJ->transmat, rates, /*IN/OUT*/site_likelihood);
     loglk += loglkchild;
     if (site_likelihood != NULL) {
       /* prevent underflows */
-      for (i = 0; i < NJ->nPos; i++) {
+      for (i = 0; i < nPos; i++) {
 	while(site_likelihood[i] < LkUnderflow) {
 	  site_likelihood[i] *= LkUnderflowInv;
 	  site_loglk[i] -= LogLkUnderflow;
@@ -5838,15 +8329,15 @@ double TreeLogLk(/*IN*/NJ_t *NJ, /*OPTIONAL OUT*/double *site_loglk) {
     if (NJ->child[node].nChild == 3) {
       assert(node == NJ->root);
       /* Infer the common parent of the 1st two to define the third... */
-      profile_t *pAB = PosteriorProfile(NJ->profiles[children[0]],
-					NJ->profiles[children[1]],
+      profile_t *pAB = PosteriorProfile(profiles[children[0]],
+					profiles[children[1]],
 					NJ->branchlength[children[0]],
 					NJ->branchlength[children[1]],
-					NJ->transmat, &NJ->rates,
-					NJ->nPos, /*nConstraints*/0);
-      double loglkup = PairLogLk(pAB, NJ->profiles[children[2]],
+					NJ->transmat, rates,
+					nPos, /*nConstraints*/0);
+      double loglkup = PairLogLk(pAB, profiles[children[2]],
 				 NJ->branchlength[children[2]],
-				 NJ->nPos, NJ->transmat, &NJ->rates,
+				 nPos, NJ->transmat, rates,
 				 /*IN/OUT*/site_likelihood);
       loglk += loglkup;
       if (verbose > 2)
@@ -5854,15 +8345,27 @@ double TreeLogLk(/*IN*/NJ_t *NJ, /*OPTIONAL OUT*/double *site_loglk) {
 		node, children[0], children[1], children[2],
 		NJ->branchlength[children[2]],
 		loglkup);
-      pAB = FreeProfile(pAB, NJ->nPos, NJ->nConstraints);
+      pAB = FreeProfile(pAB, nPos, NJ->nConstraints);
+    }
+    if (recompute) {
+      if (nChild == 2)
+	profiles[node] = PosteriorProfile(profiles[children[0]], profiles[children[1]],
+					  NJ->branchlength[children[0]], NJ->branchlength[children[1]],
+					  NJ->transmat, rates, nPos, NJ->nConstraints);
+      /* the children's profiles are no longer needed */
+      for (i = 0; i < nChild; i++)
+	if (children[i] >= NJ->nSeq)
+	  profiles[children[i]] = FreeProfile(profiles[children[i]], nPos, NJ->nConstraints);
     }
   }
   traversal = FreeTraversal(traversal,NJ);
+  if (recompute && profiles[NJ->root] != NULL && NJ->root >= NJ->nSeq)
+    profiles[NJ->root] = FreeProfile(profiles[NJ->root], nPos, NJ->nConstraints);
   if (site_likelihood != NULL) {
-    for (i = 0; i < NJ->nPos; i++) {
+    for (i = 0; i < nPos; i++) {
       site_loglk[i] += log(site_likelihood[i]);
     }
-    site_likelihood = myfree(site_likelihood, sizeof(double)*NJ->nPos);
+    site_likelihood = myfree(site_likelihood, sizeof(double)*nPos);
   }
 
   /* For Jukes-Cantor, with a tree of size 4, if the children of the root are
@@ -5887,21 +8390,29 @@ double TreeLogLk(/*IN*/NJ_t *NJ, /*OPTIONAL OUT*/double *site_loglk) {
   if (nCodes == 4 && NJ->transmat == NULL) {
     int nGaps = 0;
     double logNCodes = log((double)nCodes);
-    for (i = 0; i < NJ->nPos; i++) {
-      int nGapsThisPos = 0;
-      for (node = 0; node < NJ->nSeq; node++) {
-	unsigned char *codes = NJ->profiles[node]->codes;
+    /* count the gaps leaf by leaf, as packed leaves are not indexed by position */
+    int *nGapsAt = (int*)mymalloc(sizeof(int)*nPos);
+    unsigned char *codes = (unsigned char*)mymalloc(sizeof(unsigned char)*nPos);
+    for (i = 0; i < nPos; i++)
+      nGapsAt[i] = 0;
+    for (node = 0; node < NJ->nSeq; node++) {
+      LeafCodes(profiles[node], nPos, /*OUT*/codes);
+      for (i = 0; i < nPos; i++)
 	if (codes[i] == NOCODE)
-	  nGapsThisPos++;
-      }
-      nGaps += nGapsThisPos;
+	  nGapsAt[i]++;
+    }
+    codes = myfree(codes, sizeof(unsigned char)*nPos);
+    for (i = 0; i < nPos; i++) {
+      int nGapsThisPos = nGapsAt[i];
+      nGaps += PATTERN_COUNT(i) * nGapsThisPos;
       if (site_loglk != NULL) {
 	site_loglk[i] += nGapsThisPos * logNCodes;
 	if (nCodes == 4 && NJ->transmat == NULL)
 	  site_loglk[i] -= logNCodes;
       }
     }
-    loglk -= NJ->nPos * logNCodes;
+    nGapsAt = myfree(nGapsAt, sizeof(int)*nPos);
+    loglk -= SITES(nPos) * logNCodes;
     loglk += nGaps * logNCodes;	/* do not pay for gaps -- only Jukes-Cantor */
   }
   return(loglk);
@@ -5920,13 +8431,15 @@ void SetMLGtr(/*IN/OUT*/NJ_t *NJ, /*OPTIONAL IN*/double *freq_in, /*OPTIONAL WRI
     /* n[] and sum were int in FastTree 2.1.9 and earlier -- this
        caused gtr analyses to fail on analyses with >2e9 positions */
     long n[4] = {1,1,1,1};	/* pseudocounts */
+    unsigned char *codes = (unsigned char*)mymalloc(sizeof(unsigned char)*NJ->nPos);
     for (i=0; i<NJ->nSeq; i++) {
-      unsigned char *codes = NJ->profiles[i]->codes;
+      LeafCodes(NJ->profiles[i], NJ->nPos, /*OUT*/codes);
       int iPos;
       for (iPos=0; iPos<NJ->nPos; iPos++)
 	if (codes[iPos] < 4)
-	  n[codes[iPos]]++;
+	  n[codes[iPos]] += PATTERN_COUNT(iPos);
     }
+    codes = myfree(codes, sizeof(unsigned char)*NJ->nPos);
     long sum = n[0]+n[1]+n[2]+n[3];
     for (i=0; i<4; i++)
       gtr.freq[i] = n[i]/(double)sum;
@@ -6021,23 +8534,84 @@ numeric_t *MLSiteRates(int nRateCategories) {
 
 double *MLSiteLikelihoodsByRate(/*IN*/NJ_t *NJ, /*IN*/numeric_t *rates, int nRateCategories) {
   double *site_loglk = mymalloc(sizeof(double)*NJ->nPos*nRateCategories);
-
-  /* save the original rates */
   assert(NJ->rates.nRateCategories > 0);
-  numeric_t *oldRates = NJ->rates.rates;
-  NJ->rates.rates = mymalloc(sizeof(numeric_t) * NJ->rates.nRateCategories);
 
-  /* Compute site likelihood for each rate */
+  /* Aim for 4 tasks per thread, so that the tasks balance out */
+  int nBlocks = 1;
+#ifdef USE_OPENMP
+  int nThreads = PHASE_THREADS(PHASE_ML);
+  if (nThreads > 1)
+    nBlocks = MAX(1, MIN((4*nThreads + nRateCategories - 1) / nRateCategories,
+			 NJ->nPos / ML_SITE_BLOCK));
+#endif
+  int nTasks = nRateCategories * nBlocks;
+  int *blockStart = mymalloc(sizeof(int) * (nBlocks+1));
+  int iBlock;
+  for (iBlock = 0; iBlock <= nBlocks; iBlock++)
+    blockStart[iBlock] = (int)((NJ->nPos * (int64_t)iBlock) / nBlocks);
+
+  /* Each block has its own copy of the leaves; with one block, use NJ's */
+  profile_t **leaves = NJ->profiles;
+  int i;
+  if (nBlocks > 1) {
+    leaves = mymalloc(sizeof(profile_t*) * nBlocks * NJ->nSeq);
+#ifdef USE_OPENMP
+    #pragma omp parallel for schedule(static) num_threads(PHASE_THREADS(PHASE_ML))
+#endif
+    for (i = 0; i < nBlocks * NJ->nSeq; i++) {
+      int b = i / NJ->nSeq;
+      leaves[i] = LeafSlice(NJ->profiles[i % NJ->nSeq], blockStart[b],
+			    blockStart[b+1] - blockStart[b], NJ->nConstraints);
+    }
+  }
+
+  /* Compute site likelihood for each rate. Each task uses its own copy of
+     the rates and of the internal profiles, so NJ is not modified */
   int iPos;
   int iRate;
-  for (iRate = 0; iRate  < nRateCategories; iRate++) {
-    int i;
-    for (i = 0; i < NJ->rates.nRateCategories; i++)
-      NJ->rates.rates[i] = rates[iRate];
-    RecomputeMLProfiles(/*IN/OUT*/NJ);
-    double loglk = TreeLogLk(NJ, /*OUT*/&site_loglk[NJ->nPos*iRate]);
-    ProgressReport("Site likelihoods with rate category %d of %d", iRate+1, nRateCategories, 0, 0);
-    if(verbose > 2) {
+  int iTask;
+#ifdef USE_OPENMP
+  #pragma omp parallel for schedule(dynamic, 1) num_threads(PHASE_THREADS(PHASE_ML))
+#endif
+  for (iTask = 0; iTask < nTasks; iTask++) {
+    int iRateTask = iTask / nBlocks;
+    int iBlockTask = iTask % nBlocks;
+    int iStart = blockStart[iBlockTask];
+    int iEnd = blockStart[iBlockTask+1];
+    rates_t rateSet = { NJ->rates.nRateCategories, NULL, NJ->rates.ratecat + iStart };
+    rateSet.rates = mymalloc(sizeof(numeric_t) * rateSet.nRateCategories);
+    int j;
+    for (j = 0; j < rateSet.nRateCategories; j++)
+      rateSet.rates[j] = rates[iRateTask];
+    profile_t **profiles = mymalloc(sizeof(profile_t*) * NJ->maxnodes);
+    for (j = 0; j < NJ->maxnodes; j++)
+      profiles[j] = j < NJ->nSeq ? leaves[iBlockTask * NJ->nSeq + j] : NULL;
+    TreeLogLkProfiles(NJ, /*IN/OUT*/profiles, &rateSet, iEnd-iStart, /*recompute*/true,
+		      /*OUT*/&site_loglk[NJ->nPos*iRateTask + iStart]);
+    profiles = myfree(profiles, sizeof(profile_t*) * NJ->maxnodes);
+    rateSet.rates = myfree(rateSet.rates, sizeof(numeric_t) * rateSet.nRateCategories);
+    int iThread = 0;
+#ifdef USE_OPENMP
+    iThread = omp_get_thread_num();
+#endif
+    if (iThread == 0)		/* only the main thread reports progress */
+      ProgressReport("Site likelihoods with rate category %d of %d", iRateTask+1, nRateCategories, 0, 0);
+  }
+
+  if (nBlocks > 1) {
+    for (i = 0; i < nBlocks * NJ->nSeq; i++) {
+      int b = i / NJ->nSeq;
+      leaves[i] = FreeProfile(leaves[i], blockStart[b+1] - blockStart[b], NJ->nConstraints);
+    }
+    leaves = myfree(leaves, sizeof(profile_t*) * nBlocks * NJ->nSeq);
+  }
+  blockStart = myfree(blockStart, sizeof(int) * (nBlocks+1));
+
+  if(verbose > 2) {
+    for (iRate = 0; iRate  < nRateCategories; iRate++) {
+      double loglk = 0;
+      for (iPos = 0; iPos < NJ->nPos; iPos++)
+	loglk += PATTERN_COUNT(iPos) * site_loglk[NJ->nPos*iRate + iPos];
       fprintf(stderr, "Rate %.3f Loglk %.3f SiteLogLk", rates[iRate], loglk);
       for (iPos = 0; iPos < NJ->nPos; iPos++)
 	fprintf(stderr,"\t%.3f", site_loglk[NJ->nPos*iRate + iPos]);
@@ -6045,9 +8619,7 @@ double *MLSiteLikelihoodsByRate(/*IN*/NJ_t *NJ, /*IN*/numeric_t *rates, int nRat
     }
   }
 
-  /* restore original rates and profiles */
-  myfree(NJ->rates.rates, sizeof(numeric_t) * NJ->rates.nRateCategories);
-  NJ->rates.rates = oldRates;
+  /* leave the profiles up to date with NJ->rates, as before */
   RecomputeMLProfiles(/*IN/OUT*/NJ);
 
   return(site_loglk);
@@ -6086,12 +8658,12 @@ void SetMLRates(/*IN/OUT*/NJ_t *NJ, int nRateCategories) {
       fprintf(stderr, "Selected rate category %d rate %.3f for position %d\n",
 	      iBest, rates[iBest], iPos+1);
     NJ->rates.ratecat[iPos] = iBest;
-    sumRates += rates[iBest];
+    sumRates += PATTERN_COUNT(iPos) * rates[iBest];
   }
   site_loglk = myfree(site_loglk, sizeof(double)*NJ->nPos*nRateCategories);
 
   /* Force the rates to average to 1 */
-  double avgRate = sumRates/NJ->nPos;
+  double avgRate = sumRates/SITES(NJ->nPos);
   for (iRate = 0; iRate < nRateCategories; iRate++)
     rates[iRate] /= avgRate;
 
@@ -6125,8 +8697,13 @@ double GammaLogLk(/*IN*/siteratelk_t *s, /*OPTIONAL OUT*/double *gamma_loglk_sit
     dRate[iRate] = pMax-pMin;
   }
 
-  double loglk = 0.0;
+  double *loglk_sites = gamma_loglk_sites != NULL ? gamma_loglk_sites
+    : (double*)mymalloc(sizeof(double) * s->nPos);
+#ifdef USE_OPENMP
+  #pragma omp parallel for schedule(static) num_threads(PHASE_THREADS(PHASE_ML))
+#endif
   for (iPos = 0; iPos < s->nPos; iPos++) {
+    int iRate;
     /* Prevent underflow on large trees by comparing to maximum loglk */
     double maxloglk = -1e20;
     for (iRate = 0; iRate < s->nRateCats; iRate++) {
@@ -6139,11 +8716,14 @@ double GammaLogLk(/*IN*/siteratelk_t *s, /*OPTIONAL OUT*/double *gamma_loglk_sit
       double lk = exp(s->site_loglk[s->nPos*iRate + iPos] - maxloglk);
       rellk += lk * dRate[iRate];
     }
-    double loglk_site = maxloglk + log(rellk);
-    loglk += loglk_site;
-    if (gamma_loglk_sites != NULL)
-      gamma_loglk_sites[iPos] = loglk_site;
+    loglk_sites[iPos] = maxloglk + log(rellk);
   }
+  /* Add up the sites in order, so the total does not depend on the number of threads */
+  double loglk = 0.0;
+  for (iPos = 0; iPos < s->nPos; iPos++)
+    loglk += PATTERN_COUNT(iPos) * loglk_sites[iPos];
+  if (gamma_loglk_sites == NULL)
+    loglk_sites = myfree(loglk_sites, sizeof(double) * s->nPos);
   dRate = myfree(dRate, sizeof(double)*s->nRateCats);
   return(loglk);
 }
@@ -6162,7 +8742,7 @@ double OptMult(double mult, void *data) {
 
 /* Input site_loglk must be for each rate */
 double RescaleGammaLogLk(int nPos, int nRateCats, /*IN*/numeric_t *rates, /*IN*/double *site_loglk,
-			 /*OPTIONAL*/FILE *fpLog) {
+			 /*OPTIONAL*/FILE *fpLog, /*OPTIONAL OUT*/double *gamma_site_loglk) {
   siteratelk_t s = { /*mult*/1.0, /*alpha*/1.0, nPos, nRateCats, rates, site_loglk };
   double fx, f2x;
   int i;
@@ -6199,13 +8779,16 @@ double RescaleGammaLogLk(int nPos, int nRateCats, /*IN*/numeric_t *rates, /*IN*/
     for (iRate = 0; iRate < nRateCats; iRate++)
       fprintf(fpLog, "\tr=%.3f", rates[iRate]/s.mult);
     fprintf(fpLog,"\n");
-    for (iPos = 0; iPos < nPos; iPos++) {
-      fprintf(fpLog, "Gamma%d\t%d\t%.3f", nRateCats, iPos, gamma_loglk_sites[iPos]);
+    for (iPos = 0; iPos < SITES(nPos); iPos++) {
+      int iPattern = SITE_PATTERN(iPos);
+      fprintf(fpLog, "Gamma%d\t%d\t%.3f", nRateCats, iPos, gamma_loglk_sites[iPattern]);
       for (iRate = 0; iRate < nRateCats; iRate++)
-	fprintf(fpLog, "\t%.3f", site_loglk[nPos*iRate + iPos]);
+	fprintf(fpLog, "\t%.3f", site_loglk[nPos*iRate + iPattern]);
       fprintf(fpLog,"\n");
     }
   }
+  if (gamma_site_loglk != NULL)
+    memcpy(gamma_site_loglk, gamma_loglk_sites, sizeof(double) * nPos);
   gamma_loglk_sites = myfree(gamma_loglk_sites, sizeof(double) * nPos);
   return(1.0/s.mult);
 }
@@ -6213,6 +8796,7 @@ double RescaleGammaLogLk(int nPos, int nRateCats, /*IN*/numeric_t *rates, /*IN*/
 double MLPairOptimize(profile_t *pA, profile_t *pB,
 		      int nPos, /*OPTIONAL*/transition_matrix_t *transmat, rates_t *rates,
 		      /*IN/OUT*/double *branch_length) {
+  PROF_SCOPE(PROF_MLPAIROPTIMIZE);
   quartet_opt_t qopt = { nPos, transmat, rates,
 			 /*nEval*/0, /*pair1*/pA, /*pair2*/pB };
   double f2x,negloglk;
@@ -6243,6 +8827,11 @@ void OptimizeAllBranchLengths(/*IN/OUT*/NJ_t *NJ) {
     return;
   };
 
+  if (batchedMLLengths) {
+    OptimizeAllBranchLengthsBatched(/*IN/OUT*/NJ);
+    return;
+  }
+
   traversal_t traversal = InitTraversal(NJ);
   profile_t **upProfiles = UpProfiles(NJ);
   int node = NJ->root;
@@ -6254,39 +8843,9 @@ void OptimizeAllBranchLengths(/*IN/OUT*/NJ_t *NJ) {
 	ProgressReport("ML Lengths %d of %d splits", iDone+1, NJ->maxnode - NJ->nSeq, 0, 0);
       iDone++;
 
-      /* optimize the branch lengths between self, parent, and children,
-         with two iterations
-      */
-      assert(nChild == 2 || nChild == 3);
-      int nodes[3] = { NJ->child[node].child[0],
-		       NJ->child[node].child[1],
-		       nChild == 3 ? NJ->child[node].child[2] : node };
-      profile_t *profiles[3] = { NJ->profiles[nodes[0]],
-			   NJ->profiles[nodes[1]],
-			   nChild == 3 ? NJ->profiles[nodes[2]]
-			   : GetUpProfile(/*IN/OUT*/upProfiles, NJ, node, /*useML*/true) };
-      int iter;
-      for (iter = 0; iter < 2; iter++) {
-	int i;
-	for (i = 0; i < 3; i++) {
-	  profile_t *pA = profiles[i];
-	  int b1 = (i+1) % 3;
-	  int b2 = (i+2) % 3;
-	  profile_t *pB = PosteriorProfile(profiles[b1], profiles[b2],
-					   NJ->branchlength[nodes[b1]],
-					   NJ->branchlength[nodes[b2]],
-					   NJ->transmat, &NJ->rates, NJ->nPos, /*nConstraints*/0);
-	  double len = NJ->branchlength[nodes[i]];
-	  if (len < MLMinBranchLength)
-	    len = MLMinBranchLength;
-	  (void)MLPairOptimize(pA, pB, NJ->nPos, NJ->transmat, &NJ->rates, /*IN/OUT*/&len);
-	  NJ->branchlength[nodes[i]] = len;
-	  pB = FreeProfile(pB, NJ->nPos, /*nConstraints*/0);
-	  if (verbose>3)
-	    fprintf(stderr, "Optimize length for %d to %.3f\n",
-		    nodes[i], NJ->branchlength[nodes[i]]);
-	}
-      }
+      OptimizeNodeBranchLengths(/*IN/OUT*/NJ, node,
+				nChild == 3 ? NULL
+				: GetUpProfile(/*IN/OUT*/upProfiles, NJ, node, /*useML*/true));
       if (node != NJ->root) {
 	RecomputeProfile(/*IN/OUT*/NJ, /*IN/OUT*/upProfiles, node, /*useML*/true);
 	DeleteUpProfile(upProfiles, NJ, node);
@@ -6297,6 +8856,209 @@ void OptimizeAllBranchLengths(/*IN/OUT*/NJ_t *NJ) {
   upProfiles = FreeUpProfiles(upProfiles,NJ);
 }
 
+void OptimizeNodeBranchLengths(/*IN/OUT*/NJ_t *NJ, int node, /*OPTIONAL*/profile_t *upProfile) {
+  /* optimize the branch lengths between self, parent, and children,
+     with two iterations
+  */
+  int nChild = NJ->child[node].nChild;
+  assert(nChild == 2 || nChild == 3);
+  assert(nChild == 3 || upProfile != NULL);
+  int nodes[3] = { NJ->child[node].child[0],
+		   NJ->child[node].child[1],
+		   nChild == 3 ? NJ->child[node].child[2] : node };
+  profile_t *profiles[3] = { NJ->profiles[nodes[0]],
+			     NJ->profiles[nodes[1]],
+			     nChild == 3 ? NJ->profiles[nodes[2]] : upProfile };
+  int iter;
+  for (iter = 0; iter < 2; iter++) {
+    int i;
+    for (i = 0; i < 3; i++) {
+      profile_t *pA = profiles[i];
+      int b1 = (i+1) % 3;
+      int b2 = (i+2) % 3;
+      profile_t *pB = PosteriorProfile(profiles[b1], profiles[b2],
+				       NJ->branchlength[nodes[b1]],
+				       NJ->branchlength[nodes[b2]],
+				       NJ->transmat, &NJ->rates, NJ->nPos, /*nConstraints*/0);
+      double len = NJ->branchlength[nodes[i]];
+      if (len < MLMinBranchLength)
+	len = MLMinBranchLength;
+      (void)MLPairOptimize(pA, pB, NJ->nPos, NJ->transmat, &NJ->rates, /*IN/OUT*/&len);
+      NJ->branchlength[nodes[i]] = len;
+      pB = FreeProfile(pB, NJ->nPos, /*nConstraints*/0);
+      if (verbose>3)
+	fprintf(stderr, "Optimize length for %d to %.3f\n",
+		nodes[i], NJ->branchlength[nodes[i]]);
+    }
+  }
+}
+
+void OptimizeAllBranchLengthsBatched(/*IN/OUT*/NJ_t *NJ) {
+  int i, k;
+
+  /* List the internal nodes in postorder, and then sort them (stably) by height */
+  int *height = (int*)mymalloc(sizeof(int)*NJ->maxnodes);
+  int *order = (int*)mymalloc(sizeof(int)*NJ->maxnodes);
+  int nInternal = 0;
+  int maxHeight = 0;
+  traversal_t traversal = InitTraversal(NJ);
+  int node = NJ->root;
+  while((node = TraversePostorder(node, NJ, /*IN/OUT*/traversal, /*pUp*/NULL)) >= 0) {
+    height[node] = 0;
+    for (i = 0; i < NJ->child[node].nChild; i++)
+      height[node] = MAX(height[node], height[NJ->child[node].child[i]]+1);
+    if (NJ->child[node].nChild > 0) {
+      order[nInternal++] = node;
+      maxHeight = MAX(maxHeight, height[node]);
+    }
+  }
+  traversal = FreeTraversal(traversal,NJ);
+  int *postorder = (int*)mymalloc(sizeof(int)*nInternal);
+  for (k = 0; k < nInternal; k++)
+    postorder[k] = order[k];
+  int *first = (int*)mymalloc(sizeof(int)*(maxHeight+2)); /* first index in order[] for each height */
+  for (i = 0; i <= maxHeight+1; i++)
+    first[i] = 0;
+  for (k = 0; k < nInternal; k++)
+    first[height[postorder[k]]+1]++;
+  for (i = 1; i <= maxHeight+1; i++)
+    first[i] += first[i-1];
+  for (k = 0; k < nInternal; k++)
+    order[first[height[postorder[k]]]++] = postorder[k];
+  postorder = myfree(postorder, sizeof(int)*nInternal);
+  first = myfree(first, sizeof(int)*(maxHeight+2));
+
+  /* changedAt[node] is the last batch that changed node's length or profile (or 0),
+     and each thread's upStamp[node] is the batch that computed its cached up-profile */
+  int *changedAt = (int*)mymalloc(sizeof(int)*NJ->maxnodes);
+  for (i = 0; i < NJ->maxnodes; i++)
+    changedAt[i] = 0;
+  int nThreads = maxThreads;
+  profile_t ***upProfiles = (profile_t***)mymalloc(sizeof(profile_t**)*nThreads);
+  int **upStamp = (int**)mymalloc(sizeof(int*)*nThreads);
+  int **pathMark = (int**)mymalloc(sizeof(int*)*nThreads);
+  int *lastNode = (int*)mymalloc(sizeof(int)*nThreads);
+  int iThread;
+  for (iThread = 0; iThread < nThreads; iThread++) {
+    upProfiles[iThread] = UpProfiles(NJ);
+    upStamp[iThread] = (int*)mymalloc(sizeof(int)*NJ->maxnodes);
+    pathMark[iThread] = (int*)mymalloc(sizeof(int)*NJ->maxnodes);
+    for (i = 0; i < NJ->maxnodes; i++)
+      pathMark[iThread][i] = 0;
+    lastNode[iThread] = -1;
+  }
+  profile_t **batchUp = (profile_t**)mymalloc(sizeof(profile_t*)*ML_LENGTH_BATCH);
+  int *batchThread = (int*)mymalloc(sizeof(int)*ML_LENGTH_BATCH);
+
+  int iBatch = 0;
+  int iStart, iEnd;
+  for (iStart = 0; iStart < nInternal; iStart = iEnd) {
+    iBatch++;
+    for (iEnd = iStart+1; iEnd < nInternal && iEnd-iStart < ML_LENGTH_BATCH; iEnd++)
+      if (height[order[iEnd]] != height[order[iStart]])
+	break;
+    int nBatch = iEnd-iStart;
+    ProgressReport("ML Lengths %d of %d splits", iStart+1, nInternal, 0, 0);
+
+    /* Get the up-profiles for the whole batch before changing any lengths */
+#ifdef USE_OPENMP
+    #pragma omp parallel for schedule(static) num_threads(PHASE_THREADS(PHASE_ML))
+#endif
+    for (k = 0; k < nBatch; k++) {
+      int node = order[iStart+k];
+      int iThread = 0;
+#ifdef USE_OPENMP
+      iThread = omp_get_thread_num();
+#endif
+      batchThread[k] = iThread;
+      batchUp[k] = NULL;
+      if (node == NJ->root)
+	continue;
+      profile_t **up = upProfiles[iThread];
+      /* Going down from the root, drop the cached up-profiles that depend on a
+	 length or profile that changed since they were computed. The up-profile of x
+	 depends on the lengths and profiles of x's siblings, and on those of x's
+	 ancestors' siblings, and on the lengths of x's ancestors */
+      int depth;
+      int *path = PathToRoot(NJ, node, /*OUT*/&depth);
+      int changed = 0;
+      int j;
+      for (j = depth-2; j >= 0; j--) {
+	int x = path[j];
+	int parent = path[j+1];
+	int iChild;
+	for (iChild = 0; iChild < NJ->child[parent].nChild; iChild++)
+	  changed = MAX(changed, changedAt[NJ->child[parent].child[iChild]]);
+	if (up[x] != NULL && upStamp[iThread][x] <= changed)
+	  up[x] = DeleteUpProfile(up, NJ, x);
+	if (up[x] == NULL)
+	  upStamp[iThread][x] = iBatch;
+      }
+      path = FreePath(path, NJ);
+      batchUp[k] = GetUpProfile(/*IN/OUT*/up, NJ, node, /*useML*/true);
+      up[node] = NULL;		/* batchUp[k] owns it now */
+    }
+
+    /* Nodes of the same height share no branches, and each node's profile is
+       used only by its parent, so the nodes in the batch are independent */
+#ifdef USE_OPENMP
+    #pragma omp parallel for schedule(dynamic, 1) num_threads(PHASE_THREADS(PHASE_ML))
+#endif
+    for (k = 0; k < nBatch; k++) {
+      int node = order[iStart+k];
+      OptimizeNodeBranchLengths(/*IN/OUT*/NJ, node, batchUp[k]);
+      if (node != NJ->root) {
+	RecomputeProfile(/*IN/OUT*/NJ, /*upProfiles*/NULL, node, /*useML*/true);
+	batchUp[k] = FreeProfile(batchUp[k], NJ->nPos, NJ->nConstraints);
+      }
+    }
+
+    for (k = 0; k < nBatch; k++) {
+      int node = order[iStart+k];
+      changedAt[node] = iBatch;
+      for (i = 0; i < NJ->child[node].nChild; i++)
+	changedAt[NJ->child[node].child[i]] = iBatch;
+    }
+
+    /* To save memory, each thread keeps only the up-profiles on the path to the
+       root from the last node that it handled */
+    for (iThread = 0; iThread < nThreads; iThread++) {
+      int last = lastNode[iThread];
+      for (k = 0; k < nBatch; k++)
+	if (batchThread[k] == iThread)
+	  lastNode[iThread] = order[iStart+k];
+      if (lastNode[iThread] == last)
+	continue;		/* no nodes this time */
+      int x;
+      for (x = lastNode[iThread]; x >= 0; x = NJ->parent[x])
+	pathMark[iThread][x] = iBatch;
+      for (k = 0; k <= nBatch; k++) {
+	int start = k < nBatch ? order[iStart+k] : last;
+	if (start < 0 || (k < nBatch && batchThread[k] != iThread))
+	  continue;
+	for (x = start; x >= 0; x = NJ->parent[x])
+	  if (pathMark[iThread][x] != iBatch)
+	    DeleteUpProfile(upProfiles[iThread], NJ, x);
+      }
+    }
+  }
+
+  for (iThread = 0; iThread < nThreads; iThread++) {
+    upProfiles[iThread] = FreeUpProfiles(upProfiles[iThread], NJ);
+    upStamp[iThread] = myfree(upStamp[iThread], sizeof(int)*NJ->maxnodes);
+    pathMark[iThread] = myfree(pathMark[iThread], sizeof(int)*NJ->maxnodes);
+  }
+  upProfiles = myfree(upProfiles, sizeof(profile_t**)*nThreads);
+  upStamp = myfree(upStamp, sizeof(int*)*nThreads);
+  pathMark = myfree(pathMark, sizeof(int*)*nThreads);
+  lastNode = myfree(lastNode, sizeof(int)*nThreads);
+  batchUp = myfree(batchUp, sizeof(profile_t*)*ML_LENGTH_BATCH);
+  batchThread = myfree(batchThread, sizeof(int)*ML_LENGTH_BATCH);
+  changedAt = myfree(changedAt, sizeof(int)*NJ->maxnodes);
+  height = myfree(height, sizeof(int)*NJ->maxnodes);
+  order = myfree(order, sizeof(int)*NJ->maxnodes);
+}
+
 void RecomputeMLProfiles(/*IN/OUT*/NJ_t *NJ) {
   traversal_t traversal = InitTraversal(NJ);
   int node = NJ->root;
@@ -6734,7 +9496,7 @@ void UpdateForNNI(/*IN/OUT*/NJ_t *NJ, int node, /*IN/OUT*/profile_t **upProfiles
   }
 }
 
-void SPR(/*IN/OUT*/NJ_t *NJ, int maxSPRLength, int iRound, int nRounds) {
+int SPR(/*IN/OUT*/NJ_t *NJ, int maxSPRLength, int iRound, int nRounds) {
   /* Given a non-root node N with children A,B, sibling C, and uncle D,
      we can try to move A by doing three types of moves (4 choices):
      "down" -- swap A with a child of B (if B is not a leaf) [2 choices]
@@ -6750,8 +9512,9 @@ void SPR(/*IN/OUT*/NJ_t *NJ, int maxSPRLength, int iRound, int nRounds) {
      We store the traversal before we do SPRs to avoid any possible infinite loop
   */
   double last_tot_len = 0.0;
+  int nChange = 0;
   if (NJ->nSeq <= 3 || maxSPRLength < 1)
-    return;
+    return(0);
   if (slow)
     last_tot_len = TreeLength(NJ, /*recomputeLengths*/true);
   int *nodeList = mymalloc(sizeof(int) * NJ->maxnodes);
@@ -6837,6 +9600,7 @@ void SPR(/*IN/OUT*/NJ_t *NJ, int maxSPRLength, int iRound, int nRounds) {
 
     if (bChanged) {
       nSPR++;		/* the SPR move is OK */
+      nChange++;
       /* make sure all the profiles are OK */
       int j;
       for (j = 0; j < NJ->maxnodes; j++)
@@ -6849,6 +9613,7 @@ void SPR(/*IN/OUT*/NJ_t *NJ, int maxSPRLength, int iRound, int nRounds) {
   steps = myfree(steps, sizeof(spr_step_t) * maxSPRLength);
   upProfiles = FreeUpProfiles(upProfiles,NJ);
   nodeList = myfree(nodeList, sizeof(int) * NJ->maxnodes);
+  return(nChange);
 }
 
 void RecomputeProfile(/*IN/OUT*/NJ_t *NJ, /*IN/OUT*/profile_t **upProfiles, int node,
@@ -6999,27 +9764,30 @@ void UpdateBranchLengths(/*IN/OUT*/NJ_t *NJ) {
   upProfiles = FreeUpProfiles(upProfiles,NJ);
 }
 
-/* Pick columns for resampling, stored as returned_vector[iBoot*nPos + j] */
+/* Pick columns for resampling, stored as returned_vector[iBoot*SITES(nPos) + j]
+   With -patterns, this resamples alignment columns and stores their site patterns
+*/
 int *ResampleColumns(int nPos, int nBootstrap) {
-  long lPos = nPos; /* to prevent overflow on very long alignments when multiplying nPos * nBootstrap */
+  int nSites = SITES(nPos);
+  long lPos = nSites; /* to prevent overflow on very long alignments when multiplying nPos * nBootstrap */
   int *col = (int*)mymalloc(sizeof(int)*lPos*(size_t)nBootstrap);
   int i;
   for (i = 0; i < nBootstrap; i++) {
     int j;
-    for (j = 0; j < nPos; j++) {
-      int pos   = (int)(knuth_rand() * nPos);
+    for (j = 0; j < nSites; j++) {
+      int pos   = (int)(knuth_rand() * nSites);
       if (pos<0)
 	pos = 0;
-      else if (pos == nPos)
-	pos = nPos-1;
-      col[i*lPos + j] = pos;
+      else if (pos == nSites)
+	pos = nSites-1;
+      col[i*lPos + j] = SITE_PATTERN(pos);
     }
   }
   if (verbose > 5) {
     for (i=0; i < 3 && i < nBootstrap; i++) {
       fprintf(stderr,"Boot%d",i);
       int j;
-      for (j = 0; j < nPos; j++) {
+      for (j = 0; j < nSites; j++) {
 	fprintf(stderr,"\t%d",col[i*lPos+j]);
       }
       fprintf(stderr,"\n");
@@ -7038,6 +9806,13 @@ void ReliabilityNJ(/*IN/OUT*/NJ_t *NJ, int nBootstrap) {
 
      To save memory, we do depth-first-search down from the root, and we only keep
      up-profiles for nodes in the active path.
+
+     The nodes are handled in batches (see MESupportBatch): their profiles are set
+     up in postorder, and the supports of the batch are computed in parallel.
+     Up-profiles that are no longer needed are deleted as they would be one node
+     at a time, or after the batch if one of its nodes still uses them. The columns
+     are resampled once, up front, so the supports do not depend on the number of
+     threads.
   */
   if (NJ->nSeq <= 3 || nBootstrap <= 0)
     return;			/* nothing to do */
@@ -7045,64 +9820,98 @@ void ReliabilityNJ(/*IN/OUT*/NJ_t *NJ, int nBootstrap) {
 
   profile_t **upProfiles = UpProfiles(NJ);
   traversal_t traversal = InitTraversal(NJ);
+  int batch[ME_SUPPORT_BATCH];
+  profile_t *batchProfiles[ME_SUPPORT_BATCH][4];
+  int batchABCD[ME_SUPPORT_BATCH][4];
+  int deferred[3*ME_SUPPORT_BATCH];
+  int nBatch = 0;
+  int nDeferred = 0;
+  int nBatchMax = MESupportBatch(NJ);
   int node = NJ->root;
   int iNodesDone = 0;
-  while((node = TraversePostorder(node, NJ, /*IN/OUT*/traversal, /*pUp*/NULL)) >= 0) {
-    if (node < NJ->nSeq || node == NJ->root)
-      continue; /* nothing to do for leaves or root */
-
-    if(iNodesDone > 0 && (iNodesDone % 100) == 0)
-      ProgressReport("Local bootstrap for %6d of %6d internal splits", iNodesDone, NJ->nSeq-3, 0, 0);
-    iNodesDone++;
-
-    profile_t *profiles[4];
-    int nodeABCD[4];
-    SetupABCD(NJ, node, /*OUT*/profiles, /*IN/OUT*/upProfiles, /*OUT*/nodeABCD, /*useML*/false);
-
-    NJ->support[node] = SplitSupport(profiles[0], profiles[1], profiles[2], profiles[3],
-				     NJ->distance_matrix,
-				     NJ->nPos,
-				     nBootstrap,
-				     col);
-
-    /* no longer needed */
-    DeleteUpProfile(upProfiles, NJ, nodeABCD[0]);
-    DeleteUpProfile(upProfiles, NJ, nodeABCD[1]);
-    DeleteUpProfile(upProfiles, NJ, nodeABCD[2]);
+  while (node >= 0) {
+    node = TraversePostorder(node, NJ, /*IN/OUT*/traversal, /*pUp*/NULL);
+    if (node >= NJ->nSeq && node != NJ->root) {
+      if(iNodesDone > 0 && (iNodesDone % 100) == 0)
+	ProgressReport("Local bootstrap for %6d of %6d internal splits", iNodesDone, NJ->nSeq-3, 0, 0);
+      iNodesDone++;
+      SetupABCD(NJ, node, /*OUT*/batchProfiles[nBatch], /*IN/OUT*/upProfiles, /*OUT*/batchABCD[nBatch], /*useML*/false);
+      batch[nBatch++] = node;
+      int j;
+      for (j = 0; j < 3; j++)
+	DeleteBatchUpProfile(/*IN/OUT*/upProfiles, NJ, batchABCD[nBatch-1][j], batch, nBatch,
+			     /*IN/OUT*/deferred, /*IN/OUT*/&nDeferred);
+    }
+    if (nBatch == nBatchMax || (node < 0 && nBatch > 0)) {
+      int i;
+#ifdef USE_OPENMP
+      #pragma omp parallel for schedule(dynamic, 1) num_threads(PHASE_THREADS(PHASE_NJ))
+#endif
+      for (i = 0; i < nBatch; i++) {
+	profile_t **profiles = batchProfiles[i];
+	NJ->support[batch[i]] = SplitSupport(profiles[0], profiles[1], profiles[2], profiles[3],
+					     NJ->distance_matrix,
+					     NJ->nPos,
+					     nBootstrap,
+					     col);
+      }
+      for (i = 0; i < nDeferred; i++)
+	DeleteUpProfile(upProfiles, NJ, deferred[i]);
+      nBatch = 0;
+      nDeferred = 0;
+    }
   }
   traversal = FreeTraversal(traversal,NJ);
   upProfiles = FreeUpProfiles(upProfiles,NJ);
-  col = myfree(col, sizeof(int)*((size_t)NJ->nPos)*nBootstrap);
+  col = myfree(col, sizeof(int)*((size_t)SITES(NJ->nPos))*nBootstrap);
 }
 
 profile_t *NewProfile(int nPos, int nConstraints) {
-  profile_t *profile = (profile_t *)mymalloc(sizeof(profile_t));
-  profile->weights = mymalloc(sizeof(numeric_t)*nPos);
-  profile->codes = mymalloc(sizeof(unsigned char)*nPos);
+  profile_t *profile = (profile_t *)SlabAlloc(sizeof(profile_t));
+  profile->weights = SlabAlloc(sizeof(numeric_t)*nPos);
+  profile->codes = SlabAlloc(sizeof(unsigned char)*nPos);
   profile->vectors = NULL;
   profile->nVectors = 0;
   profile->codeDist = NULL;
+  profile->runs = NULL;
+  profile->nRuns = 0;
+  profile->nOccupied = 0;
+  profile->oocEntry = -1;
   if (nConstraints == 0) {
     profile->nOn = NULL;
     profile->nOff = NULL;
+    profile->onBits = NULL;
+    profile->offBits = NULL;
   } else {
-    profile->nOn = mymalloc(sizeof(int)*nConstraints);
-    profile->nOff = mymalloc(sizeof(int)*nConstraints);
+    profile->nOn = SlabAlloc(sizeof(int)*nConstraints);
+    profile->nOff = SlabAlloc(sizeof(int)*nConstraints);
+    profile->onBits = SlabAlloc(sizeof(uint64_t)*BITSET_WORDS(nConstraints));
+    profile->offBits = SlabAlloc(sizeof(uint64_t)*BITSET_WORDS(nConstraints));
+    memset(profile->onBits, 0, sizeof(uint64_t)*BITSET_WORDS(nConstraints));
+    memset(profile->offBits, 0, sizeof(uint64_t)*BITSET_WORDS(nConstraints));
   }
   return(profile);
 }
 
 profile_t *FreeProfile(profile_t *profile, int nPos, int nConstraints) {
     if(profile==NULL) return(NULL);
-    myfree(profile->codes, nPos);
-    myfree(profile->weights, nPos);
-    myfree(profile->vectors, sizeof(numeric_t)*nCodes*profile->nVectors);
-    myfree(profile->codeDist, sizeof(numeric_t)*nCodes*nPos);
+    if (profile->oocEntry >= 0)
+      OocForget(profile);
+    SlabFree(profile->codes, sizeof(unsigned char)*(PACKED_LEAF(profile) ? profile->nOccupied : nPos));
+    SlabFree(profile->weights, sizeof(numeric_t)*nPos);
+    SlabFree(profile->vectors, sizeof(numeric_t)*nCodes*profile->nVectors);
+    SlabFree(profile->codeDist, sizeof(numeric_t)*nCodes*nPos);
+    if (profile->runs != NULL)
+      SlabFree(profile->runs, sizeof(int)*2*MAX(profile->nRuns,1));
     if (nConstraints > 0) {
-      myfree(profile->nOn, sizeof(int)*nConstraints);
-      myfree(profile->nOff,  sizeof(int)*nConstraints);
+      if (profile->nOn != NULL) {
+	SlabFree(profile->nOn, sizeof(int)*nConstraints);
+	SlabFree(profile->nOff,  sizeof(int)*nConstraints);
+      }
+      SlabFree(profile->onBits, sizeof(uint64_t)*BITSET_WORDS(nConstraints));
+      SlabFree(profile->offBits, sizeof(uint64_t)*BITSET_WORDS(nConstraints));
     }
-    return(myfree(profile, sizeof(profile_t)));
+    return(SlabFree(profile, sizeof(profile_t)));
 }
 
 void SetupABCD(NJ_t *NJ, int node,
@@ -7211,7 +10020,7 @@ void TestSplitsML(/*IN/OUT*/NJ_t *NJ, /*OUT*/SplitCount_t *splitcount, int nBoot
 
     {
 #ifdef USE_OPENMP
-      #pragma omp parallel
+      #pragma omp parallel num_threads(PHASE_THREADS(PHASE_ML))
       #pragma omp sections
 #endif
       {
@@ -7272,14 +10081,7 @@ void TestSplitsML(/*IN/OUT*/NJ_t *NJ, /*OUT*/SplitCount_t *splitcount, int nBoot
     double p[3];
     QuartetConstraintPenalties(profiles, NJ->nConstraints, /*OUT*/p);
     bool bBadConstr = p[ABvsCD] > p[ACvsBD] + tolerance || p[ABvsCD] > p[ADvsBC] + tolerance;
-    bool violateConstraint = false;
-    int iC;
-    for (iC=0; iC < NJ->nConstraints; iC++) {
-      if (SplitViolatesConstraint(profiles, iC)) {
-	violateConstraint = true;
-	break;
-      }
-    }
+    bool violateConstraint = QuartetConstraintViolations(profiles, NJ->nConstraints) > 0;
     splitcount->nSplits++;
     if (violateConstraint)
       splitcount->nConstraintViolations++;
@@ -7307,7 +10109,7 @@ void TestSplitsML(/*IN/OUT*/NJ_t *NJ, /*OUT*/SplitCount_t *splitcount, int nBoot
   traversal = FreeTraversal(traversal,NJ);
   upProfiles = FreeUpProfiles(upProfiles,NJ);
   if (nBootstrap>0)
-    col = myfree(col, sizeof(int)*((size_t)NJ->nPos)*nBootstrap);
+    col = myfree(col, sizeof(int)*((size_t)SITES(NJ->nPos))*nBootstrap);
   for (choice = 0; choice < 3; choice++)
     site_likelihoods[choice] = myfree(site_likelihoods[choice], sizeof(double)*NJ->nPos);
 }
@@ -7324,106 +10126,135 @@ void TestSplitsMinEvo(NJ_t *NJ, /*OUT*/SplitCount_t *splitcount) {
 
   profile_t **upProfiles = UpProfiles(NJ);
   traversal_t traversal = InitTraversal(NJ);
+  /* As in ReliabilityNJ, the distances and penalties of a batch of nodes are
+     computed in parallel, and then the splits are counted in postorder */
+  int batch[ME_SUPPORT_BATCH];
+  profile_t *batchProfiles[ME_SUPPORT_BATCH][4];
+  int batchABCD[ME_SUPPORT_BATCH][4];
+  double batchDist[ME_SUPPORT_BATCH][6];
+  double batchPenalty[ME_SUPPORT_BATCH][3];
+  int batchViolated[ME_SUPPORT_BATCH];
+  int deferred[2*ME_SUPPORT_BATCH];
+  int nBatch = 0;
+  int nDeferred = 0;
+  int nBatchMax = MESupportBatch(NJ);
   int node = NJ->root;
 
-  while((node = TraversePostorder(node, NJ, /*IN/OUT*/traversal, /*pUp*/NULL)) >= 0) {
-    if (node < NJ->nSeq || node == NJ->root)
-      continue; /* nothing to do for leaves or root */
-
-    profile_t *profiles[4];
-    int nodeABCD[4];
-    SetupABCD(NJ, node, /*OUT*/profiles, /*IN/OUT*/upProfiles, /*OUT*/nodeABCD, /*useML*/false);
-
-    if (verbose>2)
-      fprintf(stderr,"Testing Split around %d: A=%d B=%d C=%d D=up(%d) or node parent %d\n",
-	      node, nodeABCD[0], nodeABCD[1], nodeABCD[2], nodeABCD[3], NJ->parent[node]);
+  while (node >= 0) {
+    node = TraversePostorder(node, NJ, /*IN/OUT*/traversal, /*pUp*/NULL);
+    if (node >= NJ->nSeq && node != NJ->root) {
+      SetupABCD(NJ, node, /*OUT*/batchProfiles[nBatch], /*IN/OUT*/upProfiles, /*OUT*/batchABCD[nBatch], /*useML*/false);
+      batch[nBatch++] = node;
+      int j;
+      for (j = 0; j < 2; j++)
+	DeleteBatchUpProfile(/*IN/OUT*/upProfiles, NJ, batchABCD[nBatch-1][j], batch, nBatch,
+			     /*IN/OUT*/deferred, /*IN/OUT*/&nDeferred);
+    }
+    if (nBatch == nBatchMax || (node < 0 && nBatch > 0)) {
+      int iBatch;
+#ifdef USE_OPENMP
+      #pragma omp parallel for schedule(dynamic, 4) num_threads(PHASE_THREADS(PHASE_NJ))
+#endif
+      for (iBatch = 0; iBatch < nBatch; iBatch++) {
+	profile_t **profiles = batchProfiles[iBatch];
+	/* distances, perhaps log-corrected distances, no constraint penalties */
+	CorrectedPairDistances(profiles, 4, NJ->distance_matrix, NJ->nPos, /*OUT*/batchDist[iBatch]);
+	QuartetConstraintPenalties(profiles, NJ->nConstraints, /*OUT*/batchPenalty[iBatch]);
+	batchViolated[iBatch] = QuartetConstraintViolations(profiles, NJ->nConstraints);
+      }
+
+      for (iBatch = 0; iBatch < nBatch; iBatch++) {
+	int node = batch[iBatch];
+	profile_t **profiles = batchProfiles[iBatch];
+	int *nodeABCD = batchABCD[iBatch];
+	if (verbose>2)
+	  fprintf(stderr,"Testing Split around %d: A=%d B=%d C=%d D=up(%d) or node parent %d\n",
+		  node, nodeABCD[0], nodeABCD[1], nodeABCD[2], nodeABCD[3], NJ->parent[node]);
 
-    double d[6];		/* distances, perhaps log-corrected distances, no constraint penalties */
-    CorrectedPairDistances(profiles, 4, NJ->distance_matrix, NJ->nPos, /*OUT*/d);
+	double *d = batchDist[iBatch];
 
-    /* alignment-based scores for each split (lower is better) */
-    double sABvsCD = d[qAB] + d[qCD];
-    double sACvsBD = d[qAC] + d[qBD];
-    double sADvsBC = d[qAD] + d[qBC];
+	/* alignment-based scores for each split (lower is better) */
+	double sABvsCD = d[qAB] + d[qCD];
+	double sACvsBD = d[qAC] + d[qBD];
+	double sADvsBC = d[qAD] + d[qBC];
 
-    /* constraint penalties, indexed by nni_t (lower is better) */
-    double p[3];
-    QuartetConstraintPenalties(profiles, NJ->nConstraints, /*OUT*/p);
+	/* constraint penalties, indexed by nni_t (lower is better) */
+	double *p = batchPenalty[iBatch];
 
-    int nConstraintsViolated = 0;
-    int iC;
-    for (iC=0; iC < NJ->nConstraints; iC++) {
-      if (SplitViolatesConstraint(profiles, iC)) {
-	nConstraintsViolated++;
-	if (verbose > 2) {
-	  double penalty[3] = {0.0,0.0,0.0};
-	  (void)QuartetConstraintPenaltiesPiece(profiles, iC, /*OUT*/penalty);
-	  fprintf(stderr, "Violate constraint %d at %d (children %d %d) penalties %.3f %.3f %.3f %d/%d %d/%d %d/%d %d/%d\n",
-		  iC, node, NJ->child[node].child[0], NJ->child[node].child[1],
-		  penalty[ABvsCD], penalty[ACvsBD], penalty[ADvsBC],
-		  profiles[0]->nOn[iC], profiles[0]->nOff[iC],
-		  profiles[1]->nOn[iC], profiles[1]->nOff[iC],
-		  profiles[2]->nOn[iC], profiles[2]->nOff[iC],
-		  profiles[3]->nOn[iC], profiles[3]->nOff[iC]);
+	int nConstraintsViolated = batchViolated[iBatch];
+	int iC;
+	for (iC=0; iC < NJ->nConstraints && verbose > 2 && nConstraintsViolated > 0; iC++) {
+	  if (SplitViolatesConstraint(profiles, iC)) {
+	    double penalty[3] = {0.0,0.0,0.0};
+	    (void)QuartetConstraintPenaltiesPiece(profiles, iC, /*OUT*/penalty);
+	    fprintf(stderr, "Violate constraint %d at %d (children %d %d) penalties %.3f %.3f %.3f %d/%d %d/%d %d/%d %d/%d\n",
+		    iC, node, NJ->child[node].child[0], NJ->child[node].child[1],
+		    penalty[ABvsCD], penalty[ACvsBD], penalty[ADvsBC],
+		    CONSTRAINT_ON(profiles[0],iC), CONSTRAINT_OFF(profiles[0],iC),
+		    CONSTRAINT_ON(profiles[1],iC), CONSTRAINT_OFF(profiles[1],iC),
+		    CONSTRAINT_ON(profiles[2],iC), CONSTRAINT_OFF(profiles[2],iC),
+		    CONSTRAINT_ON(profiles[3],iC), CONSTRAINT_OFF(profiles[3],iC));
+	  }
 	}
-      }
-    }
-
-    double delta = sABvsCD - MIN(sACvsBD,sADvsBC);
-    bool bBadDist = delta > tolerance;
-    bool bBadConstr = p[ABvsCD] > p[ACvsBD] + tolerance || p[ABvsCD] > p[ADvsBC] + tolerance;
 
-    splitcount->nSplits++;
-    if (bBadDist) {
-      nni_t choice = sACvsBD < sADvsBC ? ACvsBD : ADvsBC;
-      /* If ABvsCD is favored over the shorter NNI by constraints,
-	 then this is probably a bad split because of the constraint */
-      if (p[choice] > p[ABvsCD] + tolerance)
-	splitcount->dWorstDeltaConstrained = MAX(delta, splitcount->dWorstDeltaConstrained);
-      else
-	splitcount->dWorstDeltaUnconstrained = MAX(delta, splitcount->dWorstDeltaUnconstrained);
-    }
+	double delta = sABvsCD - MIN(sACvsBD,sADvsBC);
+	bool bBadDist = delta > tolerance;
+	bool bBadConstr = p[ABvsCD] > p[ACvsBD] + tolerance || p[ABvsCD] > p[ADvsBC] + tolerance;
+
+	splitcount->nSplits++;
+	if (bBadDist) {
+	  nni_t choice = sACvsBD < sADvsBC ? ACvsBD : ADvsBC;
+	  /* If ABvsCD is favored over the shorter NNI by constraints,
+	     then this is probably a bad split because of the constraint */
+	  if (p[choice] > p[ABvsCD] + tolerance)
+	    splitcount->dWorstDeltaConstrained = MAX(delta, splitcount->dWorstDeltaConstrained);
+	  else
+	    splitcount->dWorstDeltaUnconstrained = MAX(delta, splitcount->dWorstDeltaUnconstrained);
+	}
 
-    if (nConstraintsViolated > 0)
-      splitcount->nConstraintViolations++; /* count splits with any violations, not #constraints in a splits */
-    if (bBadDist)
-      splitcount->nBadSplits++;
-    if (bBadDist && bBadConstr)
-      splitcount->nBadBoth++;
-    if (bBadConstr && verbose > 2) {
-      /* Which NNI would be better */
-      double dist_advantage = 0;
-      double constraint_penalty = 0;
-      if (p[ACvsBD] < p[ADvsBC]) {
-	dist_advantage = sACvsBD - sABvsCD;
-	constraint_penalty = p[ABvsCD] - p[ACvsBD];
-      } else {
-	dist_advantage = sADvsBC - sABvsCD;
-	constraint_penalty = p[ABvsCD] - p[ADvsBC];
-      }
-      fprintf(stderr, "Violate constraints %d distance_advantage %.3f constraint_penalty %.3f (children %d %d):",
-	      node, dist_advantage, constraint_penalty,
-	      NJ->child[node].child[0], NJ->child[node].child[1]);
-      /* list the constraints with a penalty, meaning that ABCD all have non-zero
-         values and that AB|CD worse than others */
-      for (iC = 0; iC < NJ->nConstraints; iC++) {
-	double ppart[6];
-	if (QuartetConstraintPenaltiesPiece(profiles, iC, /*OUT*/ppart)) {
-	  if (ppart[qAB] + ppart[qCD] > ppart[qAD] + ppart[qBC] + tolerance
-	      || ppart[qAB] + ppart[qCD] > ppart[qAC] + ppart[qBD] + tolerance)
-	    fprintf(stderr, " %d (%d/%d %d/%d %d/%d %d/%d)", iC,
-		    profiles[0]->nOn[iC], profiles[0]->nOff[iC],
-		    profiles[1]->nOn[iC], profiles[1]->nOff[iC],
-		    profiles[2]->nOn[iC], profiles[2]->nOff[iC],
-		    profiles[3]->nOn[iC], profiles[3]->nOff[iC]);
+	if (nConstraintsViolated > 0)
+	  splitcount->nConstraintViolations++; /* count splits with any violations, not #constraints in a splits */
+	if (bBadDist)
+	  splitcount->nBadSplits++;
+	if (bBadDist && bBadConstr)
+	  splitcount->nBadBoth++;
+	if (bBadConstr && verbose > 2) {
+	  /* Which NNI would be better */
+	  double dist_advantage = 0;
+	  double constraint_penalty = 0;
+	  if (p[ACvsBD] < p[ADvsBC]) {
+	    dist_advantage = sACvsBD - sABvsCD;
+	    constraint_penalty = p[ABvsCD] - p[ACvsBD];
+	  } else {
+	    dist_advantage = sADvsBC - sABvsCD;
+	    constraint_penalty = p[ABvsCD] - p[ADvsBC];
+	  }
+	  fprintf(stderr, "Violate constraints %d distance_advantage %.3f constraint_penalty %.3f (children %d %d):",
+		  node, dist_advantage, constraint_penalty,
+		  NJ->child[node].child[0], NJ->child[node].child[1]);
+	  /* list the constraints with a penalty, meaning that ABCD all have non-zero
+	     values and that AB|CD worse than others */
+	  for (iC = 0; iC < NJ->nConstraints; iC++) {
+	    double ppart[6];
+	    if (QuartetConstraintPenaltiesPiece(profiles, iC, /*OUT*/ppart)) {
+	      if (ppart[qAB] + ppart[qCD] > ppart[qAD] + ppart[qBC] + tolerance
+		  || ppart[qAB] + ppart[qCD] > ppart[qAC] + ppart[qBD] + tolerance)
+		fprintf(stderr, " %d (%d/%d %d/%d %d/%d %d/%d)", iC,
+			CONSTRAINT_ON(profiles[0],iC), CONSTRAINT_OFF(profiles[0],iC),
+			CONSTRAINT_ON(profiles[1],iC), CONSTRAINT_OFF(profiles[1],iC),
+			CONSTRAINT_ON(profiles[2],iC), CONSTRAINT_OFF(profiles[2],iC),
+			CONSTRAINT_ON(profiles[3],iC), CONSTRAINT_OFF(profiles[3],iC));
+	    }
+	  }
+	  fprintf(stderr, "\n");
 	}
       }
-      fprintf(stderr, "\n");
-    }
 
-    /* no longer needed */
-    DeleteUpProfile(upProfiles, NJ, nodeABCD[0]);
-    DeleteUpProfile(upProfiles, NJ, nodeABCD[1]);
+      for (iBatch = 0; iBatch < nDeferred; iBatch++)
+	DeleteUpProfile(upProfiles, NJ, deferred[iBatch]);
+      nBatch = 0;
+      nDeferred = 0;
+    }
   }
   traversal = FreeTraversal(traversal,NJ);
   upProfiles = FreeUpProfiles(upProfiles,NJ);
@@ -7436,9 +10267,9 @@ double SplitSupport(profile_t *pA, profile_t *pB, profile_t *pC, profile_t *pD,
 		    int nBootstrap,
 		    int *col) {
   int i,j;
-  long lPos = nPos; 		/* to avoid overflow when multiplying */
+  long lPos = SITES(nPos); 	/* to avoid overflow when multiplying */
 
-  /* Note distpieces are weighted */
+  /* Note distpieces are weighted (but not by PATTERN_COUNT) */
   double *distpieces[6];
   double *weights[6];
   for (j = 0; j < 6; j++) {
@@ -7446,6 +10277,12 @@ double SplitSupport(profile_t *pA, profile_t *pB, profile_t *pC, profile_t *pD,
     weights[j] = (double*)mymalloc(sizeof(double)*nPos);
   }
 
+  /* Packed leaves are read through dense copies */
+  profile_t *in[4] = { pA, pB, pC, pD };
+  pA = DenseProfile(in[0], nPos);
+  pB = DenseProfile(in[1], nPos);
+  pC = DenseProfile(in[2], nPos);
+  pD = DenseProfile(in[3], nPos);
   int iFreqA = 0;
   int iFreqB = 0;
   int iFreqC = 0;
@@ -7474,6 +10311,10 @@ double SplitSupport(profile_t *pA, profile_t *pB, profile_t *pC, profile_t *pD,
   assert(iFreqB == pB->nVectors);
   assert(iFreqC == pC->nVectors);
   assert(iFreqD == pD->nVectors);
+  FreeDenseProfile(pA, in[0], nPos);
+  FreeDenseProfile(pB, in[1], nPos);
+  FreeDenseProfile(pC, in[2], nPos);
+  FreeDenseProfile(pD, in[3], nPos);
 
   double totpieces[6];
   double totweights[6];
@@ -7482,8 +10323,8 @@ double SplitSupport(profile_t *pA, profile_t *pB, profile_t *pC, profile_t *pD,
     totpieces[j] = 0.0;
     totweights[j] = 0.0;
     for (i = 0; i < nPos; i++) {
-      totpieces[j] += distpieces[j][i];
-      totweights[j] += weights[j][i];
+      totpieces[j] += PATTERN_COUNT(i) * distpieces[j][i];
+      totweights[j] += PATTERN_COUNT(i) * weights[j][i];
     }
     dists[j] = totweights[j] > 0.01 ? totpieces[j]/totweights[j] : 3.0;
     if (logdist)
@@ -7497,6 +10338,9 @@ double SplitSupport(profile_t *pA, profile_t *pB, profile_t *pC, profile_t *pD,
   double support2 = dists[qAD] + dists[qBC] - dists[qAB] - dists[qCD];
 
   if (support1 < 0 || support2 < 0) {
+#ifdef USE_OPENMP
+    #pragma omp atomic
+#endif
     nSuboptimalSplits++;	/* Another split seems superior */
   }
 
@@ -7512,7 +10356,7 @@ double SplitSupport(profile_t *pA, profile_t *pB, profile_t *pC, profile_t *pD,
       double totw = 0;
       double *d = distpieces[j];
       double *w = weights[j];
-      for (i=0; i<nPos; i++) {
+      for (i=0; i<lPos; i++) {
 	int c = colw[i];
 	totp += d[c];
 	totw += w[c];
@@ -7535,7 +10379,7 @@ double SplitSupport(profile_t *pA, profile_t *pB, profile_t *pC, profile_t *pD,
 }
 
 double SHSupport(int nPos, int nBootstrap, int *col, double loglk[3], double *site_likelihoods[3]) {
-  long lPos = nPos;		/* to avoid overflow when multiplying */
+  long lPos = SITES(nPos);	/* to avoid overflow when multiplying */
   assert(nBootstrap>0);
   double delta1 = loglk[0]-loglk[1];
   double delta2 = loglk[0]-loglk[2];
@@ -7555,7 +10399,7 @@ double SHSupport(int nPos, int nBootstrap, int *col, double loglk[3], double *si
     double resampled[3];
     for (i = 0; i < 3; i++)
       resampled[i] = -loglk[i];
-    for (j = 0; j < nPos; j++) {
+    for (j = 0; j < lPos; j++) {
       int pos = col[iBoot*lPos+j];
       for (i = 0; i < 3; i++)
 	resampled[i] += siteloglk[i][pos];
@@ -7578,9 +10422,9 @@ double SHSupport(int nPos, int nBootstrap, int *col, double loglk[3], double *si
 
 void SetDistCriterion(/*IN/OUT*/NJ_t *NJ, int nActive, /*IN/OUT*/besthit_t *hit) {
   if (hit->i < NJ->nSeq && hit->j < NJ->nSeq) {
-    SeqDist(NJ->profiles[hit->i]->codes,
-	    NJ->profiles[hit->j]->codes,
-	    NJ->nPos, NJ->distance_matrix, /*OUT*/hit);
+    SeqDistLeaves(NJ->profiles[hit->i],
+		  NJ->profiles[hit->j],
+		  NJ->nPos, NJ->distance_matrix, /*OUT*/hit);
   } else {
     ProfileDist(NJ->profiles[hit->i],
 		NJ->profiles[hit->j],
@@ -7620,6 +10464,7 @@ void SetCriterion(/*IN/UPDATE*/NJ_t *NJ, int nActive, /*IN/OUT*/besthit_t *join)
 }
 
 void SetOutDistance(NJ_t *NJ, int iNode, int nActive) {
+  PROF_SCOPE(PROF_SETOUTDISTANCE);
   if (NJ->nOutDistActive[iNode] == nActive)
     return;
 
@@ -7690,7 +10535,7 @@ top_hits_t *FreeTopHits(top_hits_t *tophits) {
   for (iNode = 0; iNode < tophits->maxnodes; iNode++) {
     top_hits_list_t *l = &tophits->top_hits_lists[iNode];
     if (l->hits != NULL)
-      l->hits = myfree(l->hits, sizeof(hit_t) * l->nHits);
+      l->hits = SlabFree(l->hits, sizeof(hit_t) * l->nHits);
   }
   tophits->top_hits_lists = myfree(tophits->top_hits_lists, sizeof(top_hits_list_t) * tophits->maxnodes);
   tophits->visible = myfree(tophits->visible, sizeof(hit_t*) * tophits->maxnodes);
@@ -7772,7 +10617,7 @@ void SetAllLeafTopHits(/*IN/UPDATE*/NJ_t *NJ, /*IN/OUT*/top_hits_t *tophits) {
   int *nGaps = (int*)mymalloc(sizeof(int)*NJ->nSeq);
   int iNode;
   for(iNode=0; iNode<NJ->nSeq; iNode++) {
-    nGaps[iNode] = (int)(0.5 + NJ->nPos - NJ->selfweight[iNode]);
+    nGaps[iNode] = (int)(0.5 + SITES(NJ->nPos) - NJ->selfweight[iNode]);
   }
   int *seeds = (int*)mymalloc(sizeof(int)*NJ->nSeq);
   for (iNode=0; iNode<NJ->nSeq; iNode++) seeds[iNode] = iNode;
@@ -7786,8 +10631,11 @@ void SetAllLeafTopHits(/*IN/UPDATE*/NJ_t *NJ, /*IN/OUT*/top_hits_t *tophits) {
   assert(2 * tophits->m <= NJ->nSeq);
   int iSeed;
   int nHasTopHits = 0;
+  /* Which seeds are skipped depends on which lists were already set, so if seeds
+     are handled in parallel, the lists depend on thread timing. If deterministic,
+     the seeds are handled in order and SetBestHit runs in parallel instead. */
 #ifdef USE_OPENMP
-  #pragma omp parallel for schedule(dynamic, 50)
+  #pragma omp parallel for schedule(dynamic, 50) num_threads(PHASE_THREADS(PHASE_TOPHITS)) if(!deterministic)
 #endif
   for(iSeed=0; iSeed < NJ->nSeq; iSeed++) {
     int seed = seeds[iSeed];
@@ -7833,7 +10681,7 @@ void SetAllLeafTopHits(/*IN/UPDATE*/NJ_t *NJ, /*IN/OUT*/top_hits_t *tophits) {
     double nearcover = 1.0 - neardist/2.0;
 
     if(verbose>2) fprintf(stderr,"Distance limit for close neighbors %f weight %f ungapped %d\n",
-			  neardist, nearweight, NJ->nPos-nGaps[seed]);
+			  neardist, nearweight, SITES(NJ->nPos)-nGaps[seed]);
     for (iClose = 0; iClose < tophits->m; iClose++) {
       besthit_t *closehit = &besthitsSeed[iClose];
       int closeNode = closehit->j;
@@ -7843,10 +10691,10 @@ void SetAllLeafTopHits(/*IN/UPDATE*/NJ_t *NJ, /*IN/OUT*/top_hits_t *tophits) {
       /* If within close-distance, or identical, use as close neighbor */
       bool close = closehit->dist <= neardist
 	&& (closehit->weight >= nearweight
-	    || closehit->weight >= (NJ->nPos-nGaps[closeNode])*nearcover);
+	    || closehit->weight >= (SITES(NJ->nPos)-nGaps[closeNode])*nearcover);
       bool identical = closehit->dist < 1e-6
-	&& fabs(closehit->weight - (NJ->nPos - nGaps[seed])) < 1e-5
-	&& fabs(closehit->weight - (NJ->nPos - nGaps[closeNode])) < 1e-5;
+	&& fabs(closehit->weight - (SITES(NJ->nPos) - nGaps[seed])) < 1e-5
+	&& fabs(closehit->weight - (SITES(NJ->nPos) - nGaps[closeNode])) < 1e-5;
       if (useTopHits2nd && iClose < tophits->q && (close || identical)) {
 	nHasTopHits++;
 	nClose2Used++;
@@ -7867,8 +10715,8 @@ void SetAllLeafTopHits(/*IN/UPDATE*/NJ_t *NJ, /*IN/OUT*/top_hits_t *tophits) {
 	nCloseUsed++;
 	if(verbose>2) fprintf(stderr, "Near neighbor %d (rank %d weight %f ungapped %d %d)\n",
 			      closeNode, iClose, besthitsSeed[iClose].weight,
-			      NJ->nPos-nGaps[seed],
-			      NJ->nPos-nGaps[closeNode]);
+			      SITES(NJ->nPos)-nGaps[seed],
+			      SITES(NJ->nPos)-nGaps[closeNode]);
 
 	/* compute top 2*m hits */
 	TransferBestHits(NJ, /*nActive*/NJ->nSeq,
@@ -8104,17 +10952,38 @@ besthit_t *UniqueBestHits(/*IN/UPDATE*/NJ_t *NJ, int nActive,
   }
   *nUniqueOut = nUnique;
 
-  /* Then do any updates to the criterion or the distances in parallel */
+  /* Then do any updates to the criterion or the distances in parallel,
+     the distances in blocks of DIST_BLOCK (the list is sorted by i) */
+  besthit_t **update = (besthit_t**)mymalloc(sizeof(besthit_t*) * MAX(nUnique,1));
+  int nUpdate = 0;
+  for (iHit = 0; iHit < nUnique; iHit++)
+    if (uniqueList[iHit].dist < 0.0)
+      update[nUpdate++] = &uniqueList[iHit];
+  int nBlocks = (nUpdate + DIST_BLOCK - 1)/DIST_BLOCK;
 #ifdef USE_OPENMP
-    #pragma omp parallel for schedule(dynamic, 50)
+  #pragma omp parallel num_threads(PHASE_THREADS(PHASE_TOPHITS))
 #endif
-  for (iHit = 0; iHit < nUnique; iHit++) {
-    besthit_t *hit = &uniqueList[iHit];
-    if (hit->dist < 0.0)
-      SetDistCriterion(/*IN/UPDATE*/NJ, nActive, /*IN/OUT*/hit);
-    else
-      SetCriterion(/*IN/UPDATE*/NJ, nActive, /*IN/OUT*/hit);
+  {
+    int iCrit;			/* not iHit, which is shared by the threads */
+#ifdef USE_OPENMP
+    #pragma omp for schedule(dynamic, 50)
+#endif
+    for (iCrit = 0; iCrit < nUnique; iCrit++) {
+      besthit_t *hit = &uniqueList[iCrit];
+      if (hit->dist >= 0.0)
+	SetCriterion(/*IN/UPDATE*/NJ, nActive, /*IN/OUT*/hit);
+    }
+    dist_block_t *block = NewDistBlock(NJ->nPos);
+    int iBlock;
+#ifdef USE_OPENMP
+    #pragma omp for schedule(dynamic, 4) nowait
+#endif
+    for (iBlock = 0; iBlock < nBlocks; iBlock++)
+      SetDistCriteria(/*IN/UPDATE*/NJ, nActive, /*IN/OUT*/&update[iBlock * DIST_BLOCK],
+		      MIN(DIST_BLOCK, nUpdate - iBlock * DIST_BLOCK), /*BUFFER*/block);
+    block = FreeDistBlock(block);
   }
+  update = myfree(update, sizeof(besthit_t*) * MAX(nUnique,1));
   return(uniqueList);
 }
 
@@ -8160,7 +11029,7 @@ void TopHitJoin(int newnode,
 
   /* Forget the top-hit lists of the joined nodes */
   for (i = 0; i < 2; i++) {
-    lChild[i]->hits = myfree(lChild[i]->hits, sizeof(hit_t) * lChild[i]->nHits);
+    lChild[i]->hits = SlabFree(lChild[i]->hits, sizeof(hit_t) * lChild[i]->nHits);
     lChild[i]->nHits = 0;
   }
 
@@ -8266,6 +11135,7 @@ void TopHitJoin(int newnode,
     UpdateVisible(/*IN/UPDATE*/NJ, nActive, /*IN*/uniqueList, nSave, /*IN/OUT*/tophits);
   } else {
     /* need to refresh: set top hits for node and for its top hits */
+    PROF_SCOPE(PROF_TOPHITSREFRESH);
     if(verbose > 2) fprintf(stderr,"Top hits for %d by refresh (%d unique age %d) nActive=%d\n",
 			  newnode,nUnique,lNew->age,nActive);
     nRefreshTopHits++;
@@ -8276,7 +11146,7 @@ void TopHitJoin(int newnode,
        to avoid any data overwriting issues.
     */
 #ifdef USE_OPENMP
-    #pragma omp parallel for schedule(dynamic, 50)
+    #pragma omp parallel for schedule(dynamic, 50) num_threads(PHASE_THREADS(PHASE_TOPHITS))
 #endif
     for (iNode = 0; iNode < NJ->maxnode; iNode++) {
       if (NJ->parent[iNode] < 0) {
@@ -8306,7 +11176,7 @@ void TopHitJoin(int newnode,
     /* And use the top 2*m entries to expand other best-hit lists, but only for top m */
     int iHit;
 #ifdef USE_OPENMP
-    #pragma omp parallel for schedule(dynamic, 50)
+    #pragma omp parallel for schedule(dynamic, 50) num_threads(PHASE_THREADS(PHASE_TOPHITS))
 #endif
     for (iHit=0; iHit < tophits->m; iHit++) {
       if (allhits[iHit].i < 0) continue;
@@ -8321,8 +11191,9 @@ void TopHitJoin(int newnode,
       /* Merge: old hits into 0->nHitsOld and hits from iNode above that */
       besthit_t *bothList = (besthit_t*)mymalloc(sizeof(besthit_t) * 3 * tophits->m);
       HitsToBestHits(/*IN*/l->hits, nHitsOld, iNode, /*OUT*/bothList); /* does not compute criterion */
-      for (i = 0; i < nHitsOld; i++)
-	SetCriterion(/*IN/UPDATE*/NJ, nActive, /*IN/OUT*/&bothList[i]);
+      int iOld;			/* not i, which is shared by the threads */
+      for (iOld = 0; iOld < nHitsOld; iOld++)
+	SetCriterion(/*IN/UPDATE*/NJ, nActive, /*IN/OUT*/&bothList[iOld]);
       if (nActive <= 2 * tophits->m)
 	l->hitSource = -1;	/* abandon the 2nd-level top-hits heuristic */
       int nNewHits = l->hitSource >= 0 ? tophits->q : tophits->m;
@@ -8646,11 +11517,21 @@ void TopHitNJSearch(/*IN/UPDATE*/NJ_t *NJ, int nActive,
 
 int NGaps(/*IN*/NJ_t *NJ, int iNode) {
   assert(iNode < NJ->nSeq);
+  profile_t *leaf = NJ->profiles[iNode];
   int nGaps = 0;
   int p;
+  if (PACKED_LEAF(leaf)) {
+    int iRun;
+    for(p=0; p<NJ->nPos; p++)
+      nGaps += PATTERN_COUNT(p);
+    for (iRun = 0; iRun < leaf->nRuns; iRun++)
+      for (p = leaf->runs[2*iRun]; p < leaf->runs[2*iRun+1]; p++)
+	nGaps -= PATTERN_COUNT(p);
+    return(nGaps);
+  }
   for(p=0; p<NJ->nPos; p++) {
-    if (NJ->profiles[iNode]->codes[p] == NOCODE)
-      nGaps++;
+    if (leaf->codes[p] == NOCODE)
+      nGaps += PATTERN_COUNT(p);
   }
   return(nGaps);
 }
@@ -8701,10 +11582,10 @@ void SortSaveBestHits(int iNode, /*IN/SORT*/besthit_t *besthits,
   omp_set_lock(&tophits->locks[iNode]);
 #endif
   if (l->hits != NULL) {
-    l->hits = myfree(l->hits, l->nHits * sizeof(hit_t));
+    l->hits = SlabFree(l->hits, l->nHits * sizeof(hit_t));
     l->nHits = 0;
   }
-  l->hits = mymalloc(sizeof(hit_t) * nSave);
+  l->hits = SlabAlloc(sizeof(hit_t) * nSave);
   l->nHits = nSave;
   int iSave = 0;
   jLast = -1;
@@ -8733,6 +11614,8 @@ void TransferBestHits(/*IN/UPDATE*/NJ_t *NJ,
   assert(iNode >= 0);
   assert(NJ->parent[iNode] < 0);
 
+  besthit_t **update = updateDistances ? (besthit_t**)mymalloc(sizeof(besthit_t*) * nOldHits) : NULL;
+  int nUpdate = 0;
   int iBest;
   for(iBest = 0; iBest < nOldHits; iBest++) {
     besthit_t *old = &oldhits[iBest];
@@ -8749,7 +11632,7 @@ void TransferBestHits(/*IN/UPDATE*/NJ_t *NJ,
       new->criterion = 1e20;
     } else if (new->i != old->i || new->j != old->j) {
       if (updateDistances)
-	SetDistCriterion(/*IN/UPDATE*/NJ, nActive, /*IN/OUT*/new);
+	update[nUpdate++] = new;
       else {
 	new->dist = -1e20;
 	new->criterion = 1e20;
@@ -8761,6 +11644,27 @@ void TransferBestHits(/*IN/UPDATE*/NJ_t *NJ,
 	new->criterion = 1e20;	/* leave dist alone */
     }
   }
+  if (!updateDistances)
+    return;
+
+  /* Compute the changed distances in blocks of DIST_BLOCK, see SetDistCriteria */
+  int nBlocks = (nUpdate + DIST_BLOCK - 1)/DIST_BLOCK;
+#ifdef USE_OPENMP
+  /* Only happens if deterministic, as otherwise this is called in parallel */
+  #pragma omp parallel num_threads(PHASE_THREADS(PHASE_TOPHITS)) if(deterministic && nOldHits >= 64)
+#endif
+  {
+    dist_block_t *block = NewDistBlock(NJ->nPos);
+    int iBlock;
+#ifdef USE_OPENMP
+    #pragma omp for schedule(static)
+#endif
+    for (iBlock = 0; iBlock < nBlocks; iBlock++)
+      SetDistCriteria(/*IN/UPDATE*/NJ, nActive, /*IN/OUT*/&update[iBlock * DIST_BLOCK],
+		      MIN(DIST_BLOCK, nUpdate - iBlock * DIST_BLOCK), /*BUFFER*/block);
+    block = FreeDistBlock(block);
+  }
+  update = myfree(update, sizeof(besthit_t*) * nOldHits);
 }
 
 void HitsToBestHits(/*IN*/hit_t *hits, int nHits, int iNode, /*OUT*/besthit_t *newhits) {
@@ -8789,13 +11693,174 @@ besthit_t HitToBestHit(int i, hit_t hit) {
 char *OpenMPString(void) {
 #ifdef USE_OPENMP
   static char buf[100];
-  sprintf(buf, ", OpenMP (%d threads)", omp_get_max_threads());
+  sprintf(buf, ", OpenMP (%d threads%s)", maxThreads,
+	  deterministic ? ", deterministic" : "");
   return(buf);
 #else
   return(", OpenMP OFF");
 #endif
 }
 
+char *phaseNames[N_PHASES] = { "tophits", "nj", "ml" };
+
+void ParseThreadsOption(char *spec) {
+  char *copy = (char*)mymalloc(strlen(spec)+1);
+  strcpy(copy, spec);
+  char *item;
+  for (item = strtok(copy, ","); item != NULL; item = strtok(NULL, ",")) {
+    int first = 0;
+    int last = N_PHASES-1;
+    char *value = item;
+    char *eq = strchr(item, '=');
+    if (eq != NULL) {
+      *eq = '\0';
+      value = eq+1;
+      for (first = 0; first < N_PHASES; first++)
+	if (strcmp(item, phaseNames[first]) == 0)
+	  break;
+      if (first == N_PHASES) {
+	fprintf(stderr, "Unknown phase in -threads (must be tophits, nj, or ml): %s\n", item);
+	exit(1);
+      }
+      last = first;
+    }
+    int nThreads = -1;
+    if (strcmp(value, "auto") != 0) {
+      nThreads = atoi(value);
+      if (nThreads < 1) {
+	fprintf(stderr, "Illegal argument to -threads (must be auto or 1 or more): %s\n", value);
+	exit(1);
+      }
+    }
+    int iPhase;
+    for (iPhase = first; iPhase <= last; iPhase++)
+      phaseThreadsOption[iPhase] = nThreads;
+  }
+  copy = myfree(copy, strlen(spec)+1);
+}
+
+void ApplyThreadOptions(void) {
+#ifdef USE_OPENMP
+  /* Auto and default phases use at most the OpenMP default */
+  int nMax = 0;
+  bool bAllFixed = true;
+  int iPhase;
+  for (iPhase = 0; iPhase < N_PHASES; iPhase++) {
+    nMax = MAX(nMax, phaseThreadsOption[iPhase]);
+    if (phaseThreadsOption[iPhase] <= 0)
+      bAllFixed = false;
+  }
+  maxThreads = MAX(nMax, omp_get_max_threads());
+  otherThreads = bAllFixed ? nMax : omp_get_max_threads();
+#else
+  int iPhase;
+  for (iPhase = 0; iPhase < N_PHASES; iPhase++)
+    if (phaseThreadsOption[iPhase] != 0) {
+      fprintf(stderr, "Warning: -threads is ignored without OpenMP\n");
+      break;
+    }
+#endif
+}
+
+/* Rows of the calibration table */
+int nThreadTable = 0;
+int *threadTablePhase = NULL;
+int *threadTableSeq = NULL;
+int *threadTablePos = NULL;
+int *threadTableThreads = NULL;
+bool threadTableRead = false;
+
+void ReadThreadTable(char *file) {
+  threadTableRead = true;
+  FILE *fp = fopen(file, "r");
+  if (fp == NULL) {
+    fprintf(stderr, "Warning: cannot read thread calibration table %s\n", file);
+    return;
+  }
+  int nAlloc = 0;
+  char buf[BUFFER_SIZE];
+  while (fgets(buf, sizeof(buf), fp) != NULL) {
+    char phase[BUFFER_SIZE];
+    int nSeq, nPos, nThreads;
+    if (buf[0] == '#' || sscanf(buf, "%s %d %d %d", phase, &nSeq, &nPos, &nThreads) != 4)
+      continue;
+    int iPhase;
+    for (iPhase = 0; iPhase < N_PHASES; iPhase++)
+      if (strcmp(phase, phaseNames[iPhase]) == 0)
+	break;
+    if (iPhase == N_PHASES || nSeq < 1 || nPos < 1 || nThreads < 1)
+      continue;
+    if (nThreadTable == nAlloc) {
+      int nNew = nAlloc == 0 ? 64 : 2*nAlloc;
+      threadTablePhase = myrealloc(threadTablePhase, sizeof(int)*nAlloc, sizeof(int)*nNew, /*copy*/false);
+      threadTableSeq = myrealloc(threadTableSeq, sizeof(int)*nAlloc, sizeof(int)*nNew, /*copy*/false);
+      threadTablePos = myrealloc(threadTablePos, sizeof(int)*nAlloc, sizeof(int)*nNew, /*copy*/false);
+      threadTableThreads = myrealloc(threadTableThreads, sizeof(int)*nAlloc, sizeof(int)*nNew, /*copy*/false);
+      nAlloc = nNew;
+    }
+    threadTablePhase[nThreadTable] = iPhase;
+    threadTableSeq[nThreadTable] = nSeq;
+    threadTablePos[nThreadTable] = nPos;
+    threadTableThreads[nThreadTable] = nThreads;
+    nThreadTable++;
+  }
+  fclose(fp);
+}
+
+int AutoThreads(int phase, int nSeq, int nPos) {
+  int nMax = 1;
+#ifdef USE_OPENMP
+  nMax = omp_get_max_threads();
+#endif
+  if (threadTableFile != NULL && !threadTableRead)
+    ReadThreadTable(threadTableFile);
+  int iBest = -1;
+  double bestDist = 1e20;
+  int i;
+  for (i = 0; i < nThreadTable; i++) {
+    if (threadTablePhase[i] != phase)
+      continue;
+    double dSeq = log((double)nSeq / threadTableSeq[i]);
+    double dPos = log((double)nPos / threadTablePos[i]);
+    double dist = dSeq*dSeq + dPos*dPos;
+    if (dist < bestDist) {
+      bestDist = dist;
+      iBest = i;
+    }
+  }
+  int nThreads;
+  if (iBest >= 0)
+    nThreads = threadTableThreads[iBest];
+  else
+    nThreads = 1 + (int)(((double)nSeq * (double)nPos) / AUTO_THREAD_WORK);
+  return(MIN(nThreads, nMax));
+}
+
+void SetPhaseThreads(int nSeq, int nPos) {
+  int iPhase;
+  for (iPhase = 0; iPhase < N_PHASES; iPhase++) {
+    if (phaseThreadsOption[iPhase] < 0)
+      phaseThreads[iPhase] = AutoThreads(iPhase, nSeq, nPos);
+    else
+      phaseThreads[iPhase] = phaseThreadsOption[iPhase];
+  }
+}
+
+char *PhaseThreadsString(void) {
+  static char buf[100];
+  buf[0] = '\0';
+  int iPhase;
+  for (iPhase = 0; iPhase < N_PHASES; iPhase++) {
+    int nThreads = phaseThreads[iPhase];
+#ifdef USE_OPENMP
+    if (nThreads <= 0)
+      nThreads = omp_get_max_threads();
+#endif
+    sprintf(buf+strlen(buf), "%s%s %d", iPhase > 0 ? ", " : "", phaseNames[iPhase], nThreads);
+  }
+  return(buf);
+}
+
 /* Algorithm 26.2.17 from Abromowitz and Stegun, Handbook of Mathematical Functions
    Absolute accuracy of only about 1e-7, which is enough for us
 */
@@ -8886,10 +11951,721 @@ void *myfree(void *p, size_t sz) {
   return(NULL);
 }
 
-/******************************************************************************/
-/* Minimization of a 1-dimensional function by Brent's method (Numerical Recipes)
- * Borrowed from Tree-Puzzle 5.1 util.c under GPL
- * Modified by M.N.P to pass in the accessory data for the optimization function,
+/* Out-of-core profile storage -- see the comment at the declaration of OocInit.
+   The store is an unlinked file in oocDir, grown in segments that are each
+   mapped shared, so that evicted pages go back to the file rather than to
+   swap. The first segment is sized from the expected profiles (OocExpect),
+   and each later one is twice the previous, up to OOC_SEGMENT_SIZE. Blocks
+   are whole pages, rounded up to 8 size classes per doubling, and freed
+   blocks are kept on per-class lists outside the blocks, so that freeing a
+   paged-out profile does not fault it back in. One lock guards the store
+   and the LRU list, as they are shared by all threads.
+*/
+#define OOC_MIN_SIZE (16*1024)
+#define OOC_SEGMENT_SIZE ((size_t)256*1024*1024)
+#define OOC_NCLASSES 320
+#define OOC_READAHEAD 4
+
+typedef struct {
+  void **blocks;
+  int nBlocks;
+  int nAlloc;
+} ooc_freelist_t;
+
+typedef struct {
+  profile_t *profile;		/* NULL if the entry is on the free chain */
+  int prev;			/* toward the most recently used, or -1 */
+  int next;			/* toward the least recently used, or -1 (or the free chain) */
+  bool resident;		/* on the LRU list */
+  bool readahead;		/* made resident by OocReadahead and not touched since */
+  double bytes;			/* of the profile's arrays in the store, while resident */
+} ooc_entry_t;
+
+typedef struct {
+  int fd;
+  size_t pageSize;
+  double budget;		/* oocBudget, or half of the physical memory */
+  char **segments;
+  size_t *segmentSizes;
+  int nSegments;
+  size_t szSegment;		/* of the next segment */
+  char *bump;			/* next unused byte in the newest segment */
+  size_t bumpLeft;
+  ooc_freelist_t freelist[OOC_NCLASSES];
+  double szFile;
+  double szInUse;
+  double szPeak;
+  /* LRU list of the profiles seen by OocTouch */
+  ooc_entry_t *entries;
+  int nEntries;
+  int nEntriesAlloc;
+  int freeEntry;
+  int head;			/* most recently used */
+  int tail;			/* least recently used */
+  double szResident;
+  /* statistics */
+  long nTouch;
+  long nHit;
+  long nEvict;
+  long nReadahead;
+  long nReadaheadHit;
+  long majorFaults;		/* before OocInit */
+} ooc_store_t;
+
+ooc_store_t *ooc = NULL;
+
+int OocClass(size_t pages, /*OUT*/size_t *classPages) {
+  if (pages <= 8) {
+    *classPages = pages;
+    return((int)pages - 1);
+  }
+  int shift = 3;		/* 2**shift < pages <= 2**(shift+1) */
+  while (((size_t)1 << (shift+1)) < pages)
+    shift++;
+  size_t step = (size_t)1 << (shift-3);
+  size_t k = (pages + step - 1) / step; /* 9 to 16 */
+  *classPages = k * step;
+  return(8 + 8*(shift-3) + (int)(k-9));
+}
+
+long OocMajorFaults(void) {
+#ifndef _WIN32
+  struct rusage usage;
+  if (getrusage(RUSAGE_SELF, &usage) == 0)
+    return(usage.ru_majflt);
+#endif
+  return(0);
+}
+
+void OocInit(void) {
+  OocRelease();
+  if (oocDir == NULL)
+    return;
+#ifndef _WIN32
+  ooc = (ooc_store_t*)mymalloc(sizeof(ooc_store_t));
+  memset(ooc, 0, sizeof(ooc_store_t));
+  size_t szPath = strlen(oocDir) + 32;
+  char *path = (char*)mymalloc(szPath);
+  snprintf(path, szPath, "%s/FastTree.ooc.XXXXXX", oocDir);
+  ooc->fd = mkstemp(path);
+  if (ooc->fd < 0) {
+    fprintf(stderr, "Cannot create the out-of-core file in %s: %s\n", oocDir, strerror(errno));
+    exit(1);
+  }
+  unlink(path);
+  path = myfree(path, szPath);
+  ooc->pageSize = (size_t)sysconf(_SC_PAGESIZE);
+  ooc->szSegment = OOC_SEGMENT_SIZE;
+  ooc->budget = oocBudget > 0 ? oocBudget
+    : sysconf(_SC_PHYS_PAGES) * (double)ooc->pageSize / 2.0;
+  ooc->freeEntry = -1;
+  ooc->head = -1;
+  ooc->tail = -1;
+  ooc->majorFaults = OocMajorFaults();
+#endif
+}
+
+void OocExpect(int nSeq, int nPos) {
+  if (ooc == NULL || ooc->nSegments > 0)
+    return;
+  /* the leaf arrays and the vectors of about as many internal profiles */
+  double expected = 2.0 * nSeq * (double)nPos * (sizeof(numeric_t) * nCodes + sizeof(numeric_t) + 1);
+  size_t sz = (size_t)MIN(expected, (double)OOC_SEGMENT_SIZE);
+  ooc->szSegment = MAX(OOC_MIN_SIZE, (sz + ooc->pageSize - 1) / ooc->pageSize * ooc->pageSize);
+}
+
+/* Map a new segment of at least szMin bytes at the end of the file */
+void OocGrow(size_t szMin) {
+#ifndef _WIN32
+  size_t sz = MAX(szMin, ooc->szSegment);
+  ooc->szSegment = MIN(2 * ooc->szSegment, OOC_SEGMENT_SIZE);
+  off_t offset = (off_t)ooc->szFile;
+#ifdef __linux__
+  /* reserve the blocks now, so that a full disk is an error here and not a SIGBUS later */
+  int err = posix_fallocate(ooc->fd, offset, (off_t)sz);
+#else
+  int err = ftruncate(ooc->fd, offset + (off_t)sz) == 0 ? 0 : errno;
+#endif
+  if (err != 0) {
+    fprintf(stderr, "Cannot grow the out-of-core file in %s to %.1f MB: %s\n",
+	    oocDir, (ooc->szFile + sz)/1.0e6, strerror(err));
+    exit(1);
+  }
+  void *segment = mmap(NULL, sz, PROT_READ|PROT_WRITE, MAP_SHARED, ooc->fd, offset);
+  if (segment == MAP_FAILED) {
+    fprintf(stderr, "Cannot map the out-of-core file in %s: %s\n", oocDir, strerror(errno));
+    exit(1);
+  }
+  ooc->segments = myrealloc(ooc->segments, sizeof(char*) * ooc->nSegments,
+			    sizeof(char*) * (ooc->nSegments+1), /*copy*/false);
+  ooc->segmentSizes = myrealloc(ooc->segmentSizes, sizeof(size_t) * ooc->nSegments,
+				sizeof(size_t) * (ooc->nSegments+1), /*copy*/false);
+  ooc->segments[ooc->nSegments] = (char*)segment;
+  ooc->segmentSizes[ooc->nSegments] = sz;
+  ooc->nSegments++;
+  ooc->szFile += sz;
+  ooc->bump = (char*)segment;
+  ooc->bumpLeft = sz;
+#endif
+}
+
+void *OocAlloc(size_t sz) {
+  void *new = NULL;
+#ifdef USE_OPENMP
+  #pragma omp critical(ooc)
+#endif
+  {
+    size_t classPages;
+    int iClass = OocClass((sz + ooc->pageSize - 1) / ooc->pageSize, /*OUT*/&classPages);
+    assert(iClass < OOC_NCLASSES);
+    size_t szClass = classPages * ooc->pageSize;
+    ooc_freelist_t *f = &ooc->freelist[iClass];
+    if (f->nBlocks > 0) {
+      new = f->blocks[--f->nBlocks];
+    } else {
+      if (ooc->bumpLeft < szClass)
+	OocGrow(szClass);
+      new = ooc->bump;
+      ooc->bump += szClass;
+      ooc->bumpLeft -= szClass;
+    }
+    ooc->szInUse += szClass;
+    if (ooc->szInUse > ooc->szPeak)
+      ooc->szPeak = ooc->szInUse;
+    mymallocUsed += sz;
+  }
+  return(new);
+}
+
+void *OocFree(void *p, size_t sz) {
+#ifdef USE_OPENMP
+  #pragma omp critical(ooc)
+#endif
+  {
+    size_t classPages;
+    int iClass = OocClass((sz + ooc->pageSize - 1) / ooc->pageSize, /*OUT*/&classPages);
+    ooc_freelist_t *f = &ooc->freelist[iClass];
+    if (f->nBlocks == f->nAlloc) {
+      int nAlloc = MAX(16, 2 * f->nAlloc);
+      f->blocks = myrealloc(f->blocks, sizeof(void*) * f->nAlloc, sizeof(void*) * nAlloc, /*copy*/false);
+      f->nAlloc = nAlloc;
+    }
+    f->blocks[f->nBlocks++] = p;
+    ooc->szInUse -= classPages * ooc->pageSize;
+    mymallocUsed -= sz;
+  }
+  return(NULL);
+}
+
+/* The arrays of the profile that are in the store, and their sizes in whole pages */
+int OocArrays(profile_t *profile, int nPos, /*OUT*/void *arrays[4], /*OUT*/size_t sizes[4]) {
+  void *p[4] = { profile->weights, profile->codes, profile->vectors, profile->codeDist };
+  size_t sz[4] = { sizeof(numeric_t)*nPos,
+		   sizeof(unsigned char)*(PACKED_LEAF(profile) ? profile->nOccupied : nPos),
+		   sizeof(numeric_t)*nCodes*profile->nVectors, sizeof(numeric_t)*nCodes*nPos };
+  int i, n = 0;
+  for (i = 0; i < 4; i++) {
+    if (p[i] != NULL && sz[i] >= OOC_MIN_SIZE) {
+      arrays[n] = p[i];
+      sizes[n] = (sz[i] + ooc->pageSize - 1) / ooc->pageSize * ooc->pageSize;
+      n++;
+    }
+  }
+  return(n);
+}
+
+/* Returns the bytes of the profile in the store */
+double OocAdvise(profile_t *profile, int nPos, int advice) {
+  void *arrays[4];
+  size_t sizes[4];
+  int n = OocArrays(profile, nPos, /*OUT*/arrays, /*OUT*/sizes);
+  double bytes = 0;
+  int i;
+  for (i = 0; i < n; i++) {
+#ifndef _WIN32
+    if (advice != 0)
+      madvise(arrays[i], sizes[i], advice);
+#endif
+    bytes += sizes[i];
+  }
+  return(bytes);
+}
+
+#ifndef _WIN32
+#ifdef MADV_PAGEOUT
+#define OOC_PAGEOUT MADV_PAGEOUT /* write back and reclaim now (Linux 5.4) */
+#else
+#define OOC_PAGEOUT MADV_DONTNEED
+#endif
+#define OOC_WILLNEED MADV_WILLNEED
+#else
+#define OOC_PAGEOUT 0
+#define OOC_WILLNEED 0
+#endif
+
+/* The LRU routines below are called with the ooc lock held */
+int OocNewEntry(profile_t *profile) {
+  int iEntry = ooc->freeEntry;
+  if (iEntry >= 0) {
+    ooc->freeEntry = ooc->entries[iEntry].next;
+  } else {
+    if (ooc->nEntries == ooc->nEntriesAlloc) {
+      int nAlloc = MAX(1024, 2 * ooc->nEntriesAlloc);
+      ooc->entries = myrealloc(ooc->entries, sizeof(ooc_entry_t) * ooc->nEntriesAlloc,
+			       sizeof(ooc_entry_t) * nAlloc, /*copy*/false);
+      ooc->nEntriesAlloc = nAlloc;
+    }
+    iEntry = ooc->nEntries++;
+  }
+  ooc_entry_t *e = &ooc->entries[iEntry];
+  e->profile = profile;
+  e->prev = -1;
+  e->next = -1;
+  e->resident = false;
+  e->readahead = false;
+  e->bytes = 0;
+  profile->oocEntry = iEntry;
+  return(iEntry);
+}
+
+void OocUnlink(int iEntry) {
+  ooc_entry_t *e = &ooc->entries[iEntry];
+  if (e->prev >= 0)
+    ooc->entries[e->prev].next = e->next;
+  else
+    ooc->head = e->next;
+  if (e->next >= 0)
+    ooc->entries[e->next].prev = e->prev;
+  else
+    ooc->tail = e->prev;
+  e->prev = -1;
+  e->next = -1;
+}
+
+void OocPushHead(int iEntry) {
+  ooc_entry_t *e = &ooc->entries[iEntry];
+  e->prev = -1;
+  e->next = ooc->head;
+  if (ooc->head >= 0)
+    ooc->entries[ooc->head].prev = iEntry;
+  else
+    ooc->tail = iEntry;
+  ooc->head = iEntry;
+}
+
+void OocPageOut(int iEntry, int nPos) {
+  ooc_entry_t *e = &ooc->entries[iEntry];
+  OocAdvise(e->profile, nPos, OOC_PAGEOUT);
+  if (e->resident) {
+    OocUnlink(iEntry);
+    ooc->szResident -= e->bytes;
+  }
+  e->resident = false;
+  e->readahead = false;
+  e->bytes = 0;
+  ooc->nEvict++;
+}
+
+/* Make the entry the most recently used, and page out the least recently
+   used ones while over the budget */
+void OocMakeResident(int iEntry, int nPos) {
+  ooc_entry_t *e = &ooc->entries[iEntry];
+  if (e->resident) {
+    OocUnlink(iEntry);
+    ooc->szResident -= e->bytes;
+  }
+  e->resident = true;
+  e->bytes = OocAdvise(e->profile, nPos, /*advice*/0);
+  ooc->szResident += e->bytes;
+  OocPushHead(iEntry);
+  while (ooc->szResident > ooc->budget && ooc->tail != iEntry)
+    OocPageOut(ooc->tail, nPos);
+}
+
+void OocTouch(profile_t *profile, int nPos) {
+  if (profile == NULL)
+    return;
+#ifdef USE_OPENMP
+  #pragma omp critical(ooc)
+#endif
+  {
+    int iEntry = profile->oocEntry;
+    void *arrays[4];
+    size_t sizes[4];
+    if (iEntry >= 0 || OocArrays(profile, nPos, /*OUT*/arrays, /*OUT*/sizes) > 0) {
+      ooc->nTouch++;
+      if (iEntry < 0) {
+	/* never paged out, so still in memory */
+	iEntry = OocNewEntry(profile);
+	ooc->nHit++;
+      } else if (ooc->entries[iEntry].resident) {
+	ooc->nHit++;
+	if (ooc->entries[iEntry].readahead)
+	  ooc->nReadaheadHit++;
+      }
+      ooc->entries[iEntry].readahead = false;
+      OocMakeResident(iEntry, nPos);
+    }
+  }
+}
+
+void OocEvict(profile_t *profile, int nPos) {
+  if (profile == NULL)
+    return;
+#ifdef USE_OPENMP
+  #pragma omp critical(ooc)
+#endif
+  {
+    void *arrays[4];
+    size_t sizes[4];
+    if (ooc->szInUse > ooc->budget
+	&& (profile->oocEntry >= 0 || OocArrays(profile, nPos, /*OUT*/arrays, /*OUT*/sizes) > 0)) {
+      if (profile->oocEntry < 0)
+	OocNewEntry(profile);
+      OocPageOut(profile->oocEntry, nPos);
+    }
+  }
+}
+
+void OocReadahead(profile_t *profile, int nPos) {
+  /* profiles without an entry were never paged out */
+  if (profile == NULL || profile->oocEntry < 0)
+    return;
+#ifdef USE_OPENMP
+  #pragma omp critical(ooc)
+#endif
+  {
+    ooc_entry_t *e = &ooc->entries[profile->oocEntry];
+    if (!e->resident) {
+      OocAdvise(profile, nPos, OOC_WILLNEED);
+      e->readahead = true;
+      ooc->nReadahead++;
+      OocMakeResident(profile->oocEntry, nPos);
+    }
+  }
+}
+
+void OocForget(profile_t *profile) {
+  if (ooc == NULL) {
+    profile->oocEntry = -1;
+    return;
+  }
+#ifdef USE_OPENMP
+  #pragma omp critical(ooc)
+#endif
+  {
+    int iEntry = profile->oocEntry;
+    ooc_entry_t *e = &ooc->entries[iEntry];
+    if (e->resident) {
+      OocUnlink(iEntry);
+      ooc->szResident -= e->bytes;
+    }
+    e->profile = NULL;
+    e->next = ooc->freeEntry;
+    ooc->freeEntry = iEntry;
+    profile->oocEntry = -1;
+  }
+}
+
+/* The node that TraversePostorder will return after node, if the topology
+   does not change: the deepest first unvisited descendant of the next
+   unvisited sibling, or else the parent */
+int OocNextPostorder(NJ_t *NJ, traversal_t traversal, int node) {
+  int parent = NJ->parent[node];
+  int next = -1;
+  bool after = false;
+  int i;
+  for (i = 0; i < NJ->child[parent].nChild && next < 0; i++) {
+    int child = NJ->child[parent].child[i];
+    if (child == node)
+      after = true;
+    else if (after && !traversal[child])
+      next = child;
+  }
+  if (next < 0)
+    return(parent);
+  bool found = true;
+  while (found) {
+    found = false;
+    for (i = 0; i < NJ->child[next].nChild; i++) {
+      int child = NJ->child[next].child[i];
+      if (!traversal[child]) {
+	next = child;
+	found = true;
+	break;
+      }
+    }
+  }
+  return(next);
+}
+
+void OocTraverse(NJ_t *NJ, traversal_t traversal, int node) {
+  int i;
+  OocTouch(NJ->profiles[node], NJ->nPos);
+  for (i = 0; i < NJ->child[node].nChild; i++)
+    OocTouch(NJ->profiles[NJ->child[node].child[i]], NJ->nPos);
+  int next = node;
+  for (i = 0; i < OOC_READAHEAD && next != NJ->root; i++) {
+    next = OocNextPostorder(NJ, traversal, next);
+    OocReadahead(NJ->profiles[next], NJ->nPos);
+  }
+}
+
+void OocRelease(void) {
+  if (ooc == NULL)
+    return;
+#ifndef _WIN32
+  int i;
+  for (i = 0; i < ooc->nSegments; i++)
+    munmap(ooc->segments[i], ooc->segmentSizes[i]);
+  close(ooc->fd);
+#endif
+  myfree(ooc->segments, sizeof(char*) * ooc->nSegments);
+  myfree(ooc->segmentSizes, sizeof(size_t) * ooc->nSegments);
+  int iClass;
+  for (iClass = 0; iClass < OOC_NCLASSES; iClass++)
+    myfree(ooc->freelist[iClass].blocks, sizeof(void*) * ooc->freelist[iClass].nAlloc);
+  myfree(ooc->entries, sizeof(ooc_entry_t) * ooc->nEntriesAlloc);
+  ooc = myfree(ooc, sizeof(ooc_store_t));
+}
+
+void OocReport(/*WRITE*/FILE *fp) {
+  if (ooc == NULL)
+    return;
+  fprintf(fp, "Out-of-core: file %.2f MB peak-in-use %.2f MB budget %.2f MB touches %ld"
+	  " hit-rate %.1f%% evictions %ld readahead %ld (%.1f%% used) major-faults %ld\n",
+	  ooc->szFile/1.0e6, ooc->szPeak/1.0e6, ooc->budget/1.0e6, ooc->nTouch,
+	  ooc->nTouch > 0 ? 100.0 * ooc->nHit/(double)ooc->nTouch : 0.0,
+	  ooc->nEvict, ooc->nReadahead,
+	  ooc->nReadahead > 0 ? 100.0 * ooc->nReadaheadHit/(double)ooc->nReadahead : 0.0,
+	  OocMajorFaults() - ooc->majorFaults);
+}
+
+/* Slab allocation -- see the comment at the declaration of SlabAlloc.
+   Sizes up to 128 bytes use exact 16-byte classes; larger sizes use 8 classes
+   per doubling, so at most 1/8 of a block is lost to rounding.
+   There is one arena per thread, so that chunks are first touched (and hence
+   placed, on NUMA machines) by the thread that uses them, and so that the
+   parallel sections of the ML code do not need a lock to allocate.
+*/
+#define SLAB_MAX_SIZE (256*1024)
+#define SLAB_NCLASSES 96
+#define SLAB_CHUNK_SIZE (2*1024*1024)
+#define SLAB_CHUNK_HEADER 64	/* keeps blocks 16-byte aligned */
+
+typedef struct slab_chunk_s {
+  struct slab_chunk_s *next;
+} slab_chunk_t;
+
+typedef struct {
+  void *freelist[SLAB_NCLASSES];
+  slab_chunk_t *chunks;
+  char *bump;			/* next unused byte in the newest chunk */
+  size_t bumpLeft;
+  /* statistics */
+  long nChunks;
+  long nAlloc;
+  long nReuse;
+  long nLarge;
+  double szRequested;		/* bytes currently handed out, as requested */
+  double szRounded;		/* bytes currently handed out, after rounding to a class */
+  double szTail;		/* bytes left unused at the ends of full chunks */
+} slab_arena_t;
+
+slab_arena_t *slabArenas = NULL;
+int nSlabArenas = 0;
+double slabPeakRequested = 0;	/* peak over the run, summed over threads */
+double slabPeakRounded = 0;
+
+int SlabClass(size_t sz, /*OUT*/size_t *classSize) {
+  if (sz <= 128) {
+    *classSize = (sz + 15) & ~(size_t)15;
+    return((int)(*classSize/16) - 1);
+  }
+  int shift = 7;		/* 2**shift < sz <= 2**(shift+1) */
+  while (((size_t)1 << (shift+1)) < sz)
+    shift++;
+  size_t step = (size_t)1 << (shift-3);
+  size_t k = (sz + step - 1) / step; /* 9 to 16 */
+  *classSize = k * step;
+  return(8 + 8*(shift-7) + (int)(k-9));
+}
+
+/* Page-aligned memory for chunks and big arrays, so that it can use huge pages */
+void *SlabPages(size_t sz) {
+  void *new = NULL;
+#ifndef _WIN32
+  if (posix_memalign(&new, SLAB_CHUNK_SIZE, sz) != 0)
+    new = NULL;
+#ifdef MADV_HUGEPAGE
+  if (new != NULL && useHugePages)
+    madvise(new, sz, MADV_HUGEPAGE);
+#endif
+#else
+  new = malloc(sz);
+#endif
+  if (new == NULL) {
+    fprintf(stderr, "Out of memory\n");
+    exit(1);
+  }
+  szAllAlloc += sz;
+  return(new);
+}
+
+/* The peak is only sampled when a chunk is added or a report is made, as
+   that is when the memory footprint grows; summing over the arenas on every
+   call would be too slow */
+void SlabUpdatePeak(void) {
+#ifdef USE_OPENMP
+  #pragma omp critical(slabpeak)
+#endif
+  {
+    double requested = 0, rounded = 0;
+    int i;
+    for (i = 0; i < nSlabArenas; i++) {
+      requested += slabArenas[i].szRequested;
+      rounded += slabArenas[i].szRounded;
+    }
+    if (requested > slabPeakRequested) {
+      slabPeakRequested = requested;
+      slabPeakRounded = rounded;
+    }
+  }
+}
+
+void SlabInit(void) {
+  SlabReleaseAll();
+  if (!useSlab)
+    return;
+#ifdef USE_OPENMP
+  nSlabArenas = MAX(maxThreads, omp_get_num_procs());
+#else
+  nSlabArenas = 1;
+#endif
+  slabArenas = (slab_arena_t*)mymalloc(sizeof(slab_arena_t) * nSlabArenas);
+  memset(slabArenas, 0, sizeof(slab_arena_t) * nSlabArenas);
+  slabPeakRequested = 0;
+  slabPeakRounded = 0;
+}
+
+void *SlabAlloc(size_t sz) {
+  if (sz == 0) return(NULL);
+  if (ooc != NULL && sz >= OOC_MIN_SIZE)
+    return(OocAlloc(sz));
+  if (slabArenas == NULL)
+    return(mymalloc(sz));
+  int iArena = 0;
+#ifdef USE_OPENMP
+  iArena = omp_get_thread_num();
+#endif
+  assert(iArena < nSlabArenas);
+  slab_arena_t *a = &slabArenas[iArena];
+  if (sz > SLAB_MAX_SIZE) {
+    a->nLarge++;
+    if (useHugePages && sz >= SLAB_CHUNK_SIZE) {
+      mymallocUsed += sz;
+      return(SlabPages(sz));
+    }
+    return(mymalloc(sz));
+  }
+  size_t szClass;
+  int iClass = SlabClass(sz, /*OUT*/&szClass);
+  void *new = a->freelist[iClass];
+  if (new != NULL) {
+    a->freelist[iClass] = *(void**)new;
+    a->nReuse++;
+  } else {
+    if (a->bumpLeft < szClass) {
+      SlabUpdatePeak();
+      slab_chunk_t *chunk = (slab_chunk_t*)SlabPages(SLAB_CHUNK_SIZE);
+      chunk->next = a->chunks;
+      a->chunks = chunk;
+      a->nChunks++;
+      a->szTail += a->bumpLeft;
+      a->bump = (char*)chunk + SLAB_CHUNK_HEADER;
+      a->bumpLeft = SLAB_CHUNK_SIZE - SLAB_CHUNK_HEADER;
+    }
+    new = a->bump;
+    a->bump += szClass;
+    a->bumpLeft -= szClass;
+  }
+  a->nAlloc++;
+  a->szRequested += sz;
+  a->szRounded += szClass;
+  mymallocUsed += sz;
+  assert(IS_ALIGNED(new));
+  return(new);
+}
+
+void *SlabFree(void *p, size_t sz) {
+  if (p == NULL) return(NULL);
+  if (ooc != NULL && sz >= OOC_MIN_SIZE)
+    return(OocFree(p, sz));
+  if (slabArenas == NULL || sz > SLAB_MAX_SIZE)
+    return(myfree(p, sz));
+  int iArena = 0;
+#ifdef USE_OPENMP
+  iArena = omp_get_thread_num();
+#endif
+  slab_arena_t *a = &slabArenas[iArena];
+  size_t szClass;
+  int iClass = SlabClass(sz, /*OUT*/&szClass);
+  *(void**)p = a->freelist[iClass];
+  a->freelist[iClass] = p;
+  a->szRequested -= sz;
+  a->szRounded -= szClass;
+  mymallocUsed -= sz;
+  return(NULL);
+}
+
+void SlabReleaseAll(void) {
+  int i;
+  for (i = 0; i < nSlabArenas; i++) {
+    slab_chunk_t *chunk = slabArenas[i].chunks;
+    while (chunk != NULL) {
+      slab_chunk_t *next = chunk->next;
+      free(chunk);
+      chunk = next;
+    }
+  }
+  slabArenas = myfree(slabArenas, sizeof(slab_arena_t) * nSlabArenas);
+  nSlabArenas = 0;
+}
+
+void SlabReport(/*WRITE*/FILE *fp) {
+  if (slabArenas == NULL)
+    return;
+  SlabUpdatePeak();
+  long nChunks = 0, nAlloc = 0, nReuse = 0, nLarge = 0;
+  double szFree = 0, szTail = 0;
+  int i;
+  for (i = 0; i < nSlabArenas; i++) {
+    slab_arena_t *a = &slabArenas[i];
+    nChunks += a->nChunks;
+    nAlloc += a->nAlloc;
+    nReuse += a->nReuse;
+    nLarge += a->nLarge;
+    szTail += a->szTail + a->bumpLeft;
+    /* what is neither handed out nor unused at the end of a chunk is on a free list */
+    szFree += a->nChunks * (double)(SLAB_CHUNK_SIZE - SLAB_CHUNK_HEADER)
+      - a->szTail - a->bumpLeft - a->szRounded;
+  }
+  double szChunks = nChunks * (double)SLAB_CHUNK_SIZE;
+  fprintf(fp, "Slab: chunks %ld (%.2f MB) peak-in-use %.2f MB rounding %.1f%% free-listed %.2f MB"
+	  " unused-tails %.2f MB fragmentation %.1f%% reused %.1f%% large %ld\n",
+	  nChunks, szChunks/1.0e6,
+	  slabPeakRequested/1.0e6,
+	  slabPeakRounded > 0 ? 100.0 * (1.0 - slabPeakRequested/slabPeakRounded) : 0.0,
+	  szFree/1.0e6, szTail/1.0e6,
+	  szChunks > 0 ? 100.0 * (1.0 - slabPeakRequested/szChunks) : 0.0,
+	  nAlloc > 0 ? 100.0 * nReuse/(double)nAlloc : 0.0,
+	  nLarge);
+}
+
+/******************************************************************************/
+/* Minimization of a 1-dimensional function by Brent's method (Numerical Recipes)
+ * Borrowed from Tree-Puzzle 5.1 util.c under GPL
+ * Modified by M.N.P to pass in the accessory data for the optimization function,
  * to use 2x bounds around the starting guess and expand them if necessary,
  * and to use both a fractional and an absolute tolerance
  */
@@ -9351,41 +13127,131 @@ int HashFirst(hashstrings_t *hash, hashiterator_t hi) {
   return(hash->buckets[hi].first);
 }
 
+uint64_t SeqDigest(char *seq) {
+  /* 64-bit multiply-rotate hash over 8-byte words, with a final avalanche;
+     the length is mixed in so that the tail needs no padding rules */
+  const uint64_t m1 = 0x87c37b91114253d5ULL;
+  const uint64_t m2 = 0x4cf5ad432745937fULL;
+  size_t len = strlen(seq);
+  uint64_t h = 0x9e3779b97f4a7c15ULL ^ ((uint64_t)len * m2);
+  size_t i = 0;
+  for (; i + 8 <= len; i += 8) {
+    uint64_t w;
+    memcpy(&w, seq+i, sizeof(w));
+    w *= m1;
+    w = (w << 31) | (w >> 33);
+    w *= m2;
+    h ^= w;
+    h = ((h << 27) | (h >> 37)) * 5 + 0x52dce729ULL;
+  }
+  uint64_t w = 0;
+  for (; i < len; i++)
+    w = (w << 8) | (unsigned char)seq[i];
+  w *= m1;
+  w = (w << 31) | (w >> 33);
+  w *= m2;
+  h ^= w;
+  h ^= h >> 33;
+  h *= 0xff51afd7ed558ccdULL;
+  h ^= h >> 33;
+  h *= 0xc4ceb9fe1a85ec53ULL;
+  h ^= h >> 33;
+  return(h);
+}
+
+/* Groups the sequences by digest (and, if bCompare, by comparing the strings);
+   returns the number of unique sequences. uniqueLast is the tail of each group's
+   alnNext chain, so adding a copy does not walk the chain */
+int UniquifyByDigest(alignment_t *aln, uint64_t *digests, bool bCompare,
+		     /*OUT*/char **uniqueSeq, int *uniqueFirst, int *uniqueLast, int *uniqueCount,
+		     int *alnNext, int *alnToUniq) {
+  int nSlots = 1;
+  while (nSlots < 2*aln->nSeq)
+    nSlots *= 2;
+  int *slots = (int*)mymalloc(sizeof(int)*nSlots); /* iUnique+1, or 0 if empty */
+  int i;
+  for (i = 0; i < nSlots; i++)
+    slots[i] = 0;
+
+  int nUniqueSeq = 0;
+  for (i = 0; i < aln->nSeq; i++) {
+    int iSlot = (int)(digests[i] & (uint64_t)(nSlots-1));
+    int iUnique = -1;
+    while (slots[iSlot] != 0) {
+      int iOld = slots[iSlot]-1;
+      if (digests[uniqueFirst[iOld]] == digests[i]
+	  && (!bCompare || strcmp(uniqueSeq[iOld], aln->seqs[i]) == 0)) {
+	iUnique = iOld;
+	break;
+      }
+      iSlot = (iSlot+1) & (nSlots-1);
+    }
+    alnNext[i] = -1;
+    if (iUnique < 0) {
+      iUnique = nUniqueSeq++;
+      slots[iSlot] = iUnique+1;
+      uniqueSeq[iUnique] = aln->seqs[i];
+      uniqueFirst[iUnique] = i;
+      uniqueCount[iUnique] = 0;
+    } else {
+      alnNext[uniqueLast[iUnique]] = i;
+    }
+    uniqueLast[iUnique] = i;
+    uniqueCount[iUnique]++;
+    alnToUniq[i] = iUnique;
+  }
+  slots = myfree(slots, sizeof(int)*nSlots);
+  return(nUniqueSeq);
+}
+
 uniquify_t *UniquifyAln(alignment_t *aln) {
-    int nUniqueSeq = 0;
     char **uniqueSeq = (char**)mymalloc(aln->nSeq * sizeof(char*)); /* iUnique -> seq */
     int *uniqueFirst = (int*)mymalloc(aln->nSeq * sizeof(int)); /* iUnique -> iFirst in aln */
+    int *uniqueLast = (int*)mymalloc(aln->nSeq * sizeof(int)); /* iUnique -> iLast in aln */
+    int *uniqueCount = (int*)mymalloc(aln->nSeq * sizeof(int)); /* iUnique -> #copies */
     int *alnNext = (int*)mymalloc(aln->nSeq * sizeof(int)); /* i in aln -> next, or -1 */
-    int *alnToUniq = (int*)mymalloc(aln->nSeq * sizeof(int)); /* i in aln -> iUnique; many -> -1 */
+    int *alnToUniq = (int*)mymalloc(aln->nSeq * sizeof(int)); /* i in aln -> iUnique */
+    uint64_t *digests = (uint64_t*)mymalloc(aln->nSeq * sizeof(uint64_t));
 
     int i;
     for (i = 0; i < aln->nSeq; i++) {
       uniqueSeq[i] = NULL;
       uniqueFirst[i] = -1;
-      alnNext[i] = -1;
-      alnToUniq[i] = -1;
+      uniqueCount[i] = 0;
     }
-    hashstrings_t *hashseqs = MakeHashtable(aln->seqs, aln->nSeq);
-    for (i=0; i<aln->nSeq; i++) {
-      hashiterator_t hi = FindMatch(hashseqs,aln->seqs[i]);
-      int first = HashFirst(hashseqs,hi);
-      if (first == i) {
-	uniqueSeq[nUniqueSeq] = aln->seqs[i];
-	uniqueFirst[nUniqueSeq] = i;
-	alnToUniq[i] = nUniqueSeq;
-	nUniqueSeq++;
-      } else {
-	int last = first;
-	while (alnNext[last] != -1)
-	  last = alnNext[last];
-	assert(last>=0);
-	alnNext[last] = i;
-	assert(alnToUniq[last] >= 0 && alnToUniq[last] < nUniqueSeq);
-	alnToUniq[i] = alnToUniq[last];
+#ifdef USE_OPENMP
+    #pragma omp parallel for schedule(static) num_threads(otherThreads)
+#endif
+    for (i = 0; i < aln->nSeq; i++)
+      digests[i] = SeqDigest(aln->seqs[i]);
+
+    int nUniqueSeq = UniquifyByDigest(aln, digests, /*bCompare*/false,
+				      /*OUT*/uniqueSeq, uniqueFirst, uniqueLast, uniqueCount,
+				      alnNext, alnToUniq);
+
+    /* Confirm that every copy matches its exemplar */
+    bool bCollision = false;
+#ifdef USE_OPENMP
+    #pragma omp parallel for schedule(static) reduction(||:bCollision) num_threads(otherThreads)
+#endif
+    for (i = 0; i < aln->nSeq; i++) {
+      int iUnique = alnToUniq[i];
+      if (uniqueFirst[iUnique] != i && strcmp(uniqueSeq[iUnique], aln->seqs[i]) != 0)
+	bCollision = true;
+    }
+    if (bCollision) {
+      for (i = 0; i < aln->nSeq; i++) {
+	uniqueSeq[i] = NULL;
+	uniqueFirst[i] = -1;
+	uniqueCount[i] = 0;
       }
+      nUniqueSeq = UniquifyByDigest(aln, digests, /*bCompare*/true,
+				    /*OUT*/uniqueSeq, uniqueFirst, uniqueLast, uniqueCount,
+				    alnNext, alnToUniq);
     }
     assert(nUniqueSeq>0);
-    hashseqs = FreeHashtable(hashseqs);
+    digests = myfree(digests, aln->nSeq * sizeof(uint64_t));
+    uniqueLast = myfree(uniqueLast, aln->nSeq * sizeof(int));
 
     uniquify_t *uniquify = (uniquify_t*)mymalloc(sizeof(uniquify_t));
     uniquify->nSeq = aln->nSeq;
@@ -9393,6 +13259,7 @@ uniquify_t *UniquifyAln(alignment_t *aln) {
     uniquify->uniqueFirst = uniqueFirst;
     uniquify->alnNext = alnNext;
     uniquify->alnToUniq = alnToUniq;
+    uniquify->uniqueCount = uniqueCount;
     uniquify->uniqueSeq = uniqueSeq;
     return(uniquify);
 }
@@ -9402,6 +13269,7 @@ uniquify_t *FreeUniquify(uniquify_t *unique) {
     myfree(unique->uniqueFirst, sizeof(int)*unique->nSeq);
     myfree(unique->alnNext, sizeof(int)*unique->nSeq);
     myfree(unique->alnToUniq, sizeof(int)*unique->nSeq);
+    myfree(unique->uniqueCount, sizeof(int)*unique->nSeq);
     myfree(unique->uniqueSeq, sizeof(char*)*unique->nSeq);
     myfree(unique,sizeof(uniquify_t));
     unique = NULL;
@@ -9409,6 +13277,960 @@ uniquify_t *FreeUniquify(uniquify_t *unique) {
   return(unique);
 }
 
+void PrintHaplotypes(FILE *fp, int iAln, alignment_t *aln, uniquify_t *unique) {
+  int i;
+  for (i = 0; i < aln->nSeq; i++) {
+    int iUnique = unique->alnToUniq[i];
+    if (iAln >= 0)
+      fprintf(fp, "%d\t", iAln);
+    fprintf(fp, "%s\t%d\t%d\n", aln->names[i], iUnique, unique->uniqueCount[iUnique]);
+  }
+  fflush(fp);
+}
+
+void WriteSiteLogLk(FILE *fp, char *label, NJ_t *NJ,
+		    double *site_loglk, double loglk,
+		    double *gamma_site_loglk) {
+  rates_t *rates = &NJ->rates;
+  int nSites = SITES(NJ->nPos);
+  fprintf(fp, "SiteLk\t%s\t%d\t%d\t%d\t%.6f\n",
+	  label, nSites, rates->nRateCategories, gamma_site_loglk != NULL, loglk);
+  int i;
+  for (i = 0; i < rates->nRateCategories; i++) {
+    double rate = rates->rates[i];
+    fwrite(&rate, sizeof(double), 1, fp);
+  }
+  for (i = 0; i < nSites; i++) {
+    int32_t ratecat = rates->ratecat[SITE_PATTERN(i)];
+    fwrite(&ratecat, sizeof(int32_t), 1, fp);
+  }
+  for (i = 0; i < nSites; i++)
+    fwrite(&site_loglk[SITE_PATTERN(i)], sizeof(double), 1, fp);
+  if (gamma_site_loglk != NULL)
+    for (i = 0; i < nSites; i++)
+      fwrite(&gamma_site_loglk[SITE_PATTERN(i)], sizeof(double), 1, fp);
+  fflush(fp);
+}
+
+void ScoreTopologies(NJ_t *NJ, uniquify_t *unique, hashstrings_t *hashnames,
+		     FILE *fpTrees, FILE *fpSiteLk) {
+  distance_matrix_t *tmatAsDist = TransMatToDistanceMat(/*OPTIONAL*/NJ->transmat);
+  double *site_loglk = (double*)mymalloc(sizeof(double) * NJ->nPos);
+  int iTree = 0;
+  while (true) {
+    /* Stop at the end of the file, after any trailing whitespace */
+    int c = fgetc(fpTrees);
+    while (c != EOF && isspace(c))
+      c = fgetc(fpTrees);
+    if (c == EOF)
+      break;
+    ungetc(c, fpTrees);
+
+    /* Forget the current topology but keep the leaves, as if just initialized */
+    int node;
+    for (node = NJ->nSeq; node < NJ->maxnode; node++)
+      NJ->profiles[node] = FreeProfile(NJ->profiles[node], NJ->nPos, NJ->nConstraints);
+    for (node = 0; node < NJ->maxnodes; node++) {
+      NJ->parent[node] = -1;
+      NJ->child[node].nChild = 0;
+      NJ->branchlength[node] = 0;
+      NJ->support[node] = 0;
+    }
+    NJ->maxnode = NJ->nSeq;
+    ReadTree(/*IN/OUT*/NJ, unique, hashnames, /*READ*/fpTrees);
+
+    /* Start from minimum-evolution lengths, then optimize as -mllen does */
+    UpdateBranchLengths(/*IN/OUT*/NJ);
+    RecomputeProfiles(/*IN/OUT*/NJ, /*OPTIONAL*/tmatAsDist);
+    int iRound;
+    int maxRound = (int)(0.5 + log(NJ->nSeq)/log(2));
+    double lastloglk = -1e20;
+    for (iRound = 1; iRound <= maxRound; iRound++) {
+      OptimizeAllBranchLengths(/*IN/OUT*/NJ);
+      double loglk = TreeLogLk(NJ, /*site_loglk*/NULL);
+      if (loglk < lastloglk + treeLogLkDelta)
+	break;
+      lastloglk = loglk;
+    }
+    double loglk = TreeLogLk(NJ, /*OUT*/site_loglk);
+    char label[32];
+    sprintf(label, "tree%d", ++iTree);
+    WriteSiteLogLk(fpSiteLk, label, NJ, site_loglk, loglk, /*gamma*/NULL);
+    if (verbose > 0)
+      fprintf(stderr, "Scored tree %d: LogLk = %.3f\n", iTree, loglk);
+  }
+  site_loglk = myfree(site_loglk, sizeof(double) * NJ->nPos);
+  tmatAsDist = myfree(tmatAsDist, sizeof(distance_matrix_t));
+}
+
+sweep_t *ParseModels(char *spec) {
+  sweep_t *sweep = (sweep_t*)mymalloc(sizeof(sweep_t));
+  sweep->names = (char*)mymalloc(strlen(spec)+1);
+  strcpy(sweep->names, spec);
+  sweep->nModels = 1;
+  char *p;
+  for (p = spec; *p != '\0'; p++)
+    if (*p == ',')
+      sweep->nModels++;
+  sweep->models = (sweep_model_t*)mymalloc(sizeof(sweep_model_t) * sweep->nModels);
+  sweep->iModel = 0;
+  sweep->tokens[0] = sweep->tokens[1] = -1;
+  int iModel = 0;
+  char *item;
+  for (item = strtok(sweep->names, ","); item != NULL; item = strtok(NULL, ",")) {
+    sweep_model_t *model = &sweep->models[iModel++];
+    model->name = item;
+    model->nRateCats = nRateCats;
+    model->loglk = 0;
+    model->ok = true;
+    model->fpResult = NULL;
+    model->pid = -1;
+    char *colon = strchr(item, ':');
+    if (colon != NULL) {
+      *colon = '\0';
+      model->nRateCats = atoi(colon+1);
+      if (model->nRateCats < 1) {
+	fprintf(stderr, "Illegal number of rate categories in -models: %s\n", colon+1);
+	exit(1);
+      }
+    }
+    bool known = nCodes == 20 ?
+      (strcmp(item, "jtt") == 0 || strcmp(item, "wag") == 0 || strcmp(item, "lg") == 0)
+      : (strcmp(item, "jc") == 0 || strcmp(item, "gtr") == 0);
+    if (!known) {
+      fprintf(stderr, "Unknown %s model in -models: %s (use %s)\n",
+	      nCodes == 20 ? "amino acid" : "nucleotide", item,
+	      nCodes == 20 ? "jtt, wag, or lg" : "jc or gtr");
+      exit(1);
+    }
+  }
+  if (iModel != sweep->nModels) {
+    fprintf(stderr, "Empty model name in -models: %s\n", spec);
+    exit(1);
+  }
+  return(sweep);
+}
+
+sweep_t *FreeSweep(sweep_t *sweep) {
+  if (sweep == NULL)
+    return(NULL);
+  sweep->models = myfree(sweep->models, sizeof(sweep_model_t) * sweep->nModels);
+  sweep->names = myfree(sweep->names, strlen(sweep->names)+1);
+  return(myfree(sweep, sizeof(sweep_t)));
+}
+
+transition_matrix_t *SetModel(sweep_model_t *model, bool bFixedGtr,
+			      double *gtrrates, double *gtrfreq) {
+  bUseGtr = strcmp(model->name, "gtr") == 0;
+  bUseLg = strcmp(model->name, "lg") == 0;
+  bUseWag = strcmp(model->name, "wag") == 0;
+  nRateCats = model->nRateCats;
+  if (nCodes == 20)
+    return(bUseLg ? CreateTransitionMatrix(matrixLG08,statLG08) :
+	   (bUseWag ? CreateTransitionMatrix(matrixWAG01,statWAG01) :
+	    CreateTransitionMatrix(matrixJTT92,statJTT92)));
+  if (bUseGtr && bFixedGtr)
+    return(CreateGTR(gtrrates,gtrfreq));
+  return(NULL);
+}
+
+int ProcessBudget(int nProcs) {
+  if (nProcs > 0)
+    return(nProcs);
+#ifdef USE_OPENMP
+  return(PHASE_THREADS(PHASE_ML));
+#else
+  return(1);
+#endif
+}
+
+#ifndef _WIN32
+int WaitForChild(int nPids, int *pids, int *status) {
+  const struct timespec pause = { 0, 10*1000*1000 }; /* 10 ms */
+  while (true) {
+    int i;
+    for (i = 0; i < nPids; i++) {
+      if (pids[i] < 0)
+	continue;
+      pid_t pid = waitpid(pids[i], status, WNOHANG);
+      if (pid == pids[i])
+	return(i);
+      if (pid < 0 && errno != EINTR)
+	return(-1);
+    }
+    nanosleep(&pause, NULL);
+  }
+}
+
+void StartSweep(sweep_t *sweep, int nProcs) {
+  int i;
+  nProcs = ProcessBudget(nProcs);
+  for (i = 0; i < N_PHASES; i++)
+    phaseThreads[i] = 1;
+  if (pipe(sweep->tokens) != 0) {
+    fprintf(stderr, "Cannot create a pipe for -models: %s\n", strerror(errno));
+    exit(1);
+  }
+  char token = 1;
+  for (i = 1; i < nProcs && i < sweep->nModels; i++)
+    if (write(sweep->tokens[1], &token, 1) != 1) {
+      fprintf(stderr, "Cannot write to the pipe for -models: %s\n", strerror(errno));
+      exit(1);
+    }
+  fflush(stdout);
+  fflush(stderr);
+  sweep->iModel = 0;
+  for (i = 0; i < sweep->nModels; i++) {
+    sweep_model_t *model = &sweep->models[i];
+    model->ok = true;
+    model->pid = -1;
+    model->fpResult = NULL;
+    if (i == 0)
+      continue;
+    model->fpResult = tmpfile();
+    if (model->fpResult == NULL) {
+      fprintf(stderr, "Cannot create a temporary file for -models: %s\n", strerror(errno));
+      exit(1);
+    }
+    model->pid = fork();
+    if (model->pid < 0) {
+      fprintf(stderr, "Cannot fork for -models: %s\n", strerror(errno));
+      exit(1);
+    }
+    if (model->pid == 0) {
+      sweep->iModel = i;
+      while (read(sweep->tokens[0], &token, 1) != 1)
+	if (errno != EINTR)
+	  _exit(1);
+      for (i = 0; i < N_PHASES; i++)
+	phaseThreads[i] = 1;
+#ifdef USE_OPENMP
+      omp_set_num_threads(1);
+#endif
+      verbose = 0;
+      showProgress = 0;
+      profiling = false;
+      return;
+    }
+  }
+}
+
+void EndSweepChild(sweep_t *sweep, NJ_t *NJ, char **names, uniquify_t *unique) {
+  sweep_model_t *model = &sweep->models[sweep->iModel];
+  fprintf(model->fpResult, "%.6f\n", model->loglk);
+  PrintNJ(model->fpResult, NJ, names, unique, /*support*/nBootstrap > 0, bQuote);
+  bool ok = fflush(model->fpResult) == 0 && !ferror(model->fpResult);
+  char token = 1;
+  if (write(sweep->tokens[1], &token, 1) != 1)
+    ok = false;
+  /* Not exit(), which would also flush the parent's buffers copied by fork() */
+  _exit(ok ? 0 : 1);
+}
+
+char *FinishSweep(sweep_t *sweep, FILE *fpLog, FILE *fpModels) {
+  int i;
+  char token = 1;
+  if (write(sweep->tokens[1], &token, 1) != 1) {
+    fprintf(stderr, "Cannot write to the pipe for -models: %s\n", strerror(errno));
+    exit(1);
+  }
+  /* Wait for the children in any order, and give back the slot of a child that
+     failed before giving it back itself, so that the others do not wait forever */
+  int *pids = (int*)mymalloc(sizeof(int) * sweep->nModels);
+  for (i = 0; i < sweep->nModels; i++)
+    pids[i] = sweep->models[i].pid; /* -1 for the parent's own model */
+  int nLeft = sweep->nModels - 1;
+  while (nLeft > 0) {
+    int status;
+    i = WaitForChild(sweep->nModels, pids, /*OUT*/&status);
+    if (i < 0) {
+      fprintf(stderr, "Lost the processes of -models: %s\n", strerror(errno));
+      exit(1);
+    }
+    sweep_model_t *model = &sweep->models[i];
+    pids[i] = -1;
+    model->pid = -1;
+    model->ok = WIFEXITED(status) && WEXITSTATUS(status) == 0;
+    if (!model->ok && write(sweep->tokens[1], &token, 1) != 1) {
+      fprintf(stderr, "Cannot write to the pipe for -models: %s\n", strerror(errno));
+      exit(1);
+    }
+    nLeft--;
+  }
+  pids = myfree(pids, sizeof(int) * sweep->nModels);
+  close(sweep->tokens[0]);
+  close(sweep->tokens[1]);
+
+  /* Read the log likelihoods of the children, and pick the best model */
+  int iBest = 0;
+  for (i = 1; i < sweep->nModels; i++) {
+    sweep_model_t *model = &sweep->models[i];
+    char line[100];
+    rewind(model->fpResult);
+    if (model->ok && fgets(line, sizeof(line), model->fpResult) != NULL)
+      model->loglk = atof(line);
+    else
+      model->ok = false;
+    if (model->ok && model->loglk > sweep->models[iBest].loglk)
+      iBest = i;
+  }
+
+  for (i = 0; i < sweep->nModels; i++) {
+    sweep_model_t *model = &sweep->models[i];
+    if (!model->ok) {
+      fprintf(stderr, "Model %s:%d failed\n", model->name, model->nRateCats);
+      if (fpModels)
+	fprintf(fpModels, "%s\t%d\tnan\t0\n", model->name, model->nRateCats);
+      continue;
+    }
+    if (verbose > 0)
+      fprintf(stderr, "Model %s:%d LogLk = %.3f%s\n", model->name, model->nRateCats,
+	      model->loglk, i == iBest ? " (best)" : "");
+    if (fpLog)
+      fprintf(fpLog, "ModelLogLk\t%s\t%d\t%.4f\n", model->name, model->nRateCats, model->loglk);
+    if (fpModels)
+      fprintf(fpModels, "%s\t%d\t%.6f\t%d\n", model->name, model->nRateCats, model->loglk, i == iBest);
+  }
+  if (fpModels)
+    fflush(fpModels);
+
+  /* The tree of the best model is the rest of its file */
+  char *tree = NULL;
+  if (iBest > 0) {
+    FILE *fp = sweep->models[iBest].fpResult;
+    long start = ftell(fp);
+    fseek(fp, 0, SEEK_END);
+    long size = ftell(fp) - start;
+    fseek(fp, start, SEEK_SET);
+    tree = (char*)mymalloc(size+1);
+    if (fread(tree, 1, size, fp) != (size_t)size) {
+      fprintf(stderr, "Cannot read the tree of model %s\n", sweep->models[iBest].name);
+      exit(1);
+    }
+    tree[size] = '\0';
+  }
+  for (i = 1; i < sweep->nModels; i++) {
+    fclose(sweep->models[i].fpResult);
+    sweep->models[i].fpResult = NULL;
+  }
+  return(tree);
+}
+#else
+/* Not reached, as -models is refused on Windows */
+void StartSweep(sweep_t *sweep, int nProcs) {
+  sweep->iModel = 0;
+}
+
+void EndSweepChild(sweep_t *sweep, NJ_t *NJ, char **names, uniquify_t *unique) {
+  exit(1);
+}
+
+char *FinishSweep(sweep_t *sweep, FILE *fpLog, FILE *fpModels) {
+  return(NULL);
+}
+#endif
+
+void SetReplicateWeights(int nPos) {
+  int nSites = SITES(nPos);
+  int *col = ResampleColumns(nPos, /*nBootstrap*/1);
+  if (patternCount == NULL) {
+    /* Without -patterns, each column is its own pattern */
+    patternCount = (int*)mymalloc(sizeof(int)*nPos);
+    nPatternSites = nPos;
+  }
+  int i;
+  for (i = 0; i < nPos; i++)
+    patternCount[i] = 0;
+  for (i = 0; i < nSites; i++)
+    patternCount[col[i]]++;
+  col = myfree(col, sizeof(int)*nSites);
+}
+
+static inline uint64_t SplitKey(int leaf) {
+  /* splitmix64 */
+  uint64_t z = ((uint64_t)leaf + 1) * 0x9E3779B97F4A7C15ULL;
+  z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+  z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+  return(z ^ (z >> 31));
+}
+
+uint64_t *SplitHashes(NJ_t *NJ) {
+  uint64_t *hash = (uint64_t*)mymalloc(sizeof(uint64_t) * NJ->maxnodes);
+  traversal_t traversal = InitTraversal(NJ);
+  int node = NJ->root;
+  while((node = TraversePostorder(node, NJ, /*IN/OUT*/traversal, /*pUp*/NULL)) >= 0) {
+    if (node < NJ->nSeq) {
+      hash[node] = SplitKey(node);
+    } else {
+      int j;
+      hash[node] = 0;
+      for (j = 0; j < NJ->child[node].nChild; j++)
+	hash[node] += hash[NJ->child[node].child[j]];
+    }
+  }
+  traversal = FreeTraversal(traversal,NJ);
+  uint64_t total = hash[NJ->root];
+  for (node = 0; node < NJ->maxnode; node++)
+    if (node != NJ->root && total - hash[node] < hash[node])
+      hash[node] = total - hash[node];
+  return(hash);
+}
+
+#ifndef _WIN32
+gboot_t *StartGlobalBootstrap(int nReplicates, int nProcs, int nPos, long seed) {
+  int nBudget = ProcessBudget(nProcs);
+  gboot_t *gboot = (gboot_t*)mymalloc(sizeof(gboot_t));
+  gboot->nReplicates = nReplicates;
+  gboot->bInline = nBudget <= 1;
+  gboot->nWorkers = MAX(1, MIN(nBudget - 1, nReplicates));
+  gboot->pids = (int*)mymalloc(sizeof(int) * gboot->nWorkers);
+  gboot->fpSplits = (FILE**)mymalloc(sizeof(FILE*) * gboot->nWorkers);
+  gboot->iReplicate = -1;
+  int i;
+  if (!gboot->bInline) {
+    /* Every process is single-threaded, as OpenMP's threads cannot be used again after fork() */
+    for (i = 0; i < N_PHASES; i++)
+      phaseThreads[i] = 1;
+  }
+  fflush(stdout);
+  fflush(stderr);
+  int iWorker;
+  for (iWorker = 0; iWorker < gboot->nWorkers; iWorker++) {
+    gboot->fpSplits[iWorker] = tmpfile();
+    if (gboot->fpSplits[iWorker] == NULL) {
+      fprintf(stderr, "Cannot create a temporary file for -gboot: %s\n", strerror(errno));
+      exit(1);
+    }
+    if (gboot->bInline) {
+      gboot->pids[iWorker] = -1;
+      ForkReplicates(/*IN/OUT*/gboot, iWorker, nPos, seed);
+      return(gboot);		/* in the parent or in a replicate */
+    }
+    gboot->pids[iWorker] = fork();
+    if (gboot->pids[iWorker] < 0) {
+      fprintf(stderr, "Cannot fork for -gboot: %s\n", strerror(errno));
+      exit(1);
+    }
+    if (gboot->pids[iWorker] == 0) {
+      if (ForkReplicates(/*IN/OUT*/gboot, iWorker, nPos, seed))
+	return(gboot);
+      _exit(0);
+    }
+  }
+  return(gboot);
+}
+
+bool ForkReplicates(gboot_t *gboot, int iWorker, int nPos, long seed) {
+  int iReplicate;
+  for (iReplicate = iWorker; iReplicate < gboot->nReplicates; iReplicate += gboot->nWorkers) {
+    pid_t pid = fork();
+    if (pid == 0) {
+      int i;
+      for (i = 0; i < N_PHASES; i++)
+	phaseThreads[i] = 1;
+#ifdef USE_OPENMP
+      omp_set_num_threads(1);
+#endif
+      verbose = 0;
+      showProgress = 0;
+      showWarnings = false;
+      profiling = false;
+      gboot->iReplicate = iReplicate;
+      ran_start((seed + 1 + iReplicate) % 1073741821L);
+      SetReplicateWeights(nPos);
+      return(true);
+    }
+    if (pid < 0)
+      fprintf(stderr, "Cannot fork for -gboot: %s\n", strerror(errno));
+    /* A failed replicate writes no record, and the parent counts the records */
+    int status;
+    while (pid > 0 && waitpid(pid, &status, 0) < 0 && errno == EINTR)
+      ;
+  }
+  return(false);
+}
+
+void EndReplicate(gboot_t *gboot, NJ_t *NJ) {
+  uint64_t *hash = SplitHashes(NJ);
+  int nSplits = NJ->maxnode - NJ->nSeq - 1; /* the internal nodes but the root */
+  /* The record is written at once, so that a failed replicate leaves nothing */
+  size_t sz = 2 * sizeof(int32_t) + nSplits * sizeof(uint64_t);
+  char *record = (char*)mymalloc(sz);
+  int32_t header[2] = { gboot->iReplicate, nSplits };
+  memcpy(record, header, sizeof(header));
+  uint64_t *splits = (uint64_t*)(record + sizeof(header));
+  int node;
+  for (node = NJ->nSeq; node < NJ->maxnode; node++)
+    if (node != NJ->root)
+      *splits++ = hash[node];
+  FILE *fp = gboot->fpSplits[gboot->iReplicate % gboot->nWorkers];
+  bool ok = fwrite(record, 1, sz, fp) == sz && fflush(fp) == 0;
+  /* Not exit(), which would also flush the parent's buffers copied by fork() */
+  _exit(ok ? 0 : 1);
+}
+
+typedef struct {
+  uint64_t hash;
+  int node;
+} split_hash_t;
+
+int CompareSplitHashes(const void *c1, const void *c2) {
+  uint64_t h1 = ((split_hash_t*)c1)->hash;
+  uint64_t h2 = ((split_hash_t*)c2)->hash;
+  return(h1 < h2 ? -1 : (h1 > h2 ? 1 : 0));
+}
+
+void GlobalBootstrapSupport(gboot_t *gboot, NJ_t *NJ) {
+  int iWorker;
+  for (iWorker = 0; iWorker < gboot->nWorkers && !gboot->bInline; iWorker++) {
+    int status;
+    while (waitpid(gboot->pids[iWorker], &status, 0) < 0 && errno == EINTR)
+      ;
+  }
+
+  /* The splits of the main tree, sorted by hash, and how many replicates have each */
+  uint64_t *hash = SplitHashes(NJ);
+  int nSplits = 0;
+  split_hash_t *splits = (split_hash_t*)mymalloc(sizeof(split_hash_t) * NJ->maxnodes);
+  int node;
+  for (node = NJ->nSeq; node < NJ->maxnode; node++) {
+    if (node != NJ->root) {
+      splits[nSplits].hash = hash[node];
+      splits[nSplits].node = node;
+      nSplits++;
+    }
+  }
+  hash = myfree(hash, sizeof(uint64_t) * NJ->maxnodes);
+  qsort(splits, nSplits, sizeof(split_hash_t), CompareSplitHashes);
+  int *count = (int*)mymalloc(sizeof(int) * NJ->maxnodes);
+  for (node = 0; node < NJ->maxnodes; node++)
+    count[node] = 0;
+
+  int nDone = 0;
+  uint64_t *replicate = (uint64_t*)mymalloc(sizeof(uint64_t) * NJ->maxnodes);
+  for (iWorker = 0; iWorker < gboot->nWorkers; iWorker++) {
+    FILE *fp = gboot->fpSplits[iWorker];
+    int32_t header[2];
+    rewind(fp);
+    while (fread(header, sizeof(int32_t), 2, fp) == 2) {
+      int nRepSplits = header[1];
+      if (nRepSplits < 0 || nRepSplits > NJ->maxnodes
+	  || fread(replicate, sizeof(uint64_t), nRepSplits, fp) != (size_t)nRepSplits)
+	break;
+      int i;
+      for (i = 0; i < nRepSplits; i++) {
+	split_hash_t key = { replicate[i], -1 };
+	split_hash_t *found = (split_hash_t*)bsearch(&key, splits, nSplits, sizeof(split_hash_t),
+						    CompareSplitHashes);
+	if (found != NULL)
+	  count[found->node]++;
+      }
+      nDone++;
+    }
+  }
+  replicate = myfree(replicate, sizeof(uint64_t) * NJ->maxnodes);
+
+  int i;
+  for (i = 0; i < nSplits; i++) {
+    node = splits[i].node;
+    NJ->support[node] = nDone > 0 ? count[node] / (double)nDone : 0.0;
+  }
+  if (nDone < gboot->nReplicates)
+    fprintf(stderr, "Warning: %d of %d global bootstrap replicates failed\n",
+	    gboot->nReplicates - nDone, gboot->nReplicates);
+  if (verbose > 0)
+    fprintf(stderr, "Global bootstrap supports from %d replicates\n", nDone);
+  count = myfree(count, sizeof(int) * NJ->maxnodes);
+  splits = myfree(splits, sizeof(split_hash_t) * NJ->maxnodes);
+}
+#else
+/* Not reached, as -gboot is refused on Windows */
+gboot_t *StartGlobalBootstrap(int nReplicates, int nProcs, int nPos, long seed) {
+  exit(1);
+}
+
+void EndReplicate(gboot_t *gboot, NJ_t *NJ) {
+  exit(1);
+}
+
+void GlobalBootstrapSupport(gboot_t *gboot, NJ_t *NJ) {
+}
+#endif
+
+gboot_t *FreeGlobalBootstrap(gboot_t *gboot) {
+  if (gboot == NULL)
+    return(NULL);
+  int iWorker;
+  for (iWorker = 0; iWorker < gboot->nWorkers; iWorker++)
+    fclose(gboot->fpSplits[iWorker]);
+  gboot->fpSplits = myfree(gboot->fpSplits, sizeof(FILE*) * gboot->nWorkers);
+  gboot->pids = myfree(gboot->pids, sizeof(int) * gboot->nWorkers);
+  return(myfree(gboot, sizeof(gboot_t)));
+}
+
+#ifndef _WIN32
+aln_jobs_t *StartAlnJobs(int nProcs, FILE *fpIn, FILE **streams[ALN_STREAMS]) {
+  aln_jobs_t *jobs = (aln_jobs_t*)mymalloc(sizeof(aln_jobs_t));
+  jobs->nProcs = nProcs;
+  jobs->nWindow = 2 * jobs->nProcs;
+  jobs->jobs = (aln_job_t*)mymalloc(sizeof(aln_job_t) * jobs->nWindow);
+  jobs->nStarted = 0;
+  jobs->nWritten = 0;
+  jobs->nRunning = 0;
+  jobs->fpIn = fpIn;
+  jobs->iAln = -1;
+  int i;
+  for (i = 0; i < ALN_STREAMS; i++)
+    jobs->streams[i] = streams[i];
+  return(jobs);
+}
+
+/* Waits for one of the running alignments to finish */
+void WaitAlnJob(aln_jobs_t *jobs) {
+  /* Indexed by slot; the slots of the finished or unused ones are -1 */
+  int *pids = (int*)mymalloc(sizeof(int) * jobs->nWindow);
+  int i;
+  for (i = 0; i < jobs->nWindow; i++)
+    pids[i] = -1;
+  int iAln;
+  for (iAln = jobs->nWritten; iAln < jobs->nStarted; iAln++)
+    pids[iAln % jobs->nWindow] = jobs->jobs[iAln % jobs->nWindow].pid;
+  int status;
+  i = WaitForChild(jobs->nWindow, pids, /*OUT*/&status);
+  if (i < 0) {
+    fprintf(stderr, "Lost the processes of -nprocs: %s\n", strerror(errno));
+    exit(1);
+  }
+  aln_job_t *job = &jobs->jobs[i];
+  job->pid = -1;
+  job->ok = WIFEXITED(status) && WEXITSTATUS(status) == 0;
+  jobs->nRunning--;
+  pids = myfree(pids, sizeof(int) * jobs->nWindow);
+}
+
+/* Copies the parts of the finished alignments that are next in input order */
+void WriteAlnJobs(aln_jobs_t *jobs) {
+  char buf[BUFFER_SIZE];
+  while (jobs->nWritten < jobs->nStarted) {
+    aln_job_t *job = &jobs->jobs[jobs->nWritten % jobs->nWindow];
+    if (job->pid >= 0)
+      break;
+    if (!job->ok) {
+      fprintf(stderr, "Building the tree for alignment %d failed\n", jobs->nWritten+1);
+      exit(1);
+    }
+    int i;
+    for (i = 0; i < ALN_STREAMS; i++) {
+      FILE *fpPart = job->fpParts[i];
+      FILE *fp = *jobs->streams[i];
+      if (fpPart == NULL)
+	continue;
+      rewind(fpPart);
+      size_t n;
+      while ((n = fread(buf, 1, sizeof(buf)-1, fpPart)) > 0) {
+	if (fp == stdout) {
+	  /* through fputs, which the Python module redirects; the tree is text */
+	  buf[n] = '\0';
+	  fputs(buf, fp);
+	} else if (fwrite(buf, 1, n, fp) != n) {
+	  fprintf(stderr, "Cannot write the output of alignment %d: %s\n",
+		  jobs->nWritten+1, strerror(errno));
+	  exit(1);
+	}
+      }
+      fflush(fp);
+      fclose(fpPart);
+      job->fpParts[i] = NULL;
+    }
+    jobs->nWritten++;
+  }
+}
+
+bool StartAlnJob(aln_jobs_t *jobs, int iAln) {
+  assert(iAln == jobs->nStarted);
+  while (jobs->nRunning >= jobs->nProcs || jobs->nStarted - jobs->nWritten >= jobs->nWindow) {
+    WaitAlnJob(jobs);
+    WriteAlnJobs(jobs);
+  }
+  aln_job_t *job = &jobs->jobs[iAln % jobs->nWindow];
+  int i;
+  for (i = 0; i < ALN_STREAMS; i++) {
+    job->fpParts[i] = NULL;
+    if (*jobs->streams[i] == NULL)
+      continue;
+    job->fpParts[i] = tmpfile();
+    if (job->fpParts[i] == NULL) {
+      fprintf(stderr, "Cannot create a temporary file for -nprocs: %s\n", strerror(errno));
+      exit(1);
+    }
+    /* or a child that fails would write the parent's buffer again */
+    fflush(*jobs->streams[i]);
+  }
+  fflush(stdout);
+  fflush(stderr);
+  job->ok = true;
+  job->pid = fork();
+  if (job->pid < 0) {
+    fprintf(stderr, "Cannot fork for -nprocs: %s\n", strerror(errno));
+    exit(1);
+  }
+  if (job->pid == 0) {
+    jobs->iAln = iAln;
+    /* The input's offset is shared with the parent, and exit() in the child
+       would move it back to the end of what its buffer used */
+    int fdNull = open("/dev/null", O_RDONLY);
+    if (fdNull >= 0) {
+      dup2(fdNull, fileno(jobs->fpIn));
+      close(fdNull);
+    }
+    for (i = 0; i < ALN_STREAMS; i++)
+      if (job->fpParts[i] != NULL)
+	*jobs->streams[i] = job->fpParts[i];
+    /* Every child is single-threaded, as there are nProcs of them */
+    for (i = 0; i < N_PHASES; i++)
+      phaseThreadsOption[i] = 1;
+#ifdef USE_OPENMP
+    omp_set_num_threads(1);
+#endif
+    verbose = 0;
+    showProgress = 0;
+    profiling = false;
+    return(true);
+  }
+  jobs->nStarted++;
+  jobs->nRunning++;
+  return(false);
+}
+
+void EndAlnJob(aln_jobs_t *jobs) {
+  aln_job_t *job = &jobs->jobs[jobs->iAln % jobs->nWindow];
+  bool ok = true;
+  int i;
+  for (i = 0; i < ALN_STREAMS; i++)
+    if (job->fpParts[i] != NULL && (fflush(job->fpParts[i]) != 0 || ferror(job->fpParts[i])))
+      ok = false;
+  /* Not exit(), which would also flush the parent's buffers copied by fork() */
+  _exit(ok ? 0 : 1);
+}
+
+aln_jobs_t *FinishAlnJobs(aln_jobs_t *jobs) {
+  if (jobs == NULL)
+    return(NULL);
+  while (jobs->nRunning > 0) {
+    WaitAlnJob(jobs);
+    WriteAlnJobs(jobs);
+  }
+  WriteAlnJobs(jobs);
+  jobs->jobs = myfree(jobs->jobs, sizeof(aln_job_t) * jobs->nWindow);
+  return(myfree(jobs, sizeof(aln_jobs_t)));
+}
+#else
+/* Not reached, as -nprocs is refused on Windows */
+aln_jobs_t *StartAlnJobs(int nProcs, FILE *fpIn, FILE **streams[ALN_STREAMS]) {
+  exit(1);
+}
+
+bool StartAlnJob(aln_jobs_t *jobs, int iAln) {
+  return(true);
+}
+
+void EndAlnJob(aln_jobs_t *jobs) {
+  exit(1);
+}
+
+aln_jobs_t *FinishAlnJobs(aln_jobs_t *jobs) {
+  return(NULL);
+}
+#endif
+
+prof_thread_t *ProfThread(void) {
+#if defined(__GNUC__) || defined(__clang__)
+  static __thread prof_thread_t *thread = NULL;
+#else
+  static prof_thread_t *thread = NULL; /* no timed scopes without GCC or Clang */
+#endif
+  if (thread == NULL) {
+    /* Kept until the process exits, as the thread-local pointer outlives runs */
+    thread = (prof_thread_t*)calloc(1, sizeof(prof_thread_t));
+    if (thread == NULL) {
+      fprintf(stderr, "Out of memory for the profiler\n");
+      exit(1);
+    }
+#ifdef USE_OPENMP
+    #pragma omp critical(profthreads)
+#endif
+    {
+      thread->id = profThreads == NULL ? 0 : profThreads->id + 1;
+      thread->next = profThreads;
+      profThreads = thread;
+    }
+  }
+  return(thread);
+}
+
+void ProfReset(void) {
+  prof_thread_t *t;
+  for (t = profThreads; t != NULL; t = t->next) {
+    t->depth = 0;
+    t->path = 0;
+    memset(t->entries, 0, sizeof(t->entries));
+  }
+}
+
+/* Writes {"unit": "ns", "scopes": [names], "threads": [...]}, where each thread
+   has its "id", "totals" by scope name (calls, total and self time, counting
+   only the outermost of recursive calls in the total), and "paths", each with
+   its "stack" of scope names from the outermost, calls, total, and self time.
+   Threads are numbered in order of first use, and the first is the main thread.
+   Collapsed stacks for flame graphs are the paths with their self times.
+*/
+void WriteProfile(FILE *fp) {
+  int nThreads = profThreads == NULL ? 0 : profThreads->id + 1;
+  prof_thread_t **threads = (prof_thread_t**)mymalloc(sizeof(prof_thread_t*) * (nThreads > 0 ? nThreads : 1));
+  prof_thread_t *t;
+  for (t = profThreads; t != NULL; t = t->next)
+    threads[t->id] = t;
+
+  int i, iThread, iScope;
+  fprintf(fp, "{\"unit\": \"ns\", \"scopes\": [");
+  for (iScope = 0; iScope < N_PROF_SCOPES; iScope++)
+    fprintf(fp, "%s\"%s\"", iScope > 0 ? ", " : "", profNames[iScope]);
+  fprintf(fp, "],\n \"threads\": [");
+  for (iThread = 0; iThread < nThreads; iThread++) {
+    t = threads[iThread];
+    long calls[N_PROF_SCOPES];
+    int64_t total[N_PROF_SCOPES], self[N_PROF_SCOPES];
+    for (iScope = 0; iScope < N_PROF_SCOPES; iScope++) {
+      calls[iScope] = 0;
+      total[iScope] = self[iScope] = 0;
+    }
+    for (i = 0; i < PROF_PATHS; i++) {
+      prof_entry_t *e = &t->entries[i];
+      if (e->path == 0)
+	continue;
+      int id = (int)(e->path & 15) - 1;
+      uint64_t outer;
+      bool recursive = false;
+      for (outer = e->path >> 4; outer != 0; outer >>= 4)
+	if ((int)(outer & 15) - 1 == id)
+	  recursive = true;
+      calls[id] += e->calls;
+      self[id] += e->self;
+      if (!recursive)
+	total[id] += e->total;
+    }
+    fprintf(fp, "%s\n  {\"id\": %d, \"totals\": {", iThread > 0 ? "," : "", t->id);
+    bool first = true;
+    for (iScope = 0; iScope < N_PROF_SCOPES; iScope++) {
+      if (calls[iScope] == 0)
+	continue;
+      fprintf(fp, "%s\n    \"%s\": {\"calls\": %ld, \"total\": %lld, \"self\": %lld}",
+	      first ? "" : ",", profNames[iScope], calls[iScope],
+	      (long long)total[iScope], (long long)self[iScope]);
+      first = false;
+    }
+    fprintf(fp, "},\n   \"paths\": [");
+    first = true;
+    for (i = 0; i < PROF_PATHS; i++) {
+      prof_entry_t *e = &t->entries[i];
+      if (e->path == 0)
+	continue;
+      int ids[PROF_MAX_DEPTH];
+      int depth = 0;
+      uint64_t path;
+      for (path = e->path; path != 0; path >>= 4)
+	ids[depth++] = (int)(path & 15) - 1;
+      fprintf(fp, "%s\n    {\"stack\": [", first ? "" : ",");
+      while (depth-- > 0)
+	fprintf(fp, "\"%s\"%s", profNames[ids[depth]], depth > 0 ? ", " : "");
+      fprintf(fp, "], \"calls\": %ld, \"total\": %lld, \"self\": %lld}",
+	      e->calls, (long long)e->total, (long long)e->self);
+      first = false;
+    }
+    fprintf(fp, "]}");
+  }
+  fprintf(fp, "]}\n");
+  threads = myfree(threads, sizeof(prof_thread_t*) * (nThreads > 0 ? nThreads : 1));
+}
+
+int CompressPatterns(/*IN/OUT*/char **seqs, int nSeq, int nPos) {
+  FreePatterns();
+  nPatternSites = nPos;
+  posToPattern = (int*)mymalloc(sizeof(int)*nPos);
+  patternCount = (int*)mymalloc(sizeof(int)*nPos); /* only the first nPatterns are used */
+  int *patternFirst = (int*)mymalloc(sizeof(int)*nPos); /* iPattern -> first column */
+
+  /* Hash each column, going through one sequence at a time so that
+     the sequences are read in order */
+  unsigned int *hashes = (unsigned int*)mymalloc(sizeof(unsigned int)*nPos);
+  int iSeq, iPos;
+  for (iPos = 0; iPos < nPos; iPos++)
+    hashes[iPos] = 2166136261U;
+  for (iSeq = 0; iSeq < nSeq; iSeq++) {
+    char *seq = seqs[iSeq];
+    for (iPos = 0; iPos < nPos; iPos++)
+      hashes[iPos] = (hashes[iPos] ^ (unsigned char)toupper(seq[iPos])) * 16777619U;
+  }
+
+  /* Open addressing, with at most half of the slots in use; slots hold iPattern+1 */
+  int nSlots = 1;
+  while (nSlots < 2*nPos)
+    nSlots *= 2;
+  int *slots = (int*)mymalloc(sizeof(int)*nSlots);
+  int iSlot;
+  for (iSlot = 0; iSlot < nSlots; iSlot++)
+    slots[iSlot] = 0;
+
+  int nPatterns = 0;
+  for (iPos = 0; iPos < nPos; iPos++) {
+    iSlot = hashes[iPos] & (nSlots-1);
+    int iPattern = -1;
+    while (slots[iSlot] != 0) {
+      int iOld = slots[iSlot]-1;
+      int first = patternFirst[iOld];
+      if (hashes[first] == hashes[iPos]) {
+	for (iSeq = 0; iSeq < nSeq; iSeq++)
+	  if (toupper(seqs[iSeq][first]) != toupper(seqs[iSeq][iPos]))
+	    break;
+	if (iSeq == nSeq) {
+	  iPattern = iOld;
+	  break;
+	}
+      }
+      iSlot = (iSlot+1) & (nSlots-1);
+    }
+    if (iPattern < 0) {
+      iPattern = nPatterns++;
+      slots[iSlot] = iPattern+1;
+      patternFirst[iPattern] = iPos;
+      patternCount[iPattern] = 0;
+    }
+    patternCount[iPattern]++;
+    posToPattern[iPos] = iPattern;
+  }
+
+  /* Rewrite the sequences in place -- this is safe because patternFirst[i] >= i */
+  for (iSeq = 0; iSeq < nSeq; iSeq++) {
+    char *seq = seqs[iSeq];
+    int iPattern;
+    for (iPattern = 0; iPattern < nPatterns; iPattern++)
+      seq[iPattern] = seq[patternFirst[iPattern]];
+    seq[nPatterns] = '\0';
+  }
+  slots = myfree(slots, sizeof(int)*nSlots);
+  hashes = myfree(hashes, sizeof(unsigned int)*nPos);
+  patternFirst = myfree(patternFirst, sizeof(int)*nPos);
+  return(nPatterns);
+}
+
+void FreePatterns(void) {
+  if (patternCount != NULL) {
+    patternCount = myfree(patternCount, sizeof(int)*nPatternSites);
+    posToPattern = myfree(posToPattern, sizeof(int)*nPatternSites);
+  }
+  nPatternSites = 0;
+}
+
 traversal_t InitTraversal(NJ_t *NJ) {
   traversal_t worked = (bool*)mymalloc(sizeof(bool)*NJ->maxnodes);
   int i;
@@ -9443,6 +14265,8 @@ int TraversePostorder(int node, NJ_t *NJ, /*IN/OUT*/traversal_t traversal,
       continue; /* keep moving down */
     if (!traversal[node]) {
       traversal[node] = true;
+      if (ooc != NULL)
+	OocTraverse(NJ, traversal, node);
       return(node);
     }
     /* If we've already done this node, need to move up */
@@ -9530,6 +14354,36 @@ profile_t *DeleteUpProfile(/*IN/OUT*/profile_t **upProfiles, NJ_t *NJ, int node)
   return(NULL);
 }
 
+int MESupportBatch(NJ_t *NJ) {
+  int nThreads = 1;
+#ifdef USE_OPENMP
+  nThreads = PHASE_THREADS(PHASE_NJ);
+#endif
+  /* an up-profile may have a vector at every position */
+  size_t szUp = (size_t)NJ->nPos * (sizeof(numeric_t)*(nCodes+1) + sizeof(unsigned char));
+  size_t nFit = ME_SUPPORT_MEMORY / (2 * szUp);
+  int nBatch = ME_SUPPORT_PER_THREAD * nThreads;
+  if ((size_t)nBatch > nFit)
+    nBatch = (int)nFit;
+  return(MAX(1, MIN(nBatch, ME_SUPPORT_BATCH)));
+}
+
+void DeleteBatchUpProfile(/*IN/OUT*/profile_t **upProfiles, NJ_t *NJ, int node,
+			  /*IN*/int *batch, int nBatch,
+			  /*IN/OUT*/int *deferred, /*IN/OUT*/int *nDeferred) {
+  if (upProfiles[node] == NULL)
+    return;
+  /* a node uses the up-profile of its parent */
+  int i;
+  for (i = 0; i < nBatch; i++) {
+    if (NJ->parent[batch[i]] == node) {
+      deferred[(*nDeferred)++] = node;
+      return;
+    }
+  }
+  DeleteUpProfile(upProfiles, NJ, node);
+}
+
 profile_t **FreeUpProfiles(profile_t **upProfiles, NJ_t *NJ) {
   int i;
   int nUsed = 0;
@@ -168,6 +168,8 @@ fasttree_main(PyObject *self, PyObject *args, PyObject *kwargs) {
 	extern int nBootstrap;
 	extern int mlAccuracy;
 	extern bool fastNNI;
+	extern bool usePatterns;
+	extern int phaseThreadsOption[];
 
 	fprintf(stderr, "> Setting options from parameters:\n\n");
 
@@ -190,6 +192,11 @@ fasttree_main(PyObject *self, PyObject *args, PyObject *kwargs) {
 
 	  if (parseItem(dict, "quote", 'b', &bQuote)) return NULL;
 		fprintf(stderr, "- bQuote = %i\n", bQuote);
+
+		int patterns = usePatterns;
+	  if (parseItem(dict, "patterns", 'b', &patterns)) return NULL;
+		usePatterns = patterns;
+		fprintf(stderr, "- usePatterns = %i\n", usePatterns);
 	}
 
 	dict = PyDict_GetItemString(kwargs, "model");
@@ -266,6 +273,20 @@ fasttree_main(PyObject *self, PyObject *args, PyObject *kwargs) {
 		fprintf(stderr, "- fastNNI = %i\n", fastNNI);
 	}
 
+	dict = PyDict_GetItemString(kwargs, "threads");
+	if (dict != NULL) {
+		// Phases: 0 top hits, 1 neighbor joining, 2 likelihood
+		char *phases[3] = {"tophits", "nj", "ml"};
+		int all = 0;
+		if (parseItem(dict, "all", 'i', &all)) return NULL;
+		for (int i = 0; i < 3; i++) {
+			int threads = 0;
+			if (parseItem(dict, phases[i], 'i', &threads)) return NULL;
+			phaseThreadsOption[i] = (threads != 0) ? threads : all;
+			fprintf(stderr, "- threads %s = %i\n", phases[i], phaseThreadsOption[i]);
+		}
+	}
+
 	list = PyDict_GetItemString(kwargs, "args");
 	if (list == NULL) list = PyList_New(0);
 	else Py_INCREF(list);
@@ -4,12 +4,16 @@
 __all__ = ['PhylogenyApproximation', 'quick']
 
 
-import sys
-
-from .core import PhylogenyApproximation, quick
+def __getattr__(name):
+    """Resolve the API lazily, the console tool does not need it"""
+    if name in __all__:
+        from . import core
+        return getattr(core, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def main():
     """Call an (almost) unmodified version of fasttree"""
+    import sys
     from . import fasttree
     fasttree.raw(sys.argv[1:])
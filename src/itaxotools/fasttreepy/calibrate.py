@@ -0,0 +1,142 @@
+# -----------------------------------------------------------------------------
+# FastTreePy - Maximum-likelihood phylogenetic tree approximation with FastTree
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+"""
+Calibrate automatic thread counts for this host.
+
+For a few alignment sizes, time each phase with an increasing number
+of threads and keep the fastest. The resulting table is read by FastTree
+when threads are set to automatic (-threads auto), which then picks the
+entry closest to the size of the alignment.
+"""
+
+import argparse
+import tempfile
+import pathlib
+import random
+import time
+import sys
+import os
+
+from .core import PhylogenyApproximation, threads_table
+
+
+# (sequences, positions) to calibrate for
+SIZES = [(100, 500), (500, 1000), (2000, 1000), (500, 5000)]
+
+# Extra arguments that make each phase dominate the running time
+PHASES = {
+    'tophits': ['-noml', '-nosupport'],
+    'nj': ['-notop', '-noml', '-nosupport'],
+    'ml': ['-nosupport'],
+}
+
+
+def random_alignment(path, nseq, npos, seed=0):
+    """Write a nucleotide alignment of random relatives of one sequence"""
+    rng = random.Random(seed)
+    root = [rng.choice('ACGT') for _ in range(npos)]
+    with open(path, 'w') as file:
+        for i in range(nseq):
+            seq = list(root)
+            for _ in range(int(npos * rng.uniform(0.01, 0.2))):
+                seq[rng.randrange(npos)] = rng.choice('ACGT')
+            print(f'>seq{i}\n{"".join(seq)}', file=file)
+
+
+def thread_counts(max_threads):
+    """Powers of two up to max_threads, and max_threads itself"""
+    counts = []
+    count = 1
+    while count < max_threads:
+        counts.append(count)
+        count *= 2
+    counts.append(max_threads)
+    return counts
+
+
+def timed(file, args):
+    a = PhylogenyApproximation(file)
+    a.log = os.devnull
+    a.args = ['-nt', '-quiet'] + args
+    start = time.perf_counter()
+    a.launch()
+    return time.perf_counter() - start
+
+
+def calibrate(sizes=SIZES, max_threads=None, repeats=1, progress=None):
+    """
+    Return rows of (phase, nseq, npos, threads) with the fastest
+    number of threads for each phase and alignment size.
+    """
+    max_threads = max_threads or os.cpu_count() or 1
+    rows = []
+    with tempfile.TemporaryDirectory(prefix='fasttreepy_calibrate_') as dir:
+        for nseq, npos in sizes:
+            file = str(pathlib.Path(dir) / f'{nseq}x{npos}.fas')
+            random_alignment(file, nseq, npos)
+            for phase, args in PHASES.items():
+                times = {}
+                for count in thread_counts(max_threads):
+                    spec = f'{max_threads},{phase}={count}'
+                    times[count] = min(
+                        timed(file, ['-threads', spec] + args)
+                        for _ in range(repeats))
+                    if progress is not None:
+                        progress(f'{phase} {nseq}x{npos} '
+                                 f'threads={count}: {times[count]:.2f}s')
+                best = min(times, key=times.get)
+                rows.append((phase, nseq, npos, best))
+    return rows
+
+
+def write_table(rows, path):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as file:
+        print('# phase\tnSeq\tnPos\tthreads', file=file)
+        for row in rows:
+            print('\t'.join(str(x) for x in row), file=file)
+
+
+def _parse_sizes(text):
+    sizes = []
+    for item in text.split(','):
+        nseq, npos = item.lower().split('x')
+        sizes.append((int(nseq), int(npos)))
+    return sizes
+
+
+def main():
+    """Console entry-point for calibration"""
+    parser = argparse.ArgumentParser(
+        description='Find the best number of threads per phase on this host.')
+    parser.add_argument('--output', default=str(threads_table()),
+                        help='where to write the table (default: %(default)s)')
+    parser.add_argument('--sizes', type=_parse_sizes, default=SIZES,
+                        help='alignment sizes as NSEQxNPOS,... '
+                             '(default: 100x500,500x1000,2000x1000,500x5000)')
+    parser.add_argument('--max-threads', type=int,
+                        help='largest thread count to try (default: all cores)')
+    parser.add_argument('--repeats', type=int, default=1,
+                        help='keep the fastest of this many runs')
+    args = parser.parse_args()
+    progress = lambda line: print(line, file=sys.stderr)
+    rows = calibrate(args.sizes, args.max_threads, args.repeats, progress)
+    write_table(rows, args.output)
+    print(f'Wrote {args.output}', file=sys.stderr)
@@ -17,22 +17,37 @@
 # -----------------------------------------------------------------------------
 
 
-from multiprocessing import Process
+"""
+Imports that are only needed to run an analysis are made locally,
+so that importing the package stays cheap for the console tool.
+"""
 
-import tempfile
 import pathlib
-import sys
+import os
 
-from itaxotools.common.io import redirect
-
-from . import fasttree
 from . import params
 
 
+def threads_table():
+    """
+    Path to the calibration table used for automatic thread counts,
+    as written by fasttreepy-calibrate. May be overriden by setting
+    the environment variable FASTTREEPY_THREADS_TABLE.
+    """
+    path = os.environ.get('FASTTREEPY_THREADS_TABLE')
+    if path:
+        return pathlib.Path(path)
+    return pathlib.Path.home() / '.fasttreepy' / 'threads.tsv'
+
+
 class PhylogenyApproximation():
 
     def __getstate__(self):
-        return self.__dict__
+        state = dict(self.__dict__)
+        # The callback is only called by the parent process
+        state['callback'] = None
+        state['json_log'] = self.json_log or self.callback is not None
+        return state
 
     def __setstate__(self, state):
         self.__dict__ = state
@@ -46,17 +61,63 @@ class PhylogenyApproximation():
         self.log = None
         self.param = params.params()
         self.args = []
+        self.sitelk = False
+        self.topologies = []
+        self.profiling = False
+        self.models = []
+        self.model_procs = None
+        self.global_bootstrap = 0
+        self.global_bootstrap_procs = None
+        self.out_of_core = None
+        self.out_of_core_memory = None
+        self.json_log = False
+        self.callback = None
+        self.haplotype_map = False
 
     def run(self):
         """
         Run the FastTree core with given params,
         save results to a temporary directory.
         """
+        from itaxotools.common.io import redirect
+        from . import fasttree
+
         kwargs = self.param.dumps()
-        path = str(self.fetch())
-        with redirect(fasttree, 'stdout', path, 'w'), \
+        output = str(self.fetch())
+        args = list(self.args)
+        if self.haplotype_map:
+            args += ['-haplotypes', str(self._haplotypes_path())]
+        if self.sitelk or self.topologies:
+            args += ['-sitelk', str(self._sitelk_path())]
+        if self.topologies:
+            path = pathlib.Path(self.target) / 'topologies'
+            with open(path, 'w') as file:
+                for tree in self.topologies:
+                    print(tree.strip(), file=file)
+            args += ['-sitelktrees', str(path)]
+        if self.profiling:
+            args += ['-profile', str(self._profile_path())]
+        if self.models:
+            args += ['-models', ','.join(self.models),
+                     '-modelsout', str(self._models_path())]
+            if self.model_procs:
+                args += ['-modelprocs', str(self.model_procs)]
+        if self.global_bootstrap:
+            args += ['-gboot', str(self.global_bootstrap)]
+            if self.global_bootstrap_procs:
+                args += ['-gbootprocs', str(self.global_bootstrap_procs)]
+        if self.json_log or self.callback is not None:
+            args += ['-jsonlog', str(self._json_log_path())]
+        if self.out_of_core:
+            args += ['-ooc', str(self.out_of_core)]
+            if self.out_of_core_memory:
+                args += ['-oocmem', str(self.out_of_core_memory)]
+        table = threads_table()
+        if table.exists():
+            args += ['-threadtable', str(table)]
+        with redirect(fasttree, 'stdout', output, 'w'), \
              redirect(fasttree, 'stderr', self.log, 'a'):
-            fasttree.main(self.file, args=self.args, **kwargs)
+            fasttree.main(self.file, args=args, **kwargs)
         self.results = self.target
 
     def launch(self):
@@ -66,16 +127,88 @@ class PhylogenyApproximation():
         cause segfaults. Results are saved in a temporary directory,
         use fetch() to retrieve them.
         """
+        from multiprocessing import Process
+        import tempfile
+
         self.results = None
         self._temp = tempfile.TemporaryDirectory(prefix='fasttree_')
         self.target = pathlib.Path(self._temp.name).as_posix()
         p = Process(target=self.run)
         p.start()
+        stopped = False
+        if self.callback is not None:
+            stopped = self._follow_json_log(p)
         p.join()
-        if p.exitcode != 0:
+        if p.exitcode != 0 and not stopped:
             raise RuntimeError('FastTree internal error, please check logs.')
         self.results = self.target
 
+    def _follow_json_log(self, process):
+        """
+        Pass the records of the run log to the callback while the process
+        runs. If the callback returns True, stop the process and save the
+        last intermediate tree as the result. Return whether it was stopped.
+        """
+        import json
+
+        path = self._json_log_path()
+        file = None
+        pending = ''
+        tree = None
+        try:
+            while True:
+                alive = process.is_alive()
+                if file is None and path.exists():
+                    file = open(path)
+                if file is not None:
+                    pending += file.read()
+                    *lines, pending = pending.split('\n')
+                    for line in lines:
+                        record = json.loads(line)
+                        if 'tree' in record:
+                            tree = record['tree']
+                        if self.callback(record):
+                            process.terminate()
+                            process.join()
+                            if tree is not None:
+                                with open(self.fetch(), 'w') as output:
+                                    print(tree, file=output)
+                            return True
+                if not alive:
+                    return False
+                process.join(0.2)
+        finally:
+            if file is not None:
+                file.close()
+
+    def divide_and_conquer(self, shards=None, backbone=None, queue=None,
+                           workers=None, polish=True, seed=0):
+        """
+        Like launch(), but for very large alignments: solve clades of a
+        backbone tree as separate jobs, then polish the grafted tree with
+        a final run. Shard jobs go to queue, which may be a server.Client.
+        See divide.divide_and_conquer() for the arguments.
+        """
+        from . import divide
+        import tempfile
+
+        def progress(line):
+            if self.log is None:
+                return
+            if hasattr(self.log, 'write'):
+                print(line, file=self.log)
+            else:
+                with open(self.log, 'a') as file:
+                    print(line, file=file)
+
+        self.results = None
+        self._temp = tempfile.TemporaryDirectory(prefix='fasttree_')
+        self.target = pathlib.Path(self._temp.name).as_posix()
+        divide.divide_and_conquer(
+            self, shards=shards, backbone=backbone, queue=queue,
+            workers=workers, polish=polish, seed=seed, progress=progress)
+        self.results = self.target
+
     def fetch(self):
         """
         Return the path to the resulting tree file.
@@ -84,6 +217,162 @@ class PhylogenyApproximation():
             return None
         return pathlib.Path(self.target) / 'tree'
 
+    def _haplotypes_path(self):
+        return pathlib.Path(self.target) / 'haplotypes'
+
+    def _sitelk_path(self):
+        return pathlib.Path(self.target) / 'sitelk'
+
+    def site_likelihoods(self):
+        """
+        Return the per-site results of the last run, if it was made with
+        sitelk set or with topologies given, as a list of dicts with keys:
+        tree ('best', then 'tree1', 'tree2'... for each of topologies),
+        loglk (the total), rates (of each category), ratecat (0-based rate
+        category of each site), site_loglk (of each site) and gamma_loglk
+        (Gamma20 log likelihood of each site, for the best tree with -gamma,
+        None otherwise). Arrays are numpy arrays, indexed by alignment column.
+
+        The topologies are newick strings, scored after the final tree with
+        the model and rate categories of that tree held fixed, so that their
+        site likelihoods may be compared (e.g. for AU or SH tests).
+        Only their branch lengths are optimized.
+        """
+        import numpy as np
+
+        if self.target is None or not self._sitelk_path().exists():
+            return None
+        records = []
+        with open(self._sitelk_path(), 'rb') as file:
+            while True:
+                line = file.readline()
+                if not line:
+                    break
+                _, tree, sites, cats, gamma, loglk = \
+                    line.decode().rstrip('\n').split('\t')
+                sites = int(sites)
+                records.append({
+                    'tree': tree,
+                    'loglk': float(loglk),
+                    'rates': np.fromfile(file, np.float64, int(cats)),
+                    'ratecat': np.fromfile(file, np.int32, sites),
+                    'site_loglk': np.fromfile(file, np.float64, sites),
+                    'gamma_loglk': (np.fromfile(file, np.float64, sites)
+                                    if int(gamma) else None),
+                })
+        return records
+
+    def _json_log_path(self):
+        return pathlib.Path(self.target) / 'log.jsonl'
+
+    def events(self):
+        """
+        Return the run log of the last run, if it was made with json_log
+        or callback set, as a list of dicts, one per event: 'start', 'tree'
+        (each intermediate tree, with phase and round), 'round' (after each
+        round of NNIs, SPRs or ML lengths, with loglk, changes, max_change
+        and the operation counters; rounds are numbered from 1 in each
+        phase), 'rates' and 'done'. All records carry the alignment index
+        and the time in seconds.
+        """
+        import json
+
+        if self.target is None or not self._json_log_path().exists():
+            return None
+        with open(self._json_log_path()) as file:
+            return [json.loads(line) for line in file]
+
+    def _profile_path(self):
+        return pathlib.Path(self.target) / 'profile.json'
+
+    def profile(self):
+        """
+        Return the hot-path timings of the last run, if it was made with
+        profiling set, as parsed from the JSON written by -profile: for each
+        thread, the calls, total and self nanoseconds of each timed function
+        ('totals') and of each call path ('paths').
+        """
+        import json
+
+        if self.target is None or not self._profile_path().exists():
+            return None
+        with open(self._profile_path()) as file:
+            return json.load(file)
+
+    def profile_stacks(self):
+        """
+        Return the timings of profile() as collapsed stacks, one line per
+        thread and call path with its self time in nanoseconds, as read by
+        flamegraph.pl or speedscope.
+        """
+        profile = self.profile()
+        if profile is None:
+            return None
+        lines = []
+        for thread in profile['threads']:
+            for path in thread['paths']:
+                if path['self'] > 0:
+                    stack = ';'.join([f'thread{thread["id"]}'] + path['stack'])
+                    lines.append(f'{stack} {path["self"]}')
+        return '\n'.join(lines) + '\n'
+
+    def _models_path(self):
+        return pathlib.Path(self.target) / 'models'
+
+    def model_likelihoods(self):
+        """
+        Return the results of the model sweep of the last run, if it was
+        made with models set, as a list of dicts with keys: model, ncat,
+        loglk (Gamma log likelihood, or nan if its process failed) and best
+        (True for the model whose tree was saved).
+
+        Models are given as 'jtt', 'wag', 'lg' (proteins) or 'jc', 'gtr'
+        (nucleotides), optionally followed by ':ncat', e.g. ['lg', 'lg:4'].
+        The topology search is done once and shared by all models, while
+        their ML phases run in parallel processes, up to model_procs at once
+        (POSIX only).
+        """
+        if self.target is None or not self._models_path().exists():
+            return None
+        models = []
+        with open(self._models_path()) as file:
+            for line in file:
+                model, ncat, loglk, best = line.rstrip('\n').split('\t')
+                models.append({
+                    'model': model,
+                    'ncat': int(ncat),
+                    'loglk': float(loglk),
+                    'best': best == '1',
+                })
+        return models
+
+    def haplotypes(self):
+        """
+        Return the map from sequences to unique sequences (haplotypes)
+        found by the last run, if it was made with haplotype_map set,
+        as a tuple (names, aln_to_uniq, sizes): the sequence names in
+        alignment order, the haplotype index of each sequence, and the
+        number of copies of each haplotype. If several alignments were
+        read (-n in args), return a list of such tuples, one per alignment.
+        """
+        if self.target is None or not self._haplotypes_path().exists():
+            return None
+        maps = {}
+        with open(self._haplotypes_path()) as file:
+            for line in file:
+                fields = line.rstrip('\n').split('\t')
+                index = int(fields.pop(0)) if len(fields) == 4 else None
+                name, unique, size = fields
+                names, aln_to_uniq, sizes = maps.setdefault(index, ([], [], []))
+                unique = int(unique)
+                names.append(name)
+                aln_to_uniq.append(unique)
+                if unique == len(sizes):
+                    sizes.append(int(size))
+        if None in maps:
+            return maps[None]
+        return [maps[index] for index in sorted(maps)]
+
 
 def quick(input=None, save=None, args=[]):
     """Quick analysis"""
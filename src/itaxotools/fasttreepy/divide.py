@@ -0,0 +1,473 @@
+# -----------------------------------------------------------------------------
+# FastTreePy - Maximum-likelihood phylogenetic tree approximation with FastTree
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+"""
+Divide and conquer for alignments too large for a single run.
+
+A backbone tree is built quickly from a random subsample and cut into
+clades of similar size. Every other sequence joins the clade whose
+profile is closest to it. Each clade is then solved as an alignment of
+its own, through a queue of jobs: either LocalQueue, which runs them in
+local processes, or a server.Client of a job server, possibly on another
+host. The clade trees are grafted in place of the clades of the backbone,
+and the result is used as the starting tree (-intree) of a final run on
+the whole alignment, which polishes it with the usual NNIs and SPRs.
+
+Requires numpy for assigning sequences to clades.
+"""
+
+import threading
+import tempfile
+import queue as _queue
+import pathlib
+import random
+import math
+import re
+import bz2
+import gzip
+import lzma
+import os
+
+
+NUCLEOTIDES = 'ACGT'
+AMINO_ACIDS = 'ARNDCQEGHILKMFPSTWYV'
+
+
+def _open_text(path):
+    """Open a possibly compressed file for reading text"""
+    with open(path, 'rb') as file:
+        magic = file.read(6)
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.open(path, 'rt')
+    if magic.startswith(b'BZh'):
+        return bz2.open(path, 'rt')
+    if magic.startswith(b'\xfd7zXZ\x00'):
+        return lzma.open(path, 'rt')
+    return open(path, 'r')
+
+
+def read_alignment(path, quote=False):
+    """
+    Return names and sequences of a fasta or (interleaved) phylip file.
+    Fasta names are cut where FastTree would cut them, which depends
+    on whether names are quoted.
+    """
+    stop = re.compile(r"['\t]" if quote else r"[(),: \t]")
+    with _open_text(path) as file:
+        lines = [line.rstrip('\r\n') for line in file]
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        raise ValueError(f'Empty alignment: {path}')
+    names = []
+    seqs = []
+    if lines[0].startswith('>'):
+        for line in lines:
+            if line.startswith('>'):
+                names.append(stop.split(line[1:].strip())[0])
+                seqs.append([])
+            else:
+                seqs[-1].append(line.strip())
+    else:
+        count = int(lines[0].split()[0])
+        for index, line in enumerate(lines[1:]):
+            if index < count:
+                name, _, rest = line.strip().partition(' ')
+                names.append(name)
+                seqs.append([rest])
+            else:
+                seqs[index % count].append(line)
+    seqs = [''.join(''.join(parts).split()).upper() for parts in seqs]
+    return names, seqs
+
+
+class Node():
+    """Newick tree node, leaves have a name and no children"""
+
+    def __init__(self, name=None, length=None, children=None):
+        self.name = name
+        self.length = length
+        self.children = children or []
+
+    def leaves(self):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(reversed(node.children))
+            else:
+                yield node.name
+
+
+def _read_label(text, index):
+    """Return a possibly quoted label starting at index, and the next index"""
+    if text[index] == "'":
+        end = text.index("'", index + 1)
+        return text[index + 1:end], end + 1
+    end = index
+    while end < len(text) and text[end] not in '(),:;':
+        end += 1
+    return text[index:end].strip(), end
+
+
+def parse_newick(text):
+    """Parse a newick tree without recursion, so that deep trees work"""
+    text = text.strip()
+    root = Node()
+    stack = []
+    node = root
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char == '(':
+            stack.append(node)
+            node = Node()
+            stack[-1].children.append(node)
+            index += 1
+        elif char == ',':
+            node = Node()
+            stack[-1].children.append(node)
+            index += 1
+        elif char == ')':
+            node = stack.pop()
+            index += 1
+        elif char == ':':
+            index += 1
+            end = index
+            while end < len(text) and text[end] not in '(),:;':
+                end += 1
+            node.length = float(text[index:end])
+            index = end
+        elif char == ';':
+            break
+        elif char.isspace():
+            index += 1
+        else:
+            node.name, index = _read_label(text, index)
+    return root
+
+
+def format_newick(root, quote=False):
+    """Inverse of parse_newick(), also without recursion"""
+    parts = []
+
+    def label(node):
+        text = node.name or ''
+        if quote and not node.children:
+            text = f"'{text}'"
+        if node.length is not None:
+            text += f':{node.length:.5f}'
+        return text
+
+    stack = [(root, False)]
+    while stack:
+        node, closing = stack.pop()
+        if node is None:
+            parts.append(',')
+        elif closing:
+            parts.append(')' + label(node))
+        elif node.children:
+            parts.append('(')
+            stack.append((node, True))
+            for position, child in enumerate(reversed(node.children)):
+                stack.append((child, False))
+                if position < len(node.children) - 1:
+                    stack.append((None, None))
+        else:
+            parts.append(label(node))
+    return ''.join(parts) + ';'
+
+
+def cut_clades(root, size):
+    """
+    Split the tree into disjoint clades of at most size leaves,
+    preferring larger clades. Returns the clade nodes.
+    """
+    counts = {}
+    for node in _postorder(root):
+        if node.children:
+            counts[id(node)] = sum(counts[id(child)] for child in node.children)
+        else:
+            counts[id(node)] = 1
+    clades = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if counts[id(node)] <= size or not node.children:
+            clades.append(node)
+        else:
+            stack.extend(reversed(node.children))
+    return clades
+
+
+def _postorder(root):
+    order = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(node.children)
+    return reversed(order)
+
+
+def _binary(root):
+    """
+    FastTree writes unrooted trees with three children at the root.
+    Resolve that with a zero length branch, so it may be grafted as a clade.
+    """
+    while len(root.children) > 2:
+        pair = Node(length=0.0, children=root.children[:2])
+        root.children = [pair] + root.children[2:]
+    return root
+
+
+def graft(backbone, clades, subtrees):
+    """Replace each clade node of the backbone with its subtree in place"""
+    for clade, subtree in zip(clades, subtrees):
+        if len(subtree.children) == 1:
+            subtree = subtree.children[0]
+        subtree = _binary(subtree)
+        clade.name = None if subtree.children else subtree.name
+        clade.children = subtree.children
+    return backbone
+
+
+def _codes(seqs, alphabet):
+    """Map sequences to an array of alphabet indices, len(alphabet) for gaps"""
+    import numpy as np
+
+    table = np.full(256, len(alphabet), dtype=np.uint8)
+    for index, char in enumerate(alphabet):
+        table[ord(char)] = index
+        table[ord(char.lower())] = index
+    if alphabet == NUCLEOTIDES:
+        table[ord('U')] = table[ord('u')] = alphabet.index('T')
+    data = np.frombuffer(
+        ''.join(seqs).encode('ascii', errors='replace'), dtype=np.uint8)
+    return table[data].reshape(len(seqs), -1)
+
+
+def _one_hot(codes, size):
+    import numpy as np
+
+    count, length = codes.shape
+    onehot = np.zeros((count, length, size + 1), dtype=np.float32)
+    onehot.reshape(-1, size + 1)[np.arange(codes.size), codes.ravel()] = 1
+    return onehot[:, :, :size].reshape(count, length * size)
+
+
+def assign(seqs, clades, alphabet, batch=1024):
+    """
+    Return the index of the closest clade for each sequence, where
+    clades are lists of sequences and the distance to a clade is the
+    fraction of mismatches against its profile, counting only positions
+    where both have data. Done in batches by matrix products.
+    """
+    import numpy as np
+
+    size = len(alphabet)
+    profiles = []
+    for members in clades:
+        counts = _one_hot(_codes(members, alphabet), size).sum(axis=0)
+        counts = counts.reshape(-1, size)
+        totals = counts.sum(axis=1, keepdims=True)
+        profiles.append((counts / np.maximum(totals, 1)).ravel())
+    profiles = np.array(profiles, dtype=np.float32)
+    present = profiles.reshape(len(clades), -1, size).sum(axis=2) > 0
+    present = present.astype(np.float32)
+
+    result = np.empty(len(seqs), dtype=np.int64)
+    for start in range(0, len(seqs), batch):
+        codes = _codes(seqs[start:start + batch], alphabet)
+        matched = _one_hot(codes, size) @ profiles.T
+        overlap = (codes < size).astype(np.float32) @ present.T
+        distance = 1 - matched / np.maximum(overlap, 1)
+        distance[overlap == 0] = 1
+        result[start:start + len(codes)] = distance.argmin(axis=1)
+    return result
+
+
+class LocalQueue():
+    """
+    Stand-in for a job server: runs each job through
+    PhylogenyApproximation.launch() in a process of its own.
+    Has the submit() signature of server.Client.
+    """
+
+    def submit(self, file=None, alignment=None, params=None, args=[],
+               priority=0, progress=None):
+        from .core import PhylogenyApproximation
+        from . import params as _params
+
+        if hasattr(params, 'dumps'):
+            params = params.dumps()
+        with tempfile.TemporaryDirectory(prefix='fasttreepy_shard_') as dir:
+            if alignment is not None:
+                file = os.path.join(dir, 'alignment')
+                with open(file, 'w') as output:
+                    output.write(alignment)
+            a = PhylogenyApproximation(file)
+            a.log = os.path.join(dir, 'log')
+            a.args = [str(arg) for arg in args]
+            _params.apply(a.param, params or {})
+            try:
+                a.launch()
+            finally:
+                if progress is not None and os.path.exists(a.log):
+                    with open(a.log, errors='replace') as log:
+                        for line in log.read().replace('\r', '\n').split('\n'):
+                            if line:
+                                progress(line)
+            with open(a.fetch()) as result:
+                return result.read()
+
+
+def _map(function, items, workers):
+    """
+    Like map() with threads, each thread waits for one job at a time.
+    Plain threads rather than an executor, since processes forked from
+    executor threads exit with an error code on some Python versions.
+    """
+    todo = _queue.Queue()
+    for position, item in enumerate(items):
+        todo.put((position, item))
+    results = [None] * todo.qsize()
+    errors = []
+
+    def work():
+        while not errors:
+            try:
+                position, item = todo.get_nowait()
+            except _queue.Empty:
+                break
+            try:
+                results[position] = function(item)
+            except Exception as exception:
+                errors.append(exception)
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def _trivial(names):
+    """Tree for clades too small to need a run"""
+    return Node(children=[Node(name=name, length=0.0) for name in names])
+
+
+def divide_and_conquer(
+    analysis, shards=None, backbone=None, queue=None, workers=None,
+    polish=True, seed=0, progress=None,
+):
+    """
+    Build a tree for analysis.file as described in the module docstring,
+    running shard jobs with the params and args of analysis. Writes the
+    tree to analysis.fetch(), whose target directory must exist.
+
+    shards: number of clades to aim for, by default about one per
+        2000 sequences (at least 2).
+    backbone: number of sequences in the backbone, by default about
+        four times the square root of the alignment size.
+    queue: object with the submit() method of server.Client,
+        defaults to a LocalQueue.
+    workers: number of shard jobs submitted at once, defaults to the
+        number of cores.
+    polish: if False, skip the final run and keep the grafted tree.
+    """
+    from . import params as _params
+
+    def log(line):
+        if progress is not None:
+            progress(line)
+
+    dump = analysis.param.dumps()
+    alphabet = NUCLEOTIDES if dump['sequence']['ncodes'] == 4 else AMINO_ACIDS
+    quote = dump['sequence']['quote']
+    queue = queue or LocalQueue()
+    workers = workers or os.cpu_count() or 1
+    rng = random.Random(seed)
+
+    names, seqs = read_alignment(analysis.file, quote)
+    count = len(names)
+    if shards is None:
+        shards = max(2, count // 2000)
+    if backbone is None:
+        backbone = 4 * int(math.sqrt(count))
+    backbone = max(3, min(count, max(backbone, 2 * shards)))
+    if count < 4 or shards < 2:
+        raise ValueError('Need at least 4 sequences and 2 shards.')
+    index = {name: i for i, name in enumerate(names)}
+    if len(index) != count:
+        raise ValueError('Sequence names are not unique.')
+    if polish and quote and any(re.search(r'[(),:\s]', name) for name in names):
+        raise ValueError(
+            'Starting trees may not have quoted names, use polish=False.')
+
+    sample = sorted(rng.sample(range(count), backbone))
+    log(f'Backbone of {backbone} sequences for {count} sequences')
+    text = ''.join(f'>{names[i]}\n{seqs[i]}\n' for i in sample)
+    tree = queue.submit(
+        alignment=text, params=dump,
+        args=analysis.args + ['-noml', '-nosupport'])
+    root = parse_newick(tree)
+
+    clades = cut_clades(root, math.ceil(backbone / shards))
+    members = [[index[name] for name in clade.leaves()] for clade in clades]
+    log(f'Backbone cut into {len(clades)} clades')
+
+    nearest = assign(
+        seqs, [[seqs[i] for i in group] for group in members], alphabet)
+    for position, group in enumerate(members):
+        nearest[group] = position
+    members = [[] for _ in clades]
+    for i, position in enumerate(nearest):
+        members[position].append(i)
+
+    def solve(position):
+        group = members[position]
+        if len(group) < 3:
+            return _trivial([names[i] for i in group])
+        text = ''.join(f'>{names[i]}\n{seqs[i]}\n' for i in group)
+        tree = queue.submit(
+            alignment=text, params=dump, args=analysis.args)
+        log(f'Clade {position + 1} of {len(clades)}: {len(group)} sequences')
+        return parse_newick(tree)
+
+    subtrees = _map(solve, range(len(clades)), workers)
+    root = graft(root, clades, subtrees)
+
+    path = pathlib.Path(analysis.fetch())
+    if not polish:
+        path.write_text(format_newick(root, quote) + '\n')
+        return path
+    log('Polishing the grafted tree on the whole alignment')
+    with tempfile.TemporaryDirectory(prefix='fasttreepy_graft_') as dir:
+        intree = os.path.join(dir, 'grafted.tre')
+        with open(intree, 'w') as file:
+            print(format_newick(root), file=file)
+        final = analysis.__class__(analysis.file)
+        final.log = analysis.log
+        final.args = analysis.args + ['-intree', intree]
+        _params.apply(final.param, dump)
+        final.launch()
+        path.write_text(pathlib.Path(final.fetch()).read_text())
+    return path
@@ -0,0 +1,419 @@
+# -----------------------------------------------------------------------------
+# FastTreePy - Maximum-likelihood phylogenetic tree approximation with FastTree
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+"""
+Run queue for many alignments.
+
+Each job runs FastTree in a process of its own, started and polled from
+the event loop, so a crash only fails that job. Results are saved next to
+each input as <name>.tre, with the log as <name>.log if the job failed.
+Existing trees are overwritten only if the user agrees, otherwise the
+results are saved as <name>_2.tre, <name>_3.tre...
+"""
+
+from PySide6 import QtCore
+from PySide6 import QtWidgets
+
+import multiprocessing
+import tempfile
+import pathlib
+import shutil
+import enum
+import time
+import os
+
+from .. import params
+from .. import core
+
+
+EXTENSIONS = [
+    '.fas', '.fasta', '.fa', '.fna', '.faa', '.aln',
+    '.phy', '.phylip', '.txt']
+COMPRESSED = ['.gz', '.bz2', '.xz', '.zst']
+
+
+def is_alignment(path):
+    """Guess from the extension, which may be followed by a compression one"""
+    suffixes = [suffix.lower() for suffix in path.suffixes]
+    if suffixes and suffixes[-1] in COMPRESSED:
+        suffixes.pop()
+    return bool(suffixes) and suffixes[-1] in EXTENSIONS
+
+
+def stem(path):
+    """File name without its alignment and compression extensions"""
+    if path.suffix.lower() in COMPRESSED:
+        path = path.with_suffix('')
+    return path.stem
+
+
+def free_path(path, taken=()):
+    """Return path, or the first <stem>_2, <stem>_3... that is free"""
+    candidate = path
+    count = 1
+    while candidate.exists() or candidate in taken:
+        count += 1
+        candidate = path.with_name(f'{path.stem}_{count}{path.suffix}')
+    return candidate
+
+
+def last_line(path, size=4096):
+    """Return the last non-empty line of a log file"""
+    try:
+        with open(path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(file.tell() - size, 0))
+            text = file.read().decode('utf-8', errors='replace')
+    except OSError:
+        return ''
+    lines = [line.strip() for line in text.replace('\r', '\n').split('\n')]
+    lines = [line for line in lines if line]
+    return lines[-1] if lines else ''
+
+
+class Status(enum.Enum):
+    Queued = 'Queued'
+    Running = 'Running'
+    Done = 'Done'
+    Failed = 'Failed'
+    Cancelled = 'Cancelled'
+
+
+class Job():
+    """One alignment of the queue and the process running it"""
+
+    def __init__(self, file):
+        self.file = pathlib.Path(file)
+        self.status = Status.Queued
+        self.message = ''
+        self.process = None
+        self.started = None
+        self.elapsed = None
+        self._temp = None
+        self.analysis = None
+        self.output = self.file.parent / (stem(self.file) + '.tre')
+
+    @property
+    def log(self):
+        return self.output.with_suffix('.log')
+
+    def start(self, param, threads):
+        self._temp = tempfile.TemporaryDirectory(prefix='fasttreepy_batch_')
+        self.analysis = core.PhylogenyApproximation(str(self.file))
+        self.analysis.target = pathlib.Path(self._temp.name).as_posix()
+        self.analysis.log = str(pathlib.Path(self._temp.name) / 'log')
+        params.apply(self.analysis.param, param.dumps())
+        self.analysis.param.threads.all = threads
+        self.process = multiprocessing.Process(target=self.analysis.run)
+        self.process.start()
+        self.started = time.monotonic()
+        self.status = Status.Running
+
+    def poll(self):
+        """Update status if the process exited, return True if it did"""
+        if self.status != Status.Running:
+            return False
+        if self.process.is_alive():
+            self.message = last_line(self.analysis.log)
+            return False
+        self.process.join()
+        self.elapsed = time.monotonic() - self.started
+        if self.process.exitcode == 0:
+            try:
+                shutil.copyfile(self.analysis.fetch(), self.output)
+            except Exception as exception:
+                self.fail(str(exception))
+            else:
+                self.status = Status.Done
+                self.message = f'Saved {self.output.name}'
+        else:
+            self.fail(f'Exited with code {self.process.exitcode}')
+        self.cleanup()
+        return True
+
+    def fail(self, message):
+        self.status = Status.Failed
+        self.message = message
+        try:
+            shutil.copyfile(self.analysis.log, self.log)
+        except OSError:
+            pass
+        else:
+            self.message += f', see {self.log.name}'
+
+    def cancel(self):
+        if self.status == Status.Running:
+            self.process.terminate()
+            self.process.join()
+            self.elapsed = time.monotonic() - self.started
+            self.cleanup()
+        if self.status in [Status.Queued, Status.Running]:
+            self.status = Status.Cancelled
+            self.message = ''
+
+    def cleanup(self):
+        self.process = None
+        if self._temp is not None:
+            self._temp.cleanup()
+            self._temp = None
+
+
+class BatchDialog(QtWidgets.QDialog):
+    """
+    Queue of alignments, run with the parameters of the main window.
+    Up to `workers` jobs run at the same time, sharing `threads` threads.
+    """
+
+    columns = ['File', 'Status', 'Time', 'Progress']
+
+    def __init__(self, param, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('FastTreePy - Run Queue')
+        self.resize(820, 480)
+        self.param = param
+        self.jobs = []
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.tick)
+
+        self.table = QtWidgets.QTableWidget(0, len(self.columns))
+        self.table.setHorizontalHeaderLabels(self.columns)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.table.verticalHeader().setVisible(False)
+        header = self.table.horizontalHeader()
+        header.setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(2, QtWidgets.QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(3, QtWidgets.QHeaderView.Stretch)
+
+        cpus = os.cpu_count() or 1
+        self.workers = QtWidgets.QSpinBox()
+        self.workers.setRange(1, cpus)
+        self.workers.setValue(max(1, min(4, cpus // 2)))
+        self.workers.setToolTip('Number of alignments processed at once')
+        self.threads = QtWidgets.QSpinBox()
+        self.threads.setRange(1, 4 * cpus)
+        self.threads.setValue(cpus)
+        self.threads.setToolTip('Threads shared by all running jobs')
+
+        self.button = {}
+        for key, text, slot in [
+            ('files', 'Add files', self.handleAddFiles),
+            ('folder', 'Add folder', self.handleAddFolder),
+            ('remove', 'Remove', self.handleRemove),
+            ('start', 'Start', self.handleStart),
+            ('stop', 'Stop', self.handleStop),
+        ]:
+            self.button[key] = QtWidgets.QPushButton(text)
+            self.button[key].clicked.connect(slot)
+
+        controls = QtWidgets.QHBoxLayout()
+        controls.addWidget(self.button['files'])
+        controls.addWidget(self.button['folder'])
+        controls.addWidget(self.button['remove'])
+        controls.addStretch(1)
+        controls.addWidget(QtWidgets.QLabel('Workers:'))
+        controls.addWidget(self.workers)
+        controls.addSpacing(8)
+        controls.addWidget(QtWidgets.QLabel('Threads:'))
+        controls.addWidget(self.threads)
+        controls.addSpacing(8)
+        controls.addWidget(self.button['start'])
+        controls.addWidget(self.button['stop'])
+
+        self.footer = QtWidgets.QLabel()
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addLayout(controls, 0)
+        layout.addWidget(self.table, 1)
+        layout.addWidget(self.footer, 0)
+        self.setLayout(layout)
+
+        self.setAcceptDrops(True)
+        self.refresh()
+
+    @property
+    def running(self):
+        return self.timer.isActive()
+
+    def addPaths(self, paths):
+        """Queue files, and the alignments found in directories"""
+        queued = {job.file for job in self.jobs}
+        for path in paths:
+            path = pathlib.Path(path)
+            if path.is_dir():
+                files = sorted(
+                    file for file in path.iterdir()
+                    if file.is_file() and is_alignment(file))
+            else:
+                files = [path]
+            for file in files:
+                if file not in queued:
+                    queued.add(file)
+                    self.jobs.append(Job(file))
+        self.refresh()
+
+    def refresh(self):
+        self.table.setRowCount(len(self.jobs))
+        for row, job in enumerate(self.jobs):
+            elapsed = job.elapsed
+            if job.status == Status.Running:
+                elapsed = time.monotonic() - job.started
+            values = [
+                job.file.name,
+                job.status.value,
+                '' if elapsed is None else f'{elapsed:.1f} s',
+                job.message,
+            ]
+            for column, value in enumerate(values):
+                item = self.table.item(row, column)
+                if item is None:
+                    item = QtWidgets.QTableWidgetItem()
+                    self.table.setItem(row, column, item)
+                item.setText(value)
+            self.table.item(row, 0).setToolTip(str(job.file))
+        counts = {status: 0 for status in Status}
+        for job in self.jobs:
+            counts[job.status] += 1
+        self.footer.setText(', '.join(
+            f'{counts[status]} {status.value.lower()}'
+            for status in Status if counts[status]))
+        self.button['start'].setEnabled(
+            not self.running and counts[Status.Queued] > 0)
+        self.button['stop'].setEnabled(self.running)
+        self.button['remove'].setEnabled(not self.running)
+        self.workers.setEnabled(not self.running)
+        self.threads.setEnabled(not self.running)
+
+    def tick(self):
+        """Poll running jobs and start queued ones while workers are free"""
+        for job in self.jobs:
+            job.poll()
+        running = [job for job in self.jobs if job.status == Status.Running]
+        queued = [job for job in self.jobs if job.status == Status.Queued]
+        workers = self.workers.value()
+        threads = max(1, self.threads.value() // workers)
+        for job in queued[:workers - len(running)]:
+            try:
+                job.start(self.param, threads)
+            except Exception as exception:
+                job.status = Status.Failed
+                job.message = str(exception)
+                job.cleanup()
+        if not any(job.status in [Status.Queued, Status.Running]
+                   for job in self.jobs):
+            self.timer.stop()
+        self.refresh()
+
+    def handleAddFiles(self):
+        (files, _) = QtWidgets.QFileDialog.getOpenFileNames(self,
+            self.windowTitle() + ' - Add Files',
+            QtCore.QDir.currentPath(),
+            'All Files (*)')
+        self.addPaths(files)
+
+    def handleAddFolder(self):
+        folder = QtWidgets.QFileDialog.getExistingDirectory(self,
+            self.windowTitle() + ' - Add Folder',
+            QtCore.QDir.currentPath())
+        if folder:
+            self.addPaths([folder])
+
+    def handleRemove(self):
+        rows = {index.row() for index in self.table.selectedIndexes()}
+        self.jobs = [
+            job for row, job in enumerate(self.jobs) if row not in rows]
+        self.refresh()
+
+    def handleStart(self):
+        for job in self.jobs:
+            if job.status in [Status.Failed, Status.Cancelled]:
+                job.status = Status.Queued
+                job.message = ''
+                job.elapsed = None
+        if not self.chooseOutputs():
+            self.refresh()
+            return
+        self.timer.start()
+        self.tick()
+
+    def chooseOutputs(self):
+        """
+        Ask before overwriting existing trees, or save those jobs under
+        free names instead. Jobs never share an output. Return False if
+        the user cancelled.
+        """
+        queued = [job for job in self.jobs if job.status == Status.Queued]
+        for job in queued:
+            job.output = job.file.parent / (stem(job.file) + '.tre')
+        existing = [job for job in queued if job.output.exists()]
+        overwrite = False
+        if existing:
+            names = ', '.join(job.output.name for job in existing[:5])
+            if len(existing) > 5:
+                names += ', ...'
+            msgBox = QtWidgets.QMessageBox(self)
+            msgBox.setWindowTitle(self.windowTitle())
+            msgBox.setIcon(QtWidgets.QMessageBox.Question)
+            msgBox.setText(f'{len(existing)} of the trees already exist: {names}')
+            msgBox.setInformativeText(
+                'Overwrite them, or save the new trees under other names?')
+            msgBox.setStandardButtons(
+                QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No |
+                QtWidgets.QMessageBox.Cancel)
+            msgBox.button(QtWidgets.QMessageBox.Yes).setText('Overwrite')
+            msgBox.button(QtWidgets.QMessageBox.No).setText('Keep both')
+            msgBox.setDefaultButton(QtWidgets.QMessageBox.No)
+            confirm = msgBox.exec()
+            if confirm == QtWidgets.QMessageBox.Cancel:
+                return False
+            overwrite = confirm == QtWidgets.QMessageBox.Yes
+        taken = {job.output for job in self.jobs
+                 if job.status == Status.Running}
+        for job in queued:
+            if job.output in taken or not overwrite:
+                job.output = free_path(job.output, taken)
+            taken.add(job.output)
+        return True
+
+    def handleStop(self):
+        self.timer.stop()
+        for job in self.jobs:
+            job.cancel()
+        self.refresh()
+
+    def dragEnterEvent(self, event):
+        if event.mimeData().hasUrls():
+            event.acceptProposedAction()
+        else:
+            event.ignore()
+
+    def dropEvent(self, event):
+        self.addPaths(url.toLocalFile() for url in event.mimeData().urls())
+
+    def reject(self):
+        """Closing the window cancels all running jobs"""
+        if self.running:
+            confirm = QtWidgets.QMessageBox.question(self,
+                self.windowTitle(), 'Cancel all running jobs?')
+            if confirm != QtWidgets.QMessageBox.Yes:
+                return
+            self.handleStop()
+        super().reject()
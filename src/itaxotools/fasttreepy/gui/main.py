@@ -28,6 +28,8 @@ import pathlib
 import shutil
 import enum
 import sys
+import os
+import re
 
 from itaxotools.common.param.model import Model
 from itaxotools.common.param.view import View, ListWidget, FieldWidget
@@ -40,6 +42,7 @@ from itaxotools.common import machine
 from itaxotools.common import io
 
 from .. import core
+from .batch import BatchDialog
 
 
 def get_resource(path):
@@ -52,6 +55,30 @@ def get_about():
     return common.resources.get('itaxotools.fasttreepy.gui', 'about.html')
 
 
+def summarize_tree(path, chunk=1 << 20):
+    """Return the number of taxa in a Newick file, reading it in chunks"""
+    commas = 0
+    data = False
+    with open(path) as file:
+        while True:
+            text = file.read(chunk)
+            if not text:
+                break
+            commas += text.count(',')
+            data = data or bool(text.strip())
+    return commas + 1 if data else 0
+
+
+def format_size(size):
+    for unit in ['bytes', 'KB', 'MB']:
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'GB'
+    return f'{size:.0f} {unit}' if unit == 'bytes' else f'{size:.1f} {unit}'
+
+
 class Action(enum.Enum):
     Update = enum.auto()
     Open = enum.auto()
@@ -153,7 +180,17 @@ class CustomView(View):
 
 
 class TextEditLogger(common.widgets.TextEditLogger):
-    def __init__(self, *args, **kwargs):
+    """
+    Keeps at most maxLines lines, dropping the oldest ones. Text is
+    collected in the GUI thread and appended at most once per interval
+    (in ms), so that a chatty process does not flood the event loop. The last
+    log-likelihood seen in the log is kept in loglk.
+    The line cap defaults to the environment variable FASTTREEPY_LOG_LINES.
+    """
+
+    patternLogLk = re.compile(r'LogLk = (-?[0-9.]+)')
+
+    def __init__(self, *args, maxLines=None, interval=100, **kwargs):
         super().__init__(*args, **kwargs)
         self.setStyleSheet("""
             QTextEdit {
@@ -161,6 +198,114 @@ class TextEditLogger(common.widgets.TextEditLogger):
                 border: 1px solid palette(Mid);
                 }
             """)
+        if maxLines is None:
+            maxLines = int(os.environ.get('FASTTREEPY_LOG_LINES', 10000))
+        self.maxLines = maxLines
+        self.loglk = None
+        self._pending = []
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self.flush)
+
+    @property
+    def maxLines(self):
+        return self.document().maximumBlockCount()
+
+    @maxLines.setter
+    def maxLines(self, lines):
+        self.document().setMaximumBlockCount(max(lines, 0))
+
+    @QtCore.Slot(object)
+    def _appendTextInline(self, text):
+        """Called in the GUI thread for each append()"""
+        self._pending.append(text)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        """Append all pending text at once"""
+        self._timer.stop()
+        if not self._pending:
+            return
+        text = ''.join(self._pending)
+        self._pending = []
+        for match in self.patternLogLk.finditer(text):
+            self.loglk = float(match.group(1))
+        super()._appendTextInline(text)
+
+    def clear(self):
+        self._timer.stop()
+        self._pending = []
+        self.loglk = None
+        super().clear()
+
+
+class TreeViewer(QtWidgets.QDialog):
+    """
+    Browse a large Newick file. The tree is read in chunks and split in
+    rows of fixed width as the view is scrolled, so that only the part
+    that was looked at is ever loaded.
+    """
+
+    chunkSize = 1 << 18
+    rowWidth = 100
+
+    def __init__(self, path, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(f'Resulting tree - {pathlib.Path(path).name}')
+        self.resize(760, 520)
+        self.file = open(path)
+        self.complete = False
+
+        self.view = QtWidgets.QPlainTextEdit()
+        self.view.setReadOnly(True)
+        self.view.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        self.view.setFont(QtGui.QFontDatabase.systemFont(
+            QtGui.QFontDatabase.FixedFont))
+        self.view.verticalScrollBar().valueChanged.connect(self.onScroll)
+
+        self.status = QtWidgets.QLabel()
+        self.status.setStyleSheet('color: palette(Shadow);')
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.view, 1)
+        layout.addWidget(self.status, 0)
+        self.setLayout(layout)
+
+        self.loadMore()
+
+    def loadMore(self):
+        """Read and show the next chunk of the file"""
+        if self.complete:
+            return
+        text = self.file.read(self.chunkSize)
+        if len(text) < self.chunkSize:
+            self.complete = True
+            self.file.close()
+        text = text.replace('\n', '')
+        if text:
+            rows = [
+                text[i:i + self.rowWidth]
+                for i in range(0, len(text), self.rowWidth)]
+            cursor = self.view.textCursor()
+            cursor.movePosition(QtGui.QTextCursor.End)
+            if not self.view.document().isEmpty():
+                cursor.insertText('\n')
+            cursor.insertText('\n'.join(rows))
+        shown = format_size(self.view.document().characterCount())
+        more = '' if self.complete else ', scroll down for more'
+        self.status.setText(f'Showing {shown}{more}')
+
+    def onScroll(self, value):
+        bar = self.view.verticalScrollBar()
+        if value >= bar.maximum() - bar.pageStep():
+            self.loadMore()
+
+    def done(self, result):
+        if not self.file.closed:
+            self.file.close()
+        super().done(result)
 
 
 class Header(QtWidgets.QFrame):
@@ -368,6 +513,7 @@ class Main(common.widgets.ToolDialog):
 
         self.title = 'FastTreePy'
         self.analysis = core.PhylogenyApproximation()
+        self.inlineLimit = 64 * 1024
         self.file = None
         self._temp = None
         self.temp = None
@@ -378,6 +524,7 @@ class Main(common.widgets.ToolDialog):
 
         self.process = None
         self.machine = None
+        self.batch = None
         self.skin()
         self.draw()
         self.act()
@@ -401,26 +548,32 @@ class Main(common.widgets.ToolDialog):
         return common.machine.TaggedTransition(self.actionSignal, action)
 
     def dragEnterEvent(self, event):
-        """Accept single file drops as long as state is idle"""
-        if not self.state['idle'] in list(self.machine.configuration()):
-            event.ignore()
-            return
+        """Accept single file drops as long as state is idle,
+        many files or directories are sent to the run queue"""
         data = event.mimeData()
         if data.hasUrls():
             urls = data.urls()
             if len(urls) == 1:
-                url = data.urls()[0]
-                file = QtCore.QFileInfo(url.toLocalFile())
-                if file.isFile():
+                file = QtCore.QFileInfo(urls[0].toLocalFile())
+                if file.isFile() and self.state['idle'] in list(
+                        self.machine.configuration()):
                     event.acceptProposedAction()
                     return
+            if len(urls) > 1 or QtCore.QFileInfo(
+                    urls[0].toLocalFile()).isDir():
+                event.acceptProposedAction()
+                return
         event.ignore()
 
     def dropEvent(self, event):
         data = event.mimeData()
         if data.hasUrls():
-            url = data.urls()[0]
-            self.handleOpen(fileName=url.toLocalFile())
+            urls = data.urls()
+            if len(urls) == 1 and QtCore.QFileInfo(
+                    urls[0].toLocalFile()).isFile():
+                self.handleOpen(fileName=urls[0].toLocalFile())
+            else:
+                self.handleBatch(paths=[url.toLocalFile() for url in urls])
 
     def onReject(self):
         """If running, verify cancel"""
@@ -467,6 +620,7 @@ class Main(common.widgets.ToolDialog):
 
         state = self.state['idle/input.none']
         state.assignProperty(self.action['run'], 'enabled', False)
+        state.assignProperty(self.summary, 'visible', False)
         state.assignProperty(self.pane['output'], 'visible', False)
         state.assignProperty(self.pane['about'], 'visible', True)
 
@@ -477,11 +631,14 @@ class Main(common.widgets.ToolDialog):
 
         state = self.state['idle/output.none']
         state.assignProperty(self.action['save'], 'enabled', False)
-        tip = 'Hover parameters for tips.'
+        state.assignProperty(self.summary, 'visible', False)
+        tip = ('Hover parameters for tips. '
+               'Open or drop many files or a folder to queue them.')
         state.assignProperty(self.footer, 'text', tip)
 
         state = self.state['idle/output.failed']
         state.assignProperty(self.action['save'], 'enabled', False)
+        state.assignProperty(self.summary, 'visible', False)
         tip = 'An error occured, please check the logs for details.'
         state.assignProperty(self.footer, 'text', tip)
 
@@ -501,6 +658,7 @@ class Main(common.widgets.ToolDialog):
         state.assignProperty(self.action['open'], 'enabled', False)
         state.assignProperty(self.action['save'], 'enabled', False)
         state.assignProperty(self.pane['params'], 'enabled', False)
+        state.assignProperty(self.summary, 'visible', False)
         tip = 'Generating tree, please wait...'
         state.assignProperty(self.footer, 'text', tip)
 
@@ -727,10 +885,22 @@ class Main(common.widgets.ToolDialog):
         self.textLogger.document().setDocumentMargin(10)
         self.textLogIO = common.io.TextEditLoggerIO(self.textLogger)
 
+        self.summary = QtWidgets.QFrame()
+        self.summary.label = QtWidgets.QLabel()
+        self.summary.button = QtWidgets.QPushButton('View tree')
+        self.summary.button.clicked.connect(self.handleView)
+        layout = QtWidgets.QHBoxLayout()
+        layout.addWidget(self.summary.label, 1)
+        layout.addWidget(self.summary.button, 0)
+        layout.setContentsMargins(4, 4, 0, 0)
+        self.summary.setLayout(layout)
+        self.summary.setVisible(False)
+
         self.pane['output'] = common.widgets.Panel(self)
         self.pane['output'].title = 'Progress Log'
         self.pane['output'].footer = ''
         self.pane['output'].body.addWidget(self.textLogger)
+        self.pane['output'].body.addWidget(self.summary)
         self.pane['output'].body.setContentsMargins(0, 0, 0, 0)
 
         self.textAbout = QtWidgets.QTextBrowser()
@@ -808,6 +978,12 @@ class Main(common.widgets.ToolDialog):
         self.action['stop'].setStatusTip('Cancel alignment')
         self.action['stop'].triggered.connect(self.handleStop)
 
+        self.action['batch'] = QtGui.QAction('Run &Queue', self)
+        self.action['batch'].setShortcut('Ctrl+B')
+        self.action['batch'].setStatusTip('Process many alignments')
+        self.action['batch'].triggered.connect(self.handleBatch)
+        self.addAction(self.action['batch'])
+
         self.header.toolbar.addAction(self.action['open'])
         self.header.toolbar.addAction(self.action['save'])
         self.header.toolbar.addAction(self.action['run'])
@@ -838,15 +1014,16 @@ class Main(common.widgets.ToolDialog):
         def done(result):
             self.temp = self._temp
             self.analysis.results = result
-            with open(self.analysis.fetch()) as output:
-                self.textLogger.append(
-                    f'\n> Resulting tree: \n\n{output.read()}\n')
+            self.textLogger.flush()
+            self.showResult(self.analysis.fetch())
             self.postAction(Action.Done, True)
 
         def fail(exception):
+            self.textLogger.flush()
             self.postAction(Action.Fail, exception)
 
         def error(exitcode):
+            self.textLogger.flush()
             self.textLogger.append(
                 f'> Internal error: exited with code: {exitcode}\n\n')
             exception = RuntimeError(
@@ -862,6 +1039,35 @@ class Main(common.widgets.ToolDialog):
 
         self.postAction(Action.Run)
 
+    def showResult(self, path):
+        """Inline small trees in the log, summarize large ones"""
+        size = os.path.getsize(path)
+        if size <= self.inlineLimit:
+            with open(path) as output:
+                self.textLogger.append(
+                    f'\n> Resulting tree: \n\n{output.read()}\n')
+            return
+        parts = [f'{summarize_tree(path)} taxa']
+        if self.textLogger.loglk is not None:
+            parts.append(f'log-likelihood {self.textLogger.loglk:.3f}')
+        parts.append(format_size(size))
+        text = ', '.join(parts)
+        self.textLogger.append(
+            f'\n> Resulting tree: {text}. '
+            'Click "View tree" to browse it.\n\n')
+        self.summary.label.setText(f'Resulting tree: {text}')
+        self.summary.setVisible(True)
+
+    def handleView(self):
+        """Open the latest tree in a viewer that loads it on demand"""
+        try:
+            viewer = TreeViewer(self.analysis.fetch(), self)
+        except Exception as exception:
+            self.fail(exception)
+            return
+        viewer.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        viewer.show()
+
     def handleStop(self):
         """Called by cancel button"""
         msgBox = QtWidgets.QMessageBox(self)
@@ -875,16 +1081,21 @@ class Main(common.widgets.ToolDialog):
             if self.process is not None:
                 self.process.quit()
             self.textLogger.append('\n> Interrupted by user\n\n')
+            self.textLogger.flush()
             self.postAction(Action.Cancel)
 
     def handleOpen(self, checked=False, fileName=None):
         """Called by toolbar action"""
         # `checked` kwarg provided by default trigger event
         if fileName is None:
-            (fileName, _) = QtWidgets.QFileDialog.getOpenFileName(self,
+            (fileNames, _) = QtWidgets.QFileDialog.getOpenFileNames(self,
                 self.title + ' - Open File',
                 QtCore.QDir.currentPath(),
                 'All Files (*)')
+            if len(fileNames) > 1:
+                self.handleBatch(paths=fileNames)
+                return
+            fileName = fileNames[0] if fileNames else ''
         if len(fileName) == 0:
             return
         self.textLogger.clear()
@@ -893,6 +1104,15 @@ class Main(common.widgets.ToolDialog):
         self.postAction(Action.Open, file=fileName)
         self.file = fileName
 
+    def handleBatch(self, checked=False, paths=None):
+        """Show the run queue, adding any given files or directories"""
+        if self.batch is None:
+            self.batch = BatchDialog(self.analysis.param, self)
+        self.batch.addPaths(paths or [])
+        self.batch.show()
+        self.batch.raise_()
+        self.batch.activateWindow()
+
     def handleSave(self):
         """Save latest results"""
         if self.file is not None:
@@ -28,6 +28,13 @@ def params():
                        "but not single quote characters (fasta files only)."),
                   type=bool,
                   default=False),
+            Field(key='patterns',
+                  label='Compress site patterns',
+                  doc=("Collapse identical alignment columns into\n"
+                       "weighted site patterns. Saves time and memory\n"
+                       "for alignments of closely-related sequences."),
+                  type=bool,
+                  default=False),
             ]),
         Group(key='model',
               label='Model Options',
@@ -104,4 +111,49 @@ def params():
                   type=bool,
                   default=False),
             ]),
+        Group(key='threads',
+              label='Threads',
+              children=[
+            Field(key='all',
+                  label='Threads',
+                  doc=("Number of threads for all phases. If set to 0,\n"
+                       "use all available cores (default). If set to -1,\n"
+                       "choose for each alignment from its size, using\n"
+                       "the table made by fasttreepy-calibrate if found."),
+                  type=int,
+                  range=(-1, None),
+                  default=0),
+            Field(key='tophits',
+                  label='Top-hits threads',
+                  doc=("Threads for building and refreshing the top-hit\n"
+                       "lists. Same as above if set to 0, automatic if -1."),
+                  type=int,
+                  range=(-1, None),
+                  default=0),
+            Field(key='nj',
+                  label='Neighbor-joining threads',
+                  doc=("Threads for the best-hit search of exhaustive\n"
+                       "neighbor joining. Same as above if set to 0,\n"
+                       "automatic if -1."),
+                  type=int,
+                  range=(-1, None),
+                  default=0),
+            Field(key='ml',
+                  label='Likelihood threads',
+                  doc=("Threads for the maximum-likelihood NNIs, branch\n"
+                       "lengths and rates. Same as above if set to 0,\n"
+                       "automatic if -1."),
+                  type=int,
+                  range=(-1, None),
+                  default=0),
+            ]),
         ])
+
+
+def apply(param, dump):
+    """Set the fields found in a params().dumps() dictionary"""
+    for key, value in dump.items():
+        if isinstance(value, dict):
+            apply(getattr(param, key), value)
+        else:
+            setattr(param, key, value)
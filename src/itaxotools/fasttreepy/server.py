@@ -0,0 +1,574 @@
+# -----------------------------------------------------------------------------
+# FastTreePy - Maximum-likelihood phylogenetic tree approximation with FastTree
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+"""
+Persistent local job server with warm workers, and a small client.
+
+The server listens on a Unix socket (or on localhost where Unix sockets
+are not available) and keeps a pool of worker processes that have the
+FastTree extension already imported. Each job is still run in a process
+of its own by PhylogenyApproximation.launch(), which is forked from the
+warm worker where the platform allows it.
+
+The protocol is one JSON object per line. A client sends a single request
+per connection, either {"op": "status"} or a job:
+
+    {"op": "submit", "alignment": "<fasta or phylip text>",
+     "params": {"sequence": {"ncodes": 4}, ...},
+     "args": ["-gamma"], "priority": 0}
+
+A job may give "file" (a path on the server host) instead of "alignment",
+if the server was started with a root directory that contains it.
+Params are in the format of params().dumps() and may be partial, while
+args may only hold the FastTree options of SAFE_ARGS, which name no files.
+Over TCP, every request must also carry the "token" of the server, which
+it writes to a file that only its user can read. Jobs with higher priority
+run first, ties in order of arrival. The server replies with "queued",
+"started", any number of "progress" events carrying log lines, and
+finally "done" with the tree or "error" with a message.
+"""
+
+import itertools
+import threading
+import socketserver
+import tempfile
+import argparse
+import secrets
+import socket
+import queue
+import hmac
+import json
+import stat
+import sys
+import os
+import re
+
+
+DEFAULT_PORT = 8752
+
+# FastTree options a client may pass, with their number of values.
+# Options that read or write files (-out, -log, -intree...) are left out.
+SAFE_ARGS = {
+    '-nt': 0, '-quiet': 0, '-nopr': 0, '-slow': 0, '-fastest': 0,
+    '-2nd': 0, '-no2nd': 0, '-slownni': 0, '-nomatrix': 0, '-rawdist': 0,
+    '-quote': 0, '-nj': 0, '-bionj': 0, '-noboot': 0, '-nosupport': 0,
+    '-top': 0, '-notop': 0, '-noml': 0, '-mllen': 0, '-nome': 0,
+    '-exactml': 0, '-mlexact': 0, '-approxml': 0, '-mlapprox': 0,
+    '-nocat': 0, '-lg': 0, '-wag': 0, '-gtr': 0, '-gamma': 0,
+    '-mlbatch': 0, '-noslab': 0, '-hugepages': 0, '-patterns': 0,
+    '-sparse': 0, '-nosparse': 0, '-deterministic': 0,
+    '-verbose': 1, '-boot': 1, '-seed': 1, '-topm': 1, '-close': 1,
+    '-refresh': 1, '-nni': 1, '-spr': 1, '-sprlength': 1, '-mlnni': 1,
+    '-mlacc': 1, '-cat': 1, '-tcache': 1, '-threads': 1, '-gboot': 1,
+    '-gbootprocs': 1, '-models': 1, '-modelprocs': 1,
+    '-gtrrates': 6, '-gtrfreq': 4,
+}
+
+# Values of the options above: numbers, or specs such as ml=4 or jtt,lg:4
+_SAFE_VALUE = re.compile(r'[\w.,:=+-]+')
+
+
+def check_args(args):
+    """Return args as strings, raise ValueError for any unsafe option"""
+    args = [str(arg) for arg in args]
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '-pseudo':
+            count = 1 if i + 1 < len(args) and args[i + 1][:1].isdigit() else 0
+        elif arg in SAFE_ARGS:
+            count = SAFE_ARGS[arg]
+        else:
+            raise ValueError(f'Argument not allowed by the server: {arg}')
+        values = args[i + 1:i + 1 + count]
+        if len(values) < count:
+            raise ValueError(f'Missing value for argument: {arg}')
+        for value in values:
+            if not _SAFE_VALUE.fullmatch(value):
+                raise ValueError(f'Bad value for argument {arg}: {value}')
+        i += 1 + count
+    return args
+
+
+def check_file(file, root):
+    """Return the real path of file, if it is inside root"""
+    if root is None:
+        raise ValueError('This server does not read files, send the alignment.')
+    root = os.path.realpath(root)
+    path = os.path.realpath(file)
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f'File outside of the server root: {file}')
+    return path
+
+
+def user_dir():
+    """
+    Per-user directory for the socket and token, only accessible by its
+    owner. Raises RuntimeError if it exists with other owner or access.
+    """
+    try:
+        user = os.getuid()
+    except AttributeError:
+        path = os.path.join(os.path.expanduser('~'), '.fasttreepy')
+        os.makedirs(path, exist_ok=True)
+        return path
+    path = os.path.join(tempfile.gettempdir(), f'fasttreepy-{user}')
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != user
+            or info.st_mode & 0o077):
+        raise RuntimeError(f'Unsafe server directory: {path}')
+    return path
+
+
+def default_address():
+    """Per-user Unix socket if available, localhost port otherwise"""
+    if hasattr(socket, 'AF_UNIX'):
+        return os.path.join(user_dir(), 'server.sock')
+    return ('127.0.0.1', DEFAULT_PORT)
+
+
+def token_path(address):
+    """Where the server on TCP address keeps its token"""
+    return os.path.join(user_dir(), f'token-{address[1]}')
+
+
+def _is_unix(address):
+    return isinstance(address, (str, os.PathLike))
+
+
+def _tail(path, stop, send):
+    """Send each complete line of path until stop is set and all is read"""
+    with open(path, 'r', errors='replace') as file:
+        partial = ''
+        while True:
+            stopped = stop.is_set()
+            chunk = file.read()
+            if chunk:
+                lines = (partial + chunk).replace('\r', '\n').split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    if line:
+                        send(('progress', line))
+            elif stopped:
+                break
+            else:
+                stop.wait(0.2)
+        if partial:
+            send(('progress', partial))
+
+
+def _run(request, connection):
+    """Run one job inside a worker, return the tree"""
+    from .core import PhylogenyApproximation
+    from . import params
+
+    with tempfile.TemporaryDirectory(prefix='fasttreepy_job_') as dir:
+        file = request.get('file')  # checked by the handler
+        if request.get('alignment') is not None:
+            file = os.path.join(dir, 'alignment')
+            with open(file, 'w') as output:
+                output.write(request['alignment'])
+        if file is None:
+            raise ValueError('Job has neither alignment nor file.')
+        log = os.path.join(dir, 'log')
+        open(log, 'w').close()
+
+        a = PhylogenyApproximation(file)
+        a.log = log
+        a.args = check_args(request.get('args') or [])
+        params.apply(a.param, request.get('params', {}))
+
+        stop = threading.Event()
+        tail = threading.Thread(
+            target=_tail, args=(log, stop, connection.send), daemon=True)
+        tail.start()
+        try:
+            a.launch()
+        finally:
+            stop.set()
+            tail.join()
+        with open(a.fetch()) as result:
+            return result.read()
+
+
+def _work(connection):
+    """Worker process main loop: import once, then serve jobs"""
+    from . import fasttree  # noqa: F401, keep the extension warm
+    from . import core  # noqa: F401
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        try:
+            tree = _run(request, connection)
+        except Exception as exception:
+            connection.send(('error', str(exception)))
+        else:
+            connection.send(('tree', tree))
+
+
+class Job():
+    """A queued request and the client connection awaiting its results"""
+
+    def __init__(self, request, wfile):
+        self.request = request
+        self.wfile = wfile
+        self.cancelled = False
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+
+    def send(self, **message):
+        """Write one event to the client, cancel the job if it left"""
+        with self._lock:
+            if self.cancelled:
+                return
+            try:
+                self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except (OSError, ValueError):
+                self.cancelled = True
+
+
+class Worker():
+    """A warm worker process and the pipe used to talk to it"""
+
+    def __init__(self):
+        from multiprocessing import Process, Pipe
+        self.connection, child = Pipe()
+        self.process = Process(target=_work, args=(child,))
+        self.process.start()
+        child.close()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server.owner
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError as exception:
+            job = Job({}, self.wfile)
+            job.send(event='error', message=f'Bad request: {exception}')
+            return
+        if server.token is not None and not hmac.compare_digest(
+                str(request.get('token', '')), server.token):
+            Job({}, self.wfile).send(event='error', message='Bad token.')
+            return
+        op = request.get('op', 'submit')
+        if op == 'status':
+            Job({}, self.wfile).send(event='status', **server.status())
+            return
+        if op != 'submit':
+            Job({}, self.wfile).send(
+                event='error', message=f'Unknown op: {op}')
+            return
+        try:
+            request['args'] = check_args(request.get('args') or [])
+            if request.get('alignment') is None and request.get('file'):
+                request['file'] = check_file(request['file'], server.root)
+            try:
+                request['priority'] = int(request.get('priority') or 0)
+            except (TypeError, ValueError, OverflowError):
+                raise ValueError(
+                    f'Bad priority: {request.get("priority")!r}') from None
+        except ValueError as exception:
+            Job({}, self.wfile).send(event='error', message=str(exception))
+            return
+        job = Job(request, self.wfile)
+        server.submit(job)
+        job.finished.wait()
+
+
+class JobServer():
+    """
+    Serve FastTree jobs from a pool of warm worker processes.
+    Address is a Unix socket path or a (host, port) tuple. Jobs may only
+    give files inside root, or none if it is None. Over TCP, clients must
+    send the token that start() writes to token_path(address).
+    """
+
+    def __init__(self, address=None, workers=None, root=None):
+        self.address = address or default_address()
+        self.workers = workers or os.cpu_count() or 1
+        self.root = root
+        self.token = None
+        self.queue = queue.PriorityQueue()
+        self.running = 0
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._pool = []
+        self._threads = []
+        self._server = None
+
+    def status(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'running': self.running,
+                'queued': self.queue.qsize(),
+            }
+
+    def submit(self, job):
+        """
+        Tell the client how many jobs are ahead of job, then queue it,
+        so that 'queued' is always its first event
+        """
+        position = self.queue.qsize()
+        job.send(event='queued', position=position)
+        self.queue.put((-job.request.get('priority', 0), next(self._order), job))
+        return position
+
+    def _dispatch(self, index):
+        while True:
+            _, _, job = self.queue.get()
+            if job is None:
+                break
+            if job.cancelled:
+                job.finished.set()
+                continue
+            with self._lock:
+                self.running += 1
+            job.send(event='started')
+            worker = self._pool[index]
+            try:
+                worker.connection.send(job.request)
+                while True:
+                    kind, value = worker.connection.recv()
+                    if kind == 'progress':
+                        job.send(event='progress', line=value)
+                    elif kind == 'tree':
+                        job.send(event='done', tree=value)
+                        break
+                    else:
+                        job.send(event='error', message=value)
+                        break
+            except (EOFError, OSError):
+                job.send(event='error', message='Worker process died.')
+                worker.process.join()
+                self._pool[index] = Worker()
+            finally:
+                with self._lock:
+                    self.running -= 1
+                job.finished.set()
+
+    def start(self):
+        """Spawn workers and bind the socket, but do not serve yet"""
+        if _is_unix(self.address):
+            # Only replace a stale socket of our own
+            try:
+                info = os.lstat(self.address)
+            except FileNotFoundError:
+                pass
+            else:
+                if (not stat.S_ISSOCK(info.st_mode)
+                        or info.st_uid != os.getuid()):
+                    raise RuntimeError(
+                        f'Will not replace {self.address}, not our socket')
+                os.unlink(self.address)
+            server_class = socketserver.ThreadingUnixStreamServer
+        else:
+            server_class = socketserver.ThreadingTCPServer
+        server_class.daemon_threads = True
+        self._server = server_class(self.address, _Handler)
+        self._server.owner = self
+        if not _is_unix(self.address):
+            self.address = self._server.server_address[:2]
+            self.token = secrets.token_hex(16)
+            fd = os.open(token_path(self.address),
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as file:
+                file.write(self.token)
+        self._pool = [Worker() for _ in range(self.workers)]
+        self._threads = [
+            threading.Thread(target=self._dispatch, args=(i,), daemon=True)
+            for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def serve_forever(self):
+        if self._server is None:
+            self.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """Stop serve_forever() from another thread"""
+        if self._server is not None:
+            self._server.shutdown()
+
+    def close(self):
+        for _ in self._threads:
+            self.queue.put((float('inf'), next(self._order), None))
+        for thread in self._threads:
+            thread.join()
+        for worker in self._pool:
+            worker.stop()
+        self._threads = []
+        self._pool = []
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+            if _is_unix(self.address) and os.path.exists(self.address):
+                os.unlink(self.address)
+            if self.token is not None:
+                try:
+                    os.unlink(token_path(self.address))
+                except OSError:
+                    pass
+                self.token = None
+
+
+class Client():
+    """
+    Submit jobs to a running JobServer. Over TCP, the token is read from
+    token_path(address) if not given, as written by a server of this user.
+    """
+
+    def __init__(self, address=None, token=None):
+        self.address = address or default_address()
+        self.token = token
+
+    def _request(self, request):
+        if not _is_unix(self.address):
+            if self.token is None:
+                with open(token_path(self.address)) as file:
+                    self.token = file.read().strip()
+            request = dict(request, token=self.token)
+        family = socket.AF_UNIX if _is_unix(self.address) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        with sock, sock.makefile('rwb') as file:
+            file.write((json.dumps(request) + '\n').encode('utf-8'))
+            file.flush()
+            for line in file:
+                yield json.loads(line)
+
+    def status(self):
+        """Return the number of workers, running and queued jobs"""
+        for message in self._request({'op': 'status'}):
+            if message.pop('event') == 'error':
+                raise RuntimeError(message['message'])
+            return message
+
+    def submit(self, file=None, alignment=None, params=None, args=[],
+               priority=0, progress=None):
+        """
+        Run a job and return the resulting tree as a string.
+        Give either the alignment itself, or the path to an alignment file
+        under the root of the server. Params may be a params() tree or its
+        dump. Args may only hold the options of SAFE_ARGS.
+        Progress is called with each line of the log as it arrives.
+        """
+        if hasattr(params, 'dumps'):
+            params = params.dumps()
+        request = {
+            'op': 'submit',
+            'file': None if file is None else os.path.abspath(file),
+            'alignment': alignment,
+            'params': params or {},
+            'args': list(args),
+            'priority': priority,
+        }
+        for message in self._request(request):
+            event = message['event']
+            if event == 'progress' and progress is not None:
+                progress(message['line'])
+            elif event == 'done':
+                return message['tree']
+            elif event == 'error':
+                raise RuntimeError(message['message'])
+        raise RuntimeError('Connection to the job server was lost.')
+
+
+def _parse_address(args):
+    if args.port is not None:
+        return ('127.0.0.1', args.port)
+    return args.socket
+
+
+def main():
+    """Console entry-point for the job server"""
+    parser = argparse.ArgumentParser(
+        description='Serve FastTree jobs from warm worker processes.')
+    parser.add_argument('--socket', help='Unix socket path to listen on')
+    parser.add_argument('--port', type=int, help='localhost port to listen on')
+    parser.add_argument('--workers', type=int, help='number of workers')
+    parser.add_argument('--root',
+                        help='allow jobs to give files under this directory')
+    args = parser.parse_args()
+    server = JobServer(_parse_address(args), args.workers, args.root)
+    server.start()
+    print(f'Serving on {server.address} with {server.workers} workers',
+          file=sys.stderr)
+    if server.token is not None:
+        print(f'Token written to {token_path(server.address)}',
+              file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def client():
+    """Console entry-point for submitting a job"""
+    parser = argparse.ArgumentParser(
+        description='Submit an alignment to a FastTree job server.',
+        epilog='Arguments after -- are passed on to FastTree.')
+    parser.add_argument('alignment', help='alignment file, - for stdin')
+    parser.add_argument('--socket', help='Unix socket path of the server')
+    parser.add_argument('--port', type=int, help='localhost port of server')
+    parser.add_argument('--token', help='token of a TCP server '
+                        '(read from the file of the server by default)')
+    parser.add_argument('--priority', type=int, default=0)
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not print progress to stderr')
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        extra = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    progress = None if args.quiet else lambda line: print(line, file=sys.stderr)
+    if args.alignment == '-':
+        alignment = sys.stdin.read()
+    else:
+        with open(args.alignment) as file:
+            alignment = file.read()
+    tree = Client(_parse_address(args), args.token).submit(
+        alignment=alignment,
+        args=extra, priority=args.priority, progress=progress)
+    print(tree, end='')